@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 # use django app config to customize display name
 # used in django admin
@@ -8,6 +9,22 @@ class FindingAidsConfig(AppConfig):
     name = 'findingaids.fa'
     verbose_name = "Finding Aids"
 
+    def ready(self):
+        # share pooled keep-alive connections to eXist, when configured
+        if getattr(settings, 'EXISTDB_POOL_SIZE', None):
+            from findingaids import existpool
+            existpool.install()
+
+        # use the in-process eXist stand-in when configured; True seeds
+        # it with the test fixtures, or a directory of EAD files
+        local_store = getattr(settings, 'EXISTDB_LOCAL_STORE', False)
+        if local_store:
+            from findingaids import localexist
+            if local_store is True:
+                localexist.install()
+            else:
+                localexist.install(fixtures=local_store)
+
 
 class FindingAidsAdminConfig(AppConfig):
     name = 'findingaids.fa_admin'
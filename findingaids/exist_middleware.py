@@ -0,0 +1,204 @@
+# file findingaids/exist_middleware.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Per-request instrumentation for eXist queries.
+
+Every XQuery run through the eXist REST api (reported by eulexistdb with
+the :data:`eulexistdb.db.xquery_called` signal) made while a request is
+being processed is counted and timed.  XML-RPC calls (document load,
+move, describe, etc.) are not reported by eulexistdb; they are only
+counted and timed if **EXISTDB_TIME_XMLRPC** is True, which wraps the
+eulexistdb XML-RPC transport.  :class:`ExistQueryTimingMiddleware` logs
+the totals as a single structured log line that can be summarized per
+view with the **exist_query_stats** manage command (the text of the
+slowest XQuery is only included when the logger is enabled for DEBUG),
+and adds them to the response as a ``Server-Timing`` header if
+**EXISTDB_SERVER_TIMING** is True.
+'''
+
+from contextlib import contextmanager
+import json
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from eulexistdb import db
+
+from findingaids.utils import normalize_whitespace
+
+logger = logging.getLogger(__name__)
+
+#: prefix for structured log lines, followed by the request stats as json
+LOG_PREFIX = 'exist-queries'
+
+#: maximum length of the slowest XQuery included in the log line
+XQUERY_LOG_LENGTH = 500
+
+_recording = threading.local()
+
+_xmlrpc_method = re.compile(r'<methodName>([^<]+)</methodName>')
+
+
+class QueryStats(object):
+    '''eXist queries and XML-RPC calls made while processing a single
+    request, including any made from other threads on its behalf (see
+    :func:`recording`).'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.time()
+        self.queries = 0
+        self.query_time = 0.0
+        self.xmlrpc_calls = 0
+        self.xmlrpc_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest = None
+
+    def add_query(self, xquery, time_taken):
+        with self._lock:
+            self.queries += 1
+            self.query_time += time_taken
+            if self.slowest is None or time_taken > self.slowest_time:
+                self.slowest_time = time_taken
+                self.slowest = xquery
+
+    def add_xmlrpc(self, method, time_taken):
+        with self._lock:
+            self.xmlrpc_calls += 1
+            self.xmlrpc_time += time_taken
+            if self.slowest is None or time_taken > self.slowest_time:
+                self.slowest_time = time_taken
+                self.slowest = 'xmlrpc %s' % method
+
+    @property
+    def total_time(self):
+        'total time spent waiting on eXist, in seconds'
+        return self.query_time + self.xmlrpc_time
+
+    def server_timing(self):
+        'value for a Server-Timing header'
+        timing = ['exist;dur=%.1f;desc="%d eXist quer%s"' %
+                  (self.query_time * 1000, self.queries,
+                   'y' if self.queries == 1 else 'ies')]
+        if self.xmlrpc_calls:
+            timing.append('exist-xmlrpc;dur=%.1f;desc="%d eXist XML-RPC call%s"' %
+                          (self.xmlrpc_time * 1000, self.xmlrpc_calls,
+                           '' if self.xmlrpc_calls == 1 else 's'))
+        return ', '.join(timing)
+
+    def log_data(self, view, request, response, include_query=False):
+        '''dictionary of request stats for the structured log line; the
+        text of the slowest query is only included if requested'''
+        data = {
+            'view': view,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': self.queries,
+            'xmlrpc': self.xmlrpc_calls,
+            'exist_ms': round(self.total_time * 1000, 1),
+            'slowest_ms': round(self.slowest_time * 1000, 1),
+            'total_ms': round((time.time() - self.start) * 1000, 1),
+        }
+        if include_query and self.slowest is not None:
+            data['slowest'] = normalize_whitespace(self.slowest).strip()[:XQUERY_LOG_LENGTH]
+        return data
+
+
+def current_stats():
+    '''Query stats for the request being processed in the current thread,
+    or None if no request is being recorded.'''
+    return getattr(_recording, 'stats', None)
+
+
+@contextmanager
+def recording(stats):
+    '''Record queries made by the current thread in the specified stats
+    (e.g., from :func:`current_stats` in the request thread), for queries
+    run in other threads on behalf of a request.'''
+    previous = current_stats()
+    _recording.stats = stats
+    try:
+        yield stats
+    finally:
+        _recording.stats = previous
+
+
+def _record_xquery(sender, name=None, time_taken=0, kwargs=None, **kw):
+    # eulexistdb signal handler for REST api queries
+    stats = current_stats()
+    if stats is not None and name == 'query':
+        stats.add_query((kwargs or {}).get('xquery') or '', time_taken)
+
+
+def _instrument_transport(transport_class):
+    # wrap the eulexistdb xmlrpc transport so every XML-RPC call is timed
+    if getattr(transport_class.request, 'timed', False):
+        return
+    request = transport_class.request
+
+    def timed_request(self, host, handler, request_body, verbose):
+        stats = current_stats()
+        if stats is None:
+            return request(self, host, handler, request_body, verbose)
+        start = time.time()
+        try:
+            return request(self, host, handler, request_body, verbose)
+        finally:
+            method = _xmlrpc_method.search(request_body[:500])
+            stats.add_xmlrpc(method.group(1) if method else 'unknown',
+                             time.time() - start)
+
+    timed_request.timed = True
+    transport_class.request = timed_request
+
+
+if db.xquery_called is not None:
+    db.xquery_called.connect(_record_xquery, dispatch_uid='findingaids-exist-timing')
+
+
+class ExistQueryTimingMiddleware(object):
+    '''Middleware to count and time eXist queries and XML-RPC calls for
+    each request, report them in a ``Server-Timing`` response header, and
+    log them as a structured log line.  Should be listed first in
+    **MIDDLEWARE_CLASSES**, so queries made by any other middleware are
+    included.'''
+
+    def __init__(self):
+        if getattr(settings, 'EXISTDB_TIME_XMLRPC', False):
+            _instrument_transport(db.RequestsTransport)
+
+    def process_request(self, request):
+        _recording.stats = QueryStats()
+
+    def process_response(self, request, response):
+        stats = current_stats()
+        if stats is None:
+            return response
+        _recording.stats = None
+
+        if getattr(settings, 'EXISTDB_SERVER_TIMING', False):
+            response['Server-Timing'] = stats.server_timing()
+        # not set for requests answered by other middleware (e.g. rdf urls)
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else None
+        data = stats.log_data(view, request, response,
+                              include_query=logger.isEnabledFor(logging.DEBUG))
+        logger.info('%s %s', LOG_PREFIX, json.dumps(data, sort_keys=True))
+        return response
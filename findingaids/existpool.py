@@ -0,0 +1,382 @@
+# file findingaids/existpool.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Pooled, keep-alive connections to eXist.
+
+By default every :class:`eulexistdb.db.ExistDB` (one for every queryset,
+and one for each admin view or manage command that loads, moves, or
+removes documents) opens its own HTTP session, so every query pays for a
+new TCP connection and authentication.  When pooling is installed (at
+startup, only if **EXISTDB_POOL_SIZE** is configured), the session of
+every :class:`~eulexistdb.db.ExistDB` for the same server sends its
+requests through a :class:`PooledAdapter`, so both REST queries and
+XML-RPC calls (which eulexistdb sends over the same session) use a
+bounded pool of keep-alive connections.
+
+While a request is being processed, the first connection checked out by
+the request thread stays with that thread until the request is finished,
+so all the queries for a page reuse one warm connection.  A request
+thread that is about to wait for queries run by other threads (see
+:mod:`findingaids.fa.querybatch`) returns its connection first with
+:func:`release_pinned`, so it never holds a connection the other threads
+may be waiting for.  Outside of
+requests (manage commands, celery tasks, worker threads), a connection is
+checked out for each HTTP call.  When all connections are in use, callers
+wait up to **EXISTDB_POOL_TIMEOUT** seconds for one to be returned.
+Connections idle for longer than **EXISTDB_POOL_IDLE_TIMEOUT** seconds are
+closed, and connections idle for longer than
+**EXISTDB_POOL_HEALTH_CHECK** seconds are checked with a lightweight
+request before they are reused.  Pool usage is reported by :func:`metrics`.
+
+Connections are never shared with child processes (e.g., the
+``multiprocessing`` pools used for publication checks and **load_ead**):
+a pool used in a process other than the one that created it discards the
+inherited connections, which still belong to the parent, and starts over.
+'''
+
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_started, request_finished
+from eulexistdb.db import ExistDB, ExistDBException
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+#: default maximum number of connections per eXist server
+DEFAULT_POOL_SIZE = 25
+#: default number of seconds to wait for a free connection
+DEFAULT_TIMEOUT = 30
+#: default number of seconds before an idle connection is closed
+DEFAULT_IDLE_TIMEOUT = 300
+#: default number of idle seconds before a connection is checked before use
+DEFAULT_HEALTH_CHECK = 30
+
+_pools = {}
+_pools_lock = threading.Lock()
+_local = threading.local()
+_original_init = None
+
+
+class PooledConnection(HTTPAdapter):
+    '''A single keep-alive connection to eXist: a
+    :class:`requests.adapters.HTTPAdapter` that holds at most one open
+    connection per host.'''
+
+    def __init__(self):
+        super(PooledConnection, self).__init__(pool_connections=1, pool_maxsize=1)
+        self.created = self.last_used = time.time()
+        self.uses = 0
+
+
+class ConnectionPool(object):
+    '''Bounded pool of :class:`PooledConnection` objects for one eXist
+    server.
+
+    :param url: eXist server url, used for health checks
+    :param size: maximum number of connections
+    :param timeout: seconds to wait for a free connection
+    :param idle_timeout: seconds an unused connection is kept open
+    :param health_check: seconds an unused connection may be idle before
+        it is checked before reuse
+    '''
+
+    def __init__(self, url, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, health_check=DEFAULT_HEALTH_CHECK):
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self._reset()
+        self.created = 0
+        self.closed = 0
+        self.checkouts = 0
+        self.reused = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.health_checks = 0
+        self.failed_health_checks = 0
+
+    def _reset(self):
+        # process that owns the pool's connections
+        self.pid = os.getpid()
+        self._idle = []     # most recently used last
+        self._in_use = 0
+        self._condition = threading.Condition()
+
+    def _check_process(self):
+        # after a fork, the connections (and possibly a held lock) belong
+        # to the parent process; drop them without closing the sockets,
+        # which the parent is still using
+        if self.pid != os.getpid():
+            logger.debug('Discarding %d eXist connections inherited from process %d',
+                         len(self._idle), self.pid)
+            self._reset()
+
+    def _close(self, connection):
+        # called with the condition held
+        self.closed += 1
+        connection.close()
+
+    def _close_expired(self, now):
+        # close connections idle for longer than the idle timeout; the
+        # least recently used connections are first in the list
+        while self._idle and now - self._idle[0].last_used > self.idle_timeout:
+            self._close(self._idle.pop(0))
+
+    def _healthy(self, connection):
+        # any response from eXist means the connection is usable
+        self.health_checks += 1
+        request = requests.Request('HEAD', '%s/rest/db' % self.url.rstrip('/')).prepare()
+        try:
+            connection.send(request, timeout=5)
+            return True
+        except requests.RequestException as err:
+            logger.info('Closing eXist connection that failed health check: %s', err)
+            self.failed_health_checks += 1
+            return False
+
+    def checkout(self):
+        '''Get a connection from the pool, creating one if the pool is not
+        full, or waiting for one to be returned.
+
+        :raises: :class:`~eulexistdb.db.ExistDBException` if no connection
+            is available within the pool timeout
+        '''
+        self._check_process()
+        start = time.time()
+        waited = False
+        with self._condition:
+            self.checkouts += 1
+            while True:
+                now = time.time()
+                self._close_expired(now)
+                if self._idle:
+                    connection = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use < self.size:
+                    connection = None
+                    self._in_use += 1
+                    self.created += 1
+                    break
+                remaining = self.timeout - (now - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise ExistDBException('Timed out waiting for a connection to eXist ' +
+                                           '(%d connections in use)' % self._in_use)
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self._condition.wait(remaining)
+            if waited:
+                self.wait_time += time.time() - start
+
+        # connections are created and checked without holding the lock
+        if connection is not None:
+            if now - connection.last_used <= self.health_check or self._healthy(connection):
+                with self._condition:
+                    self.reused += 1
+                connection.uses += 1
+                return connection
+            with self._condition:
+                self._close(connection)
+                self.created += 1
+        connection = PooledConnection()
+        connection.uses += 1
+        return connection
+
+    def checkin(self, connection):
+        'Return a connection to the pool.'
+        if self.pid != os.getpid():
+            # checked out before a fork; not usable by either process
+            return
+        with self._condition:
+            self._in_use -= 1
+            connection.last_used = time.time()
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def discard(self, connection):
+        'Close a checked out connection instead of returning it to the pool.'
+        if self.pid != os.getpid():
+            return
+        with self._condition:
+            self._in_use -= 1
+            self._close(connection)
+            self._condition.notify()
+
+    def clear(self):
+        'Close all idle connections.'
+        with self._condition:
+            while self._idle:
+                self._close(self._idle.pop())
+
+    def metrics(self):
+        'Pool usage, as a dictionary.'
+        self._check_process()
+        with self._condition:
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'created': self.created,
+                'closed': self.closed,
+                'checkouts': self.checkouts,
+                'reused': self.reused,
+                'waits': self.waits,
+                'wait_ms': round(self.wait_time * 1000, 1),
+                'timeouts': self.timeouts,
+                'health_checks': self.health_checks,
+                'failed_health_checks': self.failed_health_checks,
+            }
+
+
+class PooledAdapter(BaseAdapter):
+    '''Transport adapter that sends every request over a connection from
+    a :class:`ConnectionPool`.  Mounted on a :class:`requests.Session`,
+    which still handles headers and authentication.'''
+
+    def __init__(self, pool):
+        super(PooledAdapter, self).__init__()
+        self.pool = pool
+
+    def send(self, request, **kwargs):
+        pinned = _pinned()
+        if pinned is not None and self.pool in pinned:
+            connection = pinned.pop(self.pool)
+        else:
+            connection = self.pool.checkout()
+        try:
+            response = connection.send(request, **kwargs)
+            # read the response before the connection can be reused
+            # by another thread
+            if not kwargs.get('stream'):
+                response.content
+        except requests.RequestException:
+            self.pool.discard(connection)
+            raise
+        except BaseException:
+            self.pool.checkin(connection)
+            raise
+        if pinned is not None:
+            # keep the connection for the rest of the current request
+            pinned[self.pool] = connection
+        else:
+            self.pool.checkin(connection)
+        return response
+
+    def close(self):
+        # connections belong to the pool, not to the session
+        pass
+
+
+def get_pool(url):
+    '''Get the :class:`ConnectionPool` for an eXist server url, creating
+    it from the pool settings if needed.'''
+    with _pools_lock:
+        pool = _pools.get(url)
+        if pool is None:
+            pool = _pools[url] = ConnectionPool(url,
+                size=getattr(settings, 'EXISTDB_POOL_SIZE', DEFAULT_POOL_SIZE),
+                timeout=getattr(settings, 'EXISTDB_POOL_TIMEOUT', DEFAULT_TIMEOUT),
+                idle_timeout=getattr(settings, 'EXISTDB_POOL_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT),
+                health_check=getattr(settings, 'EXISTDB_POOL_HEALTH_CHECK', DEFAULT_HEALTH_CHECK))
+        return pool
+
+
+def _pooled_init(self, *args, **kwargs):
+    _original_init(self, *args, **kwargs)
+    # eulexistdb uses this session for the REST api and for the xmlrpc
+    # transport, so both go through the pool
+    adapter = PooledAdapter(get_pool(self.exist_url))
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+
+def _pinned():
+    # connections kept by the current request thread, if any; a forked
+    # child does not inherit them
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pinned = None
+    return getattr(_local, 'pinned', None)
+
+
+def _start_request(sender, **kwargs):
+    # connections checked out by the request thread are kept until the
+    # request is finished
+    _local.pinned = {}
+    _local.pid = os.getpid()
+
+
+def _finish_request(sender, **kwargs):
+    pinned = _pinned()
+    _local.pinned = None
+    for pool, connection in (pinned or {}).iteritems():
+        pool.checkin(connection)
+
+
+def release_pinned():
+    '''Return any connections kept by the current request thread to their
+    pools.  Should be called before the thread waits on other threads that
+    may need a connection; later queries in the same request will check
+    out and keep a connection again.'''
+    pinned = _pinned()
+    if not pinned:
+        return
+    for pool, connection in pinned.items():
+        pool.checkin(connection)
+    pinned.clear()
+
+
+def install():
+    'Use pooled connections for all eXist connections created from now on.'
+    global _original_init
+    if _original_init is None:
+        _original_init = ExistDB.__init__
+        ExistDB.__init__ = _pooled_init
+    request_started.connect(_start_request, dispatch_uid='findingaids-existpool-start')
+    request_finished.connect(_finish_request, dispatch_uid='findingaids-existpool-finish')
+
+
+def uninstall():
+    'Stop using pooled connections for new eXist connections, and close idle connections.'
+    global _original_init
+    if _original_init is not None:
+        ExistDB.__init__ = _original_init
+        _original_init = None
+    request_started.disconnect(dispatch_uid='findingaids-existpool-start')
+    request_finished.disconnect(dispatch_uid='findingaids-existpool-finish')
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.clear()
+
+
+def metrics():
+    '''Usage of each connection pool, as a dictionary of metrics (see
+    :meth:`ConnectionPool.metrics`) keyed by eXist server url.'''
+    with _pools_lock:
+        pools = dict(_pools)
+    return dict((url, pool.metrics()) for url, pool in pools.iteritems())
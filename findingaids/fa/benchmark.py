@@ -0,0 +1,313 @@
+# file findingaids/fa/benchmark.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Page response time benchmarks, used by the **response_times** manage
+command.
+
+Each scenario is a list of site urls (browse pages, searches, finding aid
+and series pages for a sample of documents, etc.).  Urls are requested
+once or more to warm up caches, and then timed over a number of
+iterations, optionally from several threads at once, either in process
+with the Django test client or against a running site.  Results include
+response time percentiles and, when the eXist query timing middleware is
+enabled (see :mod:`findingaids.exist_middleware`), the time spent in eXist.
+Results can be saved as JSON and compared against a stored baseline.
+'''
+
+from collections import OrderedDict
+from datetime import datetime
+import math
+import Queue
+import re
+import threading
+import time
+from urllib import urlencode
+
+from django.core.urlresolvers import reverse
+from django.test import Client
+import requests
+
+from findingaids.fa.models import FindingAid, Series, title_letters, shortform_id
+from findingaids.fa.sitemapstore import SECTIONS as SITEMAP_SECTIONS
+from findingaids.fa.utils import series_url
+
+#: sample searches, for search response times
+SEARCHES = (
+    'African American*',
+    '(Oral histor*) AND Atlanta',
+    'World War I',
+    '''Flannery O'Connor''',
+    'Segregat* +Georgia',
+    '"New York Times" AND journalis*',
+    'belfast group',
+)
+
+#: sample keywords, for searches within a single document
+DOCUMENT_SEARCHES = ('letters', 'photographs')
+
+#: response time statistics reported for each scenario, in ms
+TIME_STATS = ['p50', 'p95', 'p99', 'min', 'max', 'mean']
+
+_server_timing = re.compile(r'(?:^|,)\s*exist;dur=([0-9.]+);desc="(\d+) ')
+
+
+def browse_urls(eadids):
+    return [reverse('fa:titles-by-letter', kwargs={'letter': letter})
+            for letter in title_letters()]
+
+
+def search_urls(eadids):
+    return ['%s?%s' % (reverse('fa:search'), urlencode({'keywords': keywords}))
+            for keywords in SEARCHES]
+
+
+def findingaid_urls(eadids):
+    return [reverse('fa:findingaid', kwargs={'id': eadid}) for eadid in eadids]
+
+
+def series_urls(eadids):
+    urls = []
+    for eadid in eadids:
+        for series in Series.objects.filter(ead__eadid=eadid).only('id'):
+            urls.append(series_url(eadid, shortform_id(series.id, eadid)))
+    return urls
+
+
+def document_search_urls(eadids):
+    return ['%s?%s' % (reverse('fa:singledoc-search', kwargs={'id': eadid}),
+                       urlencode({'keywords': keywords}))
+            for eadid in eadids for keywords in DOCUMENT_SEARCHES]
+
+
+def eadxml_urls(eadids):
+    return [reverse('fa:eadxml', kwargs={'id': eadid}) for eadid in eadids]
+
+
+def pdf_urls(eadids):
+    return [reverse('fa:printable', kwargs={'id': eadid}) for eadid in eadids]
+
+
+def sitemap_urls(eadids):
+    return ['/sitemap.xml'] + ['/sitemap-%s.xml' % section for section in SITEMAP_SECTIONS]
+
+
+#: benchmark scenarios, in the order they are run; each value is a
+#: function that takes a list of sample eadids and returns a list of urls
+SCENARIOS = OrderedDict([
+    ('browse', browse_urls),
+    ('search', search_urls),
+    ('findingaid', findingaid_urls),
+    ('series', series_urls),
+    ('document_search', document_search_urls),
+    ('eadxml', eadxml_urls),
+    ('pdf', pdf_urls),
+    ('sitemap', sitemap_urls),
+])
+
+
+def sample_eadids(count):
+    '''Eadids for a sample of published documents, for scenarios based on
+    single documents.'''
+    return [ead.eadid.value for ead in
+            FindingAid.objects.only('eadid').order_by('eadid')[:count]]
+
+
+def percentile(values, pct):
+    '''Nearest-rank percentile of a sorted list of values.'''
+    index = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class ClientFetcher(object):
+    '''Request pages in process with the Django test client, with one
+    client per thread.'''
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self._local = threading.local()
+
+    def get(self, url):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = Client(**self.defaults)
+        response = client.get(url)
+        return response.status_code, response.get('Server-Timing')
+
+
+class HttpFetcher(object):
+    '''Request pages from a running site over HTTP, with one session (and
+    keep-alive connection) per thread.'''
+
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, url):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        response = session.get(self.base_url + url, timeout=self.timeout)
+        # read the full response, so it is included in the time
+        response.content
+        return response.status_code, response.headers.get('Server-Timing')
+
+
+def run_scenario(urls, fetcher, warmup=1, iterations=5, concurrency=1):
+    '''Time requests for a list of urls.
+
+    :param urls: list of site urls
+    :param fetcher: :class:`ClientFetcher` or :class:`HttpFetcher`
+    :param warmup: number of untimed requests for each url, made first
+    :param iterations: number of timed requests for each url
+    :param concurrency: number of threads making timed requests
+    :returns: dictionary of scenario results; times are in ms
+    '''
+    for i in range(warmup):
+        for url in urls:
+            try:
+                fetcher.get(url)
+            except Exception:
+                pass
+
+    pending = Queue.Queue()
+    for i in range(iterations):
+        for url in urls:
+            pending.put(url)
+
+    times, exist_times, exist_queries, errors = [], [], [], []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                url = pending.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                status, server_timing = fetcher.get(url)
+            except Exception as err:
+                with lock:
+                    errors.append('%s: %s' % (url, err))
+                continue
+            duration = (time.time() - start) * 1000
+            with lock:
+                if status >= 400:
+                    errors.append('%s: status %s' % (url, status))
+                    continue
+                times.append(duration)
+                match = _server_timing.search(server_timing or '')
+                if match:
+                    exist_times.append(float(match.group(1)))
+                    exist_queries.append(int(match.group(2)))
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    result = {
+        'urls': len(urls),
+        'requests': len(times),
+        'errors': len(errors),
+        'error_details': errors[:10],
+        'throughput': round(len(times) / elapsed, 2) if elapsed else None,
+    }
+    result.update(time_stats(times))
+    if exist_times:
+        exist_times.sort()
+        result['exist_p50'] = round(percentile(exist_times, 50), 1)
+        result['exist_p95'] = round(percentile(exist_times, 95), 1)
+        result['exist_queries'] = round(float(sum(exist_queries)) / len(exist_queries), 1)
+    return result
+
+
+def time_stats(times):
+    '''Percentiles, minimum, maximum, and mean of a list of times, in ms,
+    or None for each statistic if there are no times.'''
+    if not times:
+        return dict((stat, None) for stat in TIME_STATS)
+    times = sorted(times)
+    return {
+        'p50': round(percentile(times, 50), 1),
+        'p95': round(percentile(times, 95), 1),
+        'p99': round(percentile(times, 99), 1),
+        'min': round(times[0], 1),
+        'max': round(times[-1], 1),
+        'mean': round(sum(times) / len(times), 1),
+    }
+
+
+def run(scenarios, fetcher, eadids, warmup=1, iterations=5, concurrency=1,
+        progress=None):
+    '''Run benchmark scenarios.
+
+    :param scenarios: list of scenario names (keys of :data:`SCENARIOS`)
+    :param fetcher: :class:`ClientFetcher` or :class:`HttpFetcher`
+    :param eadids: sample eadids for single-document scenarios
+    :param progress: optional callable, called with each scenario name
+        and result as it completes
+    :returns: dictionary of benchmark results, suitable for saving as JSON
+    '''
+    results = OrderedDict()
+    for name in scenarios:
+        urls = SCENARIOS[name](eadids)
+        results[name] = run_scenario(urls, fetcher, warmup=warmup,
+                                     iterations=iterations, concurrency=concurrency)
+        if progress is not None:
+            progress(name, results[name])
+    return {
+        'date': datetime.now().isoformat(),
+        'settings': {'warmup': warmup, 'iterations': iterations,
+                     'concurrency': concurrency, 'eadids': eadids},
+        'scenarios': results,
+    }
+
+
+def compare(results, baseline, threshold=20, stat='p95'):
+    '''Compare benchmark results against a baseline.  A scenario is a
+    regression if it is slower than the baseline by more than the
+    threshold, if it has no value for the statistic when the baseline does
+    (e.g., because every request failed), or if it has more errors than
+    the baseline.  Scenarios missing from the baseline are skipped.
+
+    :param results: benchmark results, as returned by :meth:`run`
+    :param baseline: stored benchmark results
+    :param threshold: allowed increase over the baseline, as a percentage
+    :param stat: response time statistic to compare
+    :returns: list of (scenario, description) for each regression
+    '''
+    regressions = []
+    for name, result in results['scenarios'].iteritems():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            continue
+        errors, base_errors = result.get('errors') or 0, base.get('errors') or 0
+        if errors > base_errors:
+            regressions.append((name, '%d errors (baseline %d)' % (errors, base_errors)))
+        if base.get(stat) is None:
+            continue
+        if result.get(stat) is None:
+            regressions.append((name, 'no %s (baseline %.1fms)' % (stat, base[stat])))
+        elif result[stat] > base[stat] * (1 + threshold / 100.0):
+            regressions.append((name, '%s %.1fms (baseline %.1fms)' %
+                                (stat, result[stat], base[stat])))
+    return regressions
@@ -0,0 +1,174 @@
+# file findingaids/fa/cachekeys.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Generation-based cache namespaces for values derived from finding aid
+content.
+
+Each namespace (an eXist collection, a single finding aid in a
+collection, or the source files for an archive) has a generation counter
+stored in the Django cache.  Cache keys for derived values include the
+current generation of their namespace, so invalidating a namespace is a
+single counter increment: values cached under the old generation are
+never read again and expire on their own.  Because invalidation does not
+depend on expiration, derived values can be cached for
+**DERIVED_CACHE_TIMEOUT** seconds (one week by default).
+
+Generations are bumped when documents are published, previewed, loaded,
+or deleted (see :meth:`~findingaids.fa.models.CollectionState.update`
+and :meth:`~findingaids.fa.utils.invalidate_findingaid`).
+'''
+
+import hashlib
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+#: default timeout for derived values, in seconds
+DEFAULT_TIMEOUT = 60 * 60 * 24 * 7
+
+_safe_part = re.compile(r'^[\w.-]{1,64}$')
+
+
+def timeout():
+    '''Cache timeout for derived values: **DERIVED_CACHE_TIMEOUT** if
+    configured, otherwise one week.'''
+    return getattr(settings, 'DERIVED_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def collection_namespace(collection=None):
+    '''Namespace for values derived from an entire eXist collection.
+
+    :param collection: eXist collection; defaults to the configured public
+        collection, **EXISTDB_ROOT_COLLECTION**
+    '''
+    if collection is None:
+        collection = settings.EXISTDB_ROOT_COLLECTION
+    return 'collection-%s' % _key_part(collection)
+
+
+def document_namespace(eadid, collection=None):
+    '''Namespace for values derived from a single finding aid.
+
+    :param eadid: eadid
+    :param collection: eXist collection; defaults to the configured public
+        collection, **EXISTDB_ROOT_COLLECTION**
+    '''
+    return '%s-ead-%s' % (collection_namespace(collection), _key_part(eadid))
+
+
+def archive_namespace(slug):
+    '''Namespace for values derived from the source files for an archive.
+
+    :param slug: :class:`~findingaids.fa.models.Archive` slug
+    '''
+    return 'archive-%s' % _key_part(slug)
+
+
+def _key_part(value):
+    # keep simple values readable; hash anything that could be too long
+    # or contain characters that are not allowed in cache keys
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    if _safe_part.match(value):
+        return value
+    return hashlib.md5(value).hexdigest()
+
+
+def _generation_key(namespace):
+    return 'cache-generation-%s' % namespace
+
+
+def generation(namespace):
+    '''Current generation for a namespace.  A namespace that has never
+    been used (or whose counter has been evicted from the cache) is
+    initialized from the current time, so a generation number from before
+    the counter was lost is never reused.'''
+    key = _generation_key(namespace)
+    current = cache.get(key)
+    if current is None:
+        cache.add(key, int(time.time() * 1000), None)
+        current = cache.get(key)
+    return current
+
+
+def invalidate(namespace):
+    '''Increment the generation for a namespace, so that all values cached
+    under the previous generation will no longer be used.'''
+    try:
+        cache.incr(_generation_key(namespace))
+    except ValueError:
+        # generation is not set; nothing cached under the current generation
+        generation(namespace)
+
+
+def invalidate_collection(collection=None):
+    '''Invalidate all cached values derived from an eXist collection.
+
+    :param collection: eXist collection; defaults to the configured public
+        collection, **EXISTDB_ROOT_COLLECTION**
+    '''
+    invalidate(collection_namespace(collection))
+
+
+def invalidate_document(eadid, collection=None):
+    '''Invalidate all cached values derived from a single finding aid.
+
+    :param eadid: eadid
+    :param collection: eXist collection; defaults to the configured public
+        collection, **EXISTDB_ROOT_COLLECTION**
+    '''
+    invalidate(document_namespace(eadid, collection))
+
+
+def invalidate_archive(slug):
+    '''Invalidate all cached values derived from the source files for an
+    archive.
+
+    :param slug: :class:`~findingaids.fa.models.Archive` slug
+    '''
+    invalidate(archive_namespace(slug))
+
+
+def cache_key(name, namespace, *parts):
+    '''Generate a cache key for a derived value, including the current
+    generation of its namespace.
+
+    :param name: name of the derived value, e.g. ``browse-title-letters``
+    :param namespace: namespace, e.g. from :meth:`collection_namespace`
+    :param parts: any additional values that identify the cached value
+    :rtype: string
+    '''
+    key = [name, namespace, str(generation(namespace))]
+    key.extend(_key_part(part) for part in parts)
+    return '-'.join(key)
+
+
+def collection_key(name, *parts, **kwargs):
+    '''Cache key for a value derived from an eXist collection; optionally
+    takes a ``collection`` keyword argument (see
+    :meth:`collection_namespace`).'''
+    return cache_key(name, collection_namespace(kwargs.get('collection')), *parts)
+
+
+def document_key(name, eadid, *parts, **kwargs):
+    '''Cache key for a value derived from a single finding aid; optionally
+    takes a ``collection`` keyword argument (see
+    :meth:`document_namespace`).'''
+    return cache_key(name, document_namespace(eadid, kwargs.get('collection')), *parts)
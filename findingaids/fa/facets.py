@@ -0,0 +1,233 @@
+# file findingaids/fa/facets.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Search facets for published finding aids: repository, digital content,
+and controlaccess subject.
+
+Facet values for each published document are stored as a
+:class:`~findingaids.fa.models.FacetRecord` when the document is
+published, loaded, or deleted.  The records for the whole collection are
+loaded into a :class:`FacetIndex` held in process memory until the
+collection changes, so that repository and digital content filters and
+facet counts for a list of search results are calculated with set
+operations instead of eXist queries.
+'''
+
+from collections import defaultdict, Counter
+import logging
+import threading
+
+from findingaids.fa import cachekeys
+from findingaids.fa.models import FacetRecord, CollectionState
+from findingaids.utils import normalize_whitespace
+
+logger = logging.getLogger(__name__)
+
+#: :class:`~findingaids.fa.models.FindingAid` fields required to
+#: calculate facet values, for partial eXist returns
+FACET_FIELDS = ['eadid', 'repository', 'dao_count', 'public_dao_count',
+                'controlaccess_terms']
+
+#: maximum number of subject facets returned with search results
+SUBJECT_FACET_SIZE = 10
+
+
+def facet_values(ead):
+    '''Facet values for a finding aid, as a dictionary of
+    :class:`~findingaids.fa.models.FacetRecord` field values.
+
+    :param ead: :class:`~findingaids.fa.models.FindingAid`, full or with
+        at least :data:`FACET_FIELDS`
+    '''
+    # NOTE: partial returns are not normalized, and values must not
+    # span lines in the stored record
+    repositories = []
+    for repo in ead.repository:
+        repo = normalize_whitespace(repo or '').strip()
+        if repo and repo not in repositories:
+            repositories.append(repo)
+    # remove duplicates but preserve order
+    subjects = []
+    for term in ead.controlaccess_terms:
+        term = normalize_whitespace(term or '').strip()
+        if term and term not in subjects:
+            subjects.append(term)
+    return {
+        'repositories': '\n'.join(repositories),
+        'subjects': '\n'.join(subjects),
+        'dao_count': ead.dao_count or 0,
+        'public_dao_count': ead.public_dao_count or 0,
+    }
+
+
+def update_facets(ead):
+    '''Store facet values for a published finding aid.  Should be called
+    before the collection state is updated, so that the facet index built
+    for the new collection generation includes the change.
+
+    :param ead: :class:`~findingaids.fa.models.FindingAid`, full or with
+        at least :data:`FACET_FIELDS`
+    '''
+    save_facets(ead.eadid.value, facet_values(ead))
+
+
+def save_facets(eadid, values):
+    '''Store facet values calculated by :meth:`facet_values` (e.g., in a
+    worker process) for a published finding aid.'''
+    FacetRecord.objects.update_or_create(eadid=eadid, defaults=values)
+
+
+def remove_facets(eadid):
+    'Remove stored facet values for a finding aid that is no longer published.'
+    FacetRecord.objects.filter(eadid=eadid).delete()
+
+
+class FacetIndex(object):
+    '''In-memory facet index for all published finding aids.
+
+    :param records: iterable of :class:`~findingaids.fa.models.FacetRecord`
+    '''
+
+    def __init__(self, records):
+        #: set of all eadids in the index
+        self.eadids = set()
+        #: repository names for each eadid
+        self.repositories = {}
+        #: controlaccess terms for each eadid
+        self.subjects = {}
+        #: set of eadids for each repository
+        self.by_repository = defaultdict(set)
+        #: eadids with any digital archival objects
+        self.dao = set()
+        #: eadids with public digital archival objects
+        self.public_dao = set()
+
+        for record in records:
+            eadid = record.eadid
+            self.eadids.add(eadid)
+            self.repositories[eadid] = tuple(record.repository_list)
+            self.subjects[eadid] = tuple(record.subject_list)
+            for repo in self.repositories[eadid]:
+                self.by_repository[repo].add(eadid)
+            if record.dao_count:
+                self.dao.add(eadid)
+            if record.public_dao_count:
+                self.public_dao.add(eadid)
+
+    def __len__(self):
+        return len(self.eadids)
+
+    def _dao_set(self, internal_dao):
+        return self.dao if internal_dao else self.public_dao
+
+    def _repository_set(self, repository):
+        # repository search values are exact phrases, e.g. from
+        # the advanced search form
+        return self.by_repository.get(repository.strip().strip('"'), set())
+
+    def matching(self, repository=None, dao=False, internal_dao=False):
+        '''Set of eadids matching repository and digital content filters,
+        or None if no filters are set.
+
+        :param repository: repository name, optionally quoted
+        :param dao: only include documents with digital archival objects
+        :param internal_dao: when filtering on digital archival objects,
+            include documents with internal-only daos
+        '''
+        matches = None
+        if repository:
+            matches = self._repository_set(repository)
+        if dao:
+            daos = self._dao_set(internal_dao)
+            matches = daos if matches is None else matches & daos
+        return matches
+
+    def filter(self, results, repository=None, dao=False, internal_dao=False):
+        '''Filter a list of search results, preserving order.
+
+        :param results: list of results with an ``eadid`` attribute
+        :returns: list of results matching the filters (see :meth:`matching`)
+        '''
+        matches = self.matching(repository, dao, internal_dao)
+        if matches is None:
+            return results
+        return [r for r in results if r.eadid in matches]
+
+    def counts(self, results, repository=None, dao=False, internal_dao=False):
+        '''Facet counts for a list of search results.  Repository and
+        digital content counts each exclude their own filter (so that
+        alternatives can be offered), and subject counts are for the fully
+        filtered results.
+
+        :param results: list of results with an ``eadid`` attribute, before
+            repository and digital content filters are applied
+        :returns: dictionary with ``repository``, a list of (name, count)
+            sorted by name; ``dao``, the number of results with digital
+            content; and ``subject``, a list of (term, count) for the
+            :data:`SUBJECT_FACET_SIZE` most frequent terms
+        '''
+        eadids = set(r.eadid for r in results)
+
+        repo_filtered = eadids
+        if repository:
+            repo_filtered = eadids & self._repository_set(repository)
+        dao_filtered = eadids
+        if dao:
+            dao_filtered = eadids & self._dao_set(internal_dao)
+
+        repositories = Counter()
+        for eadid in dao_filtered:
+            repositories.update(self.repositories.get(eadid, ()))
+        subjects = Counter()
+        for eadid in repo_filtered & dao_filtered:
+            subjects.update(self.subjects.get(eadid, ()))
+
+        return {
+            'repository': sorted(repositories.items()),
+            'dao': len(repo_filtered & self._dao_set(internal_dao)),
+            # most frequent first, then alphabetical
+            'subject': sorted(subjects.items(),
+                              key=lambda item: (-item[1], item[0]))[:SUBJECT_FACET_SIZE],
+        }
+
+
+_index = {}
+_index_lock = threading.Lock()
+
+
+def facet_index():
+    '''Facet index for the published collection, loaded from the stored
+    facet records once per process for each collection generation.
+
+    :returns: :class:`FacetIndex`, or None if facet records do not match
+        the set of published documents (e.g., before they are first built with
+        the **facet_index** manage command), in which case filters should
+        be applied in eXist
+    '''
+    key = cachekeys.collection_key('facet-index')
+    with _index_lock:
+        if key not in _index:
+            _index.clear()
+            _index[key] = FacetIndex(FacetRecord.objects.all())
+        index = _index[key]
+    published = CollectionState.current().eadids()
+    if index.eadids != published:
+        logger.debug('Facet records do not match published documents ' +
+                     '(%d missing, %d not published)' %
+                     (len(published - index.eadids), len(index.eadids - published)))
+        return None
+    return index
@@ -0,0 +1,339 @@
+# file findingaids/fa/fop.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Run XSL-FO to PDF conversions with a bounded pool of workers.
+
+By default each conversion runs the configured **XSLFO_PROCESSOR** as a
+separate process, with the number of simultaneous conversions limited by
+**XSLFO_WORKERS** and each conversion limited to **XSLFO_TIMEOUT** seconds.
+
+If **XSLFO_WORKER_COMMAND** is configured, each worker instead keeps a
+long-running process alive and sends it one job per line on stdin, as the
+XSL-FO and PDF paths separated by a tab.  The process should write a
+single line to stdout for each job, starting with ``OK`` on success or
+``ERROR`` followed by a message on failure.  A worker that runs Apache FOP
+in embedded mode, so the JVM is started once per worker instead of once
+per PDF, is included in ``scripts/fop-worker``.
+
+If **XSLFO_SERVICE_SOCKET** is configured, conversions are sent to a
+shared rendering service listening on that unix socket (see the
+``fop_service`` management command), so that web and celery processes
+share a single pool of workers.
+'''
+
+from collections import defaultdict
+import errno
+import fcntl
+import logging
+import os
+import Queue
+import select
+import socket
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class FopError(Exception):
+    'Error converting XSL-FO to PDF'
+    pass
+
+
+class FopTimeout(FopError):
+    'XSL-FO conversion did not complete in the configured time'
+    pass
+
+
+class FopQueueFull(FopError):
+    'Too many XSL-FO conversions are waiting to be processed'
+    pass
+
+
+def fop_timeout():
+    'Configured maximum time in seconds for a single conversion'
+    return getattr(settings, 'XSLFO_TIMEOUT', 300)
+
+
+def run_processor(fo_filename, pdf_filename, timeout=None, cwd=None):
+    '''Convert XSL-FO to PDF by running the configured **XSLFO_PROCESSOR**
+    as a separate process.  Raises :class:`FopTimeout` if the process does
+    not finish within the timeout, or :class:`FopError` on failure.'''
+    if timeout is None:
+        timeout = fop_timeout()
+    cmd_parts = [settings.XSLFO_PROCESSOR, fo_filename, pdf_filename]
+    logger.debug("Calling XSL-FO processor: %s" % ' '.join(cmd_parts))
+    try:
+        proc = subprocess.Popen(cmd_parts, cwd=cwd, close_fds=True)
+    except OSError, e:
+        raise FopError("Apache Fop execution failed: %s" % e)
+
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        try:
+            proc.kill()
+        except OSError:
+            pass    # already finished
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        rval = proc.wait()
+    finally:
+        timer.cancel()
+    if timed_out.is_set():
+        raise FopTimeout("XSL-FO processor did not finish in %s seconds" % timeout)
+    if rval != 0:
+        raise FopError("XSL-FO processor exited with status %s" % rval)
+
+
+class FopWorker(object):
+    '''A single XSL-FO conversion worker.  When a worker command is
+    specified, a long-running process is started on first use and
+    restarted as needed; otherwise, each conversion runs the XSL-FO
+    processor as a new process.
+
+    :param command: optional list of command arguments for a long-running
+        worker process
+    '''
+
+    def __init__(self, command=None):
+        self.command = command
+        self.process = None
+        # output read from the worker process but not yet processed
+        self._output = ''
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        logger.debug('Starting XSL-FO worker: %s' % ' '.join(self.command))
+        try:
+            self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, close_fds=True)
+        except OSError, e:
+            raise FopError("Failed to start XSL-FO worker: %s" % e)
+        # read responses without blocking, so the job timeout always applies
+        stdout = self.process.stdout.fileno()
+        fcntl.fcntl(stdout, fcntl.F_SETFL, fcntl.fcntl(stdout, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._output = ''
+
+    def stop(self):
+        if self.alive():
+            self.process.stdin.close()
+            try:
+                self.process.terminate()
+            except OSError:
+                pass    # already exited
+            self.process.wait()
+        self.process = None
+        self._output = ''
+
+    def _read_response(self, timeout):
+        # read a single response line from the worker process, waiting at
+        # most timeout seconds in total; returns an empty string if the
+        # process exits before responding
+        deadline = time.time() + timeout
+        stdout = self.process.stdout.fileno()
+        while '\n' not in self._output:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise FopTimeout("XSL-FO worker did not respond in %s seconds" % timeout)
+            ready, _, _ = select.select([stdout], [], [], remaining)
+            if not ready:
+                continue
+            try:
+                data = os.read(stdout, 4096)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    continue
+                raise
+            if not data:
+                return ''
+            self._output += data
+        response, self._output = self._output.split('\n', 1)
+        return response
+
+    def render(self, fo_filename, pdf_filename, timeout=None, cwd=None):
+        'Convert an XSL-FO file to PDF.'
+        if timeout is None:
+            timeout = fop_timeout()
+        if self.command is None:
+            return run_processor(fo_filename, pdf_filename, timeout, cwd)
+
+        if not self.alive():
+            self.start()
+        try:
+            self.process.stdin.write('%s\t%s\n' % (fo_filename, pdf_filename))
+            self.process.stdin.flush()
+        except IOError, e:
+            self.stop()
+            raise FopError("Failed to send job to XSL-FO worker: %s" % e)
+
+        try:
+            response = self._read_response(timeout)
+        except FopTimeout:
+            # worker state is unknown; replace it on the next job
+            self.stop()
+            raise
+        if not response:
+            self.stop()
+            raise FopError("XSL-FO worker exited unexpectedly")
+        if not response.startswith('OK'):
+            raise FopError(response.strip())
+
+
+class _FopJob(object):
+    def __init__(self, fo_filename, pdf_filename, cwd=None):
+        self.fo_filename = fo_filename
+        self.pdf_filename = pdf_filename
+        self.cwd = cwd
+        self.error = None
+        self.done = threading.Event()
+
+
+class FopPool(object):
+    '''Pool of :class:`FopWorker` threads processing XSL-FO conversions from
+    a bounded queue.  Defaults are taken from **XSLFO_WORKERS**,
+    **XSLFO_QUEUE_SIZE**, **XSLFO_TIMEOUT**, and **XSLFO_WORKER_COMMAND**.
+
+    :param workers: number of workers (i.e., simultaneous conversions)
+    :param queue_size: maximum number of conversions waiting for a worker
+    :param timeout: maximum time in seconds for a single conversion
+    :param command: optional list of command arguments for long-running
+        worker processes
+    '''
+
+    def __init__(self, workers=None, queue_size=None, timeout=None, command=None):
+        if workers is None:
+            workers = getattr(settings, 'XSLFO_WORKERS', 2)
+        if queue_size is None:
+            queue_size = getattr(settings, 'XSLFO_QUEUE_SIZE', 100)
+        if timeout is None:
+            timeout = fop_timeout()
+        if command is None:
+            command = getattr(settings, 'XSLFO_WORKER_COMMAND', None)
+        self.timeout = timeout
+        self.jobs = Queue.Queue(maxsize=queue_size)
+        self.stats = defaultdict(int)
+        self._stats_lock = threading.Lock()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, args=(FopWorker(command),),
+                                      name='fop-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def _work(self, worker):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    worker.stop()
+                    return
+                worker.render(job.fo_filename, job.pdf_filename, self.timeout, job.cwd)
+                self._count('completed')
+            except Exception, e:
+                logger.error('XSL-FO conversion of %s failed: %s' % (job.fo_filename, e))
+                self._count('timeout' if isinstance(e, FopTimeout) else 'failed')
+                job.error = e
+            finally:
+                if job is not None:
+                    job.done.set()
+                self.jobs.task_done()
+
+    def render(self, fo_filename, pdf_filename, cwd=None):
+        '''Convert an XSL-FO file to PDF, waiting for an available worker.
+        Raises :class:`FopQueueFull` if the queue is full, or
+        :class:`FopError` if the conversion fails.'''
+        job = _FopJob(fo_filename, pdf_filename, cwd)
+        try:
+            self.jobs.put_nowait(job)
+        except Queue.Full:
+            self._count('rejected')
+            raise FopQueueFull('XSL-FO queue is full (%d jobs waiting)' % self.jobs.maxsize)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+
+    def shutdown(self):
+        'Stop all workers once queued jobs are finished.'
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    'Process-wide :class:`FopPool`, created on first use.'
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = FopPool()
+    return _pool
+
+
+def service_render(socket_path, fo_filename, pdf_filename):
+    '''Send a conversion to the rendering service listening on the
+    specified unix socket and wait for the result.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # allow time to wait for an available worker as well as for the conversion
+    sock.settimeout(fop_timeout() * 2)
+    try:
+        sock.connect(socket_path)
+        sock.sendall('%s\t%s\n' % (fo_filename, pdf_filename))
+        response = sock.makefile('r').readline()
+    except socket.timeout:
+        raise FopTimeout('No response from XSL-FO service at %s' % socket_path)
+    except socket.error, e:
+        raise FopError('XSL-FO service at %s failed: %s' % (socket_path, e))
+    finally:
+        sock.close()
+    if not response.startswith('OK'):
+        raise FopError(response.strip() or 'No response from XSL-FO service')
+
+
+def render_pdf(fo_filename, pdf_filename, cwd=None):
+    '''Convert an XSL-FO file to PDF, using the shared rendering service if
+    **XSLFO_SERVICE_SOCKET** is configured and otherwise the process-wide
+    worker pool.  Raises :class:`FopError` on failure.
+
+    :param fo_filename: full path to the XSL-FO file
+    :param pdf_filename: full path where the PDF should be written
+    :param cwd: working directory for per-conversion processes
+    '''
+    socket_path = getattr(settings, 'XSLFO_SERVICE_SOCKET', None)
+    if socket_path:
+        service_render(socket_path, os.path.abspath(fo_filename),
+                       os.path.abspath(pdf_filename))
+    else:
+        get_pool().render(fo_filename, pdf_filename, cwd)
@@ -0,0 +1,458 @@
+# file findingaids/fa/fulltext.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Local full-text search index for published finding aids, as an
+alternative to searching the eXist Lucene index.
+
+The index is updated when documents are published, loaded, or deleted,
+from the EAD already in hand, and supports the same collection-level
+(keyword, subject, repository, and digital content) and file-level
+searches as the site, so eXist is only used to retrieve documents for
+display.  Relevance scores mirror the field boosts configured for eXist in
+``exist_index.xconf``.
+
+A local index (:class:`SqliteSearchIndex`) is enabled by configuring
+**FULLTEXT_SEARCH_INDEX** (path to the index file).  When no index is
+configured, all searches use eXist.
+'''
+
+from collections import namedtuple
+import logging
+import re
+import sqlite3
+import threading
+
+from django.conf import settings
+from lxml import etree
+
+from eulxml.xmlmap import load_xmlobject_from_string
+from eulxml.xmlmap.eadmap import EAD_NAMESPACE, XLINK_NAMESPACE
+
+from findingaids.fa import lucene
+from findingaids.fa.models import FindingAid, FileComponent
+
+logger = logging.getLogger(__name__)
+
+
+SearchResult = namedtuple('SearchResult', ['list_title', 'eadid', 'score'])
+'''Finding aid search result: list title, eadid, and relevance score
+(relative to the best match, between 0 and 1)'''
+
+
+class SearchQueryError(Exception):
+    '''Search terms could not be parsed.'''
+
+
+class ResultList(list):
+    '''List of search results; :meth:`count` returns the number of results,
+    as for an eXist queryset, so results can be used in the same templates.'''
+
+    def count(self):
+        return len(self)
+
+
+#: field boosts, as configured for the eXist index in exist_index.xconf;
+#: all other indexed text uses the document-level boost
+FIELD_BOOSTS = [
+    ('titleproper', 2.0),
+    ('origination', 1.5),
+    ('abstract', 1.5),
+    ('bioghist', 1.2),
+    ('scopecontent', 1.2),
+    ('controlaccess', 1.7),
+    ('subarea', 1.0),
+]
+DOCUMENT_BOOST = 0.5
+
+#: elements excluded from document-level keyword search (as in exist_index.xconf)
+IGNORED_ELEMENTS = ['publicationstmt', 'profiledesc', 'langmaterial', 'repository',
+                    'acqinfo', 'prefercite', 'altformavail', 'processinfo',
+                    'arrangement', 'appraisal', 'otherfindaid', 'separatedmaterial',
+                    'relatedmaterial', 'bibliography', 'container']
+
+_ns = {'e': EAD_NAMESPACE, 'xlink': XLINK_NAMESPACE}
+_ignored = set('{%s}%s' % (EAD_NAMESPACE, name) for name in IGNORED_ELEMENTS)
+_file_components = etree.XPath('e:archdesc/e:dsc//*[@level="file"]', namespaces=_ns)
+_dao_count = etree.XPath('count(.//e:dao)', namespaces=_ns)
+_public_dao_count = etree.XPath(
+    'count(.//e:dao[@xlink:href][not(@xlink:show="none")][not(@audience) or @audience="external"])',
+    namespaces=_ns)
+# outermost elements only, since some (e.g. controlaccess) may be nested
+_field_xpaths = dict((field, etree.XPath('.//e:%s[not(ancestor::e:%s)]' % (field, field),
+                                         namespaces=_ns))
+                     for field, boost in FIELD_BOOSTS)
+
+
+def _text(node, ignore=None):
+    # all text content of a node, skipping content (but not the tail text)
+    # of any ignored elements
+    parts = []
+
+    def collect(el):
+        if ignore and el.tag in ignore:
+            return
+        if el.text:
+            parts.append(el.text)
+        for child in el:
+            collect(child)
+            if child.tail:
+                parts.append(child.tail)
+    collect(node)
+    return ' '.join(' '.join(parts).split())
+
+
+def _fields_text(node, xpath):
+    return ' '.join(_text(el) for el in xpath(node))
+
+
+def _fts_expression(clause):
+    # convert a parsed lucene clause to an SQLite FTS5 query expression.
+    # FTS5 only supports trailing wildcards, so a term with a wildcard
+    # matches everything starting with the text before the wildcard.
+    kind, value = clause
+    if kind == 'phrase':
+        if not value.strip():
+            raise SearchQueryError('Cannot parse query: empty phrase')
+        return '"%s"' % value
+    if kind == 'term':
+        wildcard = re.search(r'[*?]', value)
+        if wildcard:
+            prefix = value[:wildcard.start()]
+            if not prefix:
+                raise SearchQueryError('Cannot parse query: leading wildcard')
+            return '"%s" *' % prefix.replace('"', '')
+        if not value:
+            raise SearchQueryError('Cannot parse query: missing search term')
+        return '"%s"' % value.replace('"', '')
+
+    clauses = dict((occur, [_fts_expression(c) for o, c in value if o == occur])
+                   for occur in (lucene.MUST, lucene.SHOULD, lucene.MUST_NOT))
+    # as for lucene, documents must match all required clauses, or at least
+    # one optional clause if there are none; FTS5 cannot express optional
+    # clauses alongside required ones, so those are left out
+    if clauses[lucene.MUST]:
+        expr = _fts_combine(clauses[lucene.MUST], 'AND')
+    elif clauses[lucene.SHOULD]:
+        expr = _fts_combine(clauses[lucene.SHOULD], 'OR')
+    else:
+        raise SearchQueryError('Cannot parse query: nothing to exclude from')
+    if clauses[lucene.MUST_NOT]:
+        expr = '(%s NOT %s)' % (expr, _fts_combine(clauses[lucene.MUST_NOT], 'OR'))
+    return expr
+
+
+def _fts_combine(exprs, operator):
+    if len(exprs) == 1:
+        return exprs[0]
+    return '(%s)' % (' %s ' % operator).join(exprs)
+
+
+def fts_query(query):
+    '''Convert keyword search terms to an SQLite FTS5 query expression,
+    matching the same documents as eXist would for required, prohibited,
+    and (when nothing is required) optional terms.
+
+    :raises SearchQueryError: if the terms could not be parsed
+    '''
+    try:
+        return _fts_expression(lucene.parse(query))
+    except lucene.QuerySyntaxError as err:
+        raise SearchQueryError('Cannot parse query: %s' % err)
+
+
+class SqliteSearchIndex(object):
+    '''Full-text search index stored in a local SQLite database, using the
+    FTS5 extension.  Field boosts are applied as BM25 column weights.
+    Connections are opened per thread.
+
+    :param location: path to the index file, from **FULLTEXT_SEARCH_INDEX**
+    '''
+
+    doc_columns = ['text'] + [field for field, boost in FIELD_BOOSTS]
+
+    def __init__(self, location):
+        self.location = location
+        self._local = threading.local()
+        self._init_schema()
+
+    @property
+    def db(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.location, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = conn
+        return conn
+
+    def _init_schema(self):
+        tokenizer = "tokenize='unicode61 remove_diacritics 2'"
+        with self.db as conn:
+            conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS findingaid USING fts5('
+                         'eadid UNINDEXED, list_title UNINDEXED, dao_count UNINDEXED, '
+                         'public_dao_count UNINDEXED, %s, %s)' %
+                         (', '.join(self.doc_columns), tokenizer))
+            conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS component USING fts5('
+                         'eadid UNINDEXED, position UNINDEXED, depth UNINDEXED, '
+                         'dao_count UNINDEXED, public_dao_count UNINDEXED, xml UNINDEXED, '
+                         'text, %s)' % tokenizer)
+
+    def index_findingaid(self, ead):
+        '''Add or replace a finding aid in the index.
+
+        :param ead: full :class:`~findingaids.fa.models.FindingAid`
+        '''
+        self.save_values(index_values(ead))
+
+    def save_values(self, values):
+        '''Add or replace a finding aid in the index, from values calculated
+        by :meth:`index_values` (e.g., in a worker process).'''
+        eadid = values['eadid']
+        with self.db as conn:
+            conn.execute('DELETE FROM findingaid WHERE eadid = ?', (eadid, ))
+            conn.execute('DELETE FROM component WHERE eadid = ?', (eadid, ))
+            conn.execute('INSERT INTO findingaid (eadid, list_title, dao_count, public_dao_count, %s) '
+                         'VALUES (?, ?, ?, ?, %s)' % (', '.join(self.doc_columns),
+                                                     ', '.join('?' * len(self.doc_columns))),
+                         values['findingaid'])
+            conn.executemany('INSERT INTO component (eadid, position, depth, dao_count, '
+                             'public_dao_count, xml, text) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             values['components'])
+
+    def remove_findingaid(self, eadid):
+        'Remove a finding aid from the index.'
+        with self.db as conn:
+            conn.execute('DELETE FROM findingaid WHERE eadid = ?', (eadid, ))
+            conn.execute('DELETE FROM component WHERE eadid = ?', (eadid, ))
+
+    def clear(self):
+        'Remove all finding aids from the index.'
+        with self.db as conn:
+            conn.execute('DELETE FROM findingaid')
+            conn.execute('DELETE FROM component')
+
+    def eadids(self):
+        'Set of eadids for all finding aids in the index.'
+        return set(row[0] for row in self.db.execute('SELECT eadid FROM findingaid'))
+
+    def _dao_filter(self, dao, internal_dao, where):
+        if dao:
+            where.append('public_dao_count >= 1' if not internal_dao else 'dao_count >= 1')
+
+    def search(self, keywords=None, subject=None, repository=None, dao=False,
+               internal_dao=False):
+        '''Search finding aids, with the same options as the site search form.
+        Results are ordered by relevance when searching by keyword, and
+        otherwise by list title.
+
+        :param keywords: keyword search terms
+        :param subject: subject (controlaccess) search terms
+        :param repository: repository (subarea) search terms
+        :param dao: only return finding aids with digital archival objects
+        :param internal_dao: when filtering on digital archival objects,
+            include finding aids with internal-only daos
+        :returns: list of :class:`SearchResult`
+        :raises SearchQueryError: if search terms could not be parsed
+        '''
+        match = []
+        if keywords:
+            match.append(fts_query(keywords))
+        if subject:
+            match.append('controlaccess : (%s)' % fts_query(subject))
+        if repository:
+            match.append('subarea : (%s)' % fts_query(repository))
+        where, params = [], []
+        if match:
+            where.append('findingaid MATCH ?')
+            params.append(' AND '.join(match))
+        self._dao_filter(dao, internal_dao, where)
+
+        weights = ', '.join(['0'] * 4 + [str(DOCUMENT_BOOST)] +
+                            [str(boost) for field, boost in FIELD_BOOSTS])
+        if keywords:
+            # bm25 scores are negative; more relevant documents score lower
+            score = 'bm25(findingaid, %s)' % weights
+            order = 'score'
+        else:
+            score = '0'
+            order = 'list_title'
+        sql = 'SELECT eadid, list_title, %s AS score FROM findingaid' % score
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + order
+        try:
+            rows = self.db.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as err:
+            raise SearchQueryError('Cannot parse query: %s' % err)
+
+        best = -rows[0][2] if rows and keywords else 0
+        return [SearchResult(list_title, eadid, (-score / best) if best else None)
+                for eadid, list_title, score in rows]
+
+    def search_components(self, eadid, keywords=None, dao=False, internal_dao=False):
+        '''Search file-level components within a single finding aid.
+
+        :param eadid: eadid
+        :param keywords: keyword search terms
+        :param dao: only return components with digital archival objects
+        :param internal_dao: when filtering on digital archival objects,
+            include components with internal-only daos
+        :returns: :class:`ResultList` of
+            :class:`~findingaids.fa.models.FileComponent`, in document order,
+            with parent and series information available
+        :raises SearchQueryError: if search terms could not be parsed
+        '''
+        where, params = ['eadid = ?'], [eadid]
+        if keywords:
+            where.append('component MATCH ?')
+            params.append(fts_query(keywords))
+        self._dao_filter(dao, internal_dao, where)
+        sql = 'SELECT xml, depth FROM component WHERE %s ORDER BY position' % \
+            ' AND '.join(where)
+        try:
+            rows = self.db.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as err:
+            raise SearchQueryError('Cannot parse query: %s' % err)
+        return ResultList(_load_component(xml, depth) for xml, depth in rows)
+
+
+def _component_context(component, eadid):
+    # Copy of a file-level component inside minimal copies of its ancestor
+    # components (attributes and did only) and the ead, so that parent and
+    # series information and short ids are available without the full
+    # document.  Returns the context root element and the number of
+    # ancestor components.
+    E = lambda tag: etree.Element('{%s}%s' % (EAD_NAMESPACE, tag), nsmap={None: EAD_NAMESPACE,
+                                                                        'xlink': XLINK_NAMESPACE})
+    ead = E('ead')
+    eadheader = etree.SubElement(ead, '{%s}eadheader' % EAD_NAMESPACE)
+    etree.SubElement(eadheader, '{%s}eadid' % EAD_NAMESPACE).text = eadid
+    archdesc = etree.SubElement(ead, '{%s}archdesc' % EAD_NAMESPACE)
+    parent = etree.SubElement(archdesc, '{%s}dsc' % EAD_NAMESPACE)
+
+    ancestors = []
+    for el in component.iterancestors():
+        if el.tag == '{%s}dsc' % EAD_NAMESPACE:
+            break
+        ancestors.append(el)
+    for el in reversed(ancestors):
+        shell = etree.SubElement(parent, el.tag, attrib=dict(el.attrib))
+        did = el.find('{%s}did' % EAD_NAMESPACE)
+        if did is not None:
+            shell.append(_copy(did))
+        parent = shell
+    parent.append(_copy(component))
+    return ead, len(ancestors)
+
+
+def _copy(el):
+    copy = etree.fromstring(etree.tostring(el))
+    copy.tail = None
+    return copy
+
+
+def _load_component(xml, depth):
+    context = load_xmlobject_from_string(xml.encode('utf-8'), FindingAid)
+    xpath = 'e:archdesc/e:dsc' + '/*[not(self::e:did)]' * (depth + 1)
+    node = context.node.xpath(xpath, namespaces=_ns)[0]
+    return FileComponent(node)
+
+
+def index_values(ead):
+    '''Values to index for a finding aid: a dictionary with the eadid, the
+    finding aid row, and the file component rows.  Can be calculated
+    without an index (e.g., in a worker process) and stored with
+    :func:`save_index_values`.
+
+    :param ead: full :class:`~findingaids.fa.models.FindingAid`
+    '''
+    eadid = ead.eadid.value
+    node = ead.node
+    text = [_text(node, _ignored)] + \
+        [_fields_text(node, _field_xpaths[field]) for field, boost in FIELD_BOOSTS]
+    components = []
+    for i, component in enumerate(_file_components(node)):
+        context, depth = _component_context(component, eadid)
+        components.append((eadid, i, depth, int(_dao_count(component)),
+                           int(_public_dao_count(component)),
+                           etree.tostring(context, encoding=unicode), _text(component)))
+    return {
+        'eadid': eadid,
+        'findingaid': [eadid, unicode(ead.list_title), int(_dao_count(node)),
+                       int(_public_dao_count(node))] + text,
+        'components': components,
+    }
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def search_index():
+    '''Configured local full-text search index.
+
+    :returns: :class:`SqliteSearchIndex`, or None if no local index is
+        configured and eXist should be used for searching
+    '''
+    location = getattr(settings, 'FULLTEXT_SEARCH_INDEX', None)
+    if not location:
+        return None
+    with _indexes_lock:
+        if location not in _indexes:
+            _indexes[location] = SqliteSearchIndex(location)
+        return _indexes[location]
+
+
+def index_findingaid(ead):
+    '''Add or update a finding aid in the local search index, if one is
+    configured.  Errors are logged but not raised, so that publication does
+    not fail because of the search index; the index can be rebuilt with
+    the **fulltext_index** manage command.
+
+    :param ead: full :class:`~findingaids.fa.models.FindingAid`
+    '''
+    index = search_index()
+    if index is None:
+        return
+    try:
+        index.index_findingaid(ead)
+    except Exception as err:
+        logger.error('Failed to update search index for %s: %s' % (ead.eadid.value, err))
+
+
+def save_index_values(values):
+    '''Add or update a finding aid in the local search index, if one is
+    configured, from values calculated by :func:`index_values`.  Errors are
+    logged but not raised, as for :func:`index_findingaid`.'''
+    index = search_index()
+    if index is None:
+        return
+    try:
+        index.save_values(values)
+    except Exception as err:
+        logger.error('Failed to update search index for %s: %s' % (values['eadid'], err))
+
+
+def remove_findingaid(eadid):
+    '''Remove a finding aid from the local search index, if one is
+    configured.  Errors are logged but not raised.'''
+    index = search_index()
+    if index is None:
+        return
+    try:
+        index.remove_findingaid(eadid)
+    except Exception as err:
+        logger.error('Failed to remove %s from search index: %s' % (eadid, err))
@@ -0,0 +1,145 @@
+# file findingaids/fa/lucene.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Parser for the Lucene query syntax accepted by keyword searches (terms,
+"exact phrases", wildcards, AND/OR/NOT, +/-, and grouping with
+parentheses), shared by the local full-text index
+(:mod:`findingaids.fa.fulltext`) and the local eXist stand-in
+(:mod:`findingaids.localexist`), so both interpret queries the way eXist
+does.
+
+A query is parsed to a boolean clause, as in Lucene: a list of
+``(occur, clause)`` pairs, where occur is :data:`MUST`, :data:`SHOULD`,
+or :data:`MUST_NOT`, and each clause is a ``('term', text)`` or
+``('phrase', text)``, or a nested boolean clause for a parenthesized
+group.  Terms are returned without any field prefix, boost, or fuzzy
+modifier, and phrases without quotes or proximity.
+'''
+
+import re
+
+MUST, SHOULD, MUST_NOT = 'must', 'should', 'must_not'
+
+
+class QuerySyntaxError(Exception):
+    '''Query could not be parsed.'''
+
+
+class _Parser(object):
+
+    token_re = re.compile(r'\s*(?:(?P<phrase>"[^"]*")(?:[~^][\d.]*)*|(?P<open>\()|'
+                          r'(?P<close>\))|(?P<term>[^\s()"]+)|(?P<quote>"))', re.UNICODE)
+    conjunctions = {'AND': 'AND', '&&': 'AND', 'OR': 'OR', '||': 'OR'}
+    modifiers = {'NOT': '-', '!': '-', '-': '-', '+': '+'}
+
+    def __init__(self, query, default_operator):
+        self.default = MUST if default_operator.lower() == 'and' else SHOULD
+        self.tokens = []
+        pos = 0
+        query = query.strip()
+        while pos < len(query):
+            match = self.token_re.match(query, pos)
+            if match is None or match.group('quote'):
+                raise QuerySyntaxError('unbalanced quotes')
+            pos = match.end()
+            kind = match.lastgroup
+            self.tokens.append((kind, match.group(kind)))
+        self.pos = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise QuerySyntaxError('no search terms')
+        clause = self._boolean()
+        if self.pos != len(self.tokens):
+            raise QuerySyntaxError('unbalanced parentheses')
+        return clause
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def _boolean(self):
+        clauses = []
+        while True:
+            kind, value = self._peek()
+            if kind is None or kind == 'close':
+                break
+            conjunction = modifier = None
+            if kind == 'term' and value in self.conjunctions:
+                if not clauses:
+                    raise QuerySyntaxError('misplaced %s' % value)
+                conjunction = self.conjunctions[value]
+                self.pos += 1
+                kind, value = self._peek()
+            if kind == 'term' and value in self.modifiers:
+                modifier = self.modifiers[value]
+                self.pos += 1
+            elif kind == 'term' and value[0] in '+-!' and len(value) > 1:
+                modifier = self.modifiers[value[0]]
+                self.tokens[self.pos] = (kind, value[1:])
+            clause = self._primary()
+
+            # as for lucene: AND requires the previous clause, and OR makes
+            # it optional when terms are required by default
+            if clauses and clauses[-1][0] != MUST_NOT:
+                if conjunction == 'AND':
+                    clauses[-1] = (MUST, clauses[-1][1])
+                elif conjunction == 'OR' and self.default == MUST:
+                    clauses[-1] = (SHOULD, clauses[-1][1])
+            if modifier == '-':
+                occur = MUST_NOT
+            elif modifier == '+' or conjunction == 'AND':
+                occur = MUST
+            elif conjunction == 'OR':
+                occur = SHOULD
+            else:
+                occur = self.default
+            clauses.append((occur, clause))
+        if not clauses:
+            raise QuerySyntaxError('missing search term')
+        return ('bool', clauses)
+
+    def _primary(self):
+        kind, value = self._peek()
+        if kind is None or kind == 'close':
+            raise QuerySyntaxError('missing search term')
+        self.pos += 1
+        if kind == 'open':
+            clause = self._boolean()
+            if self._peek()[0] != 'close':
+                raise QuerySyntaxError('unbalanced parentheses')
+            self.pos += 1
+            return clause
+        if kind == 'phrase':
+            return ('phrase', value[1:-1])
+        if value in self.conjunctions or value in self.modifiers:
+            raise QuerySyntaxError('misplaced %s' % value)
+        # strip any field prefix, boost, or fuzzy modifier
+        return ('term', re.sub(r'[~^][\d.]*$', '', value.split(':')[-1]))
+
+
+def parse(query, default_operator='or'):
+    '''Parse a Lucene query to a boolean clause.
+
+    :param query: query string
+    :param default_operator: operator for terms without AND, OR, or a
+        +/- modifier; ``or`` (the Lucene and eXist default) or ``and``
+    :returns: ``('bool', [(occur, clause), ...])``
+    :raises QuerySyntaxError: if the query could not be parsed
+    '''
+    return _Parser(query, default_operator).parse()
@@ -0,0 +1,96 @@
+# file findingaids/fa/management/commands/catalog.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from eulexistdb.db import ExistDBException
+
+from findingaids.fa.models import FindingAid, CatalogEntry
+
+
+class Command(BaseCommand):
+    """Rebuild the catalog of finding aid metadata stored in the relational
+database from the documents in the configured public and preview eXist
+collections, or (with --check) report any differences between the catalog
+and eXist without changing anything.  Views only use the catalog for a
+collection once it has an entry for every document."""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', default=False,
+            help='Report differences between the catalog and eXist without updating')
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])    # 1 = normal, 0 = minimal, 2 = all
+        v_normal = 1
+
+        start_time = datetime.now()
+        differences = 0
+        for collection in [settings.EXISTDB_ROOT_COLLECTION,
+                           settings.EXISTDB_PREVIEW_COLLECTION]:
+            try:
+                findingaids = FindingAid.objects.only('eadid', 'hash', 'last_modified') \
+                                                .using(collection)
+                in_exist = dict((ead.eadid.value, ead) for ead in findingaids)
+            except ExistDBException as err:
+                raise CommandError('Error retrieving finding aids from %s: %s' %
+                                   (collection, err.message()))
+
+            entries = dict((entry.eadid, entry) for entry in
+                           CatalogEntry.objects.filter(collection=collection))
+            missing = sorted(set(in_exist) - set(entries))
+            extra = sorted(set(entries) - set(in_exist))
+            changed = sorted(eadid for eadid in set(in_exist) & set(entries)
+                             if in_exist[eadid].hash != entries[eadid].hash or
+                             in_exist[eadid].last_modified != entries[eadid].last_modified)
+
+            if options['check']:
+                for label, eadids in [('Missing from catalog', missing),
+                                      ('Not in eXist', extra),
+                                      ('Changed in eXist', changed)]:
+                    for eadid in eadids:
+                        print "%s: %s (%s)" % (label, eadid, collection)
+                differences += len(missing) + len(extra) + len(changed)
+                if verbosity >= v_normal:
+                    print "%s: %d document%s in eXist, %d catalog entr%s" % \
+                        (collection, len(in_exist), 's' if len(in_exist) != 1 else '',
+                         len(entries), 'ies' if len(entries) != 1 else 'y')
+                continue
+
+            # update everything, since archive and title may have changed
+            # even when the document has not
+            try:
+                updated = CatalogEntry.update(in_exist.keys(), collection)
+            except ExistDBException as err:
+                raise CommandError('Error retrieving finding aids from %s: %s' %
+                                   (collection, err.message()))
+            CatalogEntry.objects.filter(collection=collection, eadid__in=extra).delete()
+            CatalogEntry.clear_complete(collection)
+            if verbosity > v_normal:
+                for eadid in extra:
+                    print "Removed %s (%s)" % (eadid, collection)
+            print "%s: %d catalog entr%s updated, %d removed" % \
+                (collection, len(updated), 'ies' if len(updated) != 1 else 'y',
+                 len(extra))
+
+        if options['check']:
+            print "%d difference%s found" % (differences, 's' if differences != 1 else '')
+
+        if verbosity >= v_normal:
+            print "Ran for %s" % str(datetime.now() - start_time)
@@ -0,0 +1,132 @@
+# file findingaids/fa/management/commands/exist_query_stats.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from collections import defaultdict
+import gzip
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from findingaids.exist_middleware import LOG_PREFIX
+from findingaids.fa.benchmark import percentile
+
+# histogram buckets: (exclusive upper bound, label)
+QUERY_BUCKETS = [(1, '0'), (2, '1'), (3, '2'), (6, '3-5'), (11, '6-10'),
+                 (21, '11-20'), (None, '>20')]
+TIME_BUCKETS = [(10, '<10ms'), (50, '<50ms'), (100, '<100ms'), (250, '<250ms'),
+                (500, '<500ms'), (1000, '<1s'), (5000, '<5s'), (None, '>=5s')]
+
+
+class Command(BaseCommand):
+    """Summarize eXist queries per view from the structured log lines
+written by :class:`~findingaids.exist_middleware.ExistQueryTimingMiddleware`.
+For each view, reports the number of requests, eXist queries and XML-RPC
+calls per request, percentiles of time spent in eXist, histograms of query
+counts and eXist time, and the slowest request (with its slowest query, when
+it was logged at DEBUG level).  Views are listed by total
+time spent in eXist.  Views that make many queries for every request are
+likely to be running a query per item."""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('logfiles', nargs='+', metavar='LOGFILE',
+            help='Log files to summarize (may be gzipped)')
+        parser.add_argument('--view', dest='views', action='append',
+            help='Only report on the specified view (may be repeated)')
+        parser.add_argument('--min-requests', type=int, default=1,
+            help='Skip views with fewer requests than this (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        requests = defaultdict(list)
+        for logfile in options['logfiles']:
+            try:
+                for data in read_log(logfile):
+                    view = data.get('view') or '(no view)'
+                    if options['views'] and view not in options['views']:
+                        continue
+                    requests[view].append(data)
+            except IOError as err:
+                raise CommandError('Error reading %s: %s' % (logfile, err))
+
+        if not requests:
+            print "No eXist query log lines found"
+            return
+
+        totals = dict((view, sum(r['exist_ms'] for r in reqs))
+                      for view, reqs in requests.iteritems())
+        for view in sorted(requests, key=totals.get, reverse=True):
+            reqs = requests[view]
+            if len(reqs) < options['min_requests']:
+                continue
+            query_counts = [r['queries'] + r['xmlrpc'] for r in reqs]
+            exist_times = sorted(r['exist_ms'] for r in reqs)
+            slowest = max(reqs, key=lambda r: r['slowest_ms'])
+
+            print view
+            print "  %d request%s, %.1f eXist queries/request (max %d), including %d XML-RPC calls" % \
+                (len(reqs), 's' if len(reqs) != 1 else '',
+                 float(sum(query_counts)) / len(reqs), max(query_counts),
+                 sum(r['xmlrpc'] for r in reqs))
+            print "  eXist time: total %.1fms, p50 %.1fms, p95 %.1fms, p99 %.1fms, max %.1fms" % \
+                (totals[view], percentile(exist_times, 50), percentile(exist_times, 95),
+                 percentile(exist_times, 99), exist_times[-1])
+            print "  queries/request: %s" % histogram(query_counts, QUERY_BUCKETS)
+            print "  eXist time/request: %s" % histogram(exist_times, TIME_BUCKETS)
+            # query text is only logged at DEBUG level
+            if slowest.get('slowest'):
+                print "  slowest (%.1fms, %s): %s" % \
+                    (slowest['slowest_ms'], slowest['path'], slowest['slowest'])
+            else:
+                print "  slowest: %.1fms, %s" % (slowest['slowest_ms'], slowest['path'])
+            print
+
+
+def read_log(filename):
+    '''Generator for the request stats logged in a log file, as
+    dictionaries.'''
+    if filename.endswith('.gz'):
+        logfile = gzip.open(filename, 'rb')
+    else:
+        logfile = open(filename)
+    marker = '%s {' % LOG_PREFIX
+    try:
+        for line in logfile:
+            index = line.find(marker)
+            if index == -1:
+                continue
+            try:
+                yield json.loads(line[index + len(LOG_PREFIX):])
+            except ValueError:
+                # truncated or interleaved line
+                continue
+    finally:
+        logfile.close()
+
+
+def histogram(values, buckets):
+    '''Count values by bucket, as a display string.
+
+    :param buckets: list of (exclusive upper bound, label) tuples in
+        ascending order; the last upper bound should be None
+    '''
+    counts = [0] * len(buckets)
+    for value in values:
+        for i, (bound, label) in enumerate(buckets):
+            if bound is None or value < bound:
+                counts[i] += 1
+                break
+    return ' '.join('%s:%d' % (label, count)
+                    for (bound, label), count in zip(buckets, counts))
@@ -0,0 +1,67 @@
+# file findingaids/fa/management/commands/facet_index.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from eulexistdb.db import ExistDBException
+
+from findingaids.fa import cachekeys
+from findingaids.fa.facets import FACET_FIELDS, update_facets
+from findingaids.fa.models import FindingAid, FacetRecord
+
+
+class Command(BaseCommand):
+    """Build or update stored search facet values (repository, digital
+content, and subjects) for the finding aids published in the configured
+eXist collection.  Facet values for documents that are no longer published
+are removed.  Search facets are only displayed once every published
+document has stored facet values."""
+    help = __doc__
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])    # 1 = normal, 0 = minimal, 2 = all
+        v_normal = 1
+
+        start_time = datetime.now()
+        try:
+            findingaids = FindingAid.objects.only(*FACET_FIELDS)
+            eadids = set()
+            for ead in findingaids:
+                update_facets(ead)
+                eadids.add(ead.eadid.value)
+                if verbosity > v_normal:
+                    print "Updated %s" % ead.eadid.value
+        except ExistDBException as err:
+            raise CommandError('Error retrieving finding aids from eXist: %s' % err.message())
+
+        removed = FacetRecord.objects.exclude(eadid__in=eadids)
+        if verbosity > v_normal:
+            for record in removed:
+                print "Removed %s" % record.eadid
+        removed_count = removed.count()
+        removed.delete()
+        # stored facets are loaded once per collection generation
+        cachekeys.invalidate_collection()
+
+        print "Facet values stored for %d document%s" % \
+            (len(eadids), 's' if len(eadids) != 1 else '')
+        if removed_count:
+            print "Removed %d document%s no longer published" % \
+                (removed_count, 's' if removed_count != 1 else '')
+        if verbosity >= v_normal:
+            print "Ran for %s" % str(datetime.now() - start_time)
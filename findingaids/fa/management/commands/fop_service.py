@@ -0,0 +1,99 @@
+# file findingaids/fa/management/commands/fop_service.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import SocketServer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from findingaids.fa.fop import FopPool, FopError
+
+
+class FopRequestHandler(SocketServer.StreamRequestHandler):
+    # one job per connection: xsl-fo and pdf paths separated by a tab
+
+    def handle(self):
+        line = self.rfile.readline().strip()
+        try:
+            fo_filename, pdf_filename = line.split('\t')
+        except ValueError:
+            self.wfile.write('ERROR invalid request\n')
+            return
+        try:
+            self.server.pool.render(fo_filename, pdf_filename)
+            self.wfile.write('OK\n')
+        except FopError, e:
+            self.wfile.write('ERROR %s\n' % e)
+
+
+class FopServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool):
+        self.pool = pool
+        SocketServer.UnixStreamServer.__init__(self, socket_path, FopRequestHandler)
+
+
+class Command(BaseCommand):
+    """Run a shared XSL-FO to PDF rendering service, listening for
+conversion requests on a unix socket.  Web and celery processes configured
+with the same **XSLFO_SERVICE_SOCKET** will send PDF conversions to this
+service, so that the number of simultaneous conversions (and, when
+**XSLFO_WORKER_COMMAND** is configured, the number of long-running FOP
+processes) is bounded by **XSLFO_WORKERS** for the whole server.
+
+The service must run as a user that can read and write the temporary
+files created by the processes using it."""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket',
+            dest='socket',
+            default=getattr(settings, 'XSLFO_SERVICE_SOCKET', None),
+            help='Path of the unix socket to listen on (default: XSLFO_SERVICE_SOCKET setting)')
+        parser.add_argument('--workers', '-w',
+            type=int,
+            dest='workers',
+            help='Number of workers (default: XSLFO_WORKERS setting)')
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])    # 1 = normal, 0 = minimal, 2 = all
+        v_normal = 1
+
+        socket_path = options['socket']
+        if not socket_path:
+            raise CommandError("No socket specified and XSLFO_SERVICE_SOCKET setting is missing")
+        # remove socket left behind by a previous run
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        pool = FopPool(workers=options['workers'])
+        server = FopServer(socket_path, pool)
+        if verbosity >= v_normal:
+            print "XSL-FO service listening on %s with %d worker%s" % \
+                (socket_path, len(pool.threads), 's' if len(pool.threads) != 1 else '')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+            pool.shutdown()
+            if verbosity >= v_normal:
+                print "%(completed)d completed, %(failed)d failed, %(timeout)d timed out, " \
+                    "%(rejected)d rejected" % pool.stats
@@ -0,0 +1,96 @@
+# file findingaids/fa/management/commands/format_times.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from eulxml import xmlmap
+from eulxml.xmlmap.eadmap import EAD_NAMESPACE
+from lxml import etree
+
+from findingaids.fa.templatetags.ead import format_ead, format_ead_rdfa, \
+    memoize_fragments, fragment_cache
+
+# EAD content displayed with the format_ead filters in the site templates
+FORMATTED_XPATH = '|'.join([
+    '//e:unittitle', '//e:head', '//e:p', '//e:abstract', '//e:note',
+    '//e:origination', '//e:controlaccess/e:*[not(self::e:head)]',
+])
+
+
+class Command(BaseCommand):
+    """Benchmark EAD to HTML conversion with the format_ead and
+format_ead_rdfa filters for local EAD files (e.g., the largest documents
+in the collection).  For each file, reports the time to format all of the
+content displayed on the site, without memoization and when repeated with
+memoized fragments."""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', metavar='FILE',
+            help='EAD xml files')
+        parser.add_argument('--repeat', '-r', type=int, default=3,
+            help='Number of times to format each document (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        if repeat < 1:
+            raise CommandError('Repeat must be at least 1')
+
+        totals = [timedelta(), timedelta()]
+        for filename in options['files']:
+            try:
+                ead = xmlmap.load_xmlobject_from_file(filename)
+            except (IOError, etree.XMLSyntaxError) as err:
+                raise CommandError('Error loading %s: %s' % (filename, err))
+
+            nodes = [xmlmap.XmlObject(node) for node in
+                     ead.node.xpath(FORMATTED_XPATH, namespaces={'e': EAD_NAMESPACE})]
+
+            # without memoization
+            fragment_cache.clear()
+            start_time = datetime.now()
+            for i in range(repeat):
+                format_nodes(nodes)
+            unmemoized = datetime.now() - start_time
+
+            # memoized: the first pass formats and stores every fragment
+            # (with a cache size large enough for the whole document)
+            with override_settings(EAD_FRAGMENT_CACHE_SIZE=len(nodes) * 2):
+                fragment_cache.clear()
+                start_time = datetime.now()
+                with memoize_fragments(ead, filename):
+                    for i in range(repeat):
+                        format_nodes(nodes)
+                memoized = datetime.now() - start_time
+                fragment_cache.clear()
+
+            totals[0] += unmemoized
+            totals[1] += memoized
+            print "%s: %d fragments, %s unmemoized, %s memoized" % \
+                (filename, len(nodes), unmemoized / repeat, memoized / repeat)
+
+        if len(options['files']) > 1:
+            print "Total: %s unmemoized, %s memoized" % \
+                (totals[0] / repeat, totals[1] / repeat)
+
+
+def format_nodes(nodes):
+    # format nodes as html and as rdfa, as they are displayed on the site
+    for node in nodes:
+        format_ead(node, autoescape=True)
+        format_ead_rdfa(node, autoescape=True)
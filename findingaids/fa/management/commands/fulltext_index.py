@@ -0,0 +1,86 @@
+# file findingaids/fa/management/commands/fulltext_index.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from eulexistdb.db import ExistDBException
+
+from findingaids.fa.fulltext import search_index
+from findingaids.fa.models import FindingAid
+from findingaids.fa.utils import get_findingaid
+
+
+class Command(BaseCommand):
+    """Build or update the local full-text search index from the finding aids
+published in the configured eXist collection.  If any eadids are specified,
+only those documents are indexed; otherwise, all published documents are
+indexed, and any documents no longer published are removed from the index.
+
+Requires FULLTEXT_SEARCH_INDEX to be configured."""
+    help = __doc__
+
+    args = '[<eadid eadid ... >]'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear', '-c',
+            action='store_true',
+            dest='clear',
+            help='Remove everything from the index before indexing')
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])    # 1 = normal, 0 = minimal, 2 = all
+        v_normal = 1
+
+        index = search_index()
+        if index is None:
+            raise CommandError('FULLTEXT_SEARCH_INDEX is not configured')
+
+        start_time = datetime.now()
+        if options['clear']:
+            index.clear()
+
+        try:
+            if args:
+                eadids = list(args)
+            else:
+                eadids = [fa.eadid.value for fa in FindingAid.objects.only('eadid')]
+                removed = index.eadids() - set(eadids)
+                for eadid in removed:
+                    index.remove_findingaid(eadid)
+                    if verbosity > v_normal:
+                        print "Removed %s" % eadid
+        except ExistDBException as err:
+            raise CommandError('Error retrieving finding aids from eXist: %s' % err.message())
+
+        indexed = 0
+        errored = 0
+        for eadid in eadids:
+            try:
+                index.index_findingaid(get_findingaid(eadid))
+                indexed += 1
+                if verbosity > v_normal:
+                    print "Indexed %s" % eadid
+            except Exception as err:
+                errored += 1
+                print "Error: failed to index %s: %s" % (eadid, err)
+
+        print "%d document%s indexed" % (indexed, 's' if indexed != 1 else '')
+        if errored:
+            print "%d document%s with errors" % (errored, 's' if errored != 1 else '')
+        if verbosity >= v_normal:
+            print "Ran for %s" % str(datetime.now() - start_time)
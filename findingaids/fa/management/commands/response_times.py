@@ -14,235 +14,153 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from datetime import datetime, timedelta
-from optparse import make_option
+import json
 
-from django.core.management.base import BaseCommand
-from django.core.urlresolvers import reverse
-from django.test import Client
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
 
-from findingaids.fa.models import FindingAid, title_letters
-from findingaids.fa.views import fa_listfields
+from eulexistdb.db import ExistDBException
 
-class Command(BaseCommand):
-    """
-    Benchmark response times for running queries against the configured eXist
-    database, and warn if any take longer than the current threshold of 5 seconds.
-
-    In browse mode, tests eXist Finding Aid browse query for all browse letters.
+from findingaids import existpool
+from findingaids.fa import benchmark
 
-    In pages mode, tests a few pre-specified page urls.
 
+class Command(BaseCommand):
+    """
+    Benchmark page response times for the configured site and eXist database.
+
+    Scenarios cover browse pages, searches, and the finding aid, series,
+    single-document search, EAD xml, PDF, and sitemap pages for a sample
+    of documents.  Each url is requested --warmup times before timing, and
+    then timed --iterations times from --concurrency threads, in process
+    (with the Django test client) or against a running site (--url).
+    Reports p50/p95/p99 response times and, when the eXist query timing
+    middleware is enabled, time spent in eXist (for a running site, only
+    if it has **EXISTDB_SERVER_TIMING** enabled).
+
+    Results can be written as JSON (--output) and compared to a stored
+    baseline (--baseline); the command exits with an error if any scenario
+    is slower than the baseline by more than --threshold percent, has no
+    successful requests, or has more errors than the baseline.
     """
     help = __doc__
 
-    modes = ['browse', 'search', 'pages']
-
     def add_arguments(self, parser):
-        parser.add_argument('mode', choices=self.modes)
-
-        parser.add_argument('--pages', '-p',
-            action='store_true',
-            dest='pages_only',
-            help='Only test page load times')
-        parser.add_argument('--xqueries', '-q',
-            action='store_true',
-            dest='xquery_only',
-            help='Only test xquery times')
-
-
-    threshold = 5000
-    "warning-level threshold, in ms (queries that take longer than this will generate warnings)"
-    timedelta_threshold = timedelta(milliseconds=threshold)
-
-    # sample searches to use for testing search response times
-    test_searches = (
-        'African American*',
-        '(Oral histor*) AND Atlanta',
-        'World War I',
-        '''Flannery O'Connor''',
-        'Segregat* +Georgia',
-        '"New York Times" AND journalis*',
-        'belfast group',
-    )
-
-    test_pages = (
-        '/documents/longley744/',
-        '/documents/longley744/series1/',
-        '/documents/longley744/series8/',
-        '/documents/longley744/index1/',
-        '/documents/longley744/items/?keywords=belfast+group'
-        '/documents/ormsby805/',
-        '/documents/ormsby805/series1/',
-        '/documents/ormsby805/items/?keywords=belfast+group',
-    )
-
-    def handle(self, mode, *args, **options):
+        parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+            help='Scenarios to run (default: all): %s' %
+                 ', '.join(benchmark.SCENARIOS.keys()))
+        parser.add_argument('--warmup', type=int, default=1,
+            help='Untimed requests per url before timing (default: %(default)s)')
+        parser.add_argument('--iterations', '-i', type=int, default=5,
+            help='Timed requests per url (default: %(default)s)')
+        parser.add_argument('--concurrency', '-c', type=int, default=1,
+            help='Number of threads making requests (default: %(default)s)')
+        parser.add_argument('--documents', '-d', type=int, default=3,
+            help='Number of documents for single-document scenarios (default: %(default)s)')
+        parser.add_argument('--eadid', dest='eadids', action='append',
+            help='Use the specified document for single-document scenarios (may be repeated)')
+        parser.add_argument('--url',
+            help='Base url of a running site to benchmark, instead of running in process')
+        parser.add_argument('--output', '-o',
+            help='Write results to the specified file as JSON')
+        parser.add_argument('--baseline', '-b',
+            help='Compare results with a JSON results file')
+        parser.add_argument('--threshold', '-t', type=float, default=20,
+            help='Allowed slowdown from the baseline, as a percentage (default: %(default)s)')
+        parser.add_argument('--stat', choices=['p50', 'p95', 'p99'], default='p95',
+            help='Response time statistic to compare with the baseline (default: %(default)s)')
+
+    def handle(self, *args, **options):
         verbosity = int(options['verbosity'])    # 1 = normal, 0 = minimal, 2 = all
         v_normal = 1
         v_all = 2
 
-        # if cmd not in self._args:
-        #     print "Command '%s' not recognized\n" % cmd
-        #     print self.help
-        #     return
-
-
-        # BROWSE
-        if mode == 'browse':
-            first_letters = title_letters()
-
-            if not options['pages_only']:
-                # get eXist query times without page load
-                if verbosity == v_all:
-                    print 'Testing response times for browse xqueries'
-
-                query_times = {}
-                # eXist query times only (without page rendering / content returned)
-                for letter in first_letters:
-                    # same query used in browse view
-                    fa = FindingAid.objects.filter(list_title__startswith=letter).order_by('list_title').only(*fa_listfields)
-                    time, total = fa.queryTime(), fa.count()
-                    query_times[letter] = time
-                    if verbosity >= v_normal:
-                        print '%s : %dms, %d records' % (letter, time, total)
-                    if fa.queryTime() > self.threshold:
-                        print "Warning: query for %s took %dms and returned %d records" % \
-                            (letter, time, total)
-
-                max_min_avg(query_times.values())
-
-            if not options['xquery_only']:
-                if verbosity == v_all:
-                    print 'Testing response times for browse pages'
-
-                client = Client()
-                query_times = {}
-                for letter in first_letters:
-                    current_times = {}  # times for the current letter
-                    uri = reverse('fa:titles-by-letter', kwargs={'letter': letter})
-                    if verbosity == v_all:
-                        print letter
-                    for page in range(1, 11):
-                        start_time = datetime.now()
-                        response = client.get(uri, {'page': page})
-                        end_time = datetime.now()
-                        if response.status_code == 200:
-                            duration = end_time - start_time
-                            current_times['%s %d' % (letter, page)] = duration
-                            if duration > self.timedelta_threshold:
-                                print "Warning: page load for page %d of %s (%s) took %s" % \
-                                    (page, letter, uri, duration)
-                            if verbosity == v_all:
-                                print "  page %d : %s" % (page, duration)
-
-                    if verbosity >= v_normal and len(current_times) > 1:
-                        # summarize times for current letter
-                        print "\nMax/Min/Average for %s (all pages)" % letter
-                        max_min_avg(current_times.values(), zero=timedelta())
-                    # add times for current letter to all query times
-                    query_times.update(current_times)
-
-                print "\nMax/Min/Average - all letters, all pages"
-                max_min_avg(query_times.values(), zero=timedelta())
-
-        # SEARCH
-        elif mode == 'search':
-            client = Client()
-            query_times = {}
-
-            if not options['pages_only']:
-                # get eXist query times without page load
-                if verbosity == v_all:
-                    print 'Testing response times for search xqueries'
-                for search_terms in self.test_searches:
-                    # NOTE: search syntax duplicated from search view
-                    search_fields = fa_listfields
-                    search_fields.append('fulltext_score')
-                    fa = FindingAid.objects.filter(fulltext_terms=search_terms).or_filter(
-                        fulltext_terms=search_terms,
-                        boostfields__fulltext_terms=search_terms,
-                    ).order_by('-fulltext_score').only(*search_fields)
-
-                    time, total = fa.queryTime(), fa.count()
-                    query_times[search_terms] = time
-                    if verbosity >= v_normal:
-                        print '%s : %dms, %d records' % (search_terms, time, total)
-                    if fa.queryTime() > self.threshold:
-                        print "Warning: query for %s took %dms and returned %d records" % \
-                            (letter, time, total)
-
-                print "\nMax/Min/Average - search queries, eXist response time"
-                max_min_avg(query_times.values())
-
-            if not options['xquery_only']:
-                if verbosity == v_all:
-                    print 'Testing response times for search pages'
-
-                query_times = {}
-                for search_terms in self.test_searches:
-                    current_times = {}  # times for the current search
-                    uri = reverse('fa:search')
-                    if verbosity == v_all:
-                        print search_terms
-                    for page in range(1,11):
-                        start_time = datetime.now()
-                        response = client.get(uri, {'page': page, 'keywords': search_terms})
-                        end_time = datetime.now()
-                        if response.status_code == 200:
-                            duration = end_time - start_time
-                            current_times['%s %d' % (search_terms, page)] = duration
-                            if duration > self.timedelta_threshold:
-                                print "Warning: page load for page %d of %s (%s) took %s" % \
-                                    (page, search_terms, uri, duration)
-                            if verbosity == v_all:
-                                print "  page %d : %s" % (page, duration)
-
-
-                    # summarize times for current search
-                    print "\nMax/Min/Average for %s (all pages)" % search_terms
-                    max_min_avg(current_times.values(), zero=timedelta())
-                    # add times for current letter to all query times
-                    query_times.update(current_times)
-
-                print "\nMax/Min/Average - all letters, all pages"
-                max_min_avg(query_times.values(), zero=timedelta())
-
-        # PAGES
-        elif mode == 'pages':
-            client = Client()
-            query_times = {}
-
-            if verbosity == v_all:
-                print 'Testing response times for pre-specified pages'
-
-            query_times = {}
-            for uri in self.test_pages:
-                start_time = datetime.now()
-                response = client.get(uri)
-                end_time = datetime.now()
-                if response.status_code == 200:
-                    duration = end_time - start_time
-                    query_times[uri] = duration
-                    if duration > self.timedelta_threshold:
-                        print "Warning: page load for %s took %s" % \
-                            (uri, duration)
-                    if verbosity == v_all:
-                        print "%s : %s" % (uri, duration)
-
-            print "\nMax/Min/Average - all letters, all pages"
-            max_min_avg(query_times.values(), zero=timedelta())
-
-
-def max_min_avg(times, zero=0):
-    if not times:
-        return
-    # calculate and display max/min/average
-    maximum = max(times)
-    minimum = min(times)
-    total = sum(times, zero)
-    avg = total / len(times)
-
-    print "Longest time: %s" % maximum
-    print "Shortest time: %s" % minimum
-    print "Average time: %s\n" % avg
\ No newline at end of file
+        scenarios = options['scenarios'] or benchmark.SCENARIOS.keys()
+        unknown = [name for name in scenarios if name not in benchmark.SCENARIOS]
+        if unknown:
+            raise CommandError('Unknown scenario%s: %s' %
+                               ('s' if len(unknown) != 1 else '', ', '.join(unknown)))
+        if options['iterations'] < 1 or options['concurrency'] < 1:
+            raise CommandError('Iterations and concurrency must be at least 1')
+
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline']) as baseline_file:
+                    baseline = json.load(baseline_file)
+            except (IOError, ValueError) as err:
+                raise CommandError('Error loading baseline %s: %s' % (options['baseline'], err))
+
+        if options['url']:
+            fetcher = benchmark.HttpFetcher(options['url'])
+        else:
+            # use the configured site domain, which should be an allowed host
+            fetcher = benchmark.ClientFetcher(HTTP_HOST=Site.objects.get_current().domain)
+            # eXist time is read from the Server-Timing header
+            settings.EXISTDB_SERVER_TIMING = True
+
+        try:
+            eadids = options['eadids'] or benchmark.sample_eadids(options['documents'])
+        except ExistDBException as err:
+            raise CommandError('Error retrieving finding aids from eXist: %s' % err.message())
+
+        def progress(name, result):
+            if verbosity >= v_normal:
+                print_result(name, result, verbose=verbosity >= v_all)
+
+        try:
+            results = benchmark.run(scenarios, fetcher, eadids, warmup=options['warmup'],
+                                    iterations=options['iterations'],
+                                    concurrency=options['concurrency'], progress=progress)
+        except ExistDBException as err:
+            raise CommandError('Error retrieving urls from eXist: %s' % err.message())
+
+        # connection pool usage is only meaningful for in-process runs
+        pools = existpool.metrics() if not options['url'] else {}
+        if pools:
+            results['exist_pool'] = pools
+            if verbosity >= v_normal:
+                for url, metrics in pools.iteritems():
+                    print_pool(url, metrics)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+            if verbosity >= v_normal:
+                print "Results written to %s" % options['output']
+
+        if baseline is not None:
+            regressions = benchmark.compare(results, baseline, options['threshold'],
+                                            options['stat'])
+            if regressions:
+                raise CommandError('Regressions from baseline: %s' % '; '.join(
+                    '%s %s' % (name, description) for name, description in regressions))
+            if verbosity >= v_normal:
+                print "No scenarios more than %s%% slower than baseline or with more errors" % \
+                    options['threshold']
+
+
+def print_result(name, result, verbose=False):
+    if not result['requests']:
+        print "%s: no successful requests (%d errors)" % (name, result['errors'])
+    else:
+        print "%s: %d requests (%d urls), p50 %.1fms, p95 %.1fms, p99 %.1fms, max %.1fms, %.1f requests/s" % \
+            (name, result['requests'], result['urls'], result['p50'], result['p95'],
+             result['p99'], result['max'], result['throughput'])
+        if 'exist_p50' in result:
+            print "  eXist: p50 %.1fms, p95 %.1fms, %.1f queries/request" % \
+                (result['exist_p50'], result['exist_p95'], result['exist_queries'])
+        if result['errors']:
+            print "  %d errors" % result['errors']
+    if verbose:
+        for error in result['error_details']:
+            print "  %s" % error
+
+
+def print_pool(url, metrics):
+    print "eXist connection pool (%s): %d connections created, %d of %d checkouts reused" % \
+        (url, metrics['created'], metrics['reused'], metrics['checkouts'])
+    print "  %d waits (%.1fms), %d timeouts, %d closed, %d failed health checks" % \
+        (metrics['waits'], metrics['wait_ms'], metrics['timeouts'], metrics['closed'],
+         metrics['failed_health_checks'])
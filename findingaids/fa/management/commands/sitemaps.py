@@ -0,0 +1,76 @@
+# file findingaids/fa/management/commands/sitemaps.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from eulexistdb.db import ExistDBException
+
+from findingaids.fa import sitemapstore
+from findingaids.fa.models import FindingAid, SitemapEntry
+
+
+class Command(BaseCommand):
+    """Rebuild stored sitemap entries for all published finding aids and
+write the sitemap files to the directory configured as **SITEMAP_STORE**.
+Entries for documents that are no longer published are removed.  Once the
+command has been run for all documents, the files are updated when
+documents are published, loaded, or deleted, and sitemap requests are
+served from them; before that, updating specific documents only updates
+their stored entries."""
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('eadids', nargs='*', metavar='EADID',
+            help='Only update entries for the specified documents')
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])    # 1 = normal, 0 = minimal, 2 = all
+        v_normal = 1
+
+        if sitemapstore.sitemap_store() is None:
+            raise CommandError('Sitemap storage is not configured (SITEMAP_STORE)')
+
+        start_time = datetime.now()
+        eadids = options['eadids']
+        try:
+            if not eadids:
+                eadids = [ead.eadid.value for ead in FindingAid.objects.only('eadid')]
+                removed = SitemapEntry.objects.exclude(eadid__in=eadids)
+                if verbosity > v_normal:
+                    for eadid in removed.values_list('eadid', flat=True).distinct():
+                        print "Removed %s" % eadid
+                removed.delete()
+            changed = sitemapstore.update_documents(eadids)
+        except ExistDBException as err:
+            raise CommandError('Error retrieving finding aids from eXist: %s' % err.message())
+
+        if not options['eadids']:
+            sitemapstore.write_sitemaps()
+            sitemapstore.mark_built()
+        elif sitemapstore.is_built():
+            sitemapstore.write_sitemaps(changed)
+        elif verbosity >= v_normal:
+            print "Sitemap files not written; run without eadids to build all entries first"
+
+        if verbosity > v_normal:
+            for section in sorted(changed):
+                print "Updated %s" % section
+        print "Sitemap entries updated for %d document%s" % \
+            (len(eadids), 's' if len(eadids) != 1 else '')
+        if verbosity >= v_normal:
+            print "Ran for %s" % str(datetime.now() - start_time)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 13:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fa', '0002_archive_contacts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collection', models.CharField(help_text=b'eXist collection path', max_length=255, unique=True)),
+                ('last_modified', models.DateTimeField(blank=True, help_text=b'Most recent document modification or deletion', null=True)),
+                ('generation', models.PositiveIntegerField(default=0, help_text=b'Incremented every time the collection changes')),
+                ('count', models.PositiveIntegerField(default=0, help_text=b'Number of documents in the collection')),
+            ],
+            options={
+                'verbose_name': 'Collection State',
+            },
+        ),
+    ]
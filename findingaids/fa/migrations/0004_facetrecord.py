@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 13:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fa', '0003_collectionstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('eadid', models.CharField(max_length=50, unique=True, verbose_name=b'EAD Identifier')),
+                ('repositories', models.TextField(blank=True, help_text=b'Normalized repository names, one per line')),
+                ('subjects', models.TextField(blank=True, help_text=b'Normalized controlaccess terms, one per line')),
+                ('dao_count', models.PositiveIntegerField(default=0, help_text=b'Number of digital archival objects, public or internal')),
+                ('public_dao_count', models.PositiveIntegerField(default=0, help_text=b'Number of public digital archival objects')),
+            ],
+            options={
+                'verbose_name': 'Facet Record',
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 13:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fa', '0004_facetrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collection', models.CharField(help_text=b'eXist collection path', max_length=255)),
+                ('eadid', models.CharField(max_length=50, verbose_name=b'EAD Identifier')),
+                ('document_name', models.CharField(max_length=255)),
+                ('list_title', models.TextField(blank=True)),
+                ('first_letter', models.CharField(blank=True, db_index=True, max_length=1)),
+                ('repository', models.CharField(blank=True, help_text=b'Normalized repository name (subarea)', max_length=255)),
+                ('public_dao_count', models.PositiveIntegerField(default=0)),
+                ('hash', models.CharField(blank=True, help_text=b'SHA-1 hash of the document in eXist', max_length=40)),
+                ('last_modified', models.DateTimeField(blank=True, null=True)),
+                ('archive', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='fa.Archive')),
+            ],
+            options={
+                'verbose_name': 'Catalog Entry',
+                'verbose_name_plural': 'Catalog Entries',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='catalogentry',
+            unique_together=set([('collection', 'eadid')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 13:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fa', '0005_catalogentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SitemapEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('section', models.CharField(help_text=b'Sitemap section, e.g. findingaids-series', max_length=50)),
+                ('eadid', models.CharField(db_index=True, max_length=50, verbose_name=b'EAD Identifier')),
+                ('location', models.CharField(help_text=b'Site-relative url', max_length=255)),
+                ('lastmod', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Sitemap Entry',
+                'verbose_name_plural': 'Sitemap Entries',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='sitemapentry',
+            index_together=set([('section', 'location')]),
+        ),
+    ]
@@ -14,6 +14,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from collections import namedtuple
 from datetime import datetime
 import logging
 import os
@@ -22,13 +23,17 @@ from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 
 from eulxml import xmlmap
 from eulxml.xmlmap import eadmap
-from eulexistdb.manager import Manager
 from eulexistdb.models import XmlModel
 
+from findingaids.fa import cachekeys
+from findingaids.fa.querybatch import Manager
 from findingaids.utils import normalize_whitespace
 
 
@@ -226,6 +231,9 @@ class FindingAid(XmlModel, eadmap.EncodedArchivalDescription):
 
     origination_name = xmlmap.NodeField('e:archdesc/e:did/e:origination/e:*', Name)
     'origination name, as an instance of :class:`Name`'
+    #: all origination names, as text
+    origination_names = xmlmap.StringListField('e:archdesc/e:did/e:origination/e:*',
+                                               normalize=True)
 
     # dao anywhere in the ead, to allow filtering on finding aids with daos
     daos = xmlmap.NodeListField('.//e:dao', DigitalArchivalObject)
@@ -233,6 +241,15 @@ class FindingAid(XmlModel, eadmap.EncodedArchivalDescription):
     #: "public" is defined as audience external or not set, xlink:href present,
     #: and show not set to none.
     public_dao_count = xmlmap.IntegerField('count(.//e:dao[@xlink:href][not(@xlink:show="none")][not(@audience) or @audience="external"])')
+    #: count of all dao elements in a record, public or internal
+    dao_count = xmlmap.IntegerField('count(.//e:dao)')
+
+    #: controlaccess index terms (names, subjects, places, genres, etc.),
+    #: for subject facets
+    controlaccess_terms = xmlmap.StringListField('e:archdesc//e:controlaccess/*[' +
+        ' or '.join('self::e:%s' % term for term in ['corpname', 'famname', 'function',
+            'genreform', 'geogname', 'name', 'occupation', 'persname', 'subject', 'title']) +
+        ']', normalize=True)
 
     objects = Manager('/e:ead')
     """:class:`eulexistdb.manager.Manager` - similar to an object manager
@@ -416,13 +433,40 @@ class ListTitle(XmlModel):
 
 
 def title_letters():
-    """Cached list of distinct, sorted first letters present in all Finding Aid titles.
-    Cached results should be refreshed after half an hour."""
-    cache_key = 'browse-title-letters'
-    if cache.get(cache_key) is None:
-        letters = ListTitle.objects.only('first_letter').order_by('first_letter').distinct()
-        cache.set(cache_key, list(letters))  # use configured cache timeout
-    return cache.get(cache_key)
+    """Cached list of distinct, sorted first letters present in all Finding Aid
+    titles.  Cached until the collection changes (see
+    :mod:`findingaids.fa.cachekeys`)."""
+    cache_key = cachekeys.collection_key('browse-title-letters')
+    letters = cache.get(cache_key)
+    if letters is None:
+        letters = list(ListTitle.objects.only('first_letter').order_by('first_letter').distinct())
+        cache.set(cache_key, letters, cachekeys.timeout())
+    return letters
+
+
+TitleIndexEntry = namedtuple('TitleIndexEntry', ['list_title', 'eadid'])
+"Entry in the browse title index: list title and eadid for a single finding aid"
+
+
+def title_index(letter):
+    """Cached, sorted list of :class:`TitleIndexEntry` for all finding aids
+    with a list title starting with the specified letter, in browse order
+    (case-insensitive sort on list title).  Used to paginate and label
+    browse pages without querying eXist for every page boundary; cached
+    until the collection changes (see :mod:`findingaids.fa.cachekeys`).
+
+    :param letter: first letter of list title
+    :rtype: list
+    """
+    cache_key = cachekeys.collection_key('browse-title-index', letter)
+    index = cache.get(cache_key)
+    if index is None:
+        findingaids = FindingAid.objects.filter(list_title__startswith=letter) \
+                                        .order_by('~list_title').only('eadid', 'list_title')
+        index = [TitleIndexEntry(unicode(fa.list_title), fa.eadid.value)
+                 for fa in findingaids]
+        cache.set(cache_key, index, cachekeys.timeout())
+    return index
 
 
 class EadRepository(XmlModel):
@@ -432,13 +476,15 @@ class EadRepository(XmlModel):
 
     @staticmethod
     def distinct():
-        """Cached list of distinct owning repositories in all Finding Aids."""
-        cache_key = 'findingaid-repositories'
-        if cache.get(cache_key) is None:
+        """Cached list of distinct owning repositories in all Finding Aids.
+        Cached until the collection changes."""
+        cache_key = cachekeys.collection_key('findingaid-repositories')
+        repos = cache.get(cache_key)
+        if repos is None:
             # using normalized version because whitespace is inconsistent in this field
-            repos = EadRepository.objects.only('normalized').distinct()
-            cache.set(cache_key, list(repos))  # use configured default cache timeout
-        return cache.get(cache_key)
+            repos = list(EadRepository.objects.only('normalized').distinct())
+            cache.set(cache_key, repos, cachekeys.timeout())
+        return repos
 
 
 class LocalComponent(eadmap.Component):
@@ -935,3 +981,342 @@ class Archive(models.Model):
         return ', '.join([contact.get_full_name() or contact.email
                           for contact in self.contacts.all()])
     contact_names.short_description = "Contacts"
+
+
+class CollectionState(models.Model):
+    '''Summary of the current state of an eXist collection of finding aids:
+    most recent modification time, a generation number that is incremented
+    every time the collection changes, and the number of documents.  Updated
+    when documents are published, previewed, loaded, or deleted, so that
+    collection-wide views can generate Last-Modified and ETag headers
+    without querying eXist.'''
+    collection = models.CharField(max_length=255, unique=True,
+        help_text='eXist collection path')
+    last_modified = models.DateTimeField(null=True, blank=True,
+        help_text='Most recent document modification or deletion')
+    generation = models.PositiveIntegerField(default=0,
+        help_text='Incremented every time the collection changes')
+    count = models.PositiveIntegerField(default=0,
+        help_text='Number of documents in the collection')
+
+    class Meta:
+        verbose_name = 'Collection State'
+
+    def __unicode__(self):
+        return u'%s (generation %d)' % (self.collection, self.generation)
+
+    @classmethod
+    def current(cls, collection=None):
+        '''Get the state for a collection.  If no state has been recorded
+        yet, it is initialized from the documents in eXist and (for the
+        public collection) the most recently deleted record.
+
+        :param collection: eXist collection; defaults to the configured
+            public collection, **EXISTDB_ROOT_COLLECTION**
+        :rtype: :class:`CollectionState`
+        '''
+        if collection is None:
+            collection = settings.EXISTDB_ROOT_COLLECTION
+        try:
+            return cls.objects.get(collection=collection)
+        except cls.DoesNotExist:
+            pass
+
+        findingaids = FindingAid.objects.all().using(collection)
+        count = findingaids.count()
+        last_modified = None
+        if count:
+            last_modified = findingaids.order_by('-last_modified') \
+                                       .only('last_modified')[0].last_modified
+        if collection == settings.EXISTDB_ROOT_COLLECTION:
+            deleted = Deleted.objects.order_by('-date').first()
+            if deleted is not None and \
+                    (last_modified is None or deleted.date > last_modified):
+                last_modified = deleted.date
+        state, created = cls.objects.get_or_create(collection=collection,
+            defaults={'last_modified': last_modified, 'count': count})
+        return state
+
+    @classmethod
+    def update(cls, collection=None, modified=None):
+        '''Record a change to a collection: increment the generation,
+        update the last modification time, refresh the document count
+        from eXist, and invalidate all cached values derived from the
+        collection (see :mod:`findingaids.fa.cachekeys`).
+
+        :param collection: eXist collection; defaults to the configured
+            public collection, **EXISTDB_ROOT_COLLECTION**
+        :param modified: time of the change; defaults to now
+        :rtype: :class:`CollectionState`
+        '''
+        if collection is None:
+            collection = settings.EXISTDB_ROOT_COLLECTION
+        if modified is None:
+            modified = datetime.now()
+        state = cls.current(collection)
+        count = FindingAid.objects.all().using(collection).count()
+        # increment in the database, in case other processes are updating
+        cls.objects.filter(pk=state.pk).update(generation=F('generation') + 1,
+                                               count=count)
+        # last-modified should never go backwards
+        cls.objects.filter(pk=state.pk) \
+                   .filter(models.Q(last_modified__isnull=True) |
+                           models.Q(last_modified__lt=modified)) \
+                   .update(last_modified=modified)
+        cachekeys.invalidate_collection(collection)
+        return cls.objects.get(pk=state.pk)
+
+    def eadids(self):
+        '''Set of eadids for the documents in the collection, retrieved
+        from eXist once per collection generation (see
+        :mod:`findingaids.fa.cachekeys`).  Used to check that records
+        mirrored from the collection cover exactly the documents in it.
+
+        :rtype: frozenset
+        '''
+        key = cachekeys.collection_key('eadids', collection=self.collection)
+        eadids = cache.get(key)
+        if eadids is None:
+            eadids = frozenset(ead.eadid.value for ead in
+                               FindingAid.objects.only('eadid').using(self.collection))
+            cache.set(key, eadids, cachekeys.timeout())
+        return eadids
+
+
+class FacetRecord(models.Model):
+    '''Facet values for a single published finding aid: repositories,
+    counts of public and internal digital archival objects, and
+    controlaccess terms.  Updated when documents are published, loaded, or
+    deleted, so that search facet counts and filters can be calculated in
+    memory (see :mod:`findingaids.fa.facets`) instead of in eXist.'''
+    eadid = models.CharField('EAD Identifier', max_length=50, unique=True)
+    repositories = models.TextField(blank=True,
+        help_text='Normalized repository names, one per line')
+    subjects = models.TextField(blank=True,
+        help_text='Normalized controlaccess terms, one per line')
+    dao_count = models.PositiveIntegerField(default=0,
+        help_text='Number of digital archival objects, public or internal')
+    public_dao_count = models.PositiveIntegerField(default=0,
+        help_text='Number of public digital archival objects')
+
+    class Meta:
+        verbose_name = 'Facet Record'
+
+    def __unicode__(self):
+        return self.eadid
+
+    @property
+    def repository_list(self):
+        'list of repository names'
+        return self.repositories.splitlines()
+
+    @property
+    def subject_list(self):
+        'list of controlaccess terms'
+        return self.subjects.splitlines()
+
+
+class CatalogEntry(models.Model):
+    '''Metadata for a single finding aid in an eXist collection, mirrored
+    in the relational database so that views that only need light
+    per-document information (lists of published documents, sitemaps,
+    modification times, archive permissions) do not query eXist.
+    Updated when documents are published, previewed, loaded, or deleted;
+    can be rebuilt and checked against eXist with the **catalog** manage
+    command.'''
+    #: :class:`FindingAid` fields mirrored in the catalog, for partial
+    #: eXist returns
+    exist_fields = ['eadid', 'document_name', 'list_title', 'repository',
+                    'public_dao_count', 'hash', 'last_modified']
+    #: maximum number of documents to retrieve from eXist in a single query
+    update_batch_size = 200
+
+    collection = models.CharField(max_length=255,
+        help_text='eXist collection path')
+    eadid = models.CharField('EAD Identifier', max_length=50)
+    document_name = models.CharField(max_length=255)
+    list_title = models.TextField(blank=True)
+    first_letter = models.CharField(max_length=1, blank=True, db_index=True)
+    repository = models.CharField(max_length=255, blank=True,
+        help_text='Normalized repository name (subarea)')
+    archive = models.ForeignKey(Archive, null=True, blank=True,
+        on_delete=models.SET_NULL)
+    public_dao_count = models.PositiveIntegerField(default=0)
+    hash = models.CharField(max_length=40, blank=True,
+        help_text='SHA-1 hash of the document in eXist')
+    last_modified = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Catalog Entry'
+        verbose_name_plural = 'Catalog Entries'
+        unique_together = ('collection', 'eadid')
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.eadid, self.collection)
+
+    @classmethod
+    def published(cls):
+        'Catalog entries for the public collection.'
+        return cls.objects.filter(collection=settings.EXISTDB_ROOT_COLLECTION)
+
+    @classmethod
+    def is_complete(cls, collection=None):
+        '''Check whether the catalog has entries for exactly the documents
+        in a collection, by comparing catalog eadids with the eadids
+        recorded for the current :class:`CollectionState` generation.
+        Views should fall back to querying eXist when the catalog is
+        incomplete (e.g., before it is built for the first time).  The
+        result is cached once per collection generation, and cleared when
+        catalog entries are updated.
+
+        :param collection: eXist collection; defaults to the configured
+            public collection, **EXISTDB_ROOT_COLLECTION**
+        '''
+        if collection is None:
+            collection = settings.EXISTDB_ROOT_COLLECTION
+        key = cachekeys.collection_key('catalog-complete', collection=collection)
+        complete = cache.get(key)
+        if complete is None:
+            entries = cls.objects.filter(collection=collection)
+            state = CollectionState.current(collection)
+            # compare counts first, to skip loading eadids when they differ
+            complete = entries.count() == state.count and \
+                set(entries.values_list('eadid', flat=True)) == state.eadids()
+            cache.set(key, complete, cachekeys.timeout())
+        return complete
+
+    @classmethod
+    def clear_complete(cls, collection=None):
+        '''Clear the cached :meth:`is_complete` result for the current
+        generation of a collection, after catalog entries are changed.
+
+        :param collection: eXist collection; defaults to the configured
+            public collection, **EXISTDB_ROOT_COLLECTION**
+        '''
+        cache.delete(cachekeys.collection_key('catalog-complete', collection=collection))
+
+    @classmethod
+    def entry_values(cls, ead, archives=None):
+        '''Catalog field values for a finding aid.
+
+        :param ead: :class:`FindingAid` with at least :attr:`exist_fields`
+        :param archives: optional dictionary of :class:`Archive` by name
+        :rtype: dict
+        '''
+        if archives is None:
+            archives = dict((a.name, a) for a in Archive.objects.all())
+        list_title = normalize_whitespace(unicode(ead.list_title or '')).strip()
+        # NOTE: partial return doesn't get normalized
+        repository = normalize_whitespace(ead.repository[0]).strip() if ead.repository else ''
+        return {
+            'document_name': ead.document_name,
+            'list_title': list_title,
+            'first_letter': list_title[:1].upper(),
+            'repository': repository,
+            'archive': archives.get(repository),
+            'public_dao_count': ead.public_dao_count or 0,
+            'hash': ead.hash or '',
+            'last_modified': ead.last_modified,
+        }
+
+    @classmethod
+    def update(cls, eadids, collection=None):
+        '''Update catalog entries for documents in a collection from eXist,
+        with a single query, removing entries for any documents that are
+        not found.
+
+        :param eadids: list of eadids
+        :param collection: eXist collection; defaults to the configured
+            public collection, **EXISTDB_ROOT_COLLECTION**
+        :returns: list of updated :class:`CatalogEntry`
+        '''
+        if collection is None:
+            collection = settings.EXISTDB_ROOT_COLLECTION
+        eadids = list(eadids)
+        archives = dict((a.name, a) for a in Archive.objects.all())
+        entries = []
+        with transaction.atomic():
+            # keep eXist queries to a reasonable size for large loads
+            for i in range(0, len(eadids), cls.update_batch_size):
+                findingaids = FindingAid.objects \
+                    .filter(eadid__in=eadids[i:i + cls.update_batch_size]) \
+                    .only(*cls.exist_fields).using(collection)
+                for ead in findingaids:
+                    entry, created = cls.objects.update_or_create(
+                        collection=collection, eadid=ead.eadid.value,
+                        defaults=cls.entry_values(ead, archives))
+                    entries.append(entry)
+            found = set(entry.eadid for entry in entries)
+            cls.objects.filter(collection=collection, eadid__in=set(eadids) - found) \
+                       .delete()
+        cls.clear_complete(collection)
+        return entries
+
+    @classmethod
+    def remove(cls, eadid, collection=None):
+        '''Remove the catalog entry for a document that is no longer in a
+        collection.
+
+        :param eadid: eadid
+        :param collection: eXist collection; defaults to the configured
+            public collection, **EXISTDB_ROOT_COLLECTION**
+        '''
+        if collection is None:
+            collection = settings.EXISTDB_ROOT_COLLECTION
+        cls.objects.filter(collection=collection, eadid=eadid).delete()
+        cls.clear_complete(collection)
+
+    @classmethod
+    def publish(cls, eadids):
+        '''Update the catalog for documents moved from the preview
+        collection to the public collection, in a single transaction.
+
+        :param eadids: list of eadids
+        '''
+        with transaction.atomic():
+            cls.update(eadids)
+            cls.objects.filter(collection=settings.EXISTDB_PREVIEW_COLLECTION,
+                               eadid__in=list(eadids)).delete()
+        cls.clear_complete()
+        cls.clear_complete(settings.EXISTDB_PREVIEW_COLLECTION)
+
+
+
+class SitemapEntry(models.Model):
+    '''A single sitemap url for a published finding aid, or for one of its
+    series, subseries, or index pages, stored so that sitemap files can be
+    regenerated without querying eXist when a document is published or
+    deleted.  See :mod:`findingaids.fa.sitemapstore`.'''
+    section = models.CharField(max_length=50,
+        help_text='Sitemap section, e.g. findingaids-series')
+    eadid = models.CharField('EAD Identifier', max_length=50, db_index=True)
+    location = models.CharField(max_length=255,
+        help_text='Site-relative url')
+    lastmod = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Sitemap Entry'
+        verbose_name_plural = 'Sitemap Entries'
+        index_together = [('section', 'location')]
+
+    def __unicode__(self):
+        return self.location
+
+
+@receiver(post_save, sender=Archive)
+def archive_saved(sender, instance, **kwargs):
+    '''Keep catalog entries linked to the archive with the same name as
+    their repository when an archive is created or renamed.'''
+    CatalogEntry.objects.filter(archive=instance) \
+                        .exclude(repository=instance.name).update(archive=None)
+    CatalogEntry.objects.filter(repository=instance.name).update(archive=instance)
+    for collection in CatalogEntry.objects.values_list('collection', flat=True).distinct():
+        CatalogEntry.clear_complete(collection)
+
+
+@receiver(post_save, sender=Deleted)
+def deleted_record_saved(sender, instance, **kwargs):
+    '''Update the public collection state when a deleted record is created
+    or updated, since deleted records are included in collection last
+    modification time.'''
+    CollectionState.update(modified=instance.date)
@@ -0,0 +1,213 @@
+# file findingaids/fa/navigation.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Compact, cacheable summary of the series, subseries, and indexes in a
+finding aid, used to generate navigation links without retrieving and
+walking the full EAD document on every request.
+'''
+
+import copy
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from lxml import etree
+
+from eulxml import xmlmap
+from eulxml.xmlmap import eadmap
+
+from findingaids.fa import cachekeys
+from findingaids.fa.models import shortform_id
+from findingaids.fa.utils import get_findingaid, ead_validators
+
+logger = logging.getLogger(__name__)
+
+
+class NavigationItem(object):
+    '''Summary information about a single series, subseries, or index.
+    Provides the subset of the :class:`~findingaids.fa.models.Series` and
+    :class:`~findingaids.fa.models.Index` API used to display navigation
+    links (id, short_id, did.unitid, did.unittitle, head, match_count).
+
+    Unit titles and index headings are stored as serialized xml, so that
+    they can be displayed with the :meth:`format_ead` template filter.
+    '''
+
+    def __init__(self, id, short_id, level, label='', unitid=None,
+                 unittitle=None, head=None, has_subseries=False, children=None,
+                 match_count=0):
+        self.id = id
+        self.short_id = short_id
+        #: component tag name (c01, c02, c03) or index
+        self.level = level
+        self.label = label
+        self.unitid = unitid
+        self._unittitle = unittitle
+        self._head = head
+        self.has_subseries = has_subseries
+        self.children = children or []
+        self.match_count = match_count
+
+    @property
+    def did(self):
+        # unitid and unittitle are accessed as component.did.* in templates
+        return self
+
+    @property
+    def unittitle(self):
+        if self._unittitle is not None:
+            return xmlmap.load_xmlobject_from_string(self._unittitle, eadmap.UnitTitle)
+
+    @property
+    def head(self):
+        if self._head is not None:
+            return xmlmap.load_xmlobject_from_string(self._head)
+
+    def display_label(self):
+        "Series display label - *unitid : unittitle* (if unitid) or *unittitle* (if no unitid)"
+        return self.label
+
+    def with_match_count(self, match_count):
+        'Copy of this item with the specified keyword match count.'
+        item = copy.copy(self)
+        item.match_count = match_count
+        return item
+
+
+class FindingAidNavigation(object):
+    '''Navigation structure for a single finding aid.
+
+    :param eadid: eadid
+    :param series: list of :class:`NavigationItem` for top-level series
+    :param indexes: list of :class:`NavigationItem` for indexes
+    :param has_series: boolean indicating if the finding aid is organized
+        in series (i.e., if series links should be displayed)
+    '''
+
+    def __init__(self, eadid, series=None, indexes=None, has_series=False):
+        self.eadid = eadid
+        self.series = series or []
+        self.indexes = indexes or []
+        self.has_series = has_series
+
+    def position(self, id):
+        'Position of a top-level series in the list of series; 0 if not found.'
+        for i, item in enumerate(self.series):
+            if item.id == id:
+                return i
+        return 0
+
+    def path(self, id):
+        '''List of :class:`NavigationItem` from the top-level series down to
+        the series or subseries with the specified id, or None if not found.'''
+        return _find_path(self.series, id)
+
+
+def _find_path(items, id):
+    for item in items:
+        if item.id == id:
+            return [item]
+        path = _find_path(item.children, id)
+        if path:
+            return [item] + path
+
+
+def _xml(xmlobj):
+    if xmlobj is not None and xmlobj.node is not None:
+        return etree.tostring(xmlobj.node)
+
+
+def navigation_item(component, eadid=None):
+    '''Generate a :class:`NavigationItem` for a series or subseries, with
+    items for any subseries it contains.
+
+    :param component: :class:`~findingaids.fa.models.Series`
+    :param eadid: optional eadid, for generating short ids
+    '''
+    has_subseries = bool(component.hasSubseries())
+    children = []
+    if has_subseries:
+        children = [navigation_item(c, eadid) for c in component.c]
+    did = component.did
+    return NavigationItem(
+        id=component.id,
+        short_id=shortform_id(component.id, eadid) if eadid else component.short_id,
+        level=etree.QName(component.node).localname,
+        label=component.display_label(),
+        unitid=unicode(did.unitid) if did is not None and did.unitid else None,
+        unittitle=_xml(did.unittitle) if did is not None else None,
+        has_subseries=has_subseries,
+        children=children,
+        match_count=component.match_count or 0)
+
+
+def build_navigation(ead):
+    '''Generate :class:`FindingAidNavigation` from a full
+    :class:`~findingaids.fa.models.FindingAid`.'''
+    eadid = ead.eadid.value
+    has_series = bool(ead.dsc and ead.dsc.hasSeries())
+    series = []
+    if has_series:
+        series = [navigation_item(c, eadid) for c in ead.dsc.c]
+    indexes = [NavigationItem(id=index.id, short_id=shortform_id(index.id, eadid),
+                              level='index', head=_xml(index.head))
+               for index in ead.archdesc.index]
+    return FindingAidNavigation(eadid, series, indexes, has_series)
+
+
+def findingaid_navigation(eadid, checksum, preview=False, ead=None):
+    '''Cached :class:`FindingAidNavigation` for a version of a finding aid.
+    Cached by eadid and document hash in the namespace for the document
+    (see :mod:`findingaids.fa.cachekeys`), so a new version of a document
+    always gets a new navigation structure; if it is not cached, the full
+    document is retrieved from eXist (unless it is passed in).
+
+    :param eadid: eadid
+    :param checksum: SHA-1 hash of the current document, e.g. from
+        :meth:`~findingaids.fa.utils.ead_validators`
+    :param preview: retrieve document from the preview collection
+    :param ead: optional full :class:`~findingaids.fa.models.FindingAid`
+        to build from, if already retrieved
+    '''
+    collection = settings.EXISTDB_PREVIEW_COLLECTION if preview else None
+    cache_key = cachekeys.document_key('findingaid-navigation', eadid, checksum,
+                                       collection=collection)
+    nav = cache.get(cache_key)
+    if nav is None:
+        if ead is None:
+            ead = get_findingaid(eadid, preview=preview)
+        nav = build_navigation(ead)
+        cache.set(cache_key, nav, cachekeys.timeout())
+    return nav
+
+
+def cache_navigation(request, ead, preview=False):
+    '''Build and cache navigation for a newly published or previewed
+    finding aid, so that the first request for the document does not have
+    to walk the full EAD.  Errors are logged but not raised, since the
+    navigation will be built when it is first needed.
+
+    :param request: current request, or None (e.g., in a celery task)
+    :param ead: full :class:`~findingaids.fa.models.FindingAid`
+    :param preview: document is in the preview collection; defaults to False
+    '''
+    eadid = ead.eadid.value
+    try:
+        checksum = ead_validators(request, eadid, preview)['hash']
+        return findingaid_navigation(eadid, checksum, preview=preview, ead=ead)
+    except Exception as err:
+        logger.warning('Failed to cache navigation for %s: %s' % (eadid, err))
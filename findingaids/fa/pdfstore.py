@@ -0,0 +1,254 @@
+# file findingaids/fa/pdfstore.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Persistent storage for generated finding aid PDFs.
+
+PDFs are stored by eadid and the SHA-1 hash of the EAD document they were
+generated from, so a stored PDF is only served while it matches the
+current version of the document in eXist.  Storage is enabled by
+configuring **FINDINGAID_PDF_STORE** (a local directory) and/or
+**FINDINGAID_PDF_STORAGE** (a Django storage class); when neither is set,
+PDFs are generated on request.
+'''
+
+import errno
+import logging
+import os
+import re
+import tempfile
+
+from django import http
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, get_storage_class
+from django.utils.http import quote_etag
+
+from findingaids.fa.utils import get_findingaid, generate_pdf
+
+logger = logging.getLogger(__name__)
+
+# single byte range, e.g. bytes=0-499, bytes=500-, bytes=-500
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+#: suffix for PDFs that are still being generated
+TEMP_SUFFIX = '.tmp'
+
+
+def pdf_storage():
+    '''Configured storage for generated PDFs.
+
+    :returns: instance of :class:`django.core.files.storage.Storage`,
+        or None if PDF storage is not configured
+    '''
+    storage_class = getattr(settings, 'FINDINGAID_PDF_STORAGE', None)
+    location = getattr(settings, 'FINDINGAID_PDF_STORE', None)
+    if storage_class is None and location is None:
+        return None
+    if storage_class is not None:
+        opts = {'location': location} if location else {}
+        return get_storage_class(storage_class)(**opts)
+    return FileSystemStorage(location=location)
+
+
+def pdf_name(eadid, checksum):
+    '''Storage name for the PDF of a version of a finding aid.
+
+    :param eadid: eadid
+    :param checksum: SHA-1 hash of the EAD document
+    '''
+    return '%s/%s.pdf' % (eadid, checksum)
+
+
+def stored_pdf(eadid, checksum):
+    '''Get the storage name of a stored PDF for the specified version of a
+    finding aid, if there is one.
+
+    :returns: storage name, or None if no PDF is stored
+    '''
+    storage = pdf_storage()
+    if storage is not None:
+        name = pdf_name(eadid, checksum)
+        if storage.exists(name):
+            return name
+
+
+def store_pdf(eadid, checksum=None):
+    '''Generate a PDF for the current version of a published finding aid
+    and save it to the configured PDF storage, replacing any PDFs for
+    previous versions of the document.  Raises
+    :class:`django.http.Http404` if the document is not found.
+
+    :param eadid: eadid
+    :param checksum: SHA-1 hash of the current document, if already known
+    :returns: storage name of the PDF
+    '''
+    # avoid circular import
+    from findingaids.fa.views import full_findingaid_context
+
+    storage = pdf_storage()
+    if storage is None:
+        raise Exception('PDF storage is not configured')
+
+    # get the hash before the document, so that the PDF is never stored
+    # under the hash of a newer version than the one it was generated from
+    if checksum is None:
+        checksum = get_findingaid(eadid, only=['hash']).hash
+    name = pdf_name(eadid, checksum)
+    if storage.exists(name):
+        return name
+
+    ead = get_findingaid(eadid)
+    context = full_findingaid_context(ead, 'pdf')
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        path = None
+
+    if path is not None:
+        # generate next to the stored location and rename into place, so
+        # that concurrent generations of the same version (e.g., a request
+        # while the publication task is running) replace each other
+        # atomically instead of saving under alternate names
+        _make_dirs(os.path.dirname(path))
+        pdf_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+            prefix='%s.' % os.path.basename(path), suffix=TEMP_SUFFIX, delete=False)
+        pdf_file.close()
+        try:
+            _generate(context, pdf_file.name)
+            os.chmod(pdf_file.name, storage.file_permissions_mode or 0o644)
+            logger.info('Storing PDF for %s as %s' % (eadid, name))
+            os.rename(pdf_file.name, path)
+        except BaseException:
+            if os.path.exists(pdf_file.name):
+                os.remove(pdf_file.name)
+            raise
+    else:
+        pdf_file = tempfile.NamedTemporaryFile(prefix='findingaids-pdf-')
+        try:
+            _generate(context, pdf_file.name)
+            logger.info('Storing PDF for %s as %s' % (eadid, name))
+            saved = storage.save(name, File(pdf_file))
+        finally:
+            pdf_file.close()
+        # storage without local paths cannot rename; if another generation
+        # stored the same version first, keep that one
+        if saved != name:
+            storage.delete(saved)
+
+    remove_pdfs(eadid, checksum)
+    return name
+
+
+def _generate(context, filename):
+    if not generate_pdf('fa/full.html', context, filename):
+        raise Exception('There was an error generating the PDF')
+
+
+def _make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def remove_pdfs(eadid, checksum=None):
+    '''Remove stored PDFs for a finding aid, e.g. when it has been
+    updated or deleted.
+
+    :param eadid: eadid
+    :param checksum: optional SHA-1 hash of the current document; the PDF
+        for this version, and any PDFs still being generated, are not
+        removed
+    '''
+    storage = pdf_storage()
+    if storage is None:
+        return
+    try:
+        dirs, files = storage.listdir(eadid)
+    except (OSError, NotImplementedError):
+        # nothing stored, or storage does not support listing
+        return
+    current = os.path.basename(pdf_name(eadid, checksum)) if checksum else None
+    for filename in files:
+        if checksum is not None and \
+                (filename == current or filename.endswith(TEMP_SUFFIX)):
+            continue
+        storage.delete('%s/%s' % (eadid, filename))
+
+
+def _file_range(pdf, start, length, chunk_size=8192):
+    # iterate over a portion of a file, closing it when done
+    try:
+        pdf.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = pdf.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        pdf.close()
+
+
+def pdf_response(request, name, checksum, filename=None):
+    '''Serve a stored PDF.  Supports single byte-range requests, so that
+    PDF viewers can load large documents incrementally; a range request
+    with an If-Range header that does not match the current document gets
+    the full PDF.
+
+    :param request: current request
+    :param name: storage name of the PDF
+    :param checksum: SHA-1 hash of the EAD document, used as the etag
+    :param filename: optional filename, to specify to the browser in the response
+    :returns: :class:`django.http.StreamingHttpResponse`
+    '''
+    storage = pdf_storage()
+    size = storage.size(name)
+    start, end = 0, size - 1
+
+    byte_range = request.META.get('HTTP_RANGE', '')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    match = RANGE_RE.match(byte_range.strip())
+    if match and (if_range is None or if_range.strip() == quote_etag(checksum)):
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            if last:
+                end = min(int(last), size - 1)
+        elif last:
+            # suffix range: last N bytes of the file
+            start = max(size - int(last), 0)
+        if not (first or last) or start > end:
+            response = http.HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        status = 206
+    else:
+        status = 200
+
+    length = end - start + 1
+    response = http.StreamingHttpResponse(_file_range(storage.open(name, 'rb'), start, length),
+                                          content_type='application/pdf', status=status)
+    response['Content-Length'] = length
+    response['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    if filename:
+        response['Content-Disposition'] = "inline; filename=%s" % filename
+    return response
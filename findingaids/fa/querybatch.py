@@ -0,0 +1,298 @@
+# file findingaids/fa/querybatch.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Run independent eXist queries for a single view concurrently, so the time
+spent waiting on eXist is the time of the slowest query rather than the
+sum of all of them.
+
+Queries are added to a :class:`QueryBatch` as callables (e.g., the
+``get`` method of a queryset, or ``list`` and a queryset) and run on a
+process-wide pool of **EXISTDB_QUERY_THREADS** worker threads; the last
+query in a batch runs in the calling thread.  If any query fails, queries
+that have not started yet are cancelled and the error is raised in the
+calling thread; if the batch does not finish within
+**EXISTDB_QUERY_BATCH_TIMEOUT** seconds, pending queries are cancelled
+and :class:`~eulexistdb.exceptions.ExistDBTimeout` is raised.  Queries
+already sent to eXist cannot be interrupted, but their results are
+discarded.  Queries run by workers are included in the request stats of
+:mod:`findingaids.exist_middleware`.  Before waiting for workers, the
+calling thread returns any eXist connection kept for the current request
+(see :func:`findingaids.existpool.release_pinned`), so that workers are
+never left waiting for a connection held by the thread waiting on them.
+
+The eulxml xpath parser, used by eulexistdb to generate queries, shares
+a single lexer and parser and is not thread-safe, so queries in a batch
+are run holding a lock that is only released while waiting on eXist:
+generating queries is serialized, sending them is not.  This only
+applies to querysets from models using :class:`Manager`, which run
+queries with :class:`ExistDB`; any other callable runs entirely under
+the lock.
+'''
+
+from contextlib import contextmanager
+import logging
+import Queue
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from eulexistdb import db, manager
+from eulexistdb.exceptions import ExistDBTimeout
+from eulexistdb.query import QuerySet
+
+from findingaids import exist_middleware, existpool
+
+logger = logging.getLogger(__name__)
+
+
+# held by threads running batch queries, except while waiting on eXist
+_compile_lock = threading.Lock()
+_compiling = threading.local()
+
+
+@contextmanager
+def _compile_step():
+    # hold the compile lock, unless this thread already does (a query
+    # run in the calling thread of a nested batch)
+    if getattr(_compiling, 'held', False):
+        yield
+        return
+    with _compile_lock:
+        _compiling.held = True
+        try:
+            yield
+        finally:
+            _compiling.held = False
+
+
+@contextmanager
+def _waiting():
+    # release the compile lock, if this thread holds it, while waiting
+    # on eXist or on other queries
+    if not getattr(_compiling, 'held', False):
+        yield
+        return
+    _compiling.held = False
+    _compile_lock.release()
+    try:
+        yield
+    finally:
+        _compile_lock.acquire()
+        _compiling.held = True
+
+
+class ExistDB(db.ExistDB):
+    ''':class:`~eulexistdb.db.ExistDB` that lets other batch queries be
+    generated while it waits on eXist.'''
+
+    def query(self, *args, **kwargs):
+        with _waiting():
+            return super(ExistDB, self).query(*args, **kwargs)
+
+    def getDocument(self, *args, **kwargs):
+        with _waiting():
+            return super(ExistDB, self).getDocument(*args, **kwargs)
+
+
+class Manager(manager.Manager):
+    ''':class:`~eulexistdb.manager.Manager` for querysets that can be
+    run concurrently in a :class:`QueryBatch`.'''
+
+    def get_query_set(self):
+        return QuerySet(model=self.model, xpath=self.xpath, using=ExistDB(),
+                        collection=settings.EXISTDB_ROOT_COLLECTION,
+                        fulltext_options=getattr(settings, 'EXISTDB_FULLTEXT_OPTIONS', {}))
+
+
+class _Query(object):
+    def __init__(self, func, args, kwargs, finished):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.stats = exist_middleware.current_stats()
+        self.result = None
+        self.exc_info = None
+        self.cancelled = False
+        self.done = threading.Event()
+        # shared by all queries in a batch
+        self.finished = finished
+
+    def run(self):
+        if not self.cancelled:
+            try:
+                with exist_middleware.recording(self.stats), _compile_step():
+                    self.result = self.func(*self.args, **self.kwargs)
+            except Exception:
+                self.exc_info = sys.exc_info()
+        self.done.set()
+        self.finished.set()
+
+
+class QueryPool(object):
+    '''Pool of worker threads running queries for :class:`QueryBatch`.
+    Defaults are taken from **EXISTDB_QUERY_THREADS**.
+
+    :param workers: number of worker threads
+    :param queue_size: maximum number of queries waiting for a worker;
+        when the queue is full, queries are run in the calling thread
+    '''
+
+    def __init__(self, workers=None, queue_size=None):
+        if workers is None:
+            workers = getattr(settings, 'EXISTDB_QUERY_THREADS', 8)
+        if queue_size is None:
+            queue_size = workers * 4
+        self.workers = workers
+        self.queries = Queue.Queue(maxsize=queue_size)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='query-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            query = self.queries.get()
+            try:
+                if query is None:
+                    return
+                query.run()
+            finally:
+                # workers are not request threads; close any database
+                # connections as django does at the end of a request
+                close_old_connections()
+                self.queries.task_done()
+
+    def submit(self, query):
+        '''Queue a query for a worker, or run it in the calling thread if
+        there are no workers or the queue is full.'''
+        if self.workers:
+            try:
+                self.queries.put_nowait(query)
+                return
+            except Queue.Full:
+                logger.debug('Query queue is full; running query in the calling thread')
+        query.run()
+
+    def shutdown(self):
+        'Stop all workers once queued queries are finished.'
+        for thread in self.threads:
+            self.queries.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    'Process-wide :class:`QueryPool`, created on first use.'
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = QueryPool()
+    return _pool
+
+
+class QueryBatch(object):
+    '''A set of independent queries to be run concurrently.  Example use::
+
+        batch = QueryBatch()
+        series = batch.add(Series.objects.filter(ead__eadid=eadid).get)
+        indexes = batch.add(list, Index.objects.filter(ead__eadid=eadid))
+        series, indexes = batch.run()
+
+    :param timeout: maximum time in seconds to wait for all queries;
+        defaults to **EXISTDB_QUERY_BATCH_TIMEOUT**, or **EXISTDB_TIMEOUT**
+    :param pool: :class:`QueryPool`; defaults to the process-wide pool
+    '''
+
+    def __init__(self, timeout=None, pool=None):
+        if timeout is None:
+            timeout = getattr(settings, 'EXISTDB_QUERY_BATCH_TIMEOUT',
+                              getattr(settings, 'EXISTDB_TIMEOUT', None))
+        self.timeout = timeout
+        self.pool = pool
+        self._queries = []
+        self._finished = threading.Event()
+
+    def add(self, func, *args, **kwargs):
+        '''Add a query to the batch: a callable and any arguments.  Returns
+        the index of its result in the list returned by :meth:`run`.'''
+        self._queries.append(_Query(func, args, kwargs, self._finished))
+        return len(self._queries) - 1
+
+    def cancel(self):
+        'Cancel any queries that have not started.'
+        for query in self._queries:
+            query.cancelled = True
+
+    def run(self):
+        '''Run all queries in the batch and wait for them to finish.
+
+        :returns: list of query results, in the order queries were added
+        :raises: the error raised by a failed query (as soon as any query
+            fails), or :class:`~eulexistdb.exceptions.ExistDBTimeout`
+            if the queries do not finish within the timeout
+        '''
+        if not self._queries:
+            return []
+        start = time.time()
+        pool = self.pool or get_pool()
+        for query in self._queries[:-1]:
+            pool.submit(query)
+        # run the last query here instead of waiting idle
+        self._queries[-1].run()
+        # don't hold a pooled connection while waiting for workers
+        existpool.release_pinned()
+        with _waiting():
+            return self._wait(start)
+
+    def _wait(self, start):
+        while True:
+            self._finished.clear()
+            failed = [query for query in self._queries if query.exc_info is not None]
+            if failed:
+                self.cancel()
+                exc_type, exc_value, traceback = failed[0].exc_info
+                raise exc_type, exc_value, traceback
+            if all(query.done.is_set() for query in self._queries):
+                break
+            if self.timeout is None:
+                self._finished.wait()
+            else:
+                remaining = self.timeout - (time.time() - start)
+                if remaining <= 0:
+                    self.cancel()
+                    raise ExistDBTimeout('Queries did not finish within %s seconds' % self.timeout)
+                self._finished.wait(remaining)
+        return [query.result for query in self._queries]
+
+
+def run_queries(*funcs, **kwargs):
+    '''Run callables (e.g., queryset ``get`` methods) concurrently with a
+    :class:`QueryBatch` and return their results, in order.  Takes an
+    optional timeout.'''
+    batch = QueryBatch(timeout=kwargs.get('timeout'))
+    for func in funcs:
+        batch.add(func)
+    return batch.run()
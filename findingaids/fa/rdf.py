@@ -0,0 +1,600 @@
+# file findingaids/fa/rdf.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+RDF for finding aid pages, generated directly from the EAD document.
+
+The main finding aid page and the series and index pages embed RDFa,
+which :class:`~findingaids.rdf_middleware.RDFaMiddleware` makes available
+as RDF.  Instead of rendering the HTML page and parsing it as RDFa, the
+functions here build only the RDFa-bearing parts of each page as a small
+element tree, using the same :mod:`findingaids.fa.templatetags.ead`
+filters that the templates use for EAD content, and evaluate that
+directly into an :class:`rdflib.Graph`.  Serialized results are cached
+by document hash, so they are only generated once for each version of a
+document.
+'''
+
+import logging
+from urlparse import urljoin
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.template.defaultfilters import slugify
+from lxml import etree
+from lxml.builder import E
+import rdflib
+from rdflib.namespace import RDF
+from rdflib.plugin import PluginException
+from rdflib.serializer import Serializer
+
+from findingaids.fa import cachekeys
+from findingaids.fa.models import Series, Series2, Series3, Index
+from findingaids.fa.navigation import build_navigation
+from findingaids.fa.templatetags.ead import format_ead, format_ead_rdfa, \
+    series_section_rdfa, memoize_fragments
+from findingaids.fa.utils import get_findingaid, ead_etag, ead_lastmodified, series_url
+from findingaids.fa.views import RDFA_NAMESPACES
+
+logger = logging.getLogger(__name__)
+
+#: prefixes for RDFa on finding aid pages: the RDFa 1.1 initial context
+#: prefixes used in EAD role attributes, and the namespaces declared on
+#: the finding aid pages
+PREFIXES = {
+    'dc': 'http://purl.org/dc/terms/',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'foaf': 'http://xmlns.com/foaf/0.1/',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+}
+PREFIXES.update(RDFA_NAMESPACES)
+
+#: public views with RDF generated from the EAD by :meth:`page_rdf`
+PAGE_VIEWS = ['fa:findingaid', 'fa:series-or-index', 'fa:series2', 'fa:series3']
+
+#: RDF serializations available for content negotiation, as
+#: (mimetype, rdflib format), in increasing order of preference;
+#: RDF/XML is the default
+SERIALIZATIONS = [
+    ('text/turtle', 'turtle'),
+    ('application/rdf+xml', 'xml'),
+]
+# JSON-LD requires the rdflib-jsonld plugin
+try:
+    rdflib.plugin.get('json-ld', Serializer)
+    SERIALIZATIONS.insert(0, ('application/ld+json', 'json-ld'))
+except PluginException:
+    pass
+
+# series and index element names, and the corresponding xmlobject
+COMPONENT_CLASSES = {
+    'c01': Series,
+    'c02': Series2,
+    'c03': Series3,
+    'index': Index,
+}
+
+KNOWS_REL = 'schema:knows arch:correspondedWith'
+
+
+class RdfaEvaluator(object):
+    '''Evaluate RDFa in an element tree into an :class:`rdflib.Graph`.
+    Supports the subset of RDFa 1.1 used on the finding aid pages:
+    ``about``, ``typeof``, ``rel``, ``property``, ``content``, ``resource``,
+    ``href``, and ``inlist``, with incomplete triples for ``rel`` without
+    an object.  Terms without a prefix are ignored.
+
+    :param base: base uri, used for relative urls and as the subject
+        at the top level
+    :param prefixes: dictionary of prefixes for CURIEs; defaults to
+        :data:`PREFIXES`
+    '''
+
+    def __init__(self, base, prefixes=None):
+        self.base = base
+        self.prefixes = prefixes or PREFIXES
+        self.graph = rdflib.Graph()
+        for prefix, ns in self.prefixes.iteritems():
+            self.graph.bind(prefix, ns)
+
+    def term(self, value):
+        '''Resolve a CURIE or absolute uri; returns None if the value has
+        no prefix.'''
+        prefix, sep, reference = value.partition(':')
+        if not sep:
+            return None
+        if prefix in self.prefixes:
+            return rdflib.URIRef(self.prefixes[prefix] + reference)
+        return rdflib.URIRef(value)
+
+    def terms(self, value):
+        'Resolve a space-separated list of CURIEs, skipping unknown terms.'
+        if value is None:
+            return []
+        return [t for t in (self.term(v) for v in value.split()) if t is not None]
+
+    def uri(self, value):
+        '''Resolve a CURIE or absolute uri, or a uri relative to the base'''
+        return self.term(value) or rdflib.URIRef(urljoin(self.base, value))
+
+    def resource(self, element):
+        # resource from @resource or @href
+        if element.get('resource') is not None:
+            return self.uri(element.get('resource'))
+        if element.get('href') is not None:
+            return rdflib.URIRef(urljoin(self.base, element.get('href')))
+
+    def evaluate(self, element):
+        '''Add triples for an element and its descendants to the graph.
+
+        :returns: :class:`rdflib.Graph`
+        '''
+        base = rdflib.URIRef(self.base)
+        self._evaluate(element, base, base, [], {})
+        return self.graph
+
+    def _evaluate(self, element, parent_subject, parent_object, incomplete, lists):
+        if not isinstance(element.tag, basestring):   # comments
+            return
+        about = element.get('about')
+        rels = self.terms(element.get('rel'))
+        properties = self.terms(element.get('property'))
+        has_typeof = element.get('typeof') is not None
+        content = element.get('content')
+
+        subject = current_object = typed = None
+        skip = False
+        if not rels:
+            if properties and content is None:
+                subject = self.uri(about) if about is not None else parent_object
+                if has_typeof:
+                    if about is not None:
+                        typed = subject
+                    else:
+                        typed = self.resource(element) or rdflib.BNode()
+                    current_object = typed
+            else:
+                if about is not None:
+                    subject = self.uri(about)
+                else:
+                    subject = self.resource(element)
+                if subject is None and has_typeof:
+                    subject = rdflib.BNode()
+                if subject is None:
+                    subject = parent_object
+                    skip = not properties
+                elif has_typeof:
+                    typed = subject
+        else:
+            subject = self.uri(about) if about is not None else parent_object
+            current_object = self.resource(element)
+            if has_typeof:
+                if about is not None:
+                    typed = subject
+                else:
+                    if current_object is None:
+                        current_object = rdflib.BNode()
+                    typed = current_object
+
+        if typed is not None:
+            for rdftype in self.terms(element.get('typeof')):
+                self.graph.add((typed, RDF.type, rdftype))
+
+        # lists belong to the element that sets a new subject
+        local_lists = lists if subject == parent_object else {}
+        inlist = element.get('inlist') is not None
+        local_incomplete = []
+        if rels:
+            if current_object is not None:
+                for rel in rels:
+                    if inlist:
+                        local_lists.setdefault(rel, []).append(current_object)
+                    else:
+                        self.graph.add((subject, rel, current_object))
+            else:
+                current_object = rdflib.BNode()
+                for rel in rels:
+                    if inlist:
+                        local_lists.setdefault(rel, [])
+                    local_incomplete.append((rel, inlist))
+
+        if properties:
+            if content is not None:
+                value = rdflib.Literal(content)
+            elif not rels and self.resource(element) is not None:
+                value = self.resource(element)
+            elif has_typeof and about is None:
+                value = typed
+            else:
+                value = rdflib.Literal(u''.join(element.itertext()))
+            for prop in properties:
+                if inlist:
+                    local_lists.setdefault(prop, []).append(value)
+                else:
+                    self.graph.add((subject, prop, value))
+
+        if not skip:
+            for rel, rel_inlist in incomplete:
+                if rel_inlist:
+                    lists.setdefault(rel, []).append(subject)
+                else:
+                    self.graph.add((parent_subject, rel, subject))
+
+        for child in element:
+            if skip:
+                self._evaluate(child, parent_subject, parent_object, incomplete, lists)
+            else:
+                self._evaluate(child, subject,
+                               current_object if current_object is not None else subject,
+                               local_incomplete, local_lists)
+
+        if local_lists is not lists:
+            for prop, items in local_lists.iteritems():
+                self._add_list(subject, prop, items)
+
+    def _add_list(self, subject, prop, items):
+        node = RDF.nil
+        for item in reversed(items):
+            item_node = rdflib.BNode()
+            self.graph.add((item_node, RDF.first, item))
+            self.graph.add((item_node, RDF.rest, node))
+            node = item_node
+        self.graph.add((subject, prop, node))
+
+
+_fragment_parser = etree.XMLParser(recover=True)
+
+
+def ead_fragment(value, default_rel=None, rdfa=True):
+    '''EAD content formatted as it is on the page, as an element.
+
+    :param value: :class:`~eulxml.xmlmap.XmlObject` for EAD content; if
+        None, returns None
+    :param default_rel: default relation, as for
+        :meth:`~findingaids.fa.templatetags.ead.format_ead_rdfa`
+    :param rdfa: format with RDFa; if False, uses
+        :meth:`~findingaids.fa.templatetags.ead.format_ead`
+    '''
+    if value is None:
+        return None
+    if rdfa:
+        html = format_ead_rdfa(value, default_rel, autoescape=True)
+    else:
+        html = format_ead(value, autoescape=True)
+    return etree.fromstring(u'<span>%s</span>' % html, _fragment_parser)
+
+
+def _element(tag, attrs=None, *children):
+    # element with attributes and children, skipping any empty children
+    return getattr(E, tag)(attrs or {}, *[c for c in children if c is not None])
+
+
+def _meta(prop, content):
+    if content is None:
+        return None
+    return _element('meta', {'property': prop, 'content': unicode(content)})
+
+
+def _name_type(name):
+    # rdf type for an origination name
+    if name.is_personal_name:
+        return 'schema:Person'
+    if name.is_corporate_name:
+        return 'schema:Organization'
+    return ''
+
+
+def _series_links(items, url_ids):
+    # links to series and subseries, matching the hidden series lists
+    # in the findingaid and series templates
+    links = []
+    for item in items:
+        current_ids = url_ids + [item.short_id]
+        links.append(_element('a', {'rel': 'dcterms:hasPart',
+                                    'href': series_url(*current_ids)}))
+        if item.has_subseries:
+            links.extend(_series_links(item.children, current_ids))
+    return links
+
+
+def _description(ead):
+    # rdfa from the descriptive summary, administrative information, and
+    # collection description (fa/snippets/description.html)
+    items = []
+    name = ead.origination_name
+    if name is not None:
+        items.append(ead_fragment(name, 'schema:creator'))
+        if name.authfilenumber and name.uri:
+            items.append(_meta('schema:about', name.uri))
+        items.append(_meta('schema:keywords', name))
+    if ead.unittitle is not None and format_ead(ead.unittitle):
+        # title is padded with spaces in the description table
+        title = ead_fragment(ead.unittitle, rdfa=False)
+        title.tail = ' '
+        items.append(_element('span', {'property': 'schema:name'}, ' ', title))
+    if ead.abstract:
+        items.append(_element('span', {'property': 'schema:description'},
+                              ead_fragment(ead.abstract, rdfa=False)))
+
+    # links in related and separated material
+    for section in ead.admin_info():
+        if section.head and section.content:
+            items.extend(ead_fragment(para, rdfa=False) for para in section.content)
+
+    bioghist = ead.archdesc.biography_history
+    for section in ead.collection_description():
+        about_origination = section == bioghist and name is not None \
+            and name.authfilenumber
+        div = _element('div', {'about': name.uri} if about_origination else {})
+        for para in section.content:
+            div.append(ead_fragment(para, rdfa=about_origination or section != bioghist))
+        if about_origination:
+            div.append(_element('div', {'property': 'schema:description'},
+                       *[_element('p', {}, unicode(para)) for para in section.content]))
+            if ead.archdesc.controlaccess is not None:
+                for ca in ead.archdesc.controlaccess.controlaccess:
+                    for occupation in ca.occupation:
+                        div.append(_meta('schema:jobTitle', unicode(occupation).replace('.', '')))
+        items.append(div)
+    return items
+
+
+def _controlaccess(ead):
+    # rdfa for controlled access terms (fa/snippets/controlaccess.html)
+    items = []
+    if ead.archdesc.controlaccess is None:
+        return items
+    for ca in ead.archdesc.controlaccess.controlaccess:
+        occupation = slugify(unicode(ca.head)) == 'occupation'
+        for term in ca.terms:
+            if not occupation:
+                items.append(ead_fragment(term))
+            items.append(_meta('schema:keywords', term))
+    return items
+
+
+def _file_item(component, rdfa_rel=None):
+    # rdfa for a file-level item (fa/snippets/file_item.html), as
+    # displayed to anonymous users
+    did = component.did
+    # did note is not mapped in all versions of eulxml
+    note = getattr(did, 'note', None)
+    items = []
+    if rdfa_rel:
+        items.extend([ead_fragment(did.unittitle, rdfa_rel),
+                      ead_fragment(did.abstract, rdfa_rel),
+                      ead_fragment(note, rdfa_rel)])
+    elif component.has_semantic_data:
+        content = [ead_fragment(did.unittitle), ead_fragment(did.abstract),
+                   ead_fragment(note)]
+        if component.rdf_type:
+            for dao in did.dao_list:
+                if dao.href and dao.show != 'none' and dao.audience != 'internal':
+                    content.append(_element('a', {'property': 'schema:URL', 'href': dao.href}))
+            attrs = {'typeof': component.rdf_type}
+            if component.rdf_identifier:
+                attrs['resource'] = component.rdf_identifier
+            items.append(_element('span', {'rel': 'schema:mentions'},
+                                  _element('span', attrs, *content)))
+        else:
+            items.extend(content)
+
+    if component.rdf_mentions:
+        items.extend(ead_fragment(name, 'schema:mentions')
+                     for name in component.unittitle_names)
+        items.extend(ead_fragment(title, 'schema:mentions')
+                     for title in component.mention_titles)
+    return items
+
+
+def _container_list(series, rdfa_rel=None):
+    # rdfa for a container list (fa/snippets/containerlist.html)
+    items = []
+    for component in series.c:
+        if component.did.container:
+            items.extend(_file_item(component, rdfa_rel))
+        elif rdfa_rel:
+            # section heading
+            items.extend([ead_fragment(component.did.abstract, rdfa_rel),
+                          ead_fragment(getattr(component.did, 'note', None), rdfa_rel)])
+    return items
+
+
+def findingaid_page(ead, nav, host, last_modified=None):
+    '''RDFa-bearing structure of the main finding aid page
+    (``fa/findingaid.html``), as an element.
+
+    :param ead: full :class:`~findingaids.fa.models.FindingAid`
+    :param nav: :class:`~findingaids.fa.navigation.FindingAidNavigation`
+    :param host: site host, for absolute urls
+    :param last_modified: document last modification time, if known
+    '''
+    eadid = ead.eadid.value
+    page_url = 'http://%s%s' % (host, reverse('fa:findingaid', kwargs={'id': eadid}))
+    publication = ead.file_desc.publication
+    origination = ead.origination_name
+
+    page = _element('div', {'about': ead.eadid.url or '',
+                            'typeof': 'schema:WebPage dcmitype:Text'},
+        _element('a', {'property': 'owl:sameAs', 'href': page_url}),
+        _meta('schema:dateModified', last_modified.strftime('%Y-%m-%d')
+              if last_modified else None),
+        _meta('schema:author', ead.author),
+        _meta('schema:name', ead.title))
+    if origination is not None and origination.authfilenumber:
+        page.append(_element('a', {'property': 'schema:about', 'href': origination.uri}))
+    page.append(_element('span', {'rel': 'schema:publisher'},
+        _element('span', {'typeof': 'schema:Organization'},
+            _element('span', {'property': 'schema:name'}, unicode(publication.publisher)))))
+    if ead.eadid.url:
+        page.append(_element('a', {'property': 'schema:url', 'href': ead.eadid.url}))
+    for prop, date in [('schema:dateCreated', ead.profiledesc.date),
+                       ('schema:datePublished', publication.date)]:
+        if date is not None:
+            page.append(_meta(prop, date.normalized))
+
+    for item in nav.indexes:
+        page.append(_element('a', {'property': 'dcterms:hasPart',
+                                   'href': 'http://%s%s' % (host, series_url(eadid, item.short_id))}))
+    if nav.has_series:
+        for item in nav.series:
+            page.append(_element('a', {'property': 'dcterms:hasPart',
+                                       'href': 'http://%s%s' % (host, series_url(eadid, item.short_id))}))
+
+    collection = _element('div', {'about': ead.collection_uri(),
+                                  'typeof': 'schema:CreativeWork arch:Collection dcmitype:Collection'},
+                          *(_description(ead) + _controlaccess(ead)))
+    page.append(_element('div', {'rel': 'schema:about'}, collection))
+    if nav.has_series:
+        page.extend(_series_links(nav.series, [eadid]))
+    elif ead.dsc is not None:
+        collection.extend(_container_list(ead.dsc))
+    return page
+
+
+def series_page(ead, component, nav, page_url, last_modified=None):
+    '''RDFa-bearing structure of a series, subseries, or index page
+    (``fa/series_or_index.html``), as an element.
+
+    :param ead: full :class:`~findingaids.fa.models.FindingAid`
+    :param component: :class:`~findingaids.fa.models.Series` (or
+        subseries) or :class:`~findingaids.fa.models.Index` from the
+        full document
+    :param nav: :class:`~findingaids.fa.navigation.FindingAidNavigation`
+    :param page_url: absolute url for the page
+    :param last_modified: document last modification time, if known
+    '''
+    origination = ead.origination_name
+    origination_tagged = origination is not None and origination.authfilenumber
+    if isinstance(component, Index):
+        label = unicode(component.head)
+    else:
+        label = component.display_label()
+    page = _element('div', {'about': page_url, 'typeof': 'schema:WebPage'},
+        _meta('schema:name', u'%s; %s' % (ead.title, label)),
+        _meta('dcterms:isPartOf', ead.eadid.url or None),
+        _meta('schema:dateModified', last_modified.strftime('%Y-%m-%d')
+              if last_modified else None))
+
+    if isinstance(component, Index):
+        # fa/snippets/indexentry.html
+        if 'Selected Correspondents' in format_ead(component.head) and origination_tagged:
+            page.append(_element('div', {'typeof': 'schema:Person', 'about': origination.uri},
+                                 *[ead_fragment(entry.name, KNOWS_REL)
+                                   for entry in component.entry]))
+        return page
+
+    # fa/snippets/series.html
+    for section in component.series_info():
+        context = {}
+        divinfo = series_section_rdfa(context, component, section)
+        if context['use_rdfa']:
+            div = etree.fromstring(divinfo['start'] + divinfo['end'], _fragment_parser)
+            inner = div
+            while len(inner):
+                inner = inner[0]
+            for para in section.content:
+                inner.append(ead_fragment(para, context['default_rel']))
+            page.append(div)
+
+    correspondence = component.contains_correspondence and origination_tagged
+    if correspondence:
+        page.append(_element('div', {'typeof': _name_type(origination), 'about': origination.uri},
+                             ead_fragment(component.scope_content, KNOWS_REL)))
+
+    if component.hasSubseries():
+        path = nav.path(component.id) or []
+        if path:
+            page.extend(_series_links(path[-1].children,
+                                      [ead.eadid.value] + [item.short_id for item in path]))
+    elif correspondence:
+        page.append(_element('div', {'typeof': _name_type(origination), 'about': origination.uri},
+                             *_container_list(component, KNOWS_REL)))
+    else:
+        page.append(_element('div', {'rel': 'schema:about'},
+                             _element('div', {'about': ead.collection_uri()},
+                                      *_container_list(component))))
+    return page
+
+
+def page_graph(ead, host, series_ids=None, last_modified=None):
+    '''Generate an :class:`rdflib.Graph` with the RDF embedded in a finding
+    aid page, or in a series, subseries, or index page.
+
+    :param ead: full :class:`~findingaids.fa.models.FindingAid`
+    :param host: site host, for absolute urls
+    :param series_ids: list of short-form series ids, or an index id,
+        for a series or index page
+    :param last_modified: document last modification time, if known
+    :raises: :class:`django.http.Http404` if the series or index is
+        not found
+    '''
+    eadid = ead.eadid.value
+    nav = build_navigation(ead)
+    if not series_ids:
+        page_url = 'http://%s%s' % (host, reverse('fa:findingaid', kwargs={'id': eadid}))
+        page = findingaid_page(ead, nav, host, last_modified)
+    else:
+        page_url = 'http://%s%s' % (host, series_url(eadid, *series_ids))
+        nodes = ead.node.xpath('//e:*[@id=$id]', namespaces=ead.ROOT_NAMESPACES,
+                               id='%s_%s' % (eadid, series_ids[-1]))
+        component_class = None
+        if nodes:
+            component_class = COMPONENT_CLASSES.get(etree.QName(nodes[0]).localname)
+        if component_class is None:
+            raise Http404
+        page = series_page(ead, component_class(nodes[0]), nav, page_url, last_modified)
+    return RdfaEvaluator(page_url).evaluate(page)
+
+
+def page_rdf(request, kwargs, rdf_format):
+    '''Serialized RDF for a published finding aid, series, or index page,
+    cached by document hash.
+
+    :param request: current request, with the path for the html page
+    :param kwargs: url arguments for the page
+    :param rdf_format: rdflib serialization format
+    :returns: serialized RDF, or None if the url is not a canonical
+        finding aid, series, or index url
+    :raises: :class:`django.http.Http404` if the document or series
+        is not found
+    '''
+    eadid = kwargs['id']
+    series_ids = [kwargs[arg] for arg in ['series_id', 'series2_id', 'series3_id']
+                  if kwargs.get(arg)]
+    # long-form series ids are redirected by the view
+    if any(series_id.startswith('%s_' % eadid) for series_id in series_ids):
+        return None
+
+    checksum = ead_etag(request, eadid)
+    cache_key = cachekeys.document_key('page-rdf', eadid, checksum,
+                                       request.get_host(), request.path, rdf_format)
+    data = cache.get(cache_key)
+    if data is None:
+        ead = get_findingaid(eadid)
+        # memoized fragments of the full document are shared with the
+        # finding aid page
+        with memoize_fragments(ead, 'findingaid', checksum):
+            graph = page_graph(ead, request.get_host(), series_ids,
+                               ead_lastmodified(request, eadid))
+        data = graph.serialize(format=rdf_format)
+        cache.set(cache_key, data, cachekeys.timeout())
+    return data
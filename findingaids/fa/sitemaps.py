@@ -18,7 +18,7 @@ from django.contrib.sitemaps import Sitemap
 from django.core.urlresolvers import reverse
 
 from findingaids.fa.models import FindingAid, Series, Series2, \
-    Series3, Index
+    Series3, Index, CatalogEntry
 
 
 class _BaseFindingAidSitemap(Sitemap):
@@ -42,6 +42,10 @@ class FindingAidSitemap(_BaseFindingAidSitemap):
     view_name = 'fa:findingaid'
 
     def items(self):
+        # use the catalog when it is complete to avoid an eXist query
+        if CatalogEntry.is_complete():
+            return CatalogEntry.published().order_by('eadid') \
+                               .only('eadid', 'last_modified')
         return FindingAid.objects.only('eadid', 'last_modified')
 
     def url_args(self, obj):
@@ -0,0 +1,351 @@
+# file findingaids/fa/sitemapstore.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Precomputed sitemap files.
+
+Generating the finding aid sitemaps on request requires collection-wide
+eXist queries for every series, subseries, and index page.  When
+**SITEMAP_STORE** is configured (a local directory), sitemap urls for each
+published document are stored as
+:class:`~findingaids.fa.models.SitemapEntry` records when the document is
+published, loaded, or deleted, and the sitemap index and section files are
+written to the store as gzipped XML, with at most :data:`URLS_PER_FILE`
+urls per file.  Only the sections that changed are rewritten, and files
+whose content is unchanged are left alone, so file modification times can
+be used for Last-Modified headers.
+
+Entries are only complete once the **sitemaps** manage command has
+rebuilt them for every published document, so no files are written or
+served until the command has finished and written a marker file
+(:data:`BUILT_MARKER`) to the store; until then, sitemaps are generated on
+request.
+'''
+
+import gzip
+import logging
+import os
+import tempfile
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from django import http
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from eulexistdb.exceptions import DoesNotExist
+
+from findingaids.content.sitemaps import ContentSitemap
+from findingaids.fa.models import FindingAid, Series, Series2, Series3, Index, \
+    SitemapEntry
+from findingaids.fa.sitemaps import FINDINGAID_SITEMAPS
+
+logger = logging.getLogger(__name__)
+
+#: maximum number of urls in a single sitemap file, from the sitemap protocol
+URLS_PER_FILE = 50000
+
+#: sitemap sections for the pages of a finding aid below the top level,
+#: with the component class and xpath (relative to the ead document)
+#: matching the queries in :mod:`findingaids.fa.sitemaps`
+COMPONENT_SECTIONS = {
+    'findingaids-series': (Series, '//e:c01[@level="series"]'),
+    'findingaids-subseries': (Series2, '//e:c02[@level="subseries"]'),
+    'findingaids-subsubseries': (Series3, '//e:c03[@level="subseries"]'),
+    'findingaids-index': (Index, '//e:index[contains(@id, "_")]'),
+}
+
+#: sitemap sections for the top-level finding aid urls
+DOCUMENT_SECTIONS = [section for section in FINDINGAID_SITEMAPS
+                     if section not in COMPONENT_SECTIONS]
+
+#: all sitemap sections, in index order
+SECTIONS = ['content'] + sorted(FINDINGAID_SITEMAPS.keys())
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+#: file written to the store once the entries for all published documents
+#: have been built and the sitemap files written
+BUILT_MARKER = 'sitemaps.built'
+
+
+def sitemap_store():
+    '''Configured directory for sitemap files, or None if sitemap files
+    are not enabled.'''
+    return getattr(settings, 'SITEMAP_STORE', None)
+
+
+def sitemap_filename(section=None, page=1):
+    '''Filename for a sitemap file in the store.
+
+    :param section: sitemap section; if not specified, returns the
+        filename for the sitemap index
+    :param page: page number within the section
+    '''
+    if section is None:
+        return 'sitemap.xml.gz'
+    if page > 1:
+        return 'sitemap-%s-%d.xml.gz' % (section, page)
+    return 'sitemap-%s.xml.gz' % section
+
+
+def sitemap_path(section=None, page=1):
+    'Full path for a sitemap file in the configured store.'
+    return os.path.join(sitemap_store(), sitemap_filename(section, page))
+
+
+def is_built():
+    '''True if sitemap files are enabled and the store has been fully
+    built by the **sitemaps** manage command.'''
+    return sitemap_store() is not None and \
+        os.path.exists(os.path.join(sitemap_store(), BUILT_MARKER))
+
+
+def mark_built():
+    '''Record that the stored entries are complete and the sitemap files
+    have been written, so files are updated and served from now on.'''
+    with open(os.path.join(sitemap_store(), BUILT_MARKER), 'w') as marker:
+        marker.write('%s\n' % datetime.now().isoformat())
+
+
+def document_entries(ead):
+    '''Sitemap entries for a single published finding aid.
+
+    :param ead: full :class:`~findingaids.fa.models.FindingAid`, with
+        ``last_modified``
+    :returns: list of unsaved :class:`~findingaids.fa.models.SitemapEntry`
+    '''
+    eadid = ead.eadid.value
+    entries = []
+    for section in DOCUMENT_SECTIONS:
+        sitemap = FINDINGAID_SITEMAPS[section]()
+        entries.append(SitemapEntry(section=section, eadid=eadid,
+                                    location=sitemap.location(ead),
+                                    lastmod=ead.last_modified))
+    for section, (component_class, xpath) in COMPONENT_SECTIONS.iteritems():
+        sitemap = FINDINGAID_SITEMAPS[section]()
+        for node in ead.node.xpath(xpath, namespaces=component_class.ROOT_NAMESPACES):
+            entries.append(SitemapEntry(section=section, eadid=eadid,
+                                        location=sitemap.location(component_class(node)),
+                                        lastmod=ead.last_modified))
+    return entries
+
+
+def update_documents(eadids):
+    '''Update stored sitemap entries for published or deleted documents,
+    retrieving each document from eXist.  Entries for documents that are
+    not found are removed.
+
+    :param eadids: list of eadids
+    :returns: set of sections with changed entries
+    '''
+    changed = set()
+    for eadid in eadids:
+        try:
+            ead = FindingAid.objects.also('last_modified').get(eadid=eadid)
+            entries = document_entries(ead)
+        except DoesNotExist:
+            entries = []
+
+        current = SitemapEntry.objects.filter(eadid=eadid)
+        old_values = set((e.section, e.location, e.lastmod) for e in current)
+        new_values = set((e.section, e.location, e.lastmod) for e in entries)
+        if old_values == new_values:
+            continue
+        changed.update(section for section, location, lastmod in old_values ^ new_values)
+        with transaction.atomic():
+            current.delete()
+            SitemapEntry.objects.bulk_create(entries)
+    return changed
+
+
+def _url_xml(domain, location, lastmod=None, changefreq=None, priority=None):
+    # xml for a single url element in a sitemap file
+    parts = ['<url><loc>%s</loc>' % escape('http://%s%s' % (domain, location))]
+    if lastmod is not None:
+        parts.append('<lastmod>%s</lastmod>' % lastmod.strftime('%Y-%m-%d'))
+    if changefreq is not None:
+        parts.append('<changefreq>%s</changefreq>' % changefreq)
+    if priority is not None:
+        parts.append('<priority>%.1f</priority>' % priority)
+    parts.append('</url>\n')
+    return ''.join(parts)
+
+
+def _section_urls(section, domain):
+    # xml for each url in a sitemap section, in order
+    if section == 'content':
+        sitemap = ContentSitemap()
+        for item in sitemap.items():
+            yield _url_xml(domain, sitemap.location(item), None,
+                           sitemap.changefreq, sitemap.priority(item))
+        return
+    priority = FINDINGAID_SITEMAPS[section].priority
+    entries = SitemapEntry.objects.filter(section=section).order_by('location') \
+                                  .values_list('location', 'lastmod')
+    for location, lastmod in entries.iterator():
+        yield _url_xml(domain, location, lastmod, None, priority)
+
+
+def _write_file(path, content):
+    # write gzipped content to a file, replacing it atomically, unless the
+    # current file has the same content; returns True if the file changed
+    if os.path.exists(path):
+        current = gzip.open(path, 'rb')
+        try:
+            if current.read() == content:
+                return False
+        finally:
+            current.close()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            # fixed gzip timestamp, so unchanged content has identical bytes
+            gz = gzip.GzipFile(filename='', mode='wb', fileobj=tmp, mtime=0)
+            gz.write(content)
+            gz.close()
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
+def _write_section(section, domain):
+    # write all pages for one section, and remove any pages past the end
+    page, urls = 1, []
+
+    def write_page():
+        content = '<?xml version="1.0" encoding="UTF-8"?>\n' + \
+            '<urlset xmlns="%s">\n%s</urlset>\n' % (SITEMAP_NS, ''.join(urls))
+        if _write_file(sitemap_path(section, page), content.encode('utf-8')):
+            logger.info('Wrote %s' % sitemap_filename(section, page))
+
+    for url_xml in _section_urls(section, domain):
+        urls.append(url_xml)
+        if len(urls) == URLS_PER_FILE:
+            write_page()
+            page, urls = page + 1, []
+    # always write the first page, even if the section is empty
+    if urls or page == 1:
+        write_page()
+        page += 1
+    while os.path.exists(sitemap_path(section, page)):
+        os.remove(sitemap_path(section, page))
+        page += 1
+
+
+def section_pages(section):
+    'Number of sitemap files written for a section.'
+    page = 0
+    while os.path.exists(sitemap_path(section, page + 1)):
+        page += 1
+    return page
+
+
+def _write_index(domain):
+    sitemaps = []
+    for section in SECTIONS:
+        for page in range(1, section_pages(section) + 1):
+            location = 'http://%s/sitemap-%s.xml' % (domain, section)
+            if page > 1:
+                location += '?p=%d' % page
+            modified = datetime.fromtimestamp(os.path.getmtime(sitemap_path(section, page)))
+            sitemaps.append('<sitemap><loc>%s</loc><lastmod>%s</lastmod></sitemap>\n' %
+                            (escape(location), modified.strftime('%Y-%m-%d')))
+    content = '<?xml version="1.0" encoding="UTF-8"?>\n' + \
+        '<sitemapindex xmlns="%s">\n%s</sitemapindex>\n' % (SITEMAP_NS, ''.join(sitemaps))
+    _write_file(sitemap_path(), content.encode('utf-8'))
+
+
+def write_sitemaps(sections=None):
+    '''Write sitemap files from the stored sitemap entries, and then the
+    sitemap index.
+
+    :param sections: optional list of sections to write; by default, all
+        sections are written
+    '''
+    store = sitemap_store()
+    if store is None:
+        raise Exception('Sitemap storage is not configured')
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    domain = Site.objects.get_current().domain
+    for section in SECTIONS:
+        if sections is None or section in sections \
+                or not os.path.exists(sitemap_path(section)):
+            _write_section(section, domain)
+    _write_index(domain)
+
+
+def update_sitemaps(eadids):
+    '''Update stored entries for published or deleted documents and
+    rewrite the sitemap files for any sections that changed.  Files are
+    only written once the store has been built (see :func:`is_built`),
+    since until then the stored entries do not cover every document.
+
+    :param eadids: list of eadids
+    :returns: set of changed sections
+    '''
+    changed = update_documents(eadids)
+    if changed and is_built():
+        write_sitemaps(changed)
+    return changed
+
+
+def sitemap_response(request, section=None, page=1):
+    '''Serve a stored sitemap file, gzip-encoded if the client accepts it,
+    with a Last-Modified header based on the file modification time.
+
+    :param section: sitemap section, or None for the sitemap index
+    :param page: page number within the section
+    :returns: :class:`django.http.HttpResponse`, or None if sitemap files
+        are not enabled, the store has not been built, or the requested
+        file has not been written
+    '''
+    if not is_built():
+        return None
+    path = sitemap_path(section, page)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                              stat.st_mtime, stat.st_size):
+        return http.HttpResponseNotModified()
+
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        with open(path, 'rb') as sitemap_file:
+            content = sitemap_file.read()
+        response = http.HttpResponse(content, content_type='application/xml')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        sitemap_file = gzip.open(path, 'rb')
+        try:
+            content = sitemap_file.read()
+        finally:
+            sitemap_file.close()
+        response = http.HttpResponse(content, content_type='application/xml')
+    response['Content-Length'] = len(content)
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,153 @@
+# file findingaids/fa/suggest.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Search suggestions (typeahead) for published finding aids.
+
+List titles, origination names, and controlaccess terms for the published
+collection are retrieved from eXist with a single query, shared through
+the Django cache, and held in process memory as a sorted array of
+normalized terms, so that prefix lookups are a binary search.  Both are
+refreshed when the collection changes (see :mod:`findingaids.fa.cachekeys`).
+The number of terms held in memory is limited to
+**SUGGEST_MAX_TERMS**.
+'''
+
+from bisect import bisect_left
+from collections import Counter, namedtuple
+import logging
+import threading
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import cache
+
+from findingaids.fa import cachekeys
+from findingaids.fa.models import FindingAid
+from findingaids.utils import normalize_whitespace
+
+logger = logging.getLogger(__name__)
+
+#: default maximum number of terms in the suggestion index
+DEFAULT_MAX_TERMS = 50000
+
+#: suggestion categories
+TITLE, NAME, SUBJECT = 'title', 'name', 'subject'
+
+Suggestion = namedtuple('Suggestion', ['label', 'category', 'eadid'])
+'''Search suggestion: display label, category (title, name, or subject),
+and eadid (for titles only)'''
+
+
+def max_terms():
+    '''Maximum number of terms in the suggestion index:
+    **SUGGEST_MAX_TERMS** if configured, otherwise 50,000.'''
+    return getattr(settings, 'SUGGEST_MAX_TERMS', DEFAULT_MAX_TERMS)
+
+
+def normalize_term(term):
+    '''Normalize a term or prefix for matching: remove accents, lower case,
+    and normalize whitespace.'''
+    if not isinstance(term, unicode):
+        term = term.decode('utf-8')
+    term = unicodedata.normalize('NFKD', term)
+    term = u''.join(c for c in term if not unicodedata.combining(c))
+    return normalize_whitespace(term.lower()).strip()
+
+
+def suggestion_terms():
+    '''Suggestion terms for the published collection: every list title,
+    and origination names and controlaccess terms ordered by the number of
+    documents they occur in, limited to :meth:`max_terms` in total.
+    Cached until the collection changes.
+
+    :returns: list of :class:`Suggestion`
+    '''
+    cache_key = cachekeys.collection_key('suggest-terms', max_terms())
+    terms = cache.get(cache_key)
+    if terms is None:
+        titles = []
+        counts = Counter()
+        findingaids = FindingAid.objects.only('eadid', 'list_title', 'origination_names',
+                                              'controlaccess_terms')
+        for fa in findingaids:
+            title = normalize_whitespace(unicode(fa.list_title)).strip()
+            if title:
+                titles.append(Suggestion(title, TITLE, fa.eadid.value))
+            # count each term once per document
+            counts.update(set((name, NAME) for name in fa.origination_names if name) |
+                          set((term, SUBJECT) for term in fa.controlaccess_terms if term))
+        others = [Suggestion(label, category, None) for (label, category), count
+                  in sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+        terms = (titles + others)[:max_terms()]
+        if len(titles) + len(others) > len(terms):
+            logger.info('Suggestion index limited to %d of %d terms' %
+                        (len(terms), len(titles) + len(others)))
+        cache.set(cache_key, terms, cachekeys.timeout())
+    return terms
+
+
+class SuggestIndex(object):
+    '''Sorted array of normalized terms for prefix lookup.
+
+    :param terms: list of :class:`Suggestion`
+    '''
+
+    def __init__(self, terms):
+        entries = sorted((normalize_term(s.label), s) for s in terms)
+        #: sorted list of normalized terms
+        self.keys = [key for key, suggestion in entries]
+        #: :class:`Suggestion` for each key
+        self.suggestions = [suggestion for key, suggestion in entries]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, prefix, limit=10):
+        '''Find terms starting with a prefix, ignoring case and accents.
+
+        :param prefix: text entered so far
+        :param limit: maximum number of suggestions to return
+        :returns: list of :class:`Suggestion`, in alphabetical order
+        '''
+        prefix = normalize_term(prefix)
+        if not prefix:
+            return []
+        results = []
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(results) < limit and \
+                self.keys[i].startswith(prefix):
+            results.append(self.suggestions[i])
+            i += 1
+        return results
+
+
+_index = {}
+_index_lock = threading.Lock()
+
+
+def suggest_index():
+    '''Suggestion index for the published collection, built once per
+    process for each collection generation.
+
+    :rtype: :class:`SuggestIndex`
+    '''
+    key = cachekeys.collection_key('suggest-index', max_terms())
+    with _index_lock:
+        if key not in _index:
+            _index.clear()
+            _index[key] = SuggestIndex(suggestion_terms())
+        return _index[key]
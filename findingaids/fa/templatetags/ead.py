@@ -16,16 +16,25 @@
 
 """
 Custom template filters for converting EAD tags to HTML.
+
+Formatted fragments can be memoized while a view renders a single
+document; see :meth:`memoize_fragments`.
 """
 
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+
 from django import template
-from django.utils.html import conditional_escape, escape
+from django.conf import settings
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
 from eulxml.xmlmap.eadmap import EAD_NAMESPACE
 from findingaids.fa.models import title_rdf_identifier
 
-__all__ = ['format_ead', 'format_ead_rdfa', 'series_section_rdfa']
+__all__ = ['format_ead', 'format_ead_rdfa', 'series_section_rdfa',
+           'memoize_fragments']
 
 register = template.Library()
 
@@ -396,12 +405,17 @@ def format_ead(value, autoescape=None, rdfa=False, default_rel=None):
     """
 
     if autoescape:
-        esc = conditional_escape
+        esc = escape_text
     else:
         esc = lambda x: x
 
     if hasattr(value, 'node'):
-        result = format_ead_node(value.node, esc, rdfa, default_rel)
+        key = _fragment_key(value.node, bool(autoescape), rdfa, default_rel)
+        result = fragment_cache.get(key) if key is not None else None
+        if result is None:
+            result = format_ead_node(value.node, esc, rdfa, default_rel)
+            if key is not None:
+                fragment_cache.set(key, result)
     else:
         result = ''
 
@@ -420,66 +434,180 @@ def format_ead_rdfa(value, default_rel=None, autoescape=None):
 
 
 def format_ead_node(node, escape, rdfa=False, default_rel=None):
-    '''Recursive method to generate HTML with the text and any
-    formatting for the contents of an EAD node.
+    '''Generate HTML with the text and any formatting for the contents
+    of an EAD node, in a single pass over the node and its descendants.
 
     :param node: lxml element or node to be converted from EAD to HTML
     :param escape: template escape method to be used on node text content
     :returns: string with the HTML output
     '''
-    # find any start/end tags for the current element
-
-    # check for supported render attributes
-    rend = node.get('render', None)
-
+    contents = []
+    # pending nodes and end strings, in reverse document order
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, basestring):
+            contents.append(item)
+            continue
+
+        start, end = _node_markup(item, rdfa, default_rel)
+        contents.append(start)
+        # include any text directly in this node, before the first child
+        if item.text is not None:
+            contents.append(escape(item.text))
+        # end tag for this node + any tail text, after all child nodes
+        if item.tail is not None:
+            end += escape(item.tail)
+        stack.append(end)
+        children = list(item)
+        children.reverse()
+        stack.extend(children)
+
+    return u''.join(contents)
+
+
+def escape_text(text):
+    '''HTML-escape the text content of an lxml node.  Equivalent to
+    :meth:`django.utils.html.conditional_escape` for node text, which is
+    always a plain string, without the overhead of checking for and
+    marking safe strings on every text node.'''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;') \
+               .replace('"', '&quot;').replace("'", '&#39;')
+
+
+def _node_markup(node, rdfa=False, default_rel=None):
+    # find any start/end tags for a single element
+    tag = node.tag
     rdfa_start, rdfa_end = '', ''
 
     # convert names to semantic web / rdfa if requested
-    if rdfa and node.tag in name_tags.keys():
+    if rdfa and tag in name_tags:
         rdfa_start, rdfa_end = format_nametag(node, default_rel)
 
-    elif rdfa and node.tag in semantic_tags.keys():
-        rdfa_start, rdfa_end = semantic_tags[node.tag](node, default_rel)
+    elif rdfa and tag in semantic_tags:
+        rdfa_start, rdfa_end = semantic_tags[tag](node, default_rel)
 
     # convert display/formatting
     # NOTE: a few semantic tags also have formatting conversion
 
-    start, end = '', ''
-    if rend is not None and rend in rend_attributes.keys():
-        s, e = rend_attributes[rend]
-        start += s
-        end = e + end
+    # check for supported render attributes
+    rend = node.get('render', None)
+    if rend in rend_attributes:
+        start, end = rend_attributes[rend]
 
     # simple tags that can be converted to html markup
-    elif node.tag in simple_tags.keys():
-        start, end = simple_tags[node.tag]
+    elif tag in simple_tags:
+        start, end = simple_tags[tag]
 
     # more complex tags
-    elif node.tag in other_tags.keys():
-        start, end = other_tags[node.tag](node)
+    elif tag in other_tags:
+        start, end = other_tags[tag](node)
 
     # unsupported tags that do not get converted
     else:
         start, end = '', ''
 
-    start += rdfa_start
-    end = rdfa_end + end
+    return (start + rdfa_start, rdfa_end + end)
+
+
+#: default maximum number of formatted fragments kept in memory
+DEFAULT_FRAGMENT_CACHE_SIZE = 50000
+
+
+class FragmentCache(object):
+    '''Bounded in-process cache of formatted EAD fragments, discarding
+    the oldest fragments when full.  The size is **EAD_FRAGMENT_CACHE_SIZE**
+    if configured, otherwise 50,000 fragments; a size of 0 disables the
+    cache.'''
 
-    # list of text contents to be compiled
-    contents = [start]  # start tag
-    # include any text directly in this node, before the first child
-    if node.text is not None:
-        contents.append(escape(node.text))
+    def __init__(self):
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
 
-    # format any child nodes and add to the list of text
-    contents.extend([format_ead_node(el, escape=escape, rdfa=rdfa,
-                                     default_rel=default_rel)
-                     for el in node.iterchildren()])
+    @property
+    def max_size(self):
+        return getattr(settings, 'EAD_FRAGMENT_CACHE_SIZE',
+                       DEFAULT_FRAGMENT_CACHE_SIZE)
 
-    # end tag for this node + any tail text
-    contents.extend([end, escape(node.tail or '')])
+    def get(self, key):
+        # lookups are not reordered, so they don't need the lock
+        return self._fragments.get(key)
 
-    return ''.join(contents)
+    def set(self, key, value):
+        max_size = self.max_size
+        if max_size <= 0:
+            return
+        with self._lock:
+            self._fragments[key] = value
+            while len(self._fragments) > max_size:
+                self._fragments.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+#: formatted fragments for documents registered with :meth:`memoize_fragments`
+fragment_cache = FragmentCache()
+
+# documents registered for memoization in the current thread, by id of
+# the root element; the root element is held so the id can't be reused
+_documents = threading.local()
+
+
+@contextmanager
+def memoize_fragments(xmlobject, *key):
+    '''Context manager to memoize HTML generated by :meth:`format_ead`
+    and :meth:`format_ead_rdfa` for any part of a document while a page
+    is rendered.  Fragments are stored in :data:`fragment_cache` by the
+    key, the path to the formatted node, and the filter options, so the
+    key must identify both the document version and the way it was
+    retrieved, e.g.::
+
+        with memoize_fragments(ead, 'findingaid', checksum):
+            response = render(request, 'fa/findingaid.html', context)
+
+    Search term highlighting adds content to the document without
+    changing its hash, so highlighted documents should not be memoized.
+
+    :param xmlobject: :class:`~eulxml.xmlmap.XmlObject` for any node in
+        the document
+    :param key: values identifying the document version, e.g. the
+        document hash
+    '''
+    root = xmlobject.node.getroottree().getroot()
+    documents = getattr(_documents, 'roots', None)
+    if documents is None:
+        documents = _documents.roots = {}
+    previous = documents.get(id(root))
+    documents[id(root)] = (root, key)
+    try:
+        yield
+    finally:
+        if previous is None:
+            del documents[id(root)]
+        else:
+            documents[id(root)] = previous
+
+
+def _fragment_key(node, autoescape, rdfa, default_rel):
+    # cache key for formatting a node, if its document is being memoized;
+    # nodes with no child elements are not worth memoizing, since
+    # generating a key costs about as much as formatting their text
+    documents = getattr(_documents, 'roots', None)
+    if not documents or not len(node):
+        return None
+    tree = node.getroottree()
+    root = tree.getroot()
+    registered = documents.get(id(root))
+    if registered is None or registered[0] is not root:
+        return None
+    return registered[1] + (tree.getpath(node), autoescape, rdfa, default_rel)
 
 EAD_SCOPECONTENT = '{%s}scopecontent' % EAD_NAMESPACE
 EAD_BIOGHIST = '{%s}bioghist' % EAD_NAMESPACE
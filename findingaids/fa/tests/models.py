@@ -24,10 +24,13 @@ from django.test.utils import override_settings
 
 from eulxml.xmlmap import load_xmlobject_from_file, load_xmlobject_from_string
 from eulxml.xmlmap.eadmap import EAD_NAMESPACE
+from eulexistdb.query import QuerySet
 from eulexistdb.testutil import TestCase
 
+from findingaids.fa import cachekeys
 from findingaids.fa.models import FindingAid, LocalComponent, EadRepository, \
-    Series, Title, PhysicalDescription
+    Series, Title, PhysicalDescription, Deleted, CollectionState, CatalogEntry, \
+    Archive, title_index
 # from findingaids.fa.utils import pages_to_show, ead_lastmodified, \
     # collection_lastmodified
 
@@ -209,6 +212,173 @@ class EadRepositoryTestCase(TestCase):
         self.assert_('Manuscript, Archives, and Rare Book Library' in repos)
 
 
+class TitleIndexTestCase(TestCase):
+    exist_fixtures = {'files': [path.join(exist_fixture_path, 'abbey244.xml')]}
+
+    def test_title_index(self):
+        cachekeys.invalidate_collection()
+        index = title_index('A')
+        self.assertEqual(1, len(index))
+        self.assertEqual('abbey244', index[0].eadid)
+        self.assert_(index[0].list_title.startswith('Abbey'))
+        self.assertEqual([], title_index('Z'))
+
+        # cached index should be used until cleared
+        with patch('findingaids.fa.models.FindingAid') as mockfa:
+            self.assertEqual(index, title_index('A'))
+            self.assertEqual(0, mockfa.objects.filter.call_count)
+            cachekeys.invalidate_collection()
+            title_index('A')
+            mockfa.objects.filter.assert_called_with(list_title__startswith='A')
+
+
+class CollectionStateTestCase(TestCase):
+    exist_fixtures = {'files': [path.join(exist_fixture_path, 'abbey244.xml')]}
+
+    def test_current(self):
+        # initialized from eXist when no state has been recorded
+        state = CollectionState.current()
+        self.assertEqual(settings.EXISTDB_ROOT_COLLECTION, state.collection)
+        self.assertEqual(1, state.count)
+        self.assertEqual(0, state.generation)
+        fa = FindingAid.objects.only('last_modified').get(eadid='abbey244')
+        self.assertEqual(fa.last_modified, state.last_modified)
+
+        # recorded state is used without querying eXist
+        with patch.object(QuerySet, '_runQuery') as mockquery:
+            self.assertEqual(state, CollectionState.current())
+            self.assertEqual(0, mockquery.call_count)
+
+        # no documents
+        state = CollectionState.current('/db/missing')
+        self.assertEqual(0, state.count)
+        self.assertEqual(None, state.last_modified)
+
+        # new collection is counted through the real manager and queryset
+        with patch.object(QuerySet, 'count', return_value=0) as mockcount:
+            state = CollectionState.current('/db/new')
+            self.assertEqual(1, mockcount.call_count)
+            self.assertEqual(0, state.count)
+            CollectionState.update('/db/new')
+            self.assertEqual(2, mockcount.call_count)
+
+    def test_update(self):
+        state = CollectionState.current()
+        updated = CollectionState.update()
+        self.assertEqual(state.generation + 1, updated.generation)
+        self.assert_(updated.last_modified > state.last_modified)
+        self.assertEqual(1, updated.count)
+
+        # last modified should not go backwards
+        previous = updated
+        updated = CollectionState.update(modified=state.last_modified)
+        self.assertEqual(previous.generation + 1, updated.generation)
+        self.assertEqual(previous.last_modified, updated.last_modified)
+
+        # saving a deleted record updates the public collection
+        record = Deleted.objects.create(eadid='eadid', title='test deleted record')
+        updated = CollectionState.current()
+        self.assertEqual(previous.generation + 2, updated.generation)
+        self.assertEqual(record.date, updated.last_modified)
+
+    def test_eadids(self):
+        state = CollectionState.current()
+        self.assertEqual(set(['abbey244']), state.eadids())
+
+        # retrieved from eXist once per collection generation
+        with patch.object(FindingAid.objects, 'only', wraps=FindingAid.objects.only) as mockonly:
+            self.assertEqual(set(['abbey244']), state.eadids())
+            self.assertEqual(0, mockonly.call_count)
+            cachekeys.invalidate_collection()
+            self.assertEqual(set(['abbey244']), state.eadids())
+            mockonly.assert_called_once_with('eadid')
+
+        self.assertEqual(set(), CollectionState.current('/db/missing').eadids())
+
+
+
+class CatalogEntryTestCase(TestCase):
+    exist_fixtures = {'files': [path.join(exist_fixture_path, 'abbey244.xml')]}
+
+    def setUp(self):
+        cachekeys.invalidate_collection()
+
+    def test_update(self):
+        archive = Archive.objects.create(label='MARBL', slug='marbl',
+            name='Manuscript, Archives, and Rare Book Library',
+            svn='https://svn.example.com/marbl')
+        self.assertFalse(CatalogEntry.is_complete())
+
+        entries = CatalogEntry.update(['abbey244', 'bogus'])
+        self.assertEqual(1, len(entries))
+        entry = CatalogEntry.published().get(eadid='abbey244')
+        fa = FindingAid.objects.only('document_name', 'hash', 'last_modified') \
+                               .get(eadid='abbey244')
+        self.assertEqual(fa.document_name, entry.document_name)
+        self.assertEqual(fa.hash, entry.hash)
+        self.assertEqual(fa.last_modified, entry.last_modified)
+        self.assertEqual('A', entry.first_letter)
+        self.assertEqual(archive, entry.archive)
+        self.assert_(CatalogEntry.is_complete())
+
+        # same number of entries, but not the same documents
+        CatalogEntry.published().filter(eadid='abbey244').update(eadid='stale')
+        self.assert_(CatalogEntry.is_complete(),
+                     'result should be cached for the collection generation')
+        CatalogEntry.clear_complete()
+        self.assertFalse(CatalogEntry.is_complete())
+        CatalogEntry.published().filter(eadid='stale').update(eadid='abbey244')
+        cachekeys.invalidate_collection()
+        self.assert_(CatalogEntry.is_complete())
+
+        # documents not found in eXist are removed
+        CatalogEntry.objects.create(collection=settings.EXISTDB_ROOT_COLLECTION,
+                                    eadid='bogus', document_name='bogus.xml')
+        CatalogEntry.update(['bogus'])
+        self.assertFalse(CatalogEntry.published().filter(eadid='bogus').exists())
+
+        CatalogEntry.remove('abbey244')
+        self.assertEqual(0, CatalogEntry.published().count())
+        self.assertFalse(CatalogEntry.is_complete())
+
+    def test_archive_saved(self):
+        name = 'Manuscript, Archives, and Rare Book Library'
+        CatalogEntry.update(['abbey244'])
+        entry = CatalogEntry.published().get(eadid='abbey244')
+        self.assertEqual(name, entry.repository)
+        self.assertEqual(None, entry.archive)
+
+        # entries are linked when a matching archive is added
+        archive = Archive.objects.create(label='MARBL', slug='marbl', name=name,
+            svn='https://svn.example.com/marbl')
+        self.assertEqual(archive, CatalogEntry.published().get(eadid='abbey244').archive)
+
+        # and unlinked when it is renamed
+        archive.name = 'Rose Library'
+        archive.save()
+        self.assertEqual(None, CatalogEntry.published().get(eadid='abbey244').archive)
+        archive.name = name
+        archive.save()
+        self.assertEqual(archive, CatalogEntry.published().get(eadid='abbey244').archive)
+
+        # cached completeness is cleared when entries are relinked
+        self.assert_(CatalogEntry.is_complete())
+        CatalogEntry.published().update(eadid='stale')
+        archive.save()
+        self.assertFalse(CatalogEntry.is_complete())
+
+    def test_publish(self):
+        CatalogEntry.objects.create(collection=settings.EXISTDB_PREVIEW_COLLECTION,
+                                    eadid='abbey244', document_name='abbey244.xml')
+        self.assertFalse(CatalogEntry.is_complete())
+        CatalogEntry.publish(['abbey244'])
+        self.assert_(CatalogEntry.is_complete(),
+                     'cached completeness should be cleared on publish')
+        self.assertEqual(1, CatalogEntry.published().filter(eadid='abbey244').count())
+        self.assertFalse(CatalogEntry.objects.filter(
+            collection=settings.EXISTDB_PREVIEW_COLLECTION).exists())
+
+
 class SeriesTestCase(DjangoTestCase):
 
     # plain file item with no semantic tags
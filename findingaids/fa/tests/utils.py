@@ -14,33 +14,78 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import BaseHTTPServer
+from cStringIO import StringIO
 from datetime import datetime
+from glob import glob
+import gzip
+import json
+import logging
+import multiprocessing
 from os import path
+import os
 import re
+import resource
+from shutil import rmtree
+import SocketServer
+import sys
+import tempfile
+import threading
 from time import sleep
+import xmlrpclib
 from lxml import etree
-from mock import patch
+from mock import Mock, patch
 import rdflib
+import requests
 
+from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management.base import CommandError
 from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpRequest
-from django.template import RequestContext, Template, Context, loader
+from django.http import Http404, HttpRequest, HttpResponse
+from django.template import RequestContext, Template, Context, Engine, \
+    TemplateDoesNotExist, loader
 from django.test import TestCase as DjangoTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 
-from eulexistdb.db import ExistDB
+from eulexistdb import db as exist_db
+from eulexistdb.db import ExistDB, RequestsTransport
+from eulexistdb.exceptions import DoesNotExist
+from eulexistdb.query import QuerySet
 from eulexistdb.testutil import TestCase
-from eulxml.xmlmap import XmlObject, load_xmlobject_from_string
+from eulxml.xmlmap import XmlObject, load_xmlobject_from_string, \
+    load_xmlobject_from_file
 from eulxml.xmlmap.eadmap import EAD_NAMESPACE
 
-from findingaids.fa.models import FindingAid, Deleted, Series, \
-    title_rdf_identifier
+from findingaids.fa.models import FindingAid, Deleted, Series, FileComponent, \
+    CollectionState, FacetRecord, SitemapEntry, TitleIndexEntry, title_rdf_identifier
 from findingaids.fa.forms import boolean_to_upper, AdvancedSearchForm
-from findingaids.fa.templatetags.ead import format_ead, XLINK_NAMESPACE
+from findingaids.fa.templatetags.ead import format_ead, XLINK_NAMESPACE, \
+    memoize_fragments, fragment_cache
 from findingaids.fa.templatetags.ark_pid import ark_pid
+from findingaids.fa import utils as fa_utils
+from findingaids.fa import cachekeys, pdfstore, sitemapstore, fop, fulltext, \
+    facets, suggest, rdf, querybatch, lucene
 from findingaids.fa.utils import pages_to_show, ead_lastmodified, ead_etag, \
-    collection_lastmodified, exist_datetime_with_timezone, alpha_pagelabels
+    collection_lastmodified, collection_etag, exist_datetime_with_timezone, \
+    alpha_pagelabels, ead_validators, cached_ead_validators, invalidate_findingaid, \
+    iter_render, parse_template, render_to_pdf
+from findingaids.fa.navigation import findingaid_navigation
+from findingaids.fa.views import full_findingaid_context, _subseries_links, \
+    _navigation_links
+from findingaids.rdf_middleware import RDFaMiddleware
+from findingaids import exist_middleware
+from findingaids.exist_middleware import ExistQueryTimingMiddleware
+from findingaids.fa import benchmark
+from findingaids.fa.querybatch import QueryBatch, QueryPool, run_queries, \
+    ExistDB as BatchExistDB
+from findingaids.fa.management.commands import exist_query_stats, response_times, \
+    sitemaps as sitemaps_cmd
+from findingaids import localexist, existpool
 
 
 ## unit tests for utility methods, custom template tags, etc
@@ -128,6 +173,43 @@ class UtilsTest(TestCase):
         # invalid eadid
         self.assertRaises(Http404, ead_etag, 'rqst', 'bogusid')
 
+    def test_ead_validators(self):
+        invalidate_findingaid('abbey244')
+        rqst = HttpRequest()
+        with patch('findingaids.fa.utils.get_findingaid',
+                   wraps=fa_utils.get_findingaid) as mock_get:
+            # etag and last-modified for a single request share one query
+            checksum = ead_etag(rqst, 'abbey244')
+            modified = ead_lastmodified(rqst, 'abbey244')
+            self.assertEqual(1, mock_get.call_count,
+                'etag and last-modified should only query eXist once per request')
+            validators = ead_validators(rqst, 'abbey244')
+            self.assertEqual(checksum, validators['hash'])
+            self.assertEqual(modified,
+                exist_datetime_with_timezone(validators['last_modified']))
+
+            # a new request should use the cached values
+            mock_get.reset_mock()
+            self.assertEqual(checksum, ead_etag(HttpRequest(), 'abbey244'))
+            self.assertEqual(0, mock_get.call_count,
+                'cached validators should be used without querying eXist')
+
+            # clearing the cache should require a new query
+            invalidate_findingaid('abbey244')
+            self.assertEqual(checksum, ead_etag(HttpRequest(), 'abbey244'))
+            self.assertEqual(1, mock_get.call_count,
+                'validators should be retrieved from eXist after cache is cleared')
+
+        # cached values only; eXist is not queried
+        validators = ead_validators(rqst, 'abbey244')
+        self.assertEqual(validators, cached_ead_validators(HttpRequest(), 'abbey244'))
+        invalidate_findingaid('abbey244')
+        self.assertEqual(None, cached_ead_validators(HttpRequest(), 'abbey244'))
+
+        # not found should not be cached
+        self.assertRaises(Http404, ead_validators, rqst, 'bogusid')
+        self.assertEqual(None, cache.get(cachekeys.document_key('ead-validators', 'bogusid')))
+
     def test_collection_lastmodified(self):
         modified = collection_lastmodified('rqst')
         self.assert_(isinstance(modified, datetime),
@@ -154,13 +236,873 @@ class UtilsTest(TestCase):
             modified = collection_lastmodified('rqst')
             self.assertEqual(exist_datetime_with_timezone(record.date), modified,
                 'collection last-modified should return most recently deleted document when no data is in eXist')
-            # no exist data, no deleted records
+            # no exist data, no deleted records, no recorded state
             record = Deleted.objects.get(eadid='eadid')     # retrieve datetime from DB
             record.delete()
+            CollectionState.objects.filter(collection='/db/missing').delete()
             modified = collection_lastmodified('rqst')
             self.assertEqual(None, modified,
                 'collection last-modified should return None when no data is in eXist or deleted')
 
+    def test_collection_etag(self):
+        etag = collection_etag('rqst')
+        # etag should stay the same until the collection changes
+        self.assertEqual(etag, collection_etag('rqst'))
+        with patch.object(QuerySet, '_runQuery') as mockquery:
+            collection_etag('rqst')
+            self.assertEqual(0, mockquery.call_count,
+                'collection etag should not query eXist once state is recorded')
+        CollectionState.update()
+        self.assertNotEqual(etag, collection_etag('rqst'))
+
+
+
+class PdfStoreTest(DjangoTestCase):
+    checksum = 'c0ffee'
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp(prefix='findingaids-pdfstore-')
+        self.override = override_settings(FINDINGAID_PDF_STORE=self.store_dir)
+        self.override.enable()
+        self.storage = pdfstore.pdf_storage()
+        self.content = ''.join(chr(i % 256) for i in range(1000))
+        self.name = pdfstore.pdf_name('abbey244', self.checksum)
+        self.storage.save(self.name, ContentFile(self.content))
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        self.override.disable()
+        rmtree(self.store_dir)
+
+    def test_pdf_storage(self):
+        with override_settings(FINDINGAID_PDF_STORE=None):
+            self.assertEqual(None, pdfstore.pdf_storage())
+        self.assertEqual(self.name, pdfstore.stored_pdf('abbey244', self.checksum))
+        self.assertEqual(None, pdfstore.stored_pdf('abbey244', 'other'))
+
+    def test_remove_pdfs(self):
+        old = self.storage.save(pdfstore.pdf_name('abbey244', 'old'), ContentFile('old'))
+        # alternate name for the current version, e.g. from an older store
+        alternate = self.storage.save(self.name, ContentFile('alternate'))
+        self.assertNotEqual(self.name, alternate)
+        pending = self.storage.save(self.name + '.x' + pdfstore.TEMP_SUFFIX, ContentFile(''))
+        pdfstore.remove_pdfs('abbey244', self.checksum)
+        self.assertFalse(self.storage.exists(old))
+        self.assertFalse(self.storage.exists(alternate))
+        self.assert_(self.storage.exists(self.name))
+        self.assert_(self.storage.exists(pending))
+        pdfstore.remove_pdfs('abbey244')
+        self.assertFalse(self.storage.exists(self.name))
+        # no errors when nothing is stored
+        pdfstore.remove_pdfs('bogus')
+
+    @patch('findingaids.fa.pdfstore.generate_pdf')
+    @patch('findingaids.fa.pdfstore.get_findingaid')
+    @patch('findingaids.fa.views.full_findingaid_context')
+    def test_store_pdf(self, mockcontext, mockget, mockgenerate):
+        self.storage.save(pdfstore.pdf_name('abbey244', 'old'), ContentFile('old'))
+        new_name = pdfstore.pdf_name('abbey244', 'new')
+
+        def generate(template, context, filename):
+            # another generation of the same version finishes first
+            self.storage.save(new_name, ContentFile('other'))
+            with open(filename, 'w') as pdf:
+                pdf.write('new')
+            return True
+        mockgenerate.side_effect = generate
+
+        self.assertEqual(new_name, pdfstore.store_pdf('abbey244', 'new'))
+        dirs, files = self.storage.listdir('abbey244')
+        self.assertEqual(['new.pdf'], files,
+            'PDF should replace the concurrently stored version; older versions removed')
+        self.assertEqual('new', self.storage.open(new_name).read())
+        self.assertEqual(new_name, pdfstore.stored_pdf('abbey244', 'new'))
+
+        # already stored; not generated again
+        mockgenerate.reset_mock()
+        self.assertEqual(new_name, pdfstore.store_pdf('abbey244', 'new'))
+        self.assertEqual(0, mockgenerate.call_count)
+
+        # failed generation leaves nothing behind
+        mockgenerate.side_effect = None
+        mockgenerate.return_value = False
+        self.assertRaises(Exception, pdfstore.store_pdf, 'abbey244', 'newer')
+        self.assertEqual(['new.pdf'], self.storage.listdir('abbey244')[1])
+
+    def test_pdf_response(self):
+        rqst = self.factory.get('/')
+        response = pdfstore.pdf_response(rqst, self.name, self.checksum, 'abbey244.pdf')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/pdf', response['Content-Type'])
+        self.assertEqual('inline; filename=abbey244.pdf', response['Content-Disposition'])
+        self.assertEqual('bytes', response['Accept-Ranges'])
+        self.assertEqual(self.content, ''.join(response.streaming_content))
+
+        # byte ranges
+        rqst = self.factory.get('/', HTTP_RANGE='bytes=100-199')
+        response = pdfstore.pdf_response(rqst, self.name, self.checksum)
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('bytes 100-199/1000', response['Content-Range'])
+        self.assertEqual('100', response['Content-Length'])
+        self.assertEqual(self.content[100:200], ''.join(response.streaming_content))
+
+        rqst = self.factory.get('/', HTTP_RANGE='bytes=900-')
+        response = pdfstore.pdf_response(rqst, self.name, self.checksum)
+        self.assertEqual(self.content[900:], ''.join(response.streaming_content))
+
+        rqst = self.factory.get('/', HTTP_RANGE='bytes=-50')
+        response = pdfstore.pdf_response(rqst, self.name, self.checksum)
+        self.assertEqual('bytes 950-999/1000', response['Content-Range'])
+        self.assertEqual(self.content[950:], ''.join(response.streaming_content))
+
+        rqst = self.factory.get('/', HTTP_RANGE='bytes=2000-')
+        response = pdfstore.pdf_response(rqst, self.name, self.checksum)
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */1000', response['Content-Range'])
+
+        # if-range: ranges only honored when etag matches
+        rqst = self.factory.get('/', HTTP_RANGE='bytes=100-199',
+                                HTTP_IF_RANGE='"%s"' % self.checksum)
+        response = pdfstore.pdf_response(rqst, self.name, self.checksum)
+        self.assertEqual(206, response.status_code)
+        rqst = self.factory.get('/', HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE='"old"')
+        response = pdfstore.pdf_response(rqst, self.name, self.checksum)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.content, ''.join(response.streaming_content))
+
+
+
+class SitemapStoreTest(DjangoTestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp(prefix='findingaids-sitemaps-')
+        self.override = override_settings(SITEMAP_STORE=self.store_dir)
+        self.override.enable()
+        self.ead = load_xmlobject_from_file(path.join(exist_fixture_path, 'raoul548.xml'),
+                                            FindingAid)
+        self.ead.last_modified = datetime(2012, 3, 1)
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        self.override.disable()
+        rmtree(self.store_dir)
+
+    def _read(self, section=None, page=1):
+        sitemap_file = gzip.open(sitemapstore.sitemap_path(section, page))
+        try:
+            return sitemap_file.read()
+        finally:
+            sitemap_file.close()
+
+    def test_document_entries(self):
+        entries = sitemapstore.document_entries(self.ead)
+        locations = dict((e.location, e.section) for e in entries)
+        self.assertEqual('findingaids', locations[reverse('fa:findingaid',
+                                                          kwargs={'id': 'raoul548'})])
+        self.assertEqual('findingaids-series', locations[reverse('fa:series-or-index',
+            kwargs={'id': 'raoul548', 'series_id': 's1'})])
+        self.assertEqual('findingaids-subseries', locations[reverse('fa:series2',
+            kwargs={'id': 'raoul548', 'series_id': 's1', 'series2_id': 's1.1'})])
+        self.assertEqual('findingaids-index', locations[reverse('fa:series-or-index',
+            kwargs={'id': 'raoul548', 'series_id': 'index1'})])
+        self.assert_(all(e.lastmod == self.ead.last_modified for e in entries))
+
+    @patch('findingaids.fa.sitemapstore.FindingAid')
+    def test_update_sitemaps(self, mockfa):
+        mockfa.objects.also.return_value.get.return_value = self.ead
+        # before the store is built, only entries are updated
+        changed = sitemapstore.update_sitemaps(['raoul548'])
+        self.assert_('findingaids-series' in changed)
+        self.assert_(SitemapEntry.objects.filter(eadid='raoul548').count())
+        self.assertFalse(os.path.exists(sitemapstore.sitemap_path()))
+        self.assertFalse(os.path.exists(sitemapstore.sitemap_path('findingaids-series')))
+
+        SitemapEntry.objects.filter(eadid='raoul548').delete()
+        sitemapstore.write_sitemaps()
+        sitemapstore.mark_built()
+        changed = sitemapstore.update_sitemaps(['raoul548'])
+        self.assert_('findingaids-series' in changed)
+        series_url = reverse('fa:series-or-index', kwargs={'id': 'raoul548', 'series_id': 's1'})
+        self.assert_(series_url in self._read('findingaids-series'))
+        self.assert_('sitemap-findingaids-series.xml' in self._read())
+
+        # unchanged documents do not rewrite any files
+        self.assertEqual(set(), sitemapstore.update_sitemaps(['raoul548']))
+
+        # entries for documents that are no longer published are removed
+        mockfa.objects.also.return_value.get.side_effect = DoesNotExist
+        sitemapstore.update_sitemaps(['raoul548'])
+        self.assertFalse(SitemapEntry.objects.filter(eadid='raoul548').exists())
+        self.assert_(series_url not in self._read('findingaids-series'))
+
+    def test_pagination(self):
+        SitemapEntry.objects.bulk_create([
+            SitemapEntry(section='findingaids', eadid='doc%d' % i,
+                         location='/documents/doc%d/' % i) for i in range(5)])
+        with patch.object(sitemapstore, 'URLS_PER_FILE', new=2):
+            sitemapstore.write_sitemaps()
+            self.assertEqual(3, sitemapstore.section_pages('findingaids'))
+            self.assert_('sitemap-findingaids.xml?p=3' in self._read())
+            # extra pages are removed when a section shrinks
+            SitemapEntry.objects.filter(eadid='doc4').delete()
+            sitemapstore.write_sitemaps(['findingaids'])
+            self.assertEqual(2, sitemapstore.section_pages('findingaids'))
+
+    def test_sitemap_response(self):
+        self.assertEqual(None, sitemapstore.sitemap_response(self.factory.get('/')))
+        sitemapstore.write_sitemaps()
+        # files are not served until the store has been built
+        self.assertEqual(None, sitemapstore.sitemap_response(self.factory.get('/'), 'content'))
+        sitemapstore.mark_built()
+        response = sitemapstore.sitemap_response(self.factory.get('/'), 'content')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/xml', response['Content-Type'])
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assert_('<urlset' in response.content)
+
+        rqst = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = sitemapstore.sitemap_response(rqst, 'content')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', response['Vary'])
+
+        rqst = self.factory.get('/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        response = sitemapstore.sitemap_response(rqst, 'content')
+        self.assertEqual(304, response.status_code)
+
+        with override_settings(SITEMAP_STORE=None):
+            self.assertEqual(None, sitemapstore.sitemap_response(self.factory.get('/')))
+
+    @patch('findingaids.fa.management.commands.sitemaps.FindingAid')
+    @patch('findingaids.fa.sitemapstore.FindingAid')
+    def test_sitemaps_command(self, mockfa, mockcmdfa):
+        mockfa.objects.also.return_value.get.return_value = self.ead
+        mockcmdfa.objects.only.return_value = [self.ead]
+        SitemapEntry.objects.create(section='findingaids', eadid='old1',
+                                    location='/documents/old1/')
+        command = sitemaps_cmd.Command()
+        # updating specific documents does not write files for an unbuilt store
+        with patch('sys.stdout', new_callable=StringIO) as output:
+            command.handle('raoul548', eadids=['raoul548'], verbosity=1)
+        self.assert_('Sitemap files not written' in output.getvalue())
+        self.assertFalse(sitemapstore.is_built())
+        self.assertFalse(os.path.exists(sitemapstore.sitemap_path()))
+
+        # a full rebuild removes stale entries, writes files, and marks the store built
+        with patch('sys.stdout', new_callable=StringIO):
+            command.handle(eadids=[], verbosity=1)
+        self.assert_(sitemapstore.is_built())
+        self.assertFalse(SitemapEntry.objects.filter(eadid='old1').exists())
+        self.assert_('sitemap-findingaids-series.xml' in self._read())
+        self.assert_('/documents/old1/' not in self._read('findingaids'))
+
+        with override_settings(SITEMAP_STORE=None):
+            self.assertRaises(CommandError, command.handle, eadids=[], verbosity=1)
+
+
+def _peak_memory_increase(func, *args):
+    # increase in peak resident memory (ru_maxrss; kilobytes on linux)
+    # while running a function in a new process, so earlier tests and
+    # other allocations in this process do not affect the measurement
+    queue = multiprocessing.Queue()
+
+    def run():
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func(*args)
+        queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+    process = multiprocessing.Process(target=run)
+    process.start()
+    try:
+        return queue.get(timeout=120)
+    finally:
+        process.join()
+
+
+class IncrementalRenderTest(DjangoTestCase):
+    TEMPLATE = '''<html>{% load humanize %}<body>
+{% for group in groups %}<div class="{% if forloop.first %}first{% elif forloop.last %}last{% else %}middle{% endif %}">
+  {% for item in group %}<p>{{ forloop.parentloop.counter }}.{{ forloop.counter }}/{{ forloop.revcounter0 }} {{ item|upper }}</p>
+  {% empty %}<p>empty</p>{% endfor %}
+  {% with group|length as size %}<span>{{ size|apnumber }}</span>{% endwith %}
+</div>{% endfor %}
+{% for x in missing %}{{ x }}{% empty %}<p>none</p>{% endfor %}
+{% for a, b in pairs %}{{ a }}={{ b }}{% endfor %}
+{% if missing %}no{% else %}{{ title }}{% endif %}
+{% with label=title %}{% for group in groups %}<i>{{ label }} {{ group|length }}</i>{% endfor %}{% endwith %}
+{% include inner %}{% include inner with title="other" %}{% include inner with title="only" only %}
+</body></html>'''
+    INNER = '''<ul>{% for group in groups %}<li>{{ title }} {{ forloop.counter }}</li>{% endfor %}</ul>'''
+
+    def test_iter_render(self):
+        template = Template(self.TEMPLATE)
+        context_dict = {
+            'groups': [['a', 'b'], [], ['c'], ['d', 'e', 'f']],
+            'pairs': [(1, 2), (3, 4)],
+            'title': 'Title & <b>',
+            'inner': Template(self.INNER)}
+        chunks = list(iter_render(template, Context(context_dict)))
+        self.assert_(len(chunks) > 10, 'template should be rendered in multiple chunks')
+        self.assertEqual(template.render(Context(context_dict)), ''.join(chunks))
+        # with blocks and included templates are rendered incrementally
+        self.assert_('other' in chunks)
+        self.assert_('<i>' in chunks)
+
+    def test_iter_render_include_error(self):
+        # templates that can't be loaded are handled as by the include tag
+        context_dict = {'inner': 'fa/bogus.html'}
+        template = Engine(debug=False).from_string('<p>{% include inner %}</p>')
+        self.assertEqual('<p></p>', ''.join(iter_render(template, Context(context_dict))))
+        template = Engine(debug=True).from_string('<p>{% include inner %}</p>')
+        self.assertRaises(TemplateDoesNotExist, list, iter_render(template, Context(context_dict)))
+
+    def test_iter_render_fixtures(self):
+        # incremental rendering reimplements parts of the django if, for,
+        # with, and include tags; check that the full finding aid renders
+        # exactly as django renders it for every fixture
+        template = loader.get_template('fa/full.html').template
+        for fixture in sorted(glob(path.join(exist_fixture_path, '*.xml'))):
+            ead = load_xmlobject_from_file(fixture, FindingAid)
+            context = full_findingaid_context(ead, 'pdf')
+            self.assertEqual(template.render(Context(context)),
+                             ''.join(iter_render(template, Context(context))),
+                             'incremental rendering should match for %s' % path.basename(fixture))
+
+    def test_parse_template(self):
+        # streamed parse of the full finding aid should match parsing the
+        # fully rendered template
+        ead = load_xmlobject_from_file(path.join(exist_fixture_path, 'raoul548.xml'),
+                                       FindingAid)
+        context = full_findingaid_context(ead, 'pdf')
+        expected = etree.fromstring(loader.get_template('fa/full.html').render(Context(context)))
+        parsed = parse_template('fa/full.html', context, chunk_size=1024)
+        self.assertEqual(etree.tostring(expected), etree.tostring(parsed))
+
+    def test_peak_memory(self):
+        # streamed rendering and parsing of a large document should need
+        # much less memory than rendering it to a string and then parsing
+        template = Template('<html><body>{% for item in items %}<p>{{ item }}</p>' +
+                            '{% endfor %}</body></html>')
+        context_dict = {'items': ['%06d %s' % (i, 'x' * 1000) for i in range(20000)]}
+
+        def render_and_parse():
+            etree.fromstring(template.render(Context(context_dict)).encode('utf-8'))
+
+        full = _peak_memory_increase(render_and_parse)
+        with patch('findingaids.fa.utils.get_template') as mockget:
+            mockget.return_value.template = template
+            streamed = _peak_memory_increase(parse_template, 'large.html', context_dict)
+        self.assert_(streamed < full / 2,
+            'streamed parse should use less than half the peak memory of a full render ' +
+            '(%d KB streamed, %d KB full)' % (streamed, full))
+
+    @patch('findingaids.fa.utils.generate_pdf')
+    def test_render_to_pdf(self, mockgenerate):
+        def write_pdf(template, context, filename):
+            with open(filename, 'w') as pdf:
+                pdf.write('%PDF-1.4 test')
+            return True
+        mockgenerate.side_effect = write_pdf
+        response = render_to_pdf('fa/full.html', {}, filename='test.pdf')
+        self.assert_(response.streaming, 'PDF response should be streamed from disk')
+        self.assertEqual('13', response['Content-Length'])
+        self.assertEqual('inline; filename=test.pdf', response['Content-Disposition'])
+        self.assertEqual('%PDF-1.4 test', ''.join(response.streaming_content))
+        response.close()
+
+        mockgenerate.side_effect = None
+        mockgenerate.return_value = False
+        self.assertRaises(Exception, render_to_pdf, 'fa/full.html', {})
+
+
+class NavigationTest(DjangoTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.ead = load_xmlobject_from_file(path.join(exist_fixture_path, 'raoul548.xml'),
+                                            FindingAid)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_findingaid_navigation(self):
+        nav = findingaid_navigation('raoul548', 'abc123', ead=self.ead)
+        self.assert_(nav.has_series)
+        self.assertEqual(len(self.ead.dsc.c), len(nav.series))
+        self.assertEqual('s1', nav.series[0].short_id)
+        self.assertEqual(self.ead.dsc.c[0].display_label(), nav.series[0].display_label())
+        self.assertEqual(unicode(self.ead.dsc.c[0].did.unittitle),
+                         unicode(nav.series[0].did.unittitle))
+        self.assertEqual(len(self.ead.archdesc.index), len(nav.indexes))
+        self.assertEqual(unicode(self.ead.archdesc.index[0].head),
+                         unicode(nav.indexes[0].head))
+        self.assertEqual(1, nav.position('raoul548_s2'))
+        self.assertEqual(['raoul548_s1', 'raoul548_s1.1'],
+                         [item.id for item in nav.path('raoul548_s1.1')])
+        self.assertEqual(None, nav.path('raoul548_bogus'))
+
+        # series links should match those generated from the full document
+        self.assertEqual(_subseries_links(self.ead.dsc, url_ids=[self.ead.eadid]),
+                         _navigation_links(nav.series, url_ids=['raoul548']))
+        self.assertEqual(_subseries_links(self.ead.dsc.c[0], url_params='?keywords=raoul'),
+                         _navigation_links(nav.series[0].children, url_ids=['raoul548', 's1'],
+                                           url_params='?keywords=raoul'))
+
+        # cached by eadid and hash; document is not retrieved again
+        with patch('findingaids.fa.navigation.get_findingaid') as mockget:
+            cached_nav = findingaid_navigation('raoul548', 'abc123')
+            self.assertEqual(0, mockget.call_count)
+            self.assertEqual([s.id for s in nav.series], [s.id for s in cached_nav.series])
+            # new version of the document is retrieved
+            mockget.return_value = self.ead
+            findingaid_navigation('raoul548', 'def456', preview=True)
+            mockget.assert_called_with('raoul548', preview=True)
+
+            # invalidating the document requires a new navigation structure
+            mockget.reset_mock()
+            invalidate_findingaid('raoul548')
+            findingaid_navigation('raoul548', 'abc123')
+            mockget.assert_called_with('raoul548', preview=False)
+
+
+class CacheKeysTest(DjangoTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    @patch('findingaids.fa.cachekeys.time')
+    def test_generation(self, mocktime):
+        mocktime.time.return_value = 1000.0
+        gen = cachekeys.generation('test')
+        self.assertEqual(gen, cachekeys.generation('test'))
+        cachekeys.invalidate('test')
+        self.assertEqual(gen + 1, cachekeys.generation('test'))
+        # lost generation is reinitialized from the current time
+        cache.clear()
+        mocktime.time.return_value = 1001.0
+        self.assert_(cachekeys.generation('test') > gen + 1)
+        cache.clear()
+        cachekeys.invalidate('test')
+        self.assertNotEqual(None, cache.get('cache-generation-test'))
+
+    def test_cache_keys(self):
+        key = cachekeys.collection_key('browse-title-index', u'\u00c9')
+        self.assertEqual(key, cachekeys.collection_key('browse-title-index', u'\u00c9'))
+        self.assertNotEqual(key, cachekeys.collection_key('browse-title-index', 'A'))
+        self.assert_(' ' not in key)
+        preview_key = cachekeys.collection_key('browse-title-index', u'\u00c9',
+                                               collection=settings.EXISTDB_PREVIEW_COLLECTION)
+        self.assertNotEqual(key, preview_key)
+
+        doc_key = cachekeys.document_key('ead-validators', 'abbey244')
+        other_doc_key = cachekeys.document_key('ead-validators', 'raoul548')
+
+        # invalidating a document only changes keys for that document
+        cachekeys.invalidate_document('abbey244')
+        self.assertNotEqual(doc_key, cachekeys.document_key('ead-validators', 'abbey244'))
+        self.assertEqual(other_doc_key, cachekeys.document_key('ead-validators', 'raoul548'))
+        self.assertEqual(key, cachekeys.collection_key('browse-title-index', u'\u00c9'))
+
+        # invalidating a collection only changes keys for that collection
+        cachekeys.invalidate_collection()
+        self.assertNotEqual(key, cachekeys.collection_key('browse-title-index', u'\u00c9'))
+        self.assertEqual(preview_key, cachekeys.collection_key('browse-title-index', u'\u00c9',
+                                      collection=settings.EXISTDB_PREVIEW_COLLECTION))
+
+        # long values are hashed to keep keys within length limits
+        long_key = cachekeys.cache_key('prepared-eadxml', cachekeys.archive_namespace('marbl'),
+                                       'x' * 300)
+        self.assert_(len(long_key) < 250)
+
+
+class LuceneQueryTest(TestCase):
+
+    def test_parse(self):
+        MUST, SHOULD, MUST_NOT = lucene.MUST, lucene.SHOULD, lucene.MUST_NOT
+        self.assertEqual(('bool', [(SHOULD, ('term', 'a')), (MUST_NOT, ('term', 'b')),
+                                   (SHOULD, ('term', 'c'))]),
+                         lucene.parse('a -b c'))
+        self.assertEqual(('bool', [(MUST, ('term', 'a')), (MUST_NOT, ('phrase', 'b c')),
+                                   (SHOULD, ('bool', [(SHOULD, ('term', 'd')),
+                                                      (SHOULD, ('term', 'e*'))]))]),
+                         lucene.parse('a && NOT "b c"~2 (d || e*)'))
+        # or is only the default operator when terms are optional
+        self.assertEqual(('bool', [(MUST, ('term', 'a')), (SHOULD, ('term', 'b')),
+                                   (SHOULD, ('term', 'c'))]),
+                         lucene.parse('a b OR c', default_operator='and'))
+        self.assertEqual(('bool', [(SHOULD, ('term', 'raoul'))]),
+                         lucene.parse('title:raoul^2'))
+        for query in ['', 'a AND', 'AND a', '(a', 'a)', '"a', 'a NOT']:
+            self.assertRaises(lucene.QuerySyntaxError, lucene.parse, query)
+
+
+class FullTextIndexTest(DjangoTestCase):
+    ead_fixtures = ['abbey244.xml', 'leverette135.xml', 'raoul548.xml']
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp(prefix='findingaids-fulltext-')
+        self.override = override_settings(
+            FULLTEXT_SEARCH_INDEX=path.join(self.index_dir, 'fulltext.db'))
+        self.override.enable()
+        self.index = fulltext.search_index()
+        for fixture in self.ead_fixtures:
+            ead = load_xmlobject_from_file(path.join(exist_fixture_path, fixture),
+                                           FindingAid)
+            fulltext.index_findingaid(ead)
+
+    def tearDown(self):
+        self.override.disable()
+        rmtree(self.index_dir)
+
+    def test_search_index(self):
+        with override_settings(FULLTEXT_SEARCH_INDEX=None):
+            self.assertEqual(None, fulltext.search_index())
+        self.assert_(isinstance(self.index, fulltext.SqliteSearchIndex))
+        self.assertEqual(set(['abbey244', 'leverette135', 'raoul548']), self.index.eadids())
+
+        # re-indexing replaces the document
+        fulltext.index_findingaid(load_xmlobject_from_file(
+            path.join(exist_fixture_path, 'raoul548.xml'), FindingAid))
+        self.assertEqual(1, len(self.index.search(keywords='raoul')))
+        fulltext.remove_findingaid('raoul548')
+        self.assertEqual(set(['abbey244', 'leverette135']), self.index.eadids())
+
+        # values calculated separately (e.g., by load_ead workers)
+        values = fulltext.index_values(load_xmlobject_from_file(
+            path.join(exist_fixture_path, 'raoul548.xml'), FindingAid))
+        fulltext.save_index_values(values)
+        self.assertEqual(['raoul548'], [r.eadid for r in self.index.search(keywords='raoul')])
+        self.assertEqual(values['components'][0][-1],
+                         self.index.db.execute('SELECT text FROM component WHERE eadid = ? ' +
+                                               'AND position = 0', ('raoul548', )).fetchone()[0])
+
+    def test_fts_query(self):
+        self.assertEqual('"raoul"', fulltext.fts_query('raoul'))
+        self.assertEqual('("raoul" OR "family")', fulltext.fts_query('raoul family'))
+        self.assertEqual('("raoul" AND "family")', fulltext.fts_query('raoul AND family'))
+        self.assertEqual('"raoul family"', fulltext.fts_query('"raoul family"~2'))
+        self.assertEqual('("raoul" OR "family papers")',
+                         fulltext.fts_query('title:raoul^2 "family papers"^3'))
+        self.assertEqual('"fam" *', fulltext.fts_query('fam*'))
+        self.assertEqual('("a" AND ("b" OR "c"))', fulltext.fts_query('a AND (b OR c)'))
+        for query in ['raoul AND', '(raoul', '"raoul', '*oul', 'NOT raoul', '()',
+                      '-raoul', 'raoul (-family)']:
+            self.assertRaises(fulltext.SearchQueryError, fulltext.fts_query, query)
+
+    def test_fts_query_modifiers(self):
+        # prohibited terms exclude from all the other terms
+        self.assertEqual('(("a" OR "c") NOT "b")', fulltext.fts_query('a -b c'))
+        self.assertEqual('(("a" OR "c") NOT "b")', fulltext.fts_query('a NOT b c'))
+        self.assertEqual('("a" NOT "b")', fulltext.fts_query('a AND NOT b'))
+        # optional terms don't affect matches when any terms are required
+        self.assertEqual('("c" NOT "b")', fulltext.fts_query('a -b +c'))
+        self.assertEqual('(("a" AND "b") NOT ("d" OR "e"))',
+                         fulltext.fts_query('+a +b c -d -e'))
+        self.assertEqual('("b" AND "c")', fulltext.fts_query('a OR b AND c'))
+        self.assertEqual('(("a" OR "b") NOT ("c" NOT "d"))',
+                         fulltext.fts_query('a b -(c -d)'))
+
+        # matches the same documents as eXist
+        self.assertEqual(['raoul548'], [r.eadid for r in
+                                        self.index.search(keywords='raoul -abbey bogus')])
+        self.assertEqual(['abbey244'], [r.eadid for r in
+                                        self.index.search(keywords='raoul -raoul abbey')])
+
+    def test_search(self):
+        # keyword results ordered by relevance, relative to the best match
+        results = self.index.search(keywords='raoul')
+        self.assertEqual('raoul548', results[0].eadid)
+        self.assertEqual(1.0, results[0].score)
+        self.assert_(all(0 < r.score <= 1 for r in results))
+
+        # subject and repository searches are restricted to those fields;
+        # results without keywords are ordered by list title
+        results = self.index.search(subject='Railway')
+        self.assertEqual(['raoul548'], [r.eadid for r in results])
+        results = self.index.search(repository='"Manuscript, Archives"')
+        self.assertEqual(['abbey244', 'leverette135', 'raoul548'], [r.eadid for r in results])
+        self.assertEqual(None, results[0].score)
+
+        # digital archival objects
+        self.assertEqual(['leverette135'], [r.eadid for r in self.index.search(dao=True)])
+        self.assertEqual(['abbey244', 'leverette135'],
+                         [r.eadid for r in self.index.search(dao=True, internal_dao=True)])
+
+        self.assertRaises(fulltext.SearchQueryError, self.index.search, keywords='"raoul')
+
+    def test_search_components(self):
+        files = self.index.search_components('raoul548', keywords='oversized photographs')
+        self.assertEqual(len(files), files.count())
+        component = files[0]
+        self.assert_(isinstance(component, FileComponent))
+        self.assertEqual('file', component.level)
+        self.assertEqual('s2', component.series1.short_id)
+        self.assertEqual('s2', component.parent.short_id)
+        self.assertEqual(None, component.series2)
+
+        # all files in document order
+        files = self.index.search_components('raoul548')
+        self.assertEqual(686, files.count())
+        self.assertEqual(0, self.index.search_components('bogus').count())
+
+        self.assertEqual(1, self.index.search_components('leverette135', dao=True).count())
+        self.assertEqual(4, self.index.search_components('leverette135', dao=True,
+                                                         internal_dao=True).count())
+
+
+class FacetIndexTest(DjangoTestCase):
+    ead_fixtures = ['abbey244.xml', 'leverette135.xml', 'raoul548.xml']
+
+    def setUp(self):
+        cache.clear()
+        for fixture in self.ead_fixtures:
+            facets.update_facets(load_xmlobject_from_file(
+                path.join(exist_fixture_path, fixture), FindingAid))
+        CollectionState.objects.create(collection=settings.EXISTDB_ROOT_COLLECTION,
+                                       count=len(self.ead_fixtures))
+        self.published = set(fixture[:-len('.xml')] for fixture in self.ead_fixtures)
+        eadids_patch = patch.object(CollectionState, 'eadids',
+                                    side_effect=lambda: frozenset(self.published))
+        eadids_patch.start()
+        self.addCleanup(eadids_patch.stop)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_facet_values(self):
+        record = FacetRecord.objects.get(eadid='leverette135')
+        self.assertEqual([u'Manuscript, Archives, and Rare Book Library'],
+                         record.repository_list)
+        self.assertEqual(8, record.dao_count)
+        self.assertEqual(3, record.public_dao_count)
+        record = FacetRecord.objects.get(eadid='raoul548')
+        self.assert_(u'Central of Georgia Railway.' in record.subject_list)
+        self.assertEqual(len(set(record.subject_list)), len(record.subject_list))
+
+        facets.remove_facets('raoul548')
+        self.assertFalse(FacetRecord.objects.filter(eadid='raoul548').exists())
+
+        # partial returns are not normalized; values must be single lines
+        ead = Mock(repository=[u'Manuscript, Archives,\n  and Rare Book Library ', None,
+                               u'Manuscript, Archives, and Rare Book Library'],
+                   controlaccess_terms=[u' Georgia \n History', u'Georgia History', ''],
+                   dao_count=None, public_dao_count=1)
+        values = facets.facet_values(ead)
+        self.assertEqual(u'Manuscript, Archives, and Rare Book Library', values['repositories'])
+        self.assertEqual(u'Georgia History', values['subjects'])
+
+    def test_facet_index(self):
+        index = facets.facet_index()
+        self.assertEqual(3, len(index))
+        self.assertEqual(set(['abbey244', 'leverette135']), index.dao)
+        self.assertEqual(set(['leverette135']), index.public_dao)
+
+        # loaded once per collection generation
+        with patch('findingaids.fa.facets.FacetRecord') as mockrecord:
+            self.assertEqual(index, facets.facet_index())
+            self.assertEqual(0, mockrecord.objects.all.call_count)
+        cachekeys.invalidate_collection()
+        self.assertNotEqual(index, facets.facet_index())
+
+        # not used when facet records do not match the published documents,
+        # even if the number of records is the same
+        self.published = set(['abbey244', 'leverette135', 'bogus'])
+        self.assertEqual(None, facets.facet_index())
+        self.published = set(['abbey244', 'leverette135'])
+        self.assertEqual(None, facets.facet_index())
+        facets.remove_facets('raoul548')
+        cachekeys.invalidate_collection()
+        self.assertEqual(2, len(facets.facet_index()))
+
+    def test_filter_and_counts(self):
+        index = facets.facet_index()
+        results = [TitleIndexEntry(eadid, eadid) for eadid in
+                   ['raoul548', 'abbey244', 'leverette135']]
+        repo = '"Manuscript, Archives, and Rare Book Library"'
+
+        # order is preserved
+        self.assertEqual(results, index.filter(results))
+        self.assertEqual(['raoul548', 'abbey244', 'leverette135'],
+                         [r.eadid for r in index.filter(results, repository=repo)])
+        self.assertEqual(['leverette135'], [r.eadid for r in index.filter(results, dao=True)])
+        self.assertEqual(['abbey244', 'leverette135'],
+                         [r.eadid for r in index.filter(results, dao=True, internal_dao=True)])
+        self.assertEqual([], index.filter(results, repository='"bogus"'))
+
+        counts = index.counts(results)
+        self.assertEqual([(u'Manuscript, Archives, and Rare Book Library', 3)],
+                         counts['repository'])
+        self.assertEqual(1, counts['dao'])
+        self.assert_(len(counts['subject']) <= facets.SUBJECT_FACET_SIZE)
+        self.assertEqual(sorted(counts['subject'], key=lambda s: (-s[1], s[0])),
+                         counts['subject'])
+
+        # digital content count ignores its own filter; subjects are filtered
+        counts = index.counts(results, dao=True)
+        self.assertEqual(1, counts['dao'])
+        self.assertEqual([(u'Manuscript, Archives, and Rare Book Library', 1)],
+                         counts['repository'])
+        subjects = set(FacetRecord.objects.get(eadid='leverette135').subject_list)
+        self.assert_(all(term in subjects for term, count in counts['subject']))
+        self.assertEqual(0, index.counts(results, repository='"bogus"')['dao'])
+
+
+class SuggestTest(DjangoTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.findingaids = [load_xmlobject_from_file(path.join(exist_fixture_path, fixture),
+                                                     FindingAid)
+                            for fixture in ['abbey244.xml', 'raoul548.xml', 'leverette135.xml']]
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_normalize_term(self):
+        self.assertEqual(u'cafe society', suggest.normalize_term(u' Caf\u00e9  Society'))
+        self.assertEqual(u'cafe', suggest.normalize_term('Caf\xc3\xa9'))
+
+    @patch('findingaids.fa.suggest.FindingAid')
+    def test_suggestion_terms(self, mockfa):
+        mockfa.objects.only.return_value = self.findingaids
+        terms = suggest.suggestion_terms()
+        titles = [t for t in terms if t.category == suggest.TITLE]
+        self.assertEqual(3, len(titles))
+        self.assert_(suggest.Suggestion(u'Raoul family.', suggest.TITLE, 'raoul548') in titles)
+        self.assert_(suggest.Suggestion(u'Central of Georgia Railway.', suggest.SUBJECT, None)
+                     in terms)
+        # cached until the collection changes
+        self.assertEqual(terms, suggest.suggestion_terms())
+        self.assertEqual(1, mockfa.objects.only.call_count)
+
+        # bounded; titles are always included
+        cachekeys.invalidate_collection()
+        with override_settings(SUGGEST_MAX_TERMS=5):
+            terms = suggest.suggestion_terms()
+        self.assertEqual(5, len(terms))
+        self.assertEqual(titles, terms[:3])
+
+    def test_lookup(self):
+        index = suggest.SuggestIndex([
+            suggest.Suggestion(u'Raoul family.', suggest.TITLE, 'raoul548'),
+            suggest.Suggestion(u'Raoul, Eleanore', suggest.NAME, None),
+            suggest.Suggestion(u'Railroads--Georgia.', suggest.SUBJECT, None),
+            suggest.Suggestion(u'\u00c9migr\u00e9s', suggest.SUBJECT, None),
+        ])
+        self.assertEqual(4, len(index))
+        self.assertEqual([u'Raoul family.', u'Raoul, Eleanore'],
+                         [s.label for s in index.lookup('RAOUL')])
+        self.assertEqual([u'Railroads--Georgia.', u'Raoul family.', u'Raoul, Eleanore'],
+                         [s.label for s in index.lookup('ra')])
+        self.assertEqual(1, len(index.lookup('ra', limit=1)))
+        self.assertEqual([u'\u00c9migr\u00e9s'], [s.label for s in index.lookup('emig')])
+        self.assertEqual([], index.lookup('zz'))
+        self.assertEqual([], index.lookup('  '))
+
+    @patch('findingaids.fa.suggest.FindingAid')
+    def test_suggest_index(self, mockfa):
+        mockfa.objects.only.return_value = self.findingaids
+        index = suggest.suggest_index()
+        self.assertEqual(index, suggest.suggest_index())
+        # rebuilt when the collection changes
+        cachekeys.invalidate_collection()
+        self.assertNotEqual(index, suggest.suggest_index())
+
+
+class FopPoolTest(DjangoTestCase):
+    # fake xsl-fo processor: copies input to output; fails or hangs
+    # based on the content of the input file
+    PROCESSOR = '''#!/bin/sh
+grep -q fail "$1" && exit 1
+grep -q hang "$1" && sleep 10
+cp "$1" "$2"
+'''
+    # fake long-running worker using the line protocol
+    WORKER = '''
+import shutil, sys
+for line in iter(sys.stdin.readline, ''):
+    fo, pdf = line.rstrip('\\n').split('\\t')
+    if 'fail' in open(fo).read():
+        sys.stdout.write('ERROR bad fo\\n')
+    else:
+        shutil.copy(fo, pdf)
+        sys.stdout.write('OK\\n')
+    sys.stdout.flush()
+'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='findingaids-fop-')
+        self.processor = path.join(self.tmpdir, 'fop')
+        with open(self.processor, 'w') as script:
+            script.write(self.PROCESSOR)
+        os.chmod(self.processor, 0755)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _fo_file(self, content):
+        fo_file = tempfile.NamedTemporaryFile(dir=self.tmpdir, delete=False)
+        fo_file.write(content)
+        fo_file.close()
+        return fo_file.name
+
+    def test_processor(self):
+        pdf = path.join(self.tmpdir, 'out.pdf')
+        with override_settings(XSLFO_PROCESSOR=self.processor):
+            pool = fop.FopPool(workers=2, timeout=1)
+            pool.render(self._fo_file('ok'), pdf)
+            self.assertEqual('ok', open(pdf).read())
+            self.assertRaises(fop.FopError, pool.render, self._fo_file('fail'), pdf)
+            self.assertRaises(fop.FopTimeout, pool.render, self._fo_file('hang'), pdf)
+            pool.shutdown()
+        self.assertEqual(1, pool.stats['completed'])
+        self.assertEqual(1, pool.stats['failed'])
+        self.assertEqual(1, pool.stats['timeout'])
+
+    def test_queue_full(self):
+        with override_settings(XSLFO_PROCESSOR=self.processor):
+            pool = fop.FopPool(workers=1, queue_size=1, timeout=5)
+            # block the only worker, then fill the queue
+            with patch.object(fop.FopWorker, 'render') as mockrender:
+                started, release = threading.Event(), threading.Event()
+                mockrender.side_effect = lambda *args: started.set() or release.wait()
+                threading.Thread(target=pool.render, args=('a', 'b')).start()
+                started.wait()
+                threading.Thread(target=pool.render, args=('c', 'd')).start()
+                while not pool.jobs.full():
+                    sleep(0.01)
+                self.assertRaises(fop.FopQueueFull, pool.render, 'e', 'f')
+                release.set()
+                pool.shutdown()
+        self.assertEqual(1, pool.stats['rejected'])
+
+    def test_worker_command(self):
+        pdf = path.join(self.tmpdir, 'out.pdf')
+        worker = fop.FopWorker([sys.executable, '-c', self.WORKER])
+        worker.render(self._fo_file('ok'), pdf, timeout=5)
+        process = worker.process
+        worker.render(self._fo_file('ok again'), pdf, timeout=5)
+        self.assertEqual('ok again', open(pdf).read())
+        self.assert_(worker.process is process,
+            'worker process should be reused for multiple jobs')
+        self.assertRaises(fop.FopError, worker.render, self._fo_file('fail'), pdf, 5)
+        worker.stop()
+        self.assertFalse(worker.alive())
+
+    def test_worker_partial_response(self):
+        # a worker that stops partway through a response line must not
+        # block past the timeout
+        partial = "import sys, time\nsys.stdin.readline()\n" + \
+            "sys.stdout.write('O'); sys.stdout.flush()\ntime.sleep(30)\n"
+        worker = fop.FopWorker([sys.executable, '-c', partial])
+        start = datetime.now()
+        self.assertRaises(fop.FopTimeout, worker.render, self._fo_file('ok'),
+                          path.join(self.tmpdir, 'out.pdf'), 1)
+        self.assert_((datetime.now() - start).seconds < 5,
+                     'worker render should stop at the timeout')
+        self.assertFalse(worker.alive(), 'worker should be stopped after a timeout')
 
 
 class FormatEadTestCase(DjangoTestCase):
@@ -185,6 +1127,8 @@ school desegregation case files</abstract>""" % EAD_NAMESPACE
     % (EAD_NAMESPACE, XLINK_NAMESPACE)
     EXTREF_NOLINK = '''<p xmlns="%s">Belfast Group sheets may also be found in the
     <extref>Irish Literary Miscellany</extref>.</p>''' % EAD_NAMESPACE
+    ESCAPED = '''<abstract xmlns="%s">Letters &amp; <title>"Poems"</title> &lt;1922&gt;</abstract>''' \
+    % EAD_NAMESPACE
 
     def setUp(self):
         self.content = XmlObject(etree.fromstring(self.ITALICS))    # place-holder node
@@ -259,6 +1203,56 @@ school desegregation case files</abstract>""" % EAD_NAMESPACE
         self.assert_('<a>Irish Literary Miscellany</a>'
             in fmt, 'formatter should not fail when extref has no href')
 
+    def test_escape(self):
+        self.content.node = etree.fromstring(self.ESCAPED)
+        self.assertEqual('Letters &amp; <span class="ead-title">&quot;Poems&quot;</span> &lt;1922&gt;',
+                         format_ead(self.content, autoescape=True))
+        self.assertEqual('Letters & <span class="ead-title">"Poems"</span> <1922>',
+                         format_ead(self.content))
+
+    @override_settings(EAD_FRAGMENT_CACHE_SIZE=10)
+    def test_memoize_fragments(self):
+        fragment_cache.clear()
+        self.content.node = etree.fromstring(self.TITLE_MULTI)
+        expected = format_ead(self.content, rdfa=True)
+        # not memoized unless the document is registered
+        self.assertEqual(0, len(fragment_cache))
+
+        with memoize_fragments(self.content, 'doc', 'hash1'):
+            self.assertEqual(expected, format_ead(self.content, rdfa=True))
+            self.assertEqual(1, len(fragment_cache))
+            # filter options are part of the key
+            format_ead(self.content)
+            self.assertEqual(2, len(fragment_cache))
+            # memoized value is used for the same node and options
+            with patch('findingaids.fa.templatetags.ead.format_ead_node') as mockformat:
+                self.assertEqual(expected, format_ead(self.content, rdfa=True))
+                self.assertEqual(0, mockformat.call_count)
+            # leaf nodes are not memoized
+            format_ead(XmlObject(self.content.node[0]))
+            self.assertEqual(2, len(fragment_cache))
+
+        # another version of the document does not use the stored fragment
+        with memoize_fragments(self.content, 'doc', 'hash2'):
+            with patch('findingaids.fa.templatetags.ead.format_ead_node') as mockformat:
+                mockformat.return_value = 'formatted'
+                self.assertEqual('formatted', format_ead(self.content, rdfa=True))
+                self.assertEqual(1, mockformat.call_count)
+
+        # a different tree is not memoized under another document's key
+        with memoize_fragments(self.content, 'doc', 'hash1'):
+            other = XmlObject(etree.fromstring(self.TITLE_MULTI))
+            with patch('findingaids.fa.templatetags.ead.format_ead_node') as mockformat:
+                format_ead(other, rdfa=True)
+                self.assertEqual(1, mockformat.call_count)
+
+        # oldest fragments are discarded when the cache is full
+        with override_settings(EAD_FRAGMENT_CACHE_SIZE=1):
+            with memoize_fragments(self.content, 'doc', 'hash3'):
+                format_ead(self.content)
+        self.assertEqual(1, len(fragment_cache))
+        fragment_cache.clear()
+
 class RdfaTemplateTest(DjangoTestCase):
     # test RDFa output for file-level items
 
@@ -525,6 +1519,809 @@ class RdfaTemplateTest(DjangoTestCase):
 
 
 
+class RdfGenerationTest(DjangoTestCase):
+    # RDF generated directly from the EAD for finding aid pages
+
+    SCHEMA_ORG = rdflib.Namespace('http://schema.org/')
+    DCTERMS = rdflib.Namespace('http://purl.org/dc/terms/')
+
+    def setUp(self):
+        self.ead = load_xmlobject_from_file(path.join(exist_fixture_path, 'raoul548.xml'),
+                                            FindingAid)
+        self.factory = RequestFactory()
+        cache.clear()
+
+    def test_evaluator(self):
+        html = '''<div about="http://example.com/doc" typeof="schema:WebPage">
+            <meta property="schema:name" content="Doc"/>
+            <span rel="schema:mentions"><span typeof="schema:Person" about="http://viaf.org/viaf/1">
+              <span property="schema:name">Someone</span></span></span>
+            <span property="dcterms:isPartOf" typeof="bibo:Periodical" resource="urn:ISSN:1">
+              <span property="dc:title">Journal</span></span>
+            <span inlist="inlist" property="dc:title">One</span>
+            <span inlist="inlist" property="dc:title">Two</span>
+            <a rel="dcterms:hasPart" href="part/">part</a>
+            <span rel="unknown"><span property="schema:genre" content="none"/></span>
+          </div>'''
+        g = rdf.RdfaEvaluator('http://example.com/page/').evaluate(etree.fromstring(html))
+        doc = rdflib.URIRef('http://example.com/doc')
+        person = rdflib.URIRef('http://viaf.org/viaf/1')
+        issn = rdflib.URIRef('urn:ISSN:1')
+        self.assert_((doc, rdflib.RDF.type, self.SCHEMA_ORG.WebPage) in g)
+        self.assertEqual(u'Doc', unicode(g.value(doc, self.SCHEMA_ORG.name)))
+        # rel without an object is completed by the typed child
+        self.assert_((doc, self.SCHEMA_ORG.mentions, person) in g)
+        self.assertEqual(u'Someone', unicode(g.value(person, self.SCHEMA_ORG.name)))
+        # property with typeof and resource
+        self.assert_((doc, self.DCTERMS.isPartOf, issn) in g)
+        self.assertEqual(u'Journal', unicode(g.value(issn, self.DCTERMS.title)))
+        # inlist values generate an rdf list
+        titles = g.value(doc, self.DCTERMS.title)
+        self.assertEqual([u'One', u'Two'], [unicode(t) for t in g.items(titles)])
+        # relative urls are resolved against the base
+        self.assert_((doc, self.DCTERMS.hasPart, rdflib.URIRef('http://example.com/page/part/')) in g)
+        # unprefixed terms are ignored
+        self.assertEqual(None, g.value(None, self.SCHEMA_ORG.genre))
+
+    def test_findingaid_graph(self):
+        g = rdf.page_graph(self.ead, 'testserver')
+        doc = rdflib.URIRef(self.ead.eadid.url)
+        collection = rdflib.URIRef(self.ead.collection_uri())
+        self.assert_((doc, rdflib.RDF.type, self.SCHEMA_ORG.WebPage) in g)
+        self.assertEqual(rdflib.URIRef('http://testserver%s' % reverse('fa:findingaid',
+                                                                       kwargs={'id': 'raoul548'})),
+                         g.value(doc, rdflib.OWL.sameAs))
+        self.assert_((doc, self.SCHEMA_ORG.about, collection) in g)
+        self.assert_((collection, rdflib.RDF.type, self.SCHEMA_ORG.CreativeWork) in g)
+        self.assert_(g.value(collection, self.SCHEMA_ORG.keywords),
+                     'controlled access terms should be collection keywords')
+        # series and indexes are parts of the document
+        parts = set(g.objects(doc, self.DCTERMS.hasPart))
+        for series_id in ['s1', 's4', 'index1']:
+            self.assert_(rdflib.URIRef('http://testserver%s' % reverse('fa:series-or-index',
+                kwargs={'id': 'raoul548', 'series_id': series_id})) in parts)
+
+    def test_series_graph(self):
+        g = rdf.page_graph(self.ead, 'testserver', ['s4'])
+        page = rdflib.URIRef('http://testserver%s' % reverse('fa:series-or-index',
+            kwargs={'id': 'raoul548', 'series_id': 's4'}))
+        self.assert_((page, rdflib.RDF.type, self.SCHEMA_ORG.WebPage) in g)
+        self.assert_(unicode(g.value(page, self.SCHEMA_ORG.name)).startswith('Raoul family papers'))
+        self.assertEqual(self.ead.eadid.url, unicode(g.value(page, self.DCTERMS.isPartOf)))
+        # subseries are parts of the series page
+        self.assert_((page, self.DCTERMS.hasPart,
+                      rdflib.URIRef('http://testserver%s' % reverse('fa:series2',
+                        kwargs={'id': 'raoul548', 'series_id': 's4', 'series2_id': '4.1'}))) in g)
+
+        self.assertRaises(Http404, rdf.page_graph, self.ead, 'testserver', ['s99'])
+
+    @patch('findingaids.fa.rdf.ead_lastmodified')
+    @patch('findingaids.fa.rdf.ead_etag')
+    @patch('findingaids.fa.rdf.get_findingaid')
+    def test_page_rdf(self, mockget, mocketag, mocklastmod):
+        mockget.return_value = self.ead
+        mocketag.return_value = 'abc123'
+        mocklastmod.return_value = datetime(2012, 3, 1)
+        request = self.factory.get(reverse('fa:findingaid', kwargs={'id': 'raoul548'}))
+        data = rdf.page_rdf(request, {'id': 'raoul548'}, 'turtle')
+        self.assert_('schema:WebPage' in data)
+        self.assert_('2012-03-01' in data)
+        # cached by document hash
+        self.assertEqual(data, rdf.page_rdf(request, {'id': 'raoul548'}, 'turtle'))
+        self.assertEqual(1, mockget.call_count)
+        mocketag.return_value = 'def456'
+        rdf.page_rdf(request, {'id': 'raoul548'}, 'turtle')
+        self.assertEqual(2, mockget.call_count)
+        # long-form series ids are not handled
+        self.assertEqual(None, rdf.page_rdf(request, {'id': 'raoul548', 'series_id': 'raoul548_s1'},
+                                            'turtle'))
+
+    def test_middleware_serialization(self):
+        middleware = RDFaMiddleware()
+        request = self.factory.get('/documents/raoul548/RDF/')
+        self.assertEqual(('application/rdf+xml', 'xml'), middleware.serialization(request))
+        request = self.factory.get('/documents/raoul548/RDF/', HTTP_ACCEPT='text/html,*/*;q=0.8')
+        self.assertEqual(('application/rdf+xml', 'xml'), middleware.serialization(request))
+        request = self.factory.get('/documents/raoul548/RDF/', HTTP_ACCEPT='text/turtle')
+        self.assertEqual(('text/turtle', 'turtle'), middleware.serialization(request))
+
+
+class ExistQueryTimingTest(DjangoTestCase):
+    # per-request eXist query instrumentation
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        # restore the unwrapped xmlrpc transport after each test
+        self.transport_patch = patch.object(RequestsTransport, 'request',
+                                            RequestsTransport.__dict__['request'])
+        self.transport_patch.start()
+        self.middleware = ExistQueryTimingMiddleware()
+
+    def tearDown(self):
+        exist_middleware._recording.stats = None
+        self.transport_patch.stop()
+
+    def _xmlrpc_call(self, method):
+        # make an xmlrpc call through the instrumented transport
+        transport = RequestsTransport()
+        transport.session = Mock()
+        transport.parse_response = Mock(return_value=(True,))
+        body = xmlrpclib.dumps(('/db/test/doc.xml',), methodname=method)
+        return transport.request('localhost:8080', '/exist/xmlrpc', body, False)
+
+    @override_settings(EXISTDB_SERVER_TIMING=True, EXISTDB_TIME_XMLRPC=True)
+    def test_request_stats(self):
+        self.middleware = ExistQueryTimingMiddleware()
+        request = self.factory.get('/documents/raoul548/')
+        request.resolver_match = Mock(view_name='fa:findingaid')
+        self.middleware.process_request(request)
+        exist_db.xquery_called.send(sender=ExistDB, name='query', time_taken=0.025,
+                                    kwargs={'xquery': 'for $a in\n  collection("/db/fa") return $a'})
+        exist_db.xquery_called.send(sender=ExistDB, name='query', time_taken=0.1,
+                                    kwargs={'xquery': 'collection("/db/fa")//ead'})
+        self._xmlrpc_call('describeResource')
+
+        stats = exist_middleware.current_stats()
+        self.assertEqual(2, stats.queries)
+        self.assertEqual(1, stats.xmlrpc_calls)
+        self.assertEqual('collection("/db/fa")//ead', stats.slowest)
+
+        with patch('findingaids.exist_middleware.logger') as mocklogger:
+            mocklogger.isEnabledFor.return_value = True
+            response = self.middleware.process_response(request, HttpResponse())
+        self.assert_(response['Server-Timing'].startswith('exist;dur=125.0;desc="2 eXist queries", exist-xmlrpc;dur='))
+        self.assertEqual(None, exist_middleware.current_stats(),
+                         'recording should stop after the response')
+
+        args = mocklogger.info.call_args[0]
+        self.assertEqual(exist_middleware.LOG_PREFIX, args[1])
+        data = json.loads(args[2])
+        self.assertEqual('fa:findingaid', data['view'])
+        self.assertEqual('/documents/raoul548/', data['path'])
+        self.assertEqual(200, data['status'])
+        self.assertEqual(2, data['queries'])
+        self.assertEqual(1, data['xmlrpc'])
+        self.assertEqual(100.0, data['slowest_ms'])
+        # query text is only logged when debug logging is enabled
+        mocklogger.isEnabledFor.assert_called_with(logging.DEBUG)
+        self.assertEqual('collection("/db/fa")//ead', data['slowest'])
+
+        # queries outside a request are not recorded
+        exist_db.xquery_called.send(sender=ExistDB, name='query', time_taken=0.1,
+                                    kwargs={'xquery': 'collection("/db/fa")'})
+        self._xmlrpc_call('describeResource')
+        self.assertEqual(None, exist_middleware.current_stats())
+
+    def test_defaults(self):
+        request = self.factory.get('/browse/')
+        self.middleware.process_request(request)
+        exist_db.xquery_called.send(sender=ExistDB, name='query', time_taken=0.1,
+                                    kwargs={'xquery': 'collection("/db/fa")//ead'})
+        # xmlrpc calls are not timed unless configured
+        self._xmlrpc_call('describeResource')
+        self.assertEqual(0, exist_middleware.current_stats().xmlrpc_calls)
+        with patch('findingaids.exist_middleware.logger') as mocklogger:
+            mocklogger.isEnabledFor.return_value = False
+            response = self.middleware.process_response(request, HttpResponse())
+        self.assertFalse(response.has_header('Server-Timing'))
+        data = json.loads(mocklogger.info.call_args[0][2])
+        self.assertEqual(None, data['view'])
+        self.assertEqual(1, data['queries'])
+        self.assert_('slowest' not in data)
+
+    def test_stats_command(self):
+        logfile = tempfile.NamedTemporaryFile(suffix='.log')
+        for view, queries, exist_ms in [('fa:findingaid', 2, 40.0), ('fa:findingaid', 3, 60.0),
+                                        ('fa:series-or-index', 25, 700.0)]:
+            logfile.write('[18/Oct/2016 10:00:00] INFO:findingaids.exist_middleware::%s %s\n' %
+                          (exist_middleware.LOG_PREFIX, json.dumps({
+                              'view': view, 'path': '/documents/x/', 'method': 'GET',
+                              'status': 200, 'queries': queries, 'xmlrpc': 0,
+                              'exist_ms': exist_ms, 'slowest_ms': exist_ms / 2,
+                              'slowest': 'collection("/db/fa")', 'total_ms': 900.0})))
+        logfile.write('[18/Oct/2016 10:00:00] WARNING:django.request::Not Found\n')
+        logfile.flush()
+
+        stats = list(exist_query_stats.read_log(logfile.name))
+        self.assertEqual(3, len(stats))
+        self.assertEqual('fa:series-or-index', stats[2]['view'])
+
+        self.assertEqual('0:0 1:0 2:1 3-5:1 6-10:0 11-20:0 >20:1',
+                         exist_query_stats.histogram([2, 3, 25], exist_query_stats.QUERY_BUCKETS))
+
+        with patch('sys.stdout', new_callable=StringIO) as output:
+            exist_query_stats.Command().handle(logfiles=[logfile.name], views=None,
+                                               min_requests=1)
+        output = output.getvalue()
+        # views with the most time in eXist first
+        self.assert_(output.index('fa:series-or-index') < output.index('fa:findingaid'))
+        self.assert_('2 requests, 2.5 eXist queries/request (max 3)' in output)
+        self.assert_('queries/request: 0:0 1:0 2:1 3-5:1' in output)
+
+
+class BenchmarkTest(DjangoTestCase):
+    # page response time benchmarks
+
+    def test_run_scenario(self):
+        fetcher = Mock()
+        fetcher.get.return_value = (200, 'exist;dur=12.5;desc="3 eXist queries"')
+        result = benchmark.run_scenario(['/titles/A/', '/titles/B/'], fetcher,
+                                        warmup=2, iterations=3, concurrency=2)
+        # warmup requests are not timed
+        self.assertEqual(10, fetcher.get.call_count)
+        self.assertEqual(2, result['urls'])
+        self.assertEqual(6, result['requests'])
+        self.assertEqual(0, result['errors'])
+        for stat in benchmark.TIME_STATS:
+            self.assert_(result[stat] is not None)
+        self.assert_(result['p50'] <= result['p95'] <= result['p99'] <= result['max'])
+        self.assertEqual(12.5, result['exist_p50'])
+        self.assertEqual(3, result['exist_queries'])
+
+        # errors and error statuses are counted but not timed
+        fetcher.get.side_effect = [(200, None), (404, None), Exception('timed out')]
+        result = benchmark.run_scenario(['/documents/a/', '/documents/b/', '/documents/c/'],
+                                        fetcher, warmup=0, iterations=1)
+        self.assertEqual(1, result['requests'])
+        self.assertEqual(2, result['errors'])
+        self.assertEqual(['/documents/b/: status 404', '/documents/c/: timed out'],
+                         result['error_details'])
+        self.assert_('exist_p50' not in result)
+
+    def test_percentile(self):
+        self.assertEqual(2, benchmark.percentile([1, 2, 3, 4], 50))
+        self.assertEqual(4, benchmark.percentile([1, 2, 3, 4], 95))
+        self.assertEqual(7, benchmark.percentile([7], 99))
+
+    def test_compare(self):
+        baseline = {'scenarios': {'browse': {'p95': 100.0}, 'search': {'p95': 200.0},
+                                  'pdf': {'p95': None, 'errors': 2}}}
+        results = {'scenarios': {'browse': {'p95': 119.0}, 'search': {'p95': 250.0},
+                                 'pdf': {'p95': 5000.0, 'errors': 1},
+                                 'sitemap': {'p95': 10.0}}}
+        self.assertEqual([('search', 'p95 250.0ms (baseline 200.0ms)')],
+                         benchmark.compare(results, baseline, threshold=20))
+        self.assertEqual([], benchmark.compare(results, baseline, threshold=30))
+        self.assertEqual(['browse', 'search'],
+                         sorted(name for name, description in
+                                benchmark.compare(results, baseline, threshold=10)))
+
+        # all requests failed
+        results['scenarios']['browse'] = {'p95': None, 'errors': 5}
+        self.assertEqual([('browse', '5 errors (baseline 0)'),
+                          ('browse', 'no p95 (baseline 100.0ms)')],
+                         benchmark.compare(results, baseline, threshold=30))
+        # more errors than the baseline
+        results['scenarios']['browse'] = {'p95': 90.0, 'errors': 1}
+        self.assertEqual([('browse', '1 errors (baseline 0)')],
+                         benchmark.compare(results, baseline, threshold=30))
+        results['scenarios']['pdf']['errors'] = 3
+        self.assertEqual(['browse', 'pdf'],
+                         sorted(name for name, description in
+                                benchmark.compare(results, baseline, threshold=30)))
+
+    def test_urls(self):
+        self.assertEqual(['/documents/abbey244/', '/documents/raoul548/'],
+                         benchmark.findingaid_urls(['abbey244', 'raoul548']))
+        self.assertEqual(['/documents/abbey244/printable/'], benchmark.pdf_urls(['abbey244']))
+        self.assertEqual(['/documents/abbey244/items/?keywords=letters',
+                          '/documents/abbey244/items/?keywords=photographs'],
+                         benchmark.document_search_urls(['abbey244']))
+        urls = benchmark.sitemap_urls([])
+        self.assertEqual('/sitemap.xml', urls[0])
+        self.assert_('/sitemap-content.xml' in urls)
+
+    def test_command_baseline(self):
+        results = {'date': '2016-10-18', 'settings': {},
+                   'scenarios': {'browse': {'p95': 150.0}}}
+        baseline = tempfile.NamedTemporaryFile(suffix='.json')
+        json.dump({'scenarios': {'browse': {'p95': 100.0}}}, baseline)
+        baseline.flush()
+        output = tempfile.NamedTemporaryFile(suffix='.json')
+
+        command = response_times.Command()
+        options = {'scenarios': ['browse'], 'warmup': 0, 'iterations': 1,
+                   'concurrency': 1, 'documents': 1, 'eadids': ['abbey244'],
+                   'url': 'http://localhost:8000', 'output': output.name,
+                   'baseline': baseline.name, 'threshold': 20, 'stat': 'p95',
+                   'verbosity': 0}
+        with patch('findingaids.fa.benchmark.run', return_value=results) as mockrun:
+            self.assertRaises(CommandError, command.handle, **options)
+            self.assertEqual(['browse'], mockrun.call_args[0][0])
+            self.assert_(isinstance(mockrun.call_args[0][1], benchmark.HttpFetcher))
+            self.assertEqual(['abbey244'], mockrun.call_args[0][2])
+            with open(output.name) as outfile:
+                self.assertEqual(results, json.load(outfile))
+
+            options['threshold'] = 60
+            command.handle(**options)
+
+            options['scenarios'] = ['bogus']
+            self.assertRaises(CommandError, command.handle, **options)
+
+
+class LocalExistTest(DjangoTestCase):
+    # in-process eXist stand-in
+
+    def setUp(self):
+        # preserve any store installed with EXISTDB_LOCAL_STORE
+        self.previous_store = localexist._store
+        self.store = localexist.install(fixtures=exist_fixture_path,
+                                        store=localexist.DocumentStore())
+        self.queries = []
+        exist_db.xquery_called.connect(self._record_query, dispatch_uid='localexist-test')
+
+    def tearDown(self):
+        exist_db.xquery_called.disconnect(dispatch_uid='localexist-test')
+        localexist.uninstall()
+        if self.previous_store is not None:
+            localexist.install(fixtures=None, store=self.previous_store)
+
+    def _record_query(self, sender, name=None, **kwargs):
+        self.queries.append(name)
+
+    def test_install(self):
+        db = ExistDB()
+        self.assert_(isinstance(db, localexist.LocalExistDB))
+        self.assert_(isinstance(FindingAid.objects.all(), localexist.LocalQuerySet))
+        self.assert_(isinstance(BatchExistDB(), localexist.LocalExistDB),
+                     'subclasses of ExistDB should also use the local store')
+        self.assert_(db.hasCollection(settings.EXISTDB_ROOT_COLLECTION))
+        self.assert_('abbey244.xml' in
+                     [doc.name for doc in self.store.select(settings.EXISTDB_ROOT_COLLECTION)])
+
+        localexist.uninstall()
+        self.assertFalse(isinstance(ExistDB(), localexist.LocalExistDB))
+        self.assert_(isinstance(FindingAid.objects.all()._db, BatchExistDB))
+
+    def test_queryset(self):
+        fa = FindingAid.objects.get(eadid='abbey244')
+        self.assertEqual('abbey244', fa.eadid.value)
+        self.assertRaises(DoesNotExist, FindingAid.objects.get, eadid='bogus')
+
+        eadids = [f.eadid.value for f in
+                  FindingAid.objects.only('eadid').order_by('eadid')]
+        self.assertEqual(sorted(eadids), eadids)
+        self.assertEqual(FindingAid.objects.count(), len(eadids))
+        self.assertEqual(eadids[:2], [f.eadid.value for f in
+                                      FindingAid.objects.only('eadid').order_by('eadid')[:2]])
+
+        fa = FindingAid.objects.only('eadid', 'document_name', 'collection_name',
+                                     'hash').get(eadid='raoul548')
+        self.assertEqual('raoul548.xml', fa.document_name)
+        self.assertEqual('/db/%s' % settings.EXISTDB_ROOT_COLLECTION.strip('/'),
+                         fa.collection_name)
+        self.assert_(fa.hash)
+
+        # filters by lookup type
+        self.assertEqual(['abbey244'], [f.eadid.value for f in
+                         FindingAid.objects.filter(eadid__startswith='abb').only('eadid')])
+        self.assertEqual(0, FindingAid.objects.filter(eadid__in=[]).count())
+        self.assertEqual(2, FindingAid.objects.filter(eadid__in=['abbey244', 'raoul548']).count())
+
+        # distinct values of a field
+        letters = list(FindingAid.objects.only('first_letter')
+                       .order_by('first_letter').distinct())
+        self.assertEqual(sorted(set(letters)), letters)
+
+        # related fields returned with also()
+        series = Series.objects.filter(ead__eadid='raoul548').also('ead__eadid')[0]
+        self.assertEqual('raoul548', series.ead.eadid.value)
+
+    def test_fulltext(self):
+        query = localexist.FulltextQuery('(oral histor*) AND atlanta')
+        self.assertEqual(0, query.score(['oral', 'history']))
+        self.assert_(query.score(['oral', 'histories', 'of', 'atlanta']))
+        query = localexist.FulltextQuery('"new york" -times')
+        self.assert_(query.score(['new', 'york', 'city']))
+        self.assertEqual(0, query.score(['new', 'york', 'times']))
+        self.assertEqual(0, query.score(['york', 'new']))
+        query = localexist.FulltextQuery('new -york city')
+        self.assert_(query.score(['new', 'city']))
+        self.assert_(query.score(['city']))
+        self.assertEqual(0, query.score(['new', 'york']))
+        self.assertEqual(0, query.score(['boston']))
+        query = localexist.FulltextQuery('+new york -city')
+        self.assert_(query.score(['new', 'jersey']))
+        self.assertEqual(0, query.score(['york']))
+        self.assert_(query.score(['new', 'york']) > query.score(['new', 'jersey']),
+                     'optional terms should add to the score')
+        self.assertEqual(0, query.score(['new', 'york', 'city']))
+        query = localexist.FulltextQuery('new york', 'and')
+        self.assertEqual(0, query.score(['new', 'jersey']))
+        self.assertRaises(exist_db.ExistDBException, localexist.FulltextQuery, '(new york')
+
+        results = FindingAid.objects.filter(fulltext_terms='raoul') \
+                                    .order_by('-fulltext_score').only('eadid', 'fulltext_score')
+        self.assert_('raoul548' in [f.eadid.value for f in results])
+        scores = [float(f.fulltext_score) for f in results]
+        self.assertEqual(sorted(scores, reverse=True), scores)
+
+        fa = FindingAid.objects.filter(eadid='raoul548', highlight='raoul').get()
+        self.assert_(fa.node.xpath('//exist:match', namespaces={'exist': localexist.EXISTDB_NAMESPACE}),
+                     'matching words should be highlighted')
+
+    def test_documents(self):
+        db = ExistDB()
+        collection = settings.EXISTDB_ROOT_COLLECTION
+        doc_path = '%s/test-doc.xml' % collection
+        self.assert_(db.load('<ead><eadheader><eadid>test</eadid></eadheader></ead>', doc_path))
+        self.assert_('<eadid>test</eadid>' in db.getDocument(doc_path))
+        info = db.describeDocument(doc_path)
+        self.assertEqual('/db/%s' % doc_path.strip('/'), info['name'])
+        self.assertRaises(exist_db.ExistDBException, db.load, '<ead>', doc_path)
+
+        db.createCollection('%s-moved' % collection, True)
+        db.moveDocument(collection, '%s-moved' % collection, 'test-doc.xml')
+        self.assertEqual({}, db.describeDocument(doc_path))
+        self.assert_(db.removeDocument('%s-moved/test-doc.xml' % collection))
+        self.assertRaises(exist_db.ExistDBException, db.removeDocument,
+                          '%s-moved/test-doc.xml' % collection)
+        self.assertRaises(exist_db.ExistDBException, db.query, 'collection("/db")')
+
+    def test_query_stats(self):
+        exist_middleware._recording.stats = exist_middleware.QueryStats()
+        try:
+            FindingAid.objects.get(eadid='abbey244')
+            ExistDB().describeDocument('%s/abbey244.xml' % settings.EXISTDB_ROOT_COLLECTION)
+            stats = exist_middleware.current_stats()
+        finally:
+            exist_middleware._recording.stats = None
+        self.assert_(stats.queries >= 1)
+        self.assertEqual(1, stats.xmlrpc_calls)
+        self.assert_('query' in self.queries)
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # minimal HTTP/1.1 server recording the client port for each request
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.client_ports.append(self.client_address[1])
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), KeepAliveHandler)
+        self.client_ports = []
+        self.url = 'http://127.0.0.1:%d/exist' % self.server_address[1]
+
+
+def _pooled_get(exist_db):
+    # query from a child process; exit code reports success
+    exist_db.session.get(exist_db.restapi_path('/'), timeout=5)
+
+
+def _exist_response(request, **kwargs):
+    # response sent by a mock pooled connection; an empty xmlrpc struct
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = StringIO(xmlrpclib.dumps(({},), methodresponse=True))
+    return response
+
+
+class ExistPoolTest(DjangoTestCase):
+    # pooled keep-alive eXist connections
+
+    def setUp(self):
+        self.was_installed = existpool._original_init is not None
+        existpool.uninstall()
+        self.pool = existpool.ConnectionPool('http://localhost:8080/exist', size=2,
+                                             timeout=0.01)
+
+    def tearDown(self):
+        existpool._local.pinned = None
+        existpool.uninstall()
+        if self.was_installed:
+            existpool.install()
+
+    def test_checkout(self):
+        conn1 = self.pool.checkout()
+        conn2 = self.pool.checkout()
+        self.assertNotEqual(conn1, conn2)
+        self.assertRaises(exist_db.ExistDBException, self.pool.checkout)
+
+        self.pool.checkin(conn1)
+        self.assertEqual(conn1, self.pool.checkout(),
+                         'idle connection should be reused')
+        self.pool.discard(conn2)
+        conn3 = self.pool.checkout()
+        self.assert_(conn3 not in (conn1, conn2))
+
+        metrics = self.pool.metrics()
+        self.assertEqual(2, metrics['in_use'])
+        self.assertEqual(0, metrics['idle'])
+        self.assertEqual(3, metrics['created'])
+        self.assertEqual(1, metrics['closed'])
+        self.assertEqual(5, metrics['checkouts'])
+        self.assertEqual(1, metrics['reused'])
+        self.assertEqual(1, metrics['timeouts'])
+        self.assertEqual(1, metrics['waits'])
+
+    def test_idle_connections(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        # idle too long; closed instead of reused
+        conn.last_used -= self.pool.idle_timeout + 1
+        self.assertNotEqual(conn, self.pool.checkout())
+        self.assertEqual(1, self.pool.metrics()['closed'])
+
+        # idle past health check interval; checked before reuse
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        conn.last_used -= self.pool.health_check + 1
+        with patch.object(conn, 'send') as mocksend:
+            self.assertEqual(conn, self.pool.checkout())
+            request = mocksend.call_args[0][0]
+            self.assertEqual(('HEAD', 'http://localhost:8080/exist/rest/db'),
+                             (request.method, request.url))
+            self.pool.checkin(conn)
+            conn.last_used -= self.pool.health_check + 1
+            mocksend.side_effect = requests.ConnectionError
+            self.assertNotEqual(conn, self.pool.checkout())
+        metrics = self.pool.metrics()
+        self.assertEqual(2, metrics['health_checks'])
+        self.assertEqual(1, metrics['failed_health_checks'])
+
+    def test_fork(self):
+        server = KeepAliveServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            existpool.install()
+            db = ExistDB(server_url=server.url)
+            db.session.get(db.restapi_path('/'))
+            db.session.get(db.restapi_path('/'))
+            self.assertEqual(1, len(set(server.client_ports)),
+                             'queries should reuse a keep-alive connection')
+            pool = db.session.get_adapter(db.exist_url).pool
+
+            # a child process must not use the connection it inherited
+            child = multiprocessing.Process(target=_pooled_get, args=(db,))
+            child.start()
+            child.join(10)
+            self.assertEqual(0, child.exitcode)
+            self.assertEqual(3, len(server.client_ports))
+            self.assertEqual(2, len(set(server.client_ports)),
+                             'child process should open its own connection')
+
+            # the parent still has its connection
+            db.session.get(db.restapi_path('/'))
+            self.assertEqual(server.client_ports[0], server.client_ports[-1])
+            self.assertEqual(1, pool.metrics()['created'])
+
+            # connections checked out before a fork are not returned to
+            # the child's pool
+            connection = pool.checkout()
+            with patch('findingaids.existpool.os.getpid', return_value=os.getpid() + 1):
+                pool.checkin(connection)
+                self.assertEqual(0, pool.metrics()['idle'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @patch('findingaids.existpool.PooledConnection.send')
+    def test_pooled_existdb(self, mocksend):
+        mocksend.side_effect = _exist_response
+        existpool.install()
+        db1 = ExistDB(server_url='http://localhost:8080/exist')
+        db2 = ExistDB(server_url='http://localhost:8080/exist', username='user',
+                      password='pass')
+        adapter = db1.session.get_adapter(db1.exist_url)
+        self.assert_(isinstance(adapter, existpool.PooledAdapter))
+        pool = adapter.pool
+        self.assertEqual(pool, db2.session.get_adapter(db2.exist_url).pool,
+                         'connections to the same server should share a pool')
+        self.assertEqual(pool, existpool.get_pool('http://localhost:8080/exist'))
+        self.assertEqual(('user', 'pass'), db2.session.auth)
+
+        # outside a request, a connection is checked out per call
+        db1.session.get(db1.restapi_path('/'))
+        db2.session.get(db2.restapi_path('/'))
+        self.assertEqual(2, mocksend.call_count)
+        metrics = existpool.metrics()['http://localhost:8080/exist']
+        self.assertEqual(2, metrics['checkouts'])
+        self.assertEqual(1, metrics['created'])
+        self.assertEqual(0, metrics['in_use'])
+
+        # during a request, the first connection is kept by the thread
+        existpool._start_request(None)
+        db1.session.get(db1.restapi_path('/'))
+        self.assertEqual(1, pool.metrics()['in_use'])
+        db2.session.get(db2.restapi_path('/'))
+        self.assertEqual(3, pool.metrics()['checkouts'])
+        existpool._finish_request(None)
+        self.assertEqual(0, pool.metrics()['in_use'])
+
+        # failed connections are closed
+        mocksend.side_effect = requests.ConnectionError
+        self.assertRaises(requests.ConnectionError, db1.session.get, db1.restapi_path('/'))
+        self.assertEqual(1, pool.metrics()['closed'])
+
+        # xmlrpc calls go through the pool
+        mocksend.reset_mock()
+        mocksend.side_effect = _exist_response
+        self.assertFalse(db1.hasDocument('/db/test/doc.xml'))
+        self.assertEqual(1, mocksend.call_count)
+        self.assertEqual(5, pool.metrics()['checkouts'])
+
+        existpool.uninstall()
+        db = ExistDB(server_url='http://localhost:8080/exist')
+        self.assertFalse(isinstance(db.session.get_adapter(db.exist_url),
+                                    existpool.PooledAdapter))
+
+    @override_settings(EXISTDB_LOCAL_STORE=False)
+    def test_install_setting(self):
+        # pooling is only installed when a pool size is configured
+        config = apps.get_app_config('fa')
+        with override_settings(EXISTDB_POOL_SIZE=None):
+            config.ready()
+        self.assertEqual(None, existpool._original_init)
+        with override_settings(EXISTDB_POOL_SIZE=5):
+            config.ready()
+        self.assertNotEqual(None, existpool._original_init)
+
+    @patch('findingaids.existpool.PooledConnection.send')
+    def test_release_pinned(self, mocksend):
+        mocksend.side_effect = _exist_response
+        with override_settings(EXISTDB_POOL_SIZE=1, EXISTDB_POOL_TIMEOUT=1):
+            existpool.install()
+            db = ExistDB(server_url='http://localhost:8080/exist')
+        pool = db.session.get_adapter(db.exist_url).pool
+        # nothing to release outside a request
+        existpool.release_pinned()
+
+        existpool._start_request(None)
+        db.session.get(db.restapi_path('/'))
+        self.assertEqual(1, pool.metrics()['in_use'])
+        existpool.release_pinned()
+        self.assertEqual(0, pool.metrics()['in_use'])
+        # later queries in the request keep a connection again
+        db.session.get(db.restapi_path('/'))
+        self.assertEqual(1, pool.metrics()['in_use'])
+
+        # a query batch returns the request connection before waiting, so
+        # workers can use it even when the pool is full
+        query_pool = QueryPool(workers=1)
+        try:
+            batch = QueryBatch(pool=query_pool)
+            batch.add(db.session.get, db.restapi_path('/'))
+            batch.add(lambda: None)
+            batch.run()
+        finally:
+            query_pool.shutdown()
+        self.assertEqual(0, pool.metrics()['timeouts'])
+        existpool._finish_request(None)
+        self.assertEqual(0, pool.metrics()['in_use'])
+
+
+def _on_exist(func, *args):
+    # run as a batch query would while waiting on eXist
+    with querybatch._waiting():
+        return func(*args)
+
+
+class QueryBatchTest(DjangoTestCase):
+    # concurrent queries within a view
+
+    def setUp(self):
+        self.pool = QueryPool(workers=2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        exist_middleware._recording.stats = None
+
+    def test_run(self):
+        self.assertEqual([], QueryBatch(pool=self.pool).run())
+
+        batch = QueryBatch(pool=self.pool)
+        self.assertEqual(0, batch.add(_on_exist, sleep, 0.2))
+        self.assertEqual(1, batch.add(_on_exist, sleep, 0.2))
+        self.assertEqual(2, batch.add(lambda a, b=None: (a, b), 'a', b='b'))
+        start = datetime.now()
+        self.assertEqual([None, None, ('a', 'b')], batch.run())
+        self.assert_((datetime.now() - start).total_seconds() < 0.35,
+                     'queries should run concurrently')
+
+        # queries run in the calling thread without workers
+        batch = QueryBatch(pool=QueryPool(workers=0))
+        batch.add(threading.current_thread)
+        batch.add(threading.current_thread)
+        self.assertEqual([threading.current_thread()] * 2, batch.run())
+
+    def test_errors(self):
+        started = threading.Event()
+        release = threading.Event()
+        queued = Mock()
+
+        def blocking():
+            started.set()
+            _on_exist(release.wait, 1)
+
+        def fail():
+            _on_exist(started.wait, 1)
+            raise Http404
+
+        # one worker blocked, one query waiting, failure in the calling thread
+        pool = QueryPool(workers=1)
+        batch = QueryBatch(pool=pool)
+        batch.add(blocking)
+        batch.add(queued)
+        batch.add(fail)
+        start = datetime.now()
+        self.assertRaises(Http404, batch.run)
+        self.assert_((datetime.now() - start).total_seconds() < 0.5,
+                     'error should be raised without waiting for other queries')
+        release.set()
+        pool.shutdown()
+        self.assertEqual(0, queued.call_count, 'pending query should be cancelled')
+
+        # timeout
+        release.clear()
+        batch = QueryBatch(timeout=0.1, pool=self.pool)
+        batch.add(_on_exist, release.wait, 1)
+        batch.add(sleep, 0)
+        self.assertRaises(exist_db.ExistDBTimeout, batch.run)
+        release.set()
+
+    def test_compile_lock(self):
+        # queries are generated one at a time, but wait on eXist concurrently
+        db = object.__new__(BatchExistDB)  # no connection needed
+        compiling = []
+        overlapped = []
+
+        def query():
+            compiling.append(threading.current_thread())
+            overlapped.append(len(compiling) > 1)
+            sleep(0.05)
+            compiling.pop()
+            db.query('collection("/db/fa")')
+
+        batch = QueryBatch(pool=self.pool)
+        for i in range(3):
+            batch.add(query)
+        with patch.object(exist_db.ExistDB, 'query', side_effect=lambda *args: sleep(0.2)):
+            start = datetime.now()
+            batch.run()
+        self.assertEqual([False] * 3, overlapped,
+                         'queries should not be generated concurrently')
+        self.assert_((datetime.now() - start).total_seconds() < 0.6,
+                     'queries should wait on eXist concurrently')
+
+        # a batch run by a batch query waits without holding the lock
+        batch = QueryBatch(pool=self.pool)
+        batch.add(lambda: run_queries(query, query))
+        batch.add(query)
+        with patch.object(exist_db.ExistDB, 'query', side_effect=lambda *args: sleep(0.05)):
+            self.assertEqual(2, len(batch.run()))
+        self.assertEqual([False] * 6, overlapped)
+
+    def test_query_stats(self):
+        exist_middleware._recording.stats = exist_middleware.QueryStats()
+
+        def query():
+            exist_db.xquery_called.send(sender=ExistDB, name='query', time_taken=0.01,
+                                        kwargs={'xquery': 'collection("/db/fa")'})
+            return threading.current_thread()
+
+        batch = QueryBatch(pool=self.pool)
+        batch.add(query)
+        batch.add(query)
+        threads = batch.run()
+        self.assertNotEqual(threads[0], threads[1])
+        self.assertEqual(2, exist_middleware.current_stats().queries,
+                         'queries in worker threads should be recorded for the request')
+
+
 # test custom template tag ifurl
 class IfUrlTestCase(DjangoTestCase):
 
@@ -15,10 +15,13 @@
 #   limitations under the License.
 
 from cStringIO import StringIO
+import json
 from os import path
 from types import ListType
 from lxml import etree
 from mock import patch
+import rdflib
+from rdflib.compare import isomorphic
 import unittest
 from urllib import quote as urlquote
 
@@ -32,9 +35,12 @@ from eulexistdb.testutil import TestCase
 from eulxml.xmlmap import load_xmlobject_from_file, \
     load_xmlobject_from_string
 
+from findingaids.fa import cachekeys, facets, rdf
 from findingaids.fa.models import FindingAid, Series, Series2, Series3, \
     Deleted
-from findingaids.fa.views import _series_url, _subseries_links, _series_anchor
+from findingaids.fa import views
+from findingaids.fa.utils import ead_lastmodified, series_url
+from findingaids.fa.views import _subseries_links, _series_anchor
 
 ## unit tests for views and template logic
 
@@ -50,6 +56,9 @@ class FaViewsTest(TestCase):
 
     def setUp(self):
         self.db = ExistDB()
+        # cached title index and document validators may reflect
+        # fixtures loaded by other tests
+        cache.clear()
 
     def tearDown(self):
         # clean up any documents that were created by individual tests
@@ -90,6 +99,7 @@ class FaViewsTest(TestCase):
         ead.list_title.node.text = 'ABC alpha-test'
         self.db.load(ead.serialize(), alphatest_dbpath)
         self.exist_files.append(alphatest_dbpath)
+        cachekeys.invalidate_collection()
 
         a_titles = reverse('fa:titles-by-letter', kwargs={'letter': 'A'})
         response = self.client.get(a_titles)
@@ -179,6 +189,29 @@ class FaViewsTest(TestCase):
             r'''Pitts v. Freeman</[-A-Za-z]+> school''', response.content,
             msg_prefix='title within unittitle should be formatted on list view')
 
+    def test_suggest(self):
+        suggest_url = reverse('fa:suggest')
+        response = self.client.get(suggest_url, {'term': 'raoul'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/json', response['Content-Type'])
+        suggestions = json.loads(response.content)
+        title = [s for s in suggestions if s['category'] == 'title']
+        self.assertEqual(u'Raoul family.', title[0]['label'])
+        self.assertEqual(reverse('fa:findingaid', kwargs={'id': 'raoul548'}), title[0]['url'])
+
+        response = self.client.get(suggest_url, {'term': 'central of geo'})
+        suggestions = json.loads(response.content)
+        self.assertEqual('subject', suggestions[0]['category'])
+        self.assert_(suggestions[0]['url'].startswith(reverse('fa:search') + '?subject='))
+
+        # limit is respected; no eXist queries once the index is built
+        with patch('findingaids.fa.suggest.FindingAid') as mockfa:
+            response = self.client.get(suggest_url, {'term': 'a', 'limit': 2})
+            self.assertEqual(2, len(json.loads(response.content)))
+            self.assertEqual(0, mockfa.objects.only.call_count)
+        response = self.client.get(suggest_url)
+        self.assertEqual([], json.loads(response.content))
+
     def test_titles_xml(self):
         xml_titles = reverse('fa:all-xml')
         response = self.client.get(xml_titles)
@@ -263,6 +296,15 @@ class FaViewsTest(TestCase):
             response, '<h1>%s</h1>' % title, status_code=410,
             msg_prefix="title from deleted record is displayed in response")
 
+    def test_view_validators_cached(self):
+        # last modified is retrieved for conditional processing, so the
+        # document is queried without a concurrent batch
+        with patch('findingaids.fa.views.QueryBatch') as mockbatch:
+            response = self.client.get(reverse('fa:findingaid', kwargs={'id': 'abbey244'}))
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(0, mockbatch.call_count)
+        self.assert_(response.context['last_modified'])
+
     def test_view_dc_fields(self):
         response = self.client.get(reverse('fa:findingaid', kwargs={'id': 'abbey244'}))
         # TODO: would be nice to validate the DC output...  (if possible)
@@ -1017,19 +1059,42 @@ class FaViewsTest(TestCase):
         # clean up
         self.db.removeDocument(settings.EXISTDB_PREVIEW_COLLECTION + '/raoul548.xml')
 
+    def test_page_rdf_matches_rdfa(self):
+        # rdf generated from the EAD should match the RDFa in the rendered page
+        for ead in FindingAid.objects.only('eadid'):
+            eadid = ead.eadid.value
+            ead = FindingAid.objects.get(eadid=eadid)
+            pages = [[]]
+            if ead.dsc is not None and ead.dsc.c:
+                pages.extend([c.short_id] for c in ead.dsc.c if c.id)
+            pages.extend([index.short_id] for index in ead.archdesc.index)
+            for series_ids in pages:
+                if series_ids:
+                    url = series_url(eadid, *series_ids)
+                else:
+                    url = reverse('fa:findingaid', kwargs={'id': eadid})
+                response = self.client.get(url)
+                rdfa = rdflib.Graph()
+                rdfa.parse(data=response.content, format='rdfa', media_type='text/html',
+                           publicID='http://testserver%s' % url)
+                graph = rdf.page_graph(ead, 'testserver', series_ids,
+                                       ead_lastmodified(None, eadid))
+                self.assert_(isomorphic(rdfa, graph),
+                             'rdf for %s should match the RDFa in the page' % url)
+
 # **** tests for helper functions for creating series url, list of series/subseries for display in templates
 
-    def test__series_url(self):
+    def test_series_url(self):
         self.assertEqual(reverse('fa:series-or-index', kwargs={'id': 'docid', 'series_id': 's1'}),
-                         _series_url('docid', 's1'))
+                         series_url('docid', 's1'))
         self.assertEqual(reverse('fa:series2',
                                  kwargs={'id': 'docid', 'series_id': 's1',
                                          'series2_id': 's1.2'}),
-                         _series_url('docid', 's1', 's1.2'))
+                         series_url('docid', 's1', 's1.2'))
         self.assertEqual(
             reverse('fa:series3', kwargs={'id': 'docid', 'series_id': 's3',
                                           'series2_id': 's3.5', 'series3_id': 's3.5a'}),
-            _series_url('docid', 's3', 's3.5', 's3.5a'))
+            series_url('docid', 's3', 's3.5', 's3.5a'))
 
     def test__subseries_links__dsc(self):
         # subseries links for a top-level series that has subseries
@@ -1476,6 +1541,56 @@ class FullTextFaViewsTest(TestCase):
         self.assertContains(response, abbey_url,
             msg_prefix='search for digital resources should include abbey (internal dao only)')
 
+    def test_search_result_cache(self):
+        cache.clear()
+        search_url = reverse('fa:search')
+        response = self.client.get(search_url, {'keywords': 'raoul'})
+        self.assertEqual(200, response.status_code)
+        with patch('findingaids.fa.views._search_queryset',
+                   wraps=views._search_queryset) as mockqs:
+            # same search with different whitespace uses cached results;
+            # only the current page is retrieved
+            response = self.client.get(search_url, {'keywords': '  raoul '})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(1, mockqs.call_count)
+            self.assertEqual('raoul548',
+                             response.context['findingaids'].object_list[0].eadid.value)
+            self.assert_(response.context['findingaids'].object_list[0].fulltext_score)
+
+            # results are cached until the collection changes
+            mockqs.reset_mock()
+            cachekeys.invalidate_collection()
+            self.client.get(search_url, {'keywords': 'raoul'})
+            self.assertEqual(2, mockqs.call_count)
+
+    def test_search_facets(self):
+        cache.clear()
+        search_url = reverse('fa:search')
+        # no facets until facet values are stored for every document
+        response = self.client.get(search_url, {'keywords': 'raoul'})
+        self.assert_('facets' not in response.context)
+
+        for ead in FindingAid.objects.only(*facets.FACET_FIELDS):
+            facets.update_facets(ead)
+        cachekeys.invalidate_collection()
+        response = self.client.get(search_url, {'keywords': 'raoul OR leverette'})
+        search_facets = response.context['facets']
+        self.assertEqual(1, search_facets['dao']['count'])
+        self.assert_(search_facets['subject'])
+        self.assertContains(response, 'Available Online')
+
+        # digital content filter is applied in memory
+        with patch('findingaids.fa.views._search_queryset',
+                   wraps=views._search_queryset) as mockqs:
+            response = self.client.get(search_url, {'keywords': 'raoul OR leverette',
+                                                    'dao': 'on'})
+            self.assertEqual(1, response.context['findingaids'].paginator.count)
+            self.assertEqual('leverette135',
+                             response.context['findingaids'].object_list[0].eadid.value)
+            self.assertFalse(mockqs.call_args[0][3],
+                             'digital content filter should not be applied in eXist')
+        self.assert_(response.context['facets']['dao']['selected'])
+
     def test_search__exact_phrase(self):
         search_url = reverse('fa:search')
         # search term missing close quote - query syntax error
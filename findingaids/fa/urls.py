@@ -66,5 +66,6 @@ findingaid_urlpatterns = [
 urlpatterns = [
     url(r'^titles/', include(title_urlpatterns)),
     url(r'^documents/', include(findingaid_urlpatterns)),
+    url(r'^search/suggest/$', fa_views.suggest, name='suggest'),
     url(r'^search/', fa_views.search, name='search')
 ]
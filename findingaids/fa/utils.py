@@ -20,13 +20,17 @@ import logging
 from lxml import etree
 import os
 import re
-import subprocess
 import tempfile
 
 from django import http
 from django.conf import settings
+from django.core.cache import cache
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.core.urlresolvers import reverse
 from django.template import Context
+from django.template.base import Template, VariableDoesNotExist
+from django.template.defaulttags import ForNode, IfNode, WithNode
+from django.template.loader_tags import IncludeNode
 from django.template.loader import get_template
 from django.shortcuts import get_object_or_404
 
@@ -34,7 +38,8 @@ from django.template import RequestContext
 
 from eulexistdb.exceptions import DoesNotExist  # ReturnedMultiple needed also ?
 
-from findingaids.fa.models import FindingAid, Deleted
+from findingaids.fa import cachekeys, fop
+from findingaids.fa.models import FindingAid, Deleted, CollectionState
 
 logger = logging.getLogger(__name__)
 
@@ -55,19 +60,55 @@ def render_to_pdf(template_src, context_dict, filename=None):
     :param template_src: name of the template to render
     :param context_dict: dictionary to pass to the template for rendering
     :param filename: optional filename, to specify to the browser in the response
-    :returns: :class:`django.http.HttpResponse` with PDF content, content-type,
-            and, if a filename was specified, a content-disposition header to
-            prompt the browser to download the response as the filename specified
+    :returns: :class:`django.http.FileResponse` streaming the PDF content, with
+            content-type and, if a filename was specified, a content-disposition
+            header to prompt the browser to download the response as the
+            filename specified
     """
+    # create a temporary file where the PDF should be created
+    pdf_file = tempfile.NamedTemporaryFile(prefix='findingaids-pdf-')
+    streaming = False
+    try:
+        if generate_pdf(template_src, context_dict, pdf_file.name):
+            # stream the PDF from disk; the temporary file is removed
+            # when the response is finished and closes it
+            response = http.FileResponse(pdf_file, content_type='application/pdf')
+            response['Content-Length'] = os.fstat(pdf_file.fileno()).st_size
+            if filename:
+                response['Content-Disposition'] = "inline; filename=%s" % filename
+            streaming = True
+            return response
+    finally:
+        if not streaming:
+            # can get an OSError if the PDF file does not exist, e.g. if fop failed
+            try:
+                pdf_file.close()
+            except OSError, e:
+                logger.error("Failed to delete temporary PDF file: %s" % e)
+
+    # if nothing was returned by now, there was an error generating the pdf
+    raise Exception("There was an error generating the PDF")
 
+
+def generate_pdf(template_src, context_dict, pdf_filename):
+    """Render a template as html, convert to XSL-FO, and run it through the
+    configured XSL-FO processor to create a PDF file.  Any template used
+    with this function should produce well-formed xhtml so it can be parsed
+    as xml.
+
+    :param template_src: name of the template to render
+    :param context_dict: dictionary to pass to the template for rendering
+    :param pdf_filename: full path where the PDF should be written
+    :returns: True if the PDF was generated successfully
+    """
     xslfo = html_to_xslfo(template_src, context_dict)
     tmpdir = tempfile.mkdtemp('findingaids-fop')
     # write xsl-fo to a temporary named file that we can pass to xsl-fo processor
     xslfo_file = tempfile.NamedTemporaryFile(prefix='findingaids-xslfo-', dir=tmpdir)
     logger.debug("Writing out XSL-FO to %s" % xslfo_file.name)
-    xslfo.write(xslfo_file.name, encoding='UTF-8', pretty_print=True, xml_declaration=True)
-    # create a temporary file where the PDF should be created
-    pdf_file = tempfile.NamedTemporaryFile(prefix='findingaids-pdf-', dir=tmpdir)
+    # serialized directly to disk; not pretty-printed, since that only
+    # adds size for the processor to read
+    xslfo.write(xslfo_file.name, encoding='UTF-8', xml_declaration=True)
     # create a log4j file so we can get fop errors
     # FIXME: there must be a better way to dot his!
     log4j_prop = os.path.join(tmpdir, 'log4j.properties')
@@ -78,33 +119,19 @@ log4j.appender.CONSOLE.layout=org.apache.log4j.PatternLayout
 log4j.appender.CONSOLE.layout.ConversionPattern=%-5p %3x - %m%n
         ''')
     try:
-        # NOTE: for now, just sending errors to stdout
-        cmd_parts = [settings.XSLFO_PROCESSOR, xslfo_file.name, pdf_file.name]
-        logger.debug("Calling XSL-FO processor: %s" % ' '.join(cmd_parts))
-        rval = subprocess.call(cmd_parts, cwd=tmpdir)
-        if rval is 0:       # success!
-            response = http.HttpResponse(pdf_file.read(), content_type='application/pdf')
-            if filename:
-                response['Content-Disposition'] = "inline; filename=%s" % filename
-            return response
-    except OSError, e:
-        logger.error("Apache Fop execution failed: %s" % e)
+        # NOTE: for now, just sending processor errors to stdout
+        fop.render_pdf(xslfo_file.name, pdf_filename, cwd=tmpdir)
+        return True
+    except fop.FopError, e:
+        logger.error("XSL-FO to PDF conversion failed: %s" % e)
+        return False
     finally:
         # clean up tmp files
         os.unlink(log4j_prop)
         # temporary files are automatically deleted when closed
         xslfo_file.close()
-        # can get an OSError if the PDF file does not exist, e.g. if fop failed
-        try:
-            pdf_file.close()
-        except OSError, e:
-            logger.error("Failed to delete temporary PDF file: %s" % e)
-        finally:
-            # dir should be empty now, so we can delete it
-            os.rmdir(tmpdir)
-
-    # if nothing was returned by now, there was an error generating the pdf
-    raise Exception("There was an error generating the PDF")
+        # dir should be empty now, so we can delete it
+        os.rmdir(tmpdir)
 
 
 def html_to_xslfo(template_src, context_dict):
@@ -117,8 +144,7 @@ def html_to_xslfo(template_src, context_dict):
     :returns: result of generated html, converted to XSL-FO, as an instance of
                 :class:`lxml.etree.ElementTree`
     """
-    template = get_template(template_src)
-    xhtml = etree.fromstring(template.render(Context(context_dict)))
+    xhtml = parse_template(template_src, context_dict)
     xsl_params = {
         'STATIC_ROOT': settings.STATIC_ROOT,
         'STATIC_URL': settings.STATIC_URL,
@@ -132,6 +158,156 @@ def html_to_xslfo(template_src, context_dict):
     return XHTML_TO_XSLFO(xhtml, **xsl_params)
 
 
+def parse_template(template_src, context_dict, chunk_size=65536):
+    """Render a template and parse the result as xml, feeding the output to
+    the parser as it is rendered instead of rendering the complete document
+    as a single string first.
+
+    :param template_src: name of the template to render
+    :param context_dict: dictionary to pass to the template for rendering
+    :param chunk_size: approximate size of the chunks passed to the parser
+    :returns: root element of the parsed document
+    """
+    template = get_template(template_src).template
+    parser = etree.XMLParser()
+    chunks, size = [], 0
+    for chunk in iter_render(template, Context(context_dict)):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            parser.feed(u''.join(chunks).encode('utf-8'))
+            chunks, size = [], 0
+    parser.feed(u''.join(chunks).encode('utf-8'))
+    return parser.close()
+
+
+def iter_render(template, context):
+    """Render a template incrementally, as a sequence of strings that are
+    equivalent to the output of :meth:`django.template.base.Template.render`
+    when joined.  Output is split at the level of individual nodes and
+    ``{% if %}`` branches, each iteration of a ``{% for %}`` loop is
+    rendered separately, and the contents of ``{% with %}`` blocks and
+    included templates are rendered the same way, so that large documents
+    do not need to be held in memory as a single string.
+
+    As with Django's ``{% include %}`` tag, an included template that cannot
+    be loaded is rendered as an empty string unless template debugging is
+    on, but errors raised while an included template is being rendered are
+    not suppressed, since part of its output may already have been returned.
+
+    :param template: :class:`django.template.base.Template`
+    :param context: :class:`django.template.Context`
+    """
+    context.render_context.push()
+    try:
+        with context.bind_template(template):
+            context.template_name = template.name
+            for chunk in _iter_nodelist(template.nodelist, context):
+                yield chunk
+    finally:
+        context.render_context.pop()
+
+
+def _iter_nodelist(nodelist, context):
+    for node in nodelist:
+        if isinstance(node, IfNode):
+            # same logic as IfNode.render: render the first matching branch
+            for condition, branch in node.conditions_nodelists:
+                if condition is not None:
+                    try:
+                        match = condition.eval(context)
+                    except VariableDoesNotExist:
+                        match = None
+                else:
+                    match = True
+                if match:
+                    for chunk in _iter_nodelist(branch, context):
+                        yield chunk
+                    break
+        elif isinstance(node, ForNode) and len(node.loopvars) == 1 \
+                and not node.is_reversed:
+            for chunk in _iter_for(node, context):
+                yield chunk
+        elif isinstance(node, WithNode):
+            values = dict((key, val.resolve(context))
+                          for key, val in node.extra_context.iteritems())
+            with context.push(**values):
+                for chunk in _iter_nodelist(node.nodelist, context):
+                    yield chunk
+        elif isinstance(node, IncludeNode):
+            for chunk in _iter_include(node, context):
+                yield chunk
+        else:
+            yield node.render_annotated(context)
+
+
+def _iter_include(node, context):
+    # resolve the included template and its context as IncludeNode.render
+    # does; if that fails, let IncludeNode.render handle the error
+    try:
+        template = node.template.resolve(context)
+        if not callable(getattr(template, 'render', None)):
+            template_cache = context.render_context.setdefault(node.context_key, {})
+            template_name = template
+            template = template_cache.get(template_name)
+            if template is None:
+                template = context.template.engine.get_template(template_name)
+                template_cache[template_name] = template
+        values = dict((name, var.resolve(context))
+                      for name, var in node.extra_context.iteritems())
+    except Exception:
+        yield node.render_annotated(context)
+        return
+    if not isinstance(template, Template):
+        # e.g., a template from another backend
+        yield node.render_annotated(context)
+        return
+
+    if node.isolated_context:
+        include_context = context.new(values)
+    else:
+        include_context = context
+        context.update(values)
+    # same as Template.render for a template with a bound context
+    include_context.render_context.push()
+    try:
+        for chunk in _iter_nodelist(template.nodelist, include_context):
+            yield chunk
+    finally:
+        include_context.render_context.pop()
+        if not node.isolated_context:
+            context.pop()
+
+
+def _iter_for(node, context):
+    # same logic as ForNode.render for a single loop variable
+    parentloop = context['forloop'] if 'forloop' in context else {}
+    with context.push():
+        try:
+            values = node.sequence.resolve(context, True)
+        except VariableDoesNotExist:
+            values = []
+        if values is None:
+            values = []
+        if not hasattr(values, '__len__'):
+            values = list(values)
+        len_values = len(values)
+        if len_values < 1:
+            for chunk in _iter_nodelist(node.nodelist_empty, context):
+                yield chunk
+            return
+        loop_dict = context['forloop'] = {'parentloop': parentloop}
+        for i, item in enumerate(values):
+            loop_dict.update({
+                'counter0': i, 'counter': i + 1,
+                'revcounter': len_values - i, 'revcounter0': len_values - i - 1,
+                'first': (i == 0), 'last': (i == len_values - 1),
+            })
+            context[node.loopvars[0]] = item
+            for chunk in _iter_nodelist(node.nodelist_loop, context):
+                yield chunk
+
+
 def pages_to_show(paginator, page, page_labels={}):
     """Generate a dictionary of pages to show around the current page. Show
     3 numbers on either side of the specified page, or more if close to end or
@@ -272,6 +448,112 @@ def get_findingaid(eadid=None, preview=False, only=None, also=None, order_by=Non
     return fa
 
 
+def series_url(eadid, series_id, *ids, **extra_opts):
+    """
+    Generate a series or subseries url when given an eadid and list of series ids.
+    Requires at least ead document id and top-level series id.  Number of additional
+    series ids provided determines type of series url generated.
+
+    Default url callback for :meth:`findingaids.fa.views._subseries_links`.
+    """
+    # common args for generating all urls
+    args = {'id': eadid, 'series_id': series_id}
+
+    if len(ids) == 0:       # no additional args
+        view_name = 'series-or-index'
+    if len(ids) >= 1:       # add subseries id arg if one specified (used for sub and sub-subseries)
+        args['series2_id'] = ids[0]
+        view_name = 'series2'
+    if len(ids) == 2:       # add sub-subseries id arg if specified
+        args['series3_id'] = ids[1]
+        view_name = 'series3'
+
+    if 'preview' in extra_opts and extra_opts['preview'] is True:
+        view_namespace = 'fa-admin:preview'
+    else:
+        view_namespace = 'fa'
+
+    return reverse('%s:%s' % (view_namespace, view_name), kwargs=args)
+
+
+def _collection(preview=False):
+    return settings.EXISTDB_PREVIEW_COLLECTION if preview else settings.EXISTDB_ROOT_COLLECTION
+
+
+def ead_validators(request, id, preview=False):
+    """Get the values used for conditional processing of a single EAD document
+    (SHA-1 hash and last modification time), retrieved from eXist with a
+    single query.
+
+    Results are stored on the request, so that the etag and last-modified
+    functions for a view only need one lookup, and in the Django cache, so
+    that repeated requests for an unchanged document do not query eXist at
+    all.  Cached values are invalidated with :meth:`invalidate_findingaid`
+    whenever a document is published, previewed, or deleted.
+
+    :param request: current request
+    :param id: eadid
+    :param preview: document is in the preview collection; defaults to False
+    :returns: dictionary with hash and last_modified
+    """
+    validators = cached_ead_validators(request, id, preview)
+    if validators is None:
+        # raises 404 if not found; nothing is cached in that case
+        fa = get_findingaid(id, preview=preview, only=['hash', 'last_modified'])
+        validators = {'hash': fa.hash, 'last_modified': fa.last_modified}
+        cache.set(_ead_validators_key(id, preview), validators, cachekeys.timeout())
+        _store_ead_validators(request, id, preview, validators)
+    return validators
+
+
+def cached_ead_validators(request, id, preview=False):
+    """Get the values used for conditional processing of a single EAD
+    document (see :meth:`ead_validators`) if they are stored on the request
+    or in the Django cache, without querying eXist.
+
+    :param request: current request
+    :param id: eadid
+    :param preview: document is in the preview collection; defaults to False
+    :returns: dictionary with hash and last_modified, or None if not cached
+    """
+    key = _ead_validators_key(id, preview)
+    request_cache = getattr(request, '_ead_validators', None)
+    if request_cache is not None and key in request_cache:
+        return request_cache[key]
+
+    validators = cache.get(key)
+    if validators is not None:
+        _store_ead_validators(request, id, preview, validators)
+    return validators
+
+
+def _ead_validators_key(id, preview):
+    return cachekeys.document_key('ead-validators', id, collection=_collection(preview))
+
+
+def _store_ead_validators(request, id, preview, validators):
+    request_cache = getattr(request, '_ead_validators', None)
+    if request_cache is None:
+        request_cache = {}
+        try:
+            request._ead_validators = request_cache
+        except AttributeError:
+            # not a real request object; skip per-request storage
+            pass
+    request_cache[_ead_validators_key(id, preview)] = validators
+
+
+def invalidate_findingaid(id, preview=False):
+    """Invalidate all cached values derived from a single EAD document
+    (etag and last-modified values, navigation), e.g. after it has been
+    published, previewed, or deleted.
+
+    :param id: eadid
+    :param preview: invalidate values for the preview collection; defaults to False
+    """
+    cachekeys.invalidate_document(id, _collection(preview))
+
+
 def ead_lastmodified(request, id, preview=False, *args, **kwargs):
     """Get the last modification time for a finding aid in eXist by eadid.
     Used to generate last-modified header for views based on a single EAD document.
@@ -280,9 +562,8 @@ def ead_lastmodified(request, id, preview=False, *args, **kwargs):
     :param preview: load document from preview collection; defaults to False
     :rtype: :class:`datetime.datetime`
     """
-    # get document name last modified by eadid
-    fa = get_findingaid(id, preview=preview, only=['last_modified'])
-    return exist_datetime_with_timezone(fa.last_modified)
+    validators = ead_validators(request, id, preview=preview)
+    return exist_datetime_with_timezone(validators['last_modified'])
 
 
 def ead_etag(request, id, preview=False, *args, **kwargs):
@@ -293,8 +574,7 @@ def ead_etag(request, id, preview=False, *args, **kwargs):
     :param preview: requested document is in the preview collection; defaults to False
     :rtype: string
     """
-    fa = get_findingaid(id, preview=preview, only=['hash'])
-    return fa.hash
+    return ead_validators(request, id, preview=preview)['hash']
 
 def collection_lastmodified(request, *args, **kwargs):
     """Get the last modification time for the entire finding aid collection.
@@ -302,24 +582,26 @@ def collection_lastmodified(request, *args, **kwargs):
     collection (e.g., :meth:`~findingaids.fa.views.titles_by_letter` browse view,
     :meth:`findingaids.fa.views.search` search view).
 
-    If no documents are found in eXist and there are no deleted records, no
-    value is returned and django will not send a Last-Modified header.
+    Based on the recorded :class:`~findingaids.fa.models.CollectionState`,
+    which includes the most recently deleted document, so eXist is not
+    queried.  If no documents are found in eXist and there are no deleted
+    records, no value is returned and django will not send a Last-Modified
+    header.
     """
-    fa_last = None
-    # most recently modified document in the eXist collection
-    fa = FindingAid.objects.order_by('-last_modified').only('last_modified')
-    if fa .count():
-        fa_last = fa[0].last_modified
-    # most recently deleted document from sql DB
-    deleted = Deleted.objects.order_by('-date').all()
-    if deleted.exists():
-        deleted_last = deleted[0].date
-        # get most recent of the two
-        if fa_last is None or deleted_last > fa_last:
-            fa_last = deleted_last
-    if fa_last is not None:
+    last_modified = CollectionState.current().last_modified
+    if last_modified is not None:
         # NOTE: potentially using configured exist TZ for non-eXist date...
-        return exist_datetime_with_timezone(fa_last)
+        return exist_datetime_with_timezone(last_modified)
+
+def collection_etag(request, *args, **kwargs):
+    """Get an etag for the entire finding aid collection, based on the
+    generation of the recorded :class:`~findingaids.fa.models.CollectionState`,
+    which changes every time a document is published, loaded, or deleted.
+    Used with :meth:`collection_lastmodified` for collection-wide views.
+
+    :rtype: string
+    """
+    return 'collection-%d' % CollectionState.current().generation
 
 # object pagination - adapted directly from django paginator documentation
 def paginate_queryset(request, qs, per_page=10, orphans=0):    # 0 is django default
@@ -18,9 +18,12 @@ import logging
 from lxml import etree
 from urllib import urlencode
 
-from django.http import HttpResponse, Http404, HttpResponsePermanentRedirect
+from django.http import HttpResponse, Http404, HttpResponsePermanentRedirect, \
+    JsonResponse
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.sitemaps import views as sitemaps_views
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.shortcuts import render
 from django.template import RequestContext
@@ -33,11 +36,19 @@ from eulxml.xmlmap.eadmap import EAD_NAMESPACE
 from findingaids.utils import normalize_whitespace
 
 from findingaids.fa.models import FindingAid, Series, Series2, Series3, \
-    FileComponent, title_letters, Index, shortform_id
+    FileComponent, CatalogEntry, TitleIndexEntry, title_letters, title_index, Index, shortform_id
 from findingaids.fa.forms import KeywordSearchForm, AdvancedSearchForm
+from findingaids.fa import cachekeys, pdfstore, sitemapstore
+from findingaids.fa.facets import facet_index
+from findingaids.fa.fulltext import search_index, SearchQueryError
+from findingaids.fa.navigation import navigation_item, findingaid_navigation
+from findingaids.fa.querybatch import QueryBatch
+from findingaids.fa.suggest import suggest_index, TITLE, SUBJECT
+from findingaids.fa.templatetags.ead import memoize_fragments
 from findingaids.fa.utils import render_to_pdf, get_findingaid, pages_to_show, \
-    ead_lastmodified, ead_etag, paginate_queryset, ead_gone_or_404, \
-    collection_lastmodified, alpha_pagelabels, html_to_xslfo
+    ead_lastmodified, ead_etag, ead_validators, cached_ead_validators, paginate_queryset, \
+    ead_gone_or_404, collection_lastmodified, collection_etag, alpha_pagelabels, html_to_xslfo, \
+    series_url
 
 logger = logging.getLogger(__name__)
 
@@ -75,7 +86,7 @@ def browse_titles(request):
                   {'letters': title_letters()})
 
 
-@condition(last_modified_func=collection_lastmodified)
+@condition(etag_func=collection_etag, last_modified_func=collection_lastmodified)
 def titles_by_letter(request, letter):
     """Paginated list of finding aids by first letter in list title.
     Includes list of browse first-letters as in :meth:`browse_titles`.
@@ -88,16 +99,24 @@ def titles_by_letter(request, letter):
     request.session['last_search'] = last_search
     request.session.set_expiry(0)  # set to expire when browser closes
 
-    # using ~ to do case-insensitive ordering
+    # paginate and label pages from the cached title index (already sorted
+    # case-insensitively), then retrieve only the documents for this page
     normalized_letter = normalize_whitespace(letter)
-    fa = FindingAid.objects.filter(list_title__startswith=normalized_letter) \
-                           .order_by('~list_title').only(*fa_listfields)
-    fa_subset, paginator = paginate_queryset(request, fa, per_page=10, orphans=5)
-    page_labels = alpha_pagelabels(paginator, fa, label_attribute='list_title')
+    index = title_index(normalized_letter)
+    fa_subset, paginator = paginate_queryset(request, index, per_page=10, orphans=5)
+    page_labels = alpha_pagelabels(paginator, index, label_attribute='list_title')
     # No longer restricting the number of page labels shown using pages_to_show (like we do for numeric pages).
     # That doesn't make sense here, since the alpha range labels should ideally allow anyone to jump directly
     # to the section they want based on the labels.
 
+    page_ids = [entry.eadid for entry in fa_subset.object_list]
+    if page_ids:
+        fa = FindingAid.objects.filter(eadid__in=page_ids).only(*fa_listfields)
+        findingaids = dict((ead.eadid.value, ead) for ead in fa)
+        # restore title index order; skip anything removed since the index was built
+        fa_subset.object_list = [findingaids[eadid] for eadid in page_ids
+                                 if eadid in findingaids]
+
     response_context = {
         'findingaids': fa_subset,
         # 'querytime': [fa.queryTime()],
@@ -115,14 +134,17 @@ def titles_by_letter(request, letter):
     return render(request, 'fa/titles_list.html', response_context)
 
 
-@condition(last_modified_func=collection_lastmodified)
+@condition(etag_func=collection_etag, last_modified_func=collection_lastmodified)
 def xml_titles(request):
     """List all findingaids in the database and link to the EAD xml,
     as a simple way to make content available for harvesting.
     """
     # retrieve  all findingaids in the database and return eadids
     # - no sorting, title, etc. - barebones display for
-    fa = FindingAid.objects.only('eadid')
+    if CatalogEntry.is_complete():
+        fa = CatalogEntry.published().only('eadid')
+    else:
+        fa = FindingAid.objects.only('eadid')
     response_context = {
         'findingaids': fa,
     }
@@ -130,6 +152,32 @@ def xml_titles(request):
     return render(request, 'fa/xml.html', response_context)
 
 
+def sitemap_index(request, sitemaps):
+    '''Sitemap index, served from the precomputed sitemap files when
+    available (see :mod:`findingaids.fa.sitemapstore`), otherwise generated
+    by :mod:`django.contrib.sitemaps`.'''
+    response = sitemapstore.sitemap_response(request)
+    if response is None:
+        response = sitemaps_views.index(request, sitemaps)
+    return response
+
+
+def sitemap(request, sitemaps, section):
+    '''Sitemap for a single section, served from the precomputed sitemap
+    files when available, otherwise generated by
+    :mod:`django.contrib.sitemaps`.'''
+    try:
+        page = int(request.GET.get('p', 1))
+    except ValueError:
+        page = None
+    response = None
+    if page is not None and page > 0:
+        response = sitemapstore.sitemap_response(request, section, page)
+    if response is None:
+        response = sitemaps_views.sitemap(request, sitemaps, section)
+    return response
+
+
 @ead_gone_or_404
 @condition(etag_func=ead_etag, last_modified_func=ead_lastmodified)
 def eadxml(request, id, preview=False):
@@ -161,10 +209,28 @@ def findingaid(request, id, preview=False):
     else:
         url_params = ''
         filter = {}
-    fa = get_findingaid(id, preview=preview, filter=filter)
-    last_modified = ead_lastmodified(request, id, preview)
-    series = _subseries_links(fa.dsc, url_ids=[fa.eadid], preview=preview,
-                              url_params=url_params)
+    # last modified is usually already retrieved for conditional
+    # processing; otherwise, query for it alongside the document
+    if cached_ead_validators(request, id, preview) is not None:
+        last_modified = ead_lastmodified(request, id, preview)
+        fa = get_findingaid(id, preview=preview, filter=filter)
+    else:
+        batch = QueryBatch()
+        batch.add(ead_lastmodified, request, id, preview)
+        batch.add(get_findingaid, id, preview=preview, filter=filter)
+        last_modified, fa = batch.run()
+    if url_params:
+        # series links include match counts for the current keywords
+        series = _subseries_links(fa.dsc, url_ids=[fa.eadid], preview=preview,
+                                  url_params=url_params)
+        all_indexes = fa.archdesc.index
+    else:
+        checksum = ead_validators(request, id, preview)['hash']
+        nav = findingaid_navigation(id, checksum, preview=preview, ead=fa)
+        series = []
+        if nav.has_series:
+            series = _navigation_links(nav.series, url_ids=[id], preview=preview)
+        all_indexes = nav.indexes
 
     extra_ns = RDFA_NAMESPACES.copy()
     # add any non-default namespaces from the EAD document
@@ -173,7 +239,7 @@ def findingaid(request, id, preview=False):
     context = {
         'ead': fa,
         'series': series,
-        'all_indexes': fa.archdesc.index,
+        'all_indexes': all_indexes,
         'preview': preview,
         'url_params': url_params,
         'docsearch_form': KeywordSearchForm(),
@@ -187,8 +253,15 @@ def findingaid(request, id, preview=False):
     if url_params and not preview:
         context['series_noparam'] = _subseries_links(fa.dsc, url_ids=[fa.eadid])
 
-    response = render(request, 'fa/findingaid.html', context,
-                      current_app='preview')
+    if url_params:
+        response = render(request, 'fa/findingaid.html', context,
+                          current_app='preview')
+    else:
+        # formatted EAD content is memoized by document version, except
+        # when search terms are highlighted
+        with memoize_fragments(fa, 'findingaid', checksum):
+            response = render(request, 'fa/findingaid.html', context,
+                              current_app='preview')
     # Set Cache-Control to private when there is a last_search
     if "last_search" in request.session:
         response['Cache-Control'] = 'private'
@@ -196,6 +269,31 @@ def findingaid(request, id, preview=False):
     return response
 
 
+def full_findingaid_context(fa, mode, preview=False, navigation=None):
+    """Template context for displaying the full contents of a single finding
+    aid with the `fa/full.html` template, as used for PDF generation.
+
+    :param fa: :class:`~findingaids.fa.models.FindingAid`
+    :param mode: display mode, e.g. html or pdf
+    :param preview: boolean indicating preview mode, defaults to False
+    :param navigation: optional :class:`~findingaids.fa.navigation.FindingAidNavigation`
+        for the document, to generate series links without walking the document
+    """
+    if navigation is not None:
+        series = []
+        if navigation.has_series:
+            series = _navigation_links(navigation.series, url_ids=[fa.eadid.value],
+                                       url_callback=_series_anchor, preview=preview)
+    else:
+        series = _subseries_links(fa.dsc, url_ids=[fa.eadid], url_callback=_series_anchor,
+                                  preview=preview)
+    return {'ead': fa, 'series': series, 'mode': mode, 'preview': preview,
+            # normally supplied by context processor
+            'DEFAULT_DAO_LINK_TEXT': getattr(settings, 'DEFAULT_DAO_LINK_TEXT',
+                                             '[Resource available online]')
+            }
+
+
 @ead_gone_or_404
 @condition(etag_func=ead_etag, last_modified_func=ead_lastmodified)
 def full_findingaid(request, id, mode, preview=False):
@@ -207,23 +305,27 @@ def full_findingaid(request, id, mode, preview=False):
             of the PDF display
     :param preview: boolean indicating preview mode, defaults to False
     """
-    fa = get_findingaid(id, preview=preview)
-    series = _subseries_links(fa.dsc, url_ids=[fa.eadid], url_callback=_series_anchor, preview=preview)
+    if mode == 'pdf' and not preview and pdfstore.pdf_storage() is not None:
+        # serve from PDF storage, generating and storing the PDF if
+        # this version of the document has not been stored yet
+        checksum = ead_validators(request, id)['hash']
+        pdf = pdfstore.stored_pdf(id, checksum) or pdfstore.store_pdf(id, checksum)
+        return pdfstore.pdf_response(request, pdf, checksum, filename='%s.pdf' % id)
 
+    fa = get_findingaid(id, preview=preview)
+    checksum = ead_validators(request, id, preview)['hash']
+    nav = findingaid_navigation(id, checksum, preview=preview, ead=fa)
     template = 'fa/full.html'
-    template_args = {'ead': fa, 'series': series,
-                     'mode': mode, 'preview': preview, 'request': request,
-                     # normally supplied by context processor
-                     'DEFAULT_DAO_LINK_TEXT': getattr(settings, 'DEFAULT_DAO_LINK_TEXT',
-                                                      '[Resource available online]')
-                     }
-    if mode == 'html':
-        return render(request, template, template_args)
-    elif mode == 'pdf':
-        return render_to_pdf(template, template_args, filename='%s.pdf' % fa.eadid.value)
-    elif mode == 'xsl-fo':
-        xslfo = html_to_xslfo(template, template_args)
-        return HttpResponse(etree.tostring(xslfo), content_type='application/xml')
+    template_args = full_findingaid_context(fa, mode, preview, navigation=nav)
+    template_args['request'] = request
+    with memoize_fragments(fa, 'findingaid', checksum):
+        if mode == 'html':
+            return render(request, template, template_args)
+        elif mode == 'pdf':
+            return render_to_pdf(template, template_args, filename='%s.pdf' % fa.eadid.value)
+        elif mode == 'xsl-fo':
+            xslfo = html_to_xslfo(template, template_args)
+            return HttpResponse(etree.tostring(xslfo), content_type='application/xml')
 
 
 @condition(etag_func=ead_etag, last_modified_func=ead_lastmodified)
@@ -289,18 +391,18 @@ def _view_series(request, eadid, *series_ids, **kwargs):
 
         logger.info('''Redirecting from long-form series/index %s url to short-form url. %s'''
                     % (request.path, referrer))
-        return HttpResponsePermanentRedirect(_series_url(eadid, *redirect_ids))
-
-    # build initial series and index filters and field lists
-    filter_list = {'ead__eadid': eadid}
-    series_fields = ['id', 'level', 'did__unitid', 'did__unittitle']
-    index_fields = ['id', 'head']
+        return HttpResponsePermanentRedirect(series_url(eadid, *redirect_ids))
 
     # info needed to construct navigation links within this ead
-    # - summary info for all top-level series in this finding aid
-    all_series = Series.objects.filter(**filter_list).using(collection)
-    # - summary info for any indexes
-    all_indexes = Index.objects.filter(**filter_list).using(collection)
+    # (summary info for all top-level series and any indexes) is
+    # cached by document version
+    checksum = ead_validators(request, eadid, preview_mode)['hash']
+
+    # independent queries are run concurrently: navigation (only queried
+    # when not cached), the item to be displayed, and, when highlighting,
+    # match counts for navigation links and the highlighted ead
+    batch = QueryBatch()
+    batch.add(findingaid_navigation, eadid, checksum, preview=preview_mode)
 
     if 'keywords' in request.GET:
         search_terms = request.GET['keywords']
@@ -308,19 +410,15 @@ def _view_series(request, eadid, *series_ids, **kwargs):
         #filter further based on highlighting
         filter = {'highlight': search_terms}
         # filter = {'boostfields__fulltext_terms':search_terms,'highlight':search_terms}
-        # add highlighting & match counts to series & index lists for navigation links
-        all_series = all_series.filter(**filter)
-        all_indexes = all_indexes.filter(**filter)
-        series_fields.append('match_count')
-        index_fields.append('match_count')
-
-    else:
-        url_params = ''
-        filter = {}
-    # get the item to be displayed (series, subseries, index)
-    result = _get_series_or_index(eadid, *series_ids, filter=filter, use_collection=collection)
+        # add match counts to series & index lists for navigation links
+        filter_list = {'ead__eadid': eadid}
+        series_matches = Series.objects.filter(**filter_list).filter(**filter) \
+                               .only('id', 'match_count').using(collection)
+        index_matches = Index.objects.filter(**filter_list).filter(**filter) \
+                              .only('id', 'match_count').using(collection)
+        batch.add(list, series_matches)
+        batch.add(list, index_matches)
 
-    if 'keywords' in request.GET:
         # when full-text highlighting is enabled, ead must be retrieved separately
         # in order to retrieve match counts for main page ToC items
 
@@ -333,28 +431,32 @@ def _view_series(request, eadid, *series_ids, **kwargs):
                          ]
         fa = FindingAid.objects.filter(eadid=eadid).filter(**filter).using(collection)
         # using raw xpaths for exist-specific logic to expand and count matches
-        ead = fa.only(*return_fields) \
-                .only_raw(coll_desc_matches=FindingAid.coll_desc_matches_xpath,
-                          admin_info_matches=FindingAid.admin_info_matches_xpath,
-                          archdesc__controlaccess__match_count=FindingAid.controlaccess_matches_xpath) \
-                .using(collection).get()
+        batch.add(fa.only(*return_fields)
+                    .only_raw(coll_desc_matches=FindingAid.coll_desc_matches_xpath,
+                              admin_info_matches=FindingAid.admin_info_matches_xpath,
+                              archdesc__controlaccess__match_count=FindingAid.controlaccess_matches_xpath)
+                    .using(collection).get)
+    else:
+        url_params = ''
+        filter = {}
+    # get the item to be displayed (series, subseries, index)
+    batch.add(_get_series_or_index, eadid, *series_ids, filter=filter, use_collection=collection)
+
+    if url_params:
+        nav, series_matches, index_matches, ead, result = batch.run()
+        series_counts = dict((s.id, s.match_count) for s in series_matches)
+        index_counts = dict((i.id, i.match_count) for i in index_matches)
+        all_series = [s.with_match_count(series_counts.get(s.id, 0)) for s in nav.series]
+        all_indexes = [i.with_match_count(index_counts.get(i.id, 0)) for i in nav.indexes]
     else:
-        # when no highlighting, get ead retrieved with main item
-        fa = FindingAid.objects.filter(eadid=eadid).using(collection)
+        nav, result = batch.run()
+        all_series = nav.series
+        all_indexes = nav.indexes
         # when no highlighting, use partial ead retrieved with main item
         ead = result.ead
 
-    # info needed to construct navigation links within this ead
-    # - summary info for all top-level series in this finding aid
-    all_series = all_series.only(*series_fields).all()
-    # - summary info for any indexes
-    all_indexes = all_indexes.only(*index_fields).all()
-
     #find index of requested object so next and prev can be determined
-    index = 0
-    for i, s in enumerate(all_series):
-        if(s.id == result.id):
-            index = i
+    index = nav.position(result.id)
     prev = index - 1
     next = index + 1
 
@@ -375,7 +477,7 @@ def _view_series(request, eadid, *series_ids, **kwargs):
         'prev': prev,
         'next': next,
         'url_params': url_params,
-        'canonical_url': _series_url(eadid, *[shortform_id(id) for id in series_ids]),
+        'canonical_url': series_url(eadid, *[shortform_id(id) for id in series_ids]),
         'docsearch_form': KeywordSearchForm(),
         'last_search': request.session.get('last_search', None),
         'feedback_opts': _get_feedback_options(request, eadid),
@@ -389,13 +491,29 @@ def _view_series(request, eadid, *series_ids, **kwargs):
         render_opts['index'] = result
     else:
         render_opts['series'] = result
-        render_opts['subseries'] = _subseries_links(result, preview=preview_mode, url_params=url_params)
+        path = nav.path(result.id)
+        if url_params or path is None:
+            # subseries links include match counts for the current keywords
+            render_opts['subseries'] = _subseries_links(result, preview=preview_mode, url_params=url_params)
+        else:
+            current = path[-1]
+            render_opts['subseries'] = []
+            if current.has_subseries:
+                render_opts['subseries'] = _navigation_links(
+                    current.children, url_ids=[eadid] + [item.short_id for item in path],
+                    preview=preview_mode)
 
         # provide series list without keyword params to use in RDFa uris
         if url_params and not preview_mode:
             render_opts['subseries_noparam'] = _subseries_links(result)
 
-    response = render(request, 'fa/series_or_index.html', render_opts)
+    if url_params:
+        response = render(request, 'fa/series_or_index.html', render_opts)
+    else:
+        # formatted EAD content is memoized by document version and the
+        # requested series or index, except when search terms are highlighted
+        with memoize_fragments(result, 'series', checksum, *series_ids):
+            response = render(request, 'fa/series_or_index.html', render_opts)
 
     #Cache-Control to private when there is a last_search
     if "last_search" in request.session:
@@ -486,9 +604,145 @@ def _get_feedback_options(request, id):
     return urlencode({'eadid': id, 'url': request.build_absolute_uri()})
 
 
-@condition(last_modified_func=collection_lastmodified)
+def _search_queryset(keywords, subject, repository, dao, internal_dao=False):
+    """Generate the eXist queryset for a finding aid search, in result order
+    (relevance when searching by keyword, otherwise list title).
+
+    :param internal_dao: when filtering on digital archival objects, include
+        documents with internal-only daos
+    """
+    # initialize findingaid queryset - filters will be added based on search terms;
+    # order by list title unless searching by keyword
+    findingaids = FindingAid.objects.order_by('list_title')
+    if subject:
+        # if a subject was specified, filter on subject
+        findingaids = findingaids.filter(subject__fulltext_terms=subject).order_by('list_title')
+        # order by list title when searching by subject only
+        # (if keywords are specified, fulltext score ordering will override this)
+    if repository:
+        # if repository is set, filter finding aids by requested repository
+        # expecting repository value to come in as exact phrase
+        findingaids = findingaids.filter(repository__fulltext_terms=repository).order_by('list_title')
+    if keywords:
+        # if keywords were specified, do a fulltext search
+        findingaids = findingaids.filter(
+            # first do a full-text search to restrict to relevant documents
+            fulltext_terms=keywords
+        ).or_filter(
+            # do an OR search on boosted fields, so that relevance score
+            # will be calculated based on boosted field values
+            fulltext_terms=keywords,
+            boostfields__fulltext_terms=keywords,
+            highlight=False,    # disable highlighting in search results list
+        ).order_by('-fulltext_score')
+
+    # optional filter: restrict to items with digital archival objects
+    if dao:
+        findingaids = findingaids.filter(daos__exists=True)
+
+        # if user does not have permission to view internal daos,
+        # restrict to public daos only
+        if not internal_dao:
+            findingaids = findingaids.filter(public_dao_count__gte=1)
+
+        # NOTE: using >= filter to force a where clause because this works
+        # when what seems to be the same filter on the xpath does not
+        # (possibly an indexing issue?)
+    return findingaids
+
+
+def _search_results(keywords, subject, repository, dao, internal_dao=False):
+    """Cached, ordered list of :class:`~findingaids.fa.models.TitleIndexEntry`
+    for all finding aids matching a search, so that paginating through
+    results does not re-run the full query.  Search terms are
+    whitespace-normalized for the cache key, and results are cached until
+    the collection changes (see :mod:`findingaids.fa.cachekeys`).  Takes
+    the same parameters as :meth:`_search_queryset`.
+
+    If a local full-text index is configured (see
+    :mod:`findingaids.fa.fulltext`), it is searched instead of eXist, and
+    results are :class:`~findingaids.fa.fulltext.SearchResult` with
+    relevance scores.
+    """
+    keywords = normalize_whitespace(keywords or '').strip()
+    subject = normalize_whitespace(subject or '').strip()
+    repository = repository or ''
+    dao = bool(dao)
+    # internal dao permission only changes results when filtering on daos
+    internal_dao = dao and bool(internal_dao)
+    index = search_index()
+    cache_key = cachekeys.collection_key('search-results', keywords, subject,
+                                         repository, dao, internal_dao,
+                                         'local' if index is not None else 'exist')
+    results = cache.get(cache_key)
+    if results is None and index is not None:
+        results = index.search(keywords=keywords, subject=subject,
+                               repository=repository, dao=dao,
+                               internal_dao=internal_dao)
+        cache.set(cache_key, results, cachekeys.timeout())
+    elif results is None:
+        index_fields = ['eadid', 'list_title']
+        if keywords:
+            index_fields.append('fulltext_score')
+        findingaids = _search_queryset(keywords, subject, repository, dao,
+                                       internal_dao).only(*index_fields)
+        results = [TitleIndexEntry(unicode(fa.list_title), fa.eadid.value)
+                   for fa in findingaids]
+        cache.set(cache_key, results, cachekeys.timeout())
+    return results
+
+
+def _search_facets(counts, search_params):
+    """Facet counts for display with search results, with a search url to
+    add or remove each facet filter.
+
+    :param counts: facet counts, from
+        :meth:`~findingaids.fa.facets.FacetIndex.counts`
+    :param search_params: current search parameters, utf-8 encoded
+    """
+    def search_url(**changes):
+        params = dict((key, val) for key, val in search_params.iteritems()
+                      if key != 'page')
+        for key, val in changes.iteritems():
+            if val:
+                params[key] = val
+            else:
+                params.pop(key, None)
+        return '%s?%s' % (reverse('fa:search'), urlencode(params))
+
+    current_repo = search_params.get('repository', '').decode('utf-8').strip('"')
+    repositories = []
+    for name, count in counts['repository']:
+        selected = (name == current_repo)
+        repositories.append({
+            'label': name, 'count': count, 'selected': selected,
+            'url': search_url(repository=None if selected else
+                              ('"%s"' % name).encode('utf-8'))
+        })
+
+    dao_selected = bool(search_params.get('dao'))
+    dao = {'count': counts['dao'], 'selected': dao_selected,
+           'url': search_url(dao=not dao_selected)}
+
+    # subject facets narrow any current subject search
+    current_subject = search_params.get('subject')
+    subjects = []
+    for term, count in counts['subject']:
+        phrase = ('"%s"' % term.replace('"', '')).encode('utf-8')
+        if current_subject:
+            phrase = '(%s) AND %s' % (current_subject, phrase)
+        subjects.append({'label': term, 'count': count, 'url': search_url(subject=phrase)})
+
+    return {'repository': repositories, 'dao': dao, 'subject': subjects}
+
+
+@condition(etag_func=collection_etag, last_modified_func=collection_lastmodified)
 def search(request):
-    "Simple keyword search - runs exist full-text terms query on all terms included."
+    """Simple keyword search - runs exist full-text terms query on all terms included.
+
+    The ordered list of matching documents is cached (see
+    :meth:`_search_results`); only the documents for the current page are
+    retrieved from eXist."""
 
     form = AdvancedSearchForm(request.GET)
     query_error = False
@@ -499,61 +753,55 @@ def search(request):
         keywords = form.cleaned_data['keywords']
         repository = form.cleaned_data['repository']
         dao = form.cleaned_data['dao']
+        internal_dao = request.user.has_perm('fa_admin.can_view_internal_dao')
         page = request.GET.get('page', 1)
-        print keywords, "#######"
-        # initialize findingaid queryset - filters will be added based on search terms
-        findingaids = FindingAid.objects
 
         # local copy of return fields (fulltext-score may be added-- don't modify master copy!)
         return_fields = fa_listfields[:]
+        if keywords:
+            return_fields.append('fulltext_score')
 
         try:
-            if subject:
-                # if a subject was specified, filter on subject
-                findingaids = findingaids.filter(subject__fulltext_terms=subject).order_by('list_title')
-                # order by list title when searching by subject only
-                # (if keywords are specified, fulltext score ordering will override this)
-            if repository:
-                # if repository is set, filter finding aids by requested repository
-                # expecting repository value to come in as exact phrase
-                findingaids = findingaids.filter(repository__fulltext_terms=repository).order_by('list_title')
-            if keywords:
-                # if keywords were specified, do a fulltext search
-                return_fields.append('fulltext_score')
-                findingaids = findingaids.filter(
-                    # first do a full-text search to restrict to relevant documents
-                    fulltext_terms=keywords
-                ).or_filter(
-                    # do an OR search on boosted fields, so that relevance score
-                    # will be calculated based on boosted field values
-                    fulltext_terms=keywords,
-                    boostfields__fulltext_terms=keywords,
-                    highlight=False,    # disable highlighting in search results list
-                ).order_by('-fulltext_score')
-
-            # optional filter: restrict to items with digital archival objects
-            if dao:
-                findingaids = findingaids.filter(daos__exists=True)
-
-                # if user does not have permission to view internal daos,
-                # restrict to public daos only
-                if not request.user.has_perm('fa_admin.can_view_internal_dao'):
-                    findingaids = findingaids.filter(public_dao_count__gte=1)
-
-                # NOTE: using >= filter to force a where clause because this works
-                # when what seems to be the same filter on the xpath does not
-                # (possibly an indexing issue?)
-
-            findingaids = findingaids.only(*return_fields)
-            result_subset, paginator = paginate_queryset(request, findingaids,
+            facets = facet_index()
+            if facets is not None:
+                # search without repository and digital content filters,
+                # then filter and count facets in memory
+                results = _search_results(keywords, subject, '', False)
+                facet_counts = facets.counts(results, repository, dao, internal_dao)
+                results = facets.filter(results, repository, dao, internal_dao)
+                query_repository, query_dao = '', False
+            else:
+                results = _search_results(keywords, subject, repository, dao, internal_dao)
+                facet_counts = None
+                query_repository, query_dao = repository, dao
+            result_subset, paginator = paginate_queryset(request, results,
                                                          per_page=10, orphans=5)
             # when searching by subject only, use alpha pagination
             if subject and not keywords:
-                page_labels = alpha_pagelabels(paginator, findingaids,
+                page_labels = alpha_pagelabels(paginator, results,
                                                label_attribute='list_title')
             else:
                 page_labels = {}
             show_pages = pages_to_show(paginator, result_subset.number, page_labels)
+
+            # retrieve display fields for the current page only; the search
+            # filters are repeated so relevance scores are calculated
+            page_ids = [entry.eadid for entry in result_subset.object_list]
+            if page_ids and search_index() is not None:
+                # relevance scores come from the local index
+                fa = FindingAid.objects.filter(eadid__in=page_ids).only(*fa_listfields)
+                findingaids = dict((ead.eadid.value, ead) for ead in fa)
+                for entry in result_subset.object_list:
+                    if entry.eadid in findingaids:
+                        findingaids[entry.eadid].fulltext_score = entry.score
+            elif page_ids:
+                fa = _search_queryset(keywords, subject, query_repository, query_dao,
+                                      internal_dao).filter(eadid__in=page_ids).only(*return_fields)
+                findingaids = dict((ead.eadid.value, ead) for ead in fa)
+            if page_ids:
+                # restore result order; skip anything removed since results were cached
+                result_subset.object_list = [findingaids[eadid] for eadid in page_ids
+                                             if eadid in findingaids]
             # query_times = findingaids.queryTime()
 
             # select non-empty form values for use in template
@@ -593,6 +841,8 @@ def search(request):
                 # 'querytime': [query_times],
                 'show_pages': show_pages
             }
+            if facet_counts is not None:
+                response_context['facets'] = _search_facets(facet_counts, search_params)
             if page_labels:     # if there are page labels to show, add to context
                 # other page labels handled by show_pages, but first & last are special
                 response_context['first_page_label'] = page_labels[1]
@@ -600,6 +850,12 @@ def search(request):
 
             return render(request, 'fa/search_results.html', response_context)
 
+        except SearchQueryError:
+            # invalid query for the local full-text index
+            query_error = True
+            messages.error(request,
+                           'Your search query could not be parsed.  ' +
+                           'Please revise your search and try again.')
         except ExistDBException as e:
             # for an invalid full-text query (e.g., missing close quote), eXist
             # error reports 'Cannot parse' and 'Lexical error'
@@ -626,6 +882,37 @@ def search(request):
     return response
 
 
+#: maximum number of search suggestions returned by :meth:`suggest`
+MAX_SUGGESTIONS = 25
+
+
+@condition(etag_func=collection_etag, last_modified_func=collection_lastmodified)
+def suggest(request):
+    """Search suggestions for text entered in a search box, as JSON for
+    jQuery UI autocomplete: a list of objects with label, value, category
+    (title, name, or subject), and the url for the finding aid or a search.
+    Expects the text entered in ``term``, and optionally a ``limit`` on the
+    number of suggestions.  Lookups use an in-memory index (see
+    :mod:`findingaids.fa.suggest`) and do not query eXist.
+    """
+    try:
+        limit = min(int(request.GET.get('limit', 10)), MAX_SUGGESTIONS)
+    except ValueError:
+        limit = 10
+    suggestions = []
+    for item in suggest_index().lookup(request.GET.get('term', ''), limit):
+        if item.category == TITLE:
+            url = reverse('fa:findingaid', kwargs={'id': item.eadid})
+        else:
+            search_field = 'subject' if item.category == SUBJECT else 'keywords'
+            phrase = '"%s"' % item.label.replace('"', '')
+            url = '%s?%s' % (reverse('fa:search'),
+                             urlencode({search_field: phrase.encode('utf-8')}))
+        suggestions.append({'label': item.label, 'value': item.label,
+                            'category': item.category, 'url': url})
+    return JsonResponse(suggestions, safe=False)
+
+
 @condition(etag_func=ead_etag, last_modified_func=ead_lastmodified)
 def document_search(request, id):
     "Keyword search on file-level items in a single Finding Aid."
@@ -643,27 +930,34 @@ def document_search(request, id):
             # include parent series information and enough ancestor series ids
             # in order to generate link to containing series at any level (c01-c03)
 
-            # use path to restrict query to a single document (much faster)
-            path = '%s/%s' % (ead.collection_name, ead.document_name)
-            files = FileComponent.objects.filter(document_path=path)
+            internal_dao = request.user.has_perm('fa_admin.can_view_internal_dao')
+            index = search_index()
+            if index is not None:
+                # search the local full-text index instead of eXist
+                files = index.search_components(id, keywords=search_terms,
+                    dao=form.cleaned_data['dao'], internal_dao=internal_dao)
+            else:
+                # use path to restrict query to a single document (much faster)
+                path = '%s/%s' % (ead.collection_name, ead.document_name)
+                files = FileComponent.objects.filter(document_path=path)
 
-            # at least one of search terms or dao may be present,
-            # but both are optional
+                # at least one of search terms or dao may be present,
+                # but both are optional
 
-            # filter by keyword if present
-            if search_terms:
-                files = files.filter(fulltext_terms=search_terms)
+                # filter by keyword if present
+                if search_terms:
+                    files = files.filter(fulltext_terms=search_terms)
 
-            # restrict to publicly-accessible dao items, if set
-            if form.cleaned_data['dao']:
-                files = files.filter(did__dao_list__exists=True)
-                # if user can view internal daos, no additional filter is needed
-                # otherwise, restrict to publicly-accessible dao content
-                if not request.user.has_perm('fa_admin.can_view_internal_dao'):
-                    files = files.filter(public_dao_count__gte=1)
+                # restrict to publicly-accessible dao items, if set
+                if form.cleaned_data['dao']:
+                    files = files.filter(did__dao_list__exists=True)
+                    # if user can view internal daos, no additional filter is needed
+                    # otherwise, restrict to publicly-accessible dao content
+                    if not internal_dao:
+                        files = files.filter(public_dao_count__gte=1)
 
-            files = files.also('parent__id', 'parent__did',
-                               'series1__id', 'series1__did', 'series2__id', 'series2__did')
+                files = files.also('parent__id', 'parent__did',
+                                   'series1__id', 'series1__did', 'series2__id', 'series2__did')
 
             # if there is a keyword search term, pass on for highlighting
             url_params = ''
@@ -678,6 +972,12 @@ def document_search(request, id):
                 'url_params': url_params,
                 'docsearch_form': KeywordSearchForm(),
             })
+        except SearchQueryError:
+            # invalid query for the local full-text index
+            query_error = True
+            messages.error(request,
+                           'Your search query could not be parsed. ' +
+                           'Please revise your search and try again.')
         except ExistDBTimeout:
             # error for exist db timeout
             messages.error(request, "Your search has resulted in too many hits, \
@@ -710,34 +1010,6 @@ def document_search(request, id):
     return response
 
 
-def _series_url(eadid, series_id, *ids, **extra_opts):
-    """
-    Generate a series or subseries url when given an eadid and list of series ids.
-    Requires at least ead document id and top-level series id.  Number of additional
-    series ids provided determines type of series url generated.
-
-    Default url callback for :meth:`_subseries_links`.
-    """
-    # common args for generating all urls
-    args = {'id': eadid, 'series_id': series_id}
-
-    if len(ids) == 0:       # no additional args
-        view_name = 'series-or-index'
-    if len(ids) >= 1:       # add subseries id arg if one specified (used for sub and sub-subseries)
-        args['series2_id'] = ids[0]
-        view_name = 'series2'
-    if len(ids) == 2:       # add sub-subseries id arg if specified
-        args['series3_id'] = ids[1]
-        view_name = 'series3'
-
-    if 'preview' in extra_opts and extra_opts['preview'] is True:
-        view_namespace = 'fa-admin:preview'
-    else:
-        view_namespace = 'fa'
-
-    return reverse('%s:%s' % (view_namespace, view_name), kwargs=args)
-
-
 def _series_anchor(*ids, **extra_opts):
     """Generate a same-page id-based anchor link for a series.
 
@@ -748,7 +1020,7 @@ def _series_anchor(*ids, **extra_opts):
     return "#%s" % ids[-1]
 
 
-def _subseries_links(series, url_ids=None, url_callback=_series_url, preview=False,
+def _subseries_links(series, url_ids=None, url_callback=series_url, preview=False,
                      url_params=''):
     """
     Recursive function to build a nested list of links to series and subseries
@@ -802,36 +1074,56 @@ def _subseries_links(series, url_ids=None, url_callback=_series_url, preview=Fal
         if series.node.tag in [C01, C02, C03]:
             url_ids.append(series.short_id)
 
-    links = []
+    components = []
     if (hasattr(series, 'hasSubseries') and series.hasSubseries()) or \
        (hasattr(series, 'hasSeries') and series.hasSeries()):
-        for component in series.c:
-            # get match count for each series / subseries and append it to the link if > 0
-            if component.match_count > 0:
-                plural = "es" if component.match_count > 1 else ""
-                match_count = "<span class='exist-match'>%s match%s</span>" % (component.match_count, plural)
-            else:
-                match_count = ""
-
-            current_url_ids = url_ids + [component.short_id]
-            #set c01 rel attrib to 'section' c02 and c03 to 'subsection'
-            if (component.node.tag == C01):
-                rel = 'section'
-            elif (component.node.tag in [C02, C03]):
-                rel = 'subsection'
-
-            # don't include preview/keyword arg urls in RDFa rel
-            if not url_params and not preview:
-                rel += ' dcterms:hasPart'
-
-            text = "<a href='%(url)s%(url_params)s' rel='%(rel)s'>%(linktext)s</a> %(match_count)s" % \
-                {'url': url_callback(preview=preview, *current_url_ids),
-                 'url_params': url_params,
-                 'rel': rel,
-                 'linktext':  component.display_label(), 'match_count': match_count}
-            links.append(text)
-            if component.hasSubseries():
-                links.append(_subseries_links(component, url_ids=current_url_ids,
-                                              url_callback=url_callback,
-                                              preview=preview, url_params=url_params))
+        components = [navigation_item(component) for component in series.c]
+    return _navigation_links(components, url_ids, url_callback=url_callback,
+                             preview=preview, url_params=url_params)
+
+
+def _navigation_links(items, url_ids, url_callback=series_url, preview=False,
+                      url_params=''):
+    """
+    Recursive function to build a nested list of links to series and
+    subseries from :class:`~findingaids.fa.navigation.NavigationItem`
+    objects.  Generates the same output as :meth:`_subseries_links`; see
+    there for details.
+
+    :param items: list of :class:`~findingaids.fa.navigation.NavigationItem`
+    :param url_ids: list of series ids for generating urls, starting with eadid
+    :param url_callback: method to use for generating the series url
+    :param preview: boolean; when True, links will be generated for preview urls.
+    :param url_params: optional string to add to the end of urls
+    """
+    links = []
+    for component in items:
+        # get match count for each series / subseries and append it to the link if > 0
+        if component.match_count > 0:
+            plural = "es" if component.match_count > 1 else ""
+            match_count = "<span class='exist-match'>%s match%s</span>" % (component.match_count, plural)
+        else:
+            match_count = ""
+
+        current_url_ids = url_ids + [component.short_id]
+        #set c01 rel attrib to 'section' c02 and c03 to 'subsection'
+        if component.level == 'c01':
+            rel = 'section'
+        elif component.level in ['c02', 'c03']:
+            rel = 'subsection'
+
+        # don't include preview/keyword arg urls in RDFa rel
+        if not url_params and not preview:
+            rel += ' dcterms:hasPart'
+
+        text = "<a href='%(url)s%(url_params)s' rel='%(rel)s'>%(linktext)s</a> %(match_count)s" % \
+            {'url': url_callback(preview=preview, *current_url_ids),
+             'url_params': url_params,
+             'rel': rel,
+             'linktext':  component.display_label(), 'match_count': match_count}
+        links.append(text)
+        if component.has_subseries:
+            links.append(_navigation_links(component.children, url_ids=current_url_ids,
+                                           url_callback=url_callback,
+                                           preview=preview, url_params=url_params))
     return links
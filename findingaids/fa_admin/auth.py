@@ -18,7 +18,7 @@ from django.core.exceptions import ObjectDoesNotExist
 
 from eulexistdb.exceptions import DoesNotExist
 
-from findingaids.fa.models import FindingAid, Archive
+from findingaids.fa.models import FindingAid, Archive, CatalogEntry
 from findingaids.utils import normalize_whitespace
 
 
@@ -76,6 +76,13 @@ def archive_access_by_ead(user, id, *args, **kwargs):
     '''
     archive = None
 
+    if CatalogEntry.is_complete():
+        entry = CatalogEntry.published().filter(eadid=id) \
+                            .select_related('archive').first()
+        if entry is not None and entry.archive is not None:
+            archive = entry.archive.slug
+        return archive_access(user, archive, *args, **kwargs)
+
     try:
         ead = FindingAid.objects.only('repository').get(eadid=id)
 
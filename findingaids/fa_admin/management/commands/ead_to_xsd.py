@@ -22,6 +22,8 @@ from os import path
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
+from findingaids.fa_admin.utils import validate_ead
+
 class Command(BaseCommand):
     """Convert DTD-based EAD to XSD schema-based EAD.
 
@@ -35,9 +37,9 @@ directory will be converted."""
 
 
     # canonical location of the EAD XSD schema
+    # (converted documents are validated against the cached local copy;
+    # see findingaids.fa_admin.utils.ead_schema)
     schema_url = 'http://www.loc.gov/ead/ead.xsd'
-    # parse and load the schema for validating converted documents
-    eadschema = etree.XMLSchema(etree.parse(schema_url))
     # load XSLT for conversion
     dtd2schema = etree.XSLT(etree.parse(path.join(path.dirname(path.abspath(__file__)),
                             'dtd2schema.xsl')))
@@ -117,14 +119,14 @@ directory will be converted."""
                     countrycode.getparent().set('countrycode', countrycode.upper())
 
                 # validate against XSD schema
-                valid = self.eadschema.validate(result)
-                if not valid:
+                validation_errors = validate_ead(result)
+                if validation_errors:
                     errored += 1
                     if verbosity >= v_normal:
                         print "Error: converted document for %s is not schema valid" % base_filename
                     if verbosity > v_normal:
                         print "Validation errors:"
-                        for err in self.eadschema.error_log:
+                        for err in validation_errors:
                             print '  ', err.message
                 # save if valid and not unchanged and not dry-run
                 else:
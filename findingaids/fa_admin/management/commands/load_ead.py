@@ -14,23 +14,33 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from collections import defaultdict
 from datetime import datetime
 import glob
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 import os
 import sys
+import threading
+import time
 from time import sleep
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import connections
 
+from lxml.etree import XMLSyntaxError
 from eulxml.xmlmap.core import load_xmlobject_from_file
 from eulexistdb.db import ExistDB, ExistDBException
 
-from findingaids.fa.models import FindingAid, Archive
-from findingaids.fa_admin.utils import check_ead
+from findingaids.fa import facets, fulltext
+from findingaids.fa.models import FindingAid, Archive, CollectionState, CatalogEntry
+from findingaids.fa.utils import invalidate_findingaid
+from findingaids.fa_admin.utils import check_ead, ead_schema
 from findingaids.fa_admin.svn import svn_client
-from findingaids.fa_admin.tasks import reload_cached_pdf
+from findingaids.fa_admin.tasks import reload_cached_pdf, queue_sitemap_update
 
 
 class Command(BaseCommand):
@@ -56,6 +66,12 @@ directory will be loaded."""
             action='store_true',
             dest='pdf_only',
             help='Only reload PDFs in the cache; do not load EAD files to eXist.')
+        parser.add_argument('--jobs', '-j',
+            type=int,
+            dest='jobs',
+            default=1,
+            help='Number of processes for parsing and checking files, and ' +
+                 'of simultaneous eXist uploads (default: 1)')
 
 
     def handle(self, *args, **options):
@@ -88,59 +104,110 @@ directory will be loaded."""
             if options['skip_pdf_reload']:
                 print "** Skipping PDFs cache reload"
 
-        db = ExistDB()
+        jobs = max(options['jobs'], 1)
 
         loaded = 0
+        loaded_eadids = []
         errored = 0
         pdf_tasks = {}
+        # cumulative time in seconds spent in each phase
+        timing = defaultdict(float)
 
         start_time = datetime.now()
 
         if not options['pdf_only']:
         # unless PDF reload only has been specified, load files
 
-            for file in files:
-                try:
-                    # full path location where file will be loaded in exist db collection
-                    dbpath = settings.EXISTDB_ROOT_COLLECTION + "/" + os.path.basename(file)
-                    errors = check_ead(file, dbpath)
-                    if errors:
-                        # report errors, don't load
-                        errored += 1
-                        print "Error: %s does not pass publication checks; not loading to eXist." % file
-                        if verbosity >= v_normal:
-                            print "  Errors found:"
-                            for err in errors:
-                                print "    %s" % err
-                    else:
-                        with open(file, 'r') as eadfile:
-                            success = db.load(eadfile, dbpath)
-
-                        if success:
-                            loaded += 1
-                            if verbosity >= v_normal:
-                                print "Loaded %s" % file
-                            # load the file as a FindingAid object to get the eadid for PDF reload
-                            ead = load_xmlobject_from_file(file, FindingAid)
-
-                            # trigger PDF regeneration in the cache and store task result
-                            # - unless user has requested PDF reload be skipped
-                            if not options['skip_pdf_reload']:
-                                pdf_tasks[ead.eadid.value] = reload_cached_pdf.delay(ead.eadid.value)
-                                # NOTE: unlike the web admin publish, this does not
-                                # generate TaskResult db records; task outcomes will be
-                                # checked & reported before the script finishes
-                        else:
-                            errored += 1
-                            print "Error: failed to load %s to eXist" % file
-                except ExistDBException, e:
-                    print "Error: failed to load %s to eXist" % file
-                    print e.message()
+            # full path location where each file will be loaded in exist db
+            # collection, and whether to calculate values for the search index
+            index_fulltext = fulltext.search_index() is not None
+            paths = [(file, settings.EXISTDB_ROOT_COLLECTION + "/" + os.path.basename(file),
+                      index_fulltext)
+                     for file in files]
+
+            # files are parsed and checked in worker processes; files that
+            # pass are uploaded to eXist by a pool of threads, each with its
+            # own eXist connection, while remaining files are checked
+            if jobs > 1:
+                # compile the schema once, before worker processes are forked
+                ead_schema()
+                # don't share database connections with forked worker processes
+                connections.close_all()
+                check_pool = multiprocessing.Pool(jobs)
+                checked = check_pool.imap_unordered(check_file, paths)
+            else:
+                check_pool = None
+                checked = itertools.imap(check_file, paths)
+            upload_pool = ThreadPool(jobs)
+
+            uploads = []
+            for result in checked:
+                timing['parse'] += result['parse']
+                timing['validate'] += result['validate']
+                if result['errors']:
+                    # report errors, don't load
+                    errored += 1
+                    print "Error: %s does not pass publication checks; not loading to eXist." \
+                        % result['file']
+                    if verbosity >= v_normal:
+                        print "  Errors found:"
+                        for err in result['errors']:
+                            print "    %s" % err
+                else:
+                    uploads.append((result, upload_pool.apply_async(upload_file,
+                        (result['file'], result['dbpath']))))
+
+            if check_pool is not None:
+                check_pool.close()
+                check_pool.join()
+
+            for result, upload in uploads:
+                success, error, upload_time = upload.get()
+                timing['upload'] += upload_time
+                file = result['file']
+                if success:
+                    loaded += 1
+                    if verbosity >= v_normal:
+                        print "Loaded %s" % file
+                    eadid = result['eadid']
+                    loaded_eadids.append(eadid)
+                    invalidate_findingaid(eadid)
+                    facets.save_facets(eadid, result['facets'])
+                    if result['fulltext'] is not None:
+                        fulltext.save_index_values(result['fulltext'])
+
+                    # trigger PDF regeneration in the cache and store task result
+                    # - unless user has requested PDF reload be skipped
+                    if not options['skip_pdf_reload']:
+                        queue_start = time.time()
+                        pdf_tasks[eadid] = reload_cached_pdf.delay(eadid)
+                        timing['pdf queue'] += time.time() - queue_start
+                        # NOTE: unlike the web admin publish, this does not
+                        # generate TaskResult db records; task outcomes will be
+                        # checked & reported before the script finishes
+                else:
                     errored += 1
+                    print "Error: failed to load %s to eXist" % file
+                    if error:
+                        print error
+
+            upload_pool.close()
+            upload_pool.join()
+
+            if loaded:
+                CatalogEntry.update(loaded_eadids)
+                # also invalidates cached values derived from the collection
+                CollectionState.update()
+                queue_sitemap_update(loaded_eadids)
 
             # output a summary of what was done
             print "%d document%s loaded" % (loaded, 's' if loaded != 1 else '')
             print "%d document%s with errors" % (errored, 's' if errored != 1 else '')
+            if verbosity >= v_normal:
+                print "Time spent (cumulative across %d job%s): parse %.2fs, validate %.2fs, " \
+                    "upload %.2fs, PDF queue %.2fs" % \
+                    (jobs, 's' if jobs != 1 else '', timing['parse'], timing['validate'],
+                     timing['upload'], timing['pdf queue'])
 
         # only PDF cache reloading requested
         if options['pdf_only']:
@@ -189,6 +256,71 @@ directory will be loaded."""
 
 
 
+def check_file(paths):
+    """Parse and run publication checks on a single EAD file, for use in a
+    pool of worker processes.  Expects a tuple of the full path to the file,
+    the full path where it will be loaded in eXist, and whether to calculate
+    full-text index values.  Returns a dictionary with the file, dbpath,
+    eadid, facet values, full-text index values (or None), list of errors
+    (as text), and time in seconds spent parsing and validating.  Any
+    error is reported as an error for the file, so that one bad file does
+    not stop the other files from being loaded."""
+    file, dbpath, index_fulltext = paths
+    result = {'file': file, 'dbpath': dbpath, 'eadid': None, 'facets': None,
+              'fulltext': None, 'errors': [], 'parse': 0, 'validate': 0}
+    start = time.time()
+    try:
+        ead = load_xmlobject_from_file(file, FindingAid)
+    except (XMLSyntaxError, IOError) as err:
+        # document is not well-formed xml; no further checks possible
+        result['errors'] = [unicode(err)]
+        return result
+    except Exception as err:
+        result['errors'] = ['Error loading %s: %s' % (os.path.basename(file), err)]
+        return result
+    finally:
+        result['parse'] = time.time() - start
+
+    start = time.time()
+    try:
+        result['eadid'] = ead.eadid.value
+        result['facets'] = facets.facet_values(ead)
+        result['errors'] = [unicode(err) for err in check_ead(file, dbpath, ead=ead)]
+        if index_fulltext and not result['errors']:
+            result['fulltext'] = fulltext.index_values(ead)
+    except ExistDBException as err:
+        result['errors'] = [err.message()]
+    except Exception as err:
+        result['errors'] = ['Error checking %s: %s' % (os.path.basename(file), err)]
+    finally:
+        result['validate'] = time.time() - start
+    return result
+
+
+_upload_local = threading.local()
+
+
+def upload_file(file, dbpath):
+    """Load a single file to eXist, using an eXist connection for the
+    current thread.  Returns a tuple of success, error message (if any),
+    and time in seconds spent uploading."""
+    start = time.time()
+    try:
+        db = getattr(_upload_local, 'db', None)
+        if db is None:
+            db = _upload_local.db = ExistDB()
+        with open(file, 'r') as eadfile:
+            success = db.load(eadfile, dbpath)
+        error = None
+    except ExistDBException, e:
+        success = False
+        error = e.message()
+    except Exception as err:
+        success = False
+        error = 'Error loading %s: %s' % (os.path.basename(file), err)
+    return success, error, time.time() - start
+
+
 def check_tasks(tasks):
     """Check the status of celery tasks for successful completion.  Expects
     a dictionary with values that are instances of :class:`celery.result.AsyncResult`.
@@ -23,9 +23,8 @@ from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
 from eulexistdb.db import ExistDB
-from eulxml.xmlmap.core import load_xmlobject_from_file
 
-from findingaids.fa.models import FindingAid, Archive
+from findingaids.fa.models import Archive
 from findingaids.fa_admin import utils
 from findingaids.fa_admin.svn import svn_client
 
@@ -77,12 +76,12 @@ the defined Archives will be prepared."""
 
         for file in files:
             try:
-                ead = load_xmlobject_from_file(file, FindingAid)
-                orig_xml = ead.serializeDocument(pretty=True)
-                ead = utils.prep_ead(ead, file)
+                # parse once; prep, compare, and check the same tree
+                eaddoc = utils.EadDocument(file)
+                eaddoc.prepare(pretty=True)
                 # sanity check before saving
                 dbpath = settings.EXISTDB_ROOT_COLLECTION + "/" + os.path.basename(file)
-                errors = utils.check_ead(file, dbpath, xml=ead.serializeDocument())
+                errors = eaddoc.check(dbpath)
                 if errors:
                     errored += 1
                     print "Prepared EAD for %s does not pass sanity checks, not saving." % file
@@ -95,13 +94,13 @@ the defined Archives will be prepared."""
                                     print "    %s" % suberr
                             else:
                                 print "  %s" % err
-                elif orig_xml == ead.serializeDocument(pretty=True):
+                elif not eaddoc.changed:
                     if verbosity >= self.v_normal:
                         print "No changes made to %s" % file
                     unchanged += 1
                 else:
                     with open(file, 'w') as f:
-                        ead.serializeDocument(f, pretty=True)
+                        f.write(eaddoc.prepared_xml)
                     if verbosity >= self.v_normal:
                         print "Updated %s" % file
                     updated += 1
@@ -0,0 +1,96 @@
+# file findingaids/fa_admin/management/commands/publish_ead.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from findingaids.fa.models import FindingAid
+from findingaids.fa_admin.publish import publish_documents
+
+
+class Command(BaseCommand):
+    """Publish documents from the configured eXist preview collection, as
+from the admin site publish form.  Publication checks are run in parallel,
+and documents that pass are moved to the public collection.  For each
+published document, a celery task is queued to reload the PDF, with a task
+result that will be displayed on the admin site.
+
+Documents should be specified by eadid; use --all to publish every
+document currently in the preview collection."""
+    help = __doc__
+
+    args = '[<eadid eadid ... >]'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', '-a',
+            action='store_true',
+            dest='all',
+            help='Publish all documents in the preview collection')
+        parser.add_argument('--jobs', '-j',
+            type=int,
+            dest='jobs',
+            default=getattr(settings, 'PUBLISH_JOBS', None),
+            help='Number of processes for publication checks (default: number of cpus)')
+        parser.add_argument('--skip-pdf-reload', '-s',
+            action='store_true',
+            dest='skip_pdf_reload',
+            help='Skip reloading PDFs in the cache.')
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])    # 1 = normal, 0 = minimal, 2 = all
+        v_normal = 1
+        v_all = 2
+
+        eadids = list(args)
+        if options['all']:
+            if eadids:
+                raise CommandError("Specify eadids or --all, not both")
+            previews = FindingAid.objects.only('eadid') \
+                                 .using(settings.EXISTDB_PREVIEW_COLLECTION)
+            eadids = [fa.eadid.value for fa in previews]
+        if not eadids:
+            raise CommandError("No documents specified for publication")
+
+        if verbosity == v_all:
+            print 'Publishing %d document%s to configured eXist collection: %s' % \
+                (len(eadids), 's' if len(eadids) != 1 else '', settings.EXISTDB_ROOT_COLLECTION)
+
+        start_time = datetime.now()
+        results = publish_documents(eadids, jobs=options['jobs'],
+                                    reload_pdfs=not options['skip_pdf_reload'])
+
+        published = 0
+        errored = 0
+        for result in results:
+            if result.published:
+                published += 1
+                if verbosity >= v_normal:
+                    print "%s %s" % ('Updated' if result.replaced else 'Added', result.eadid)
+            else:
+                errored += 1
+                print "Error: %s was not published" % result.eadid
+                if verbosity >= v_normal:
+                    print "  Errors found:"
+                    for err in result.errors:
+                        print "    %s" % err
+
+        # output a summary of what was done
+        print "%d document%s published" % (published, 's' if published != 1 else '')
+        print "%d document%s with errors" % (errored, 's' if errored != 1 else '')
+        if verbosity >= v_normal:
+            print "Ran for %s" % str(datetime.now() - start_time)
@@ -0,0 +1,303 @@
+# file findingaids/fa_admin/publish.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+Publish multiple previewed EAD documents at once.
+
+Publication checks for all documents are run in a pool of worker
+processes, documents that pass are moved from the preview collection to
+the public collection with a small number of eXist queries, and a PDF
+reload task is queued for each published document.
+'''
+
+import logging
+import multiprocessing
+import os
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connections
+
+from eulcommon.djangoextras.taskresult.models import TaskResult
+from eulexistdb.db import ExistDB, ExistDBException
+from eulexistdb.query import escape_string
+from eulxml.xmlmap import load_xmlobject_from_file
+
+from findingaids.fa import facets, fulltext
+from findingaids.fa.models import FindingAid, Archive, CollectionState, CatalogEntry
+from findingaids.fa.navigation import cache_navigation
+from findingaids.fa.utils import invalidate_findingaid
+from findingaids.fa_admin.utils import check_ead, ead_schema
+from findingaids.utils import normalize_whitespace
+
+logger = logging.getLogger(__name__)
+
+#: maximum number of documents to move in a single eXist query
+MOVE_BATCH_SIZE = 50
+
+
+class PublishResult(object):
+    '''Publication outcome for a single document.
+
+    :param eadid: eadid
+    :param filename: document name in eXist and the archive source directory
+    :param archive: :class:`~findingaids.fa.models.Archive` for the document
+    '''
+
+    def __init__(self, eadid, filename=None, archive=None):
+        self.eadid = eadid
+        self.filename = filename
+        self.archive = archive
+        #: list of errors that prevented publication
+        self.errors = []
+        #: True if the document replaced a previously published version
+        self.replaced = False
+        self.published = False
+        #: :class:`~eulcommon.djangoextras.taskresult.models.TaskResult`
+        #: for the PDF reload, if one was queued
+        self.pdf_task = None
+
+    def __unicode__(self):
+        if self.published:
+            return u'%s: %s' % (self.eadid, 'updated' if self.replaced else 'added')
+        return u'%s: %s' % (self.eadid, '; '.join(self.errors))
+
+    @property
+    def fullpath(self):
+        'full path to the file in the archive source directory'
+        return os.path.join(self.archive.svn_local_path, self.filename)
+
+    @property
+    def dbpath(self):
+        'full path to the publication location in eXist'
+        return settings.EXISTDB_ROOT_COLLECTION + '/' + self.filename
+
+
+def preview_documents(eadids):
+    '''Find previewed documents to be published, with the
+    :class:`~findingaids.fa.models.Archive` each one belongs to, using a
+    single eXist query.  Documents that are not found in the preview
+    collection or cannot be associated with an archive have errors set.
+
+    :param eadids: list of eadids
+    :returns: list of :class:`PublishResult`, in the order of eadids
+    '''
+    previews = FindingAid.objects.filter(eadid__in=eadids) \
+                         .only('eadid', 'document_name', 'repository') \
+                         .using(settings.EXISTDB_PREVIEW_COLLECTION)
+    found = dict((fa.eadid.value, fa) for fa in previews)
+    archives = dict((a.name, a) for a in Archive.objects.all())
+
+    results = []
+    for eadid in eadids:
+        result = PublishResult(eadid)
+        results.append(result)
+        fa = found.get(eadid)
+        if fa is None:
+            result.errors.append('Not found in preview collection')
+            continue
+        result.filename = fa.document_name
+        if not fa.repository:
+            result.errors.append('Could not determine which archive the document belongs to')
+            continue
+        # NOTE: partial return doesn't get normalized
+        archive_name = normalize_whitespace(fa.repository[0])
+        result.archive = archives.get(archive_name)
+        if result.archive is None:
+            result.errors.append('Could not find archive %s' % archive_name)
+    return results
+
+
+def _check_document(paths):
+    # run publication checks for a single file; for use in a process pool,
+    # so errors are returned as text and exceptions are not propagated
+    fullpath, dbpath = paths
+    try:
+        return [unicode(err) for err in check_ead(fullpath, dbpath)]
+    except Exception as err:
+        return ['Error checking %s: %s' % (os.path.basename(fullpath), err)]
+
+
+def check_documents(paths, jobs=None):
+    '''Run :meth:`~findingaids.fa_admin.utils.check_ead` on multiple files,
+    using a pool of worker processes when more than one job is requested.
+
+    :param paths: list of tuples of full path to the file on disk and
+        full path to the publication location in eXist
+    :param jobs: number of worker processes; defaults to the number of cpus
+    :returns: list of lists of errors, in the same order as paths
+    '''
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(paths))
+    # daemon processes (e.g., celery workers) are not allowed to have children
+    if jobs > 1 and multiprocessing.current_process().daemon:
+        logger.info('Checking %d documents serially in daemon process %s' %
+                    (len(paths), multiprocessing.current_process().name))
+        jobs = 1
+    if jobs <= 1:
+        return [_check_document(p) for p in paths]
+
+    # compile the schema once, before worker processes are forked
+    ead_schema()
+    # don't share database connections with forked worker processes
+    connections.close_all()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(_check_document, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def move_documents(filenames, db=None):
+    '''Move documents from the preview collection to the public collection.
+    Documents are moved in groups, with one eXist query per group; if a
+    group fails, its documents are moved one at a time so that failures can
+    be reported for individual documents.
+
+    :param filenames: list of document names
+    :param db: optional :class:`~eulexistdb.db.ExistDB`
+    :returns: dictionary of error messages keyed on document name, for any
+        documents that could not be moved
+    '''
+    if db is None:
+        db = ExistDB()
+    preview = settings.EXISTDB_PREVIEW_COLLECTION
+    public = settings.EXISTDB_ROOT_COLLECTION
+    errors = {}
+    for i in range(0, len(filenames), MOVE_BATCH_SIZE):
+        group = filenames[i:i + MOVE_BATCH_SIZE]
+        xquery = '(%s)' % ', '.join('xmldb:move("%s", "%s", "%s")' %
+                                    tuple(escape_string(arg) for arg in (preview, public, name))
+                                    for name in group)
+        try:
+            db.query(xquery)
+            continue
+        except ExistDBException as err:
+            logger.warning('Failed to move %d documents as a group: %s' %
+                           (len(group), err.message()))
+
+        for name in group:
+            # documents moved before the group failed are already public
+            if not db.hasDocument(preview + '/' + name) and \
+                    db.hasDocument(public + '/' + name):
+                continue
+            try:
+                db.moveDocument(preview, public, name)
+            except ExistDBException as err:
+                errors[name] = 'Failed to move document from preview collection ' + \
+                    'to main collection: %s' % err.message()
+    return errors
+
+
+def publish_documents(eadids, jobs=None, reload_pdfs=True):
+    '''Publish previewed documents: run publication checks for all
+    documents, move those that pass from the preview collection to the
+    public collection, update everything derived from them (see
+    :meth:`update_published`), and queue a PDF reload task (with a
+    :class:`~eulcommon.djangoextras.taskresult.models.TaskResult`) for
+    each published document.
+
+    :param eadids: list of eadids for documents in the preview collection
+    :param jobs: number of worker processes for publication checks
+    :param reload_pdfs: queue PDF reload tasks; defaults to True
+    :returns: list of :class:`PublishResult`
+    '''
+    # avoid circular import
+    from findingaids.fa_admin.tasks import reload_cached_pdf
+
+    results = preview_documents(eadids)
+    to_check = [r for r in results if not r.errors]
+    check_errors = check_documents([(r.fullpath, r.dbpath) for r in to_check], jobs)
+    for result, errors in zip(to_check, check_errors):
+        result.errors.extend(errors)
+
+    to_publish = [r for r in results if not r.errors]
+    if not to_publish:
+        return results
+
+    # determine which documents will replace published versions
+    published = FindingAid.objects.filter(eadid__in=[r.eadid for r in to_publish]) \
+                                  .only('eadid')
+    published_ids = set(fa.eadid.value for fa in published)
+
+    move_errors = move_documents([r.filename for r in to_publish])
+    published_eads = []
+    for result in to_publish:
+        if result.filename in move_errors:
+            result.errors.append(move_errors[result.filename])
+            continue
+        result.published = True
+        result.replaced = result.eadid in published_ids
+        # published content is identical to the checked source file
+        try:
+            published_eads.append(load_xmlobject_from_file(result.fullpath, FindingAid))
+        except Exception:
+            logger.exception('Error loading %s after publication' % result.fullpath)
+        if reload_pdfs:
+            task = reload_cached_pdf.delay(result.eadid)
+            result.pdf_task = TaskResult(label='PDF reload', object_id=result.eadid,
+                url=reverse('fa:findingaid', kwargs={'id': result.eadid}),
+                task_id=task.task_id)
+            result.pdf_task.save()
+
+    published_eadids = [r.eadid for r in results if r.published]
+    if published_eadids:
+        update_published(published_eadids, published_eads)
+    return results
+
+
+def update_published(eadids, eads, request=None):
+    '''Update everything derived from newly published documents, once they
+    have been moved to the public collection: clear cached information
+    about them in both collections, store facet values, update the catalog
+    and collection state, update the local full-text index (if
+    configured), cache navigation, and queue a sitemap update (if
+    enabled).  The documents are already public, so every step is
+    attempted even if an earlier one fails; failures are logged.
+
+    :param eadids: list of published eadids
+    :param eads: list of :class:`~findingaids.fa.models.FindingAid` for
+        the published documents, as published
+    :param request: current request, if any (used to cache navigation)
+    '''
+    # avoid circular import
+    from findingaids.fa_admin.tasks import queue_sitemap_update
+
+    def attempt(description, func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception('Error %s after publication' % description)
+
+    for eadid in eadids:
+        # cached values for the document in both collections are no longer valid
+        attempt('invalidating cached values for %s' % eadid, invalidate_findingaid, eadid)
+        attempt('invalidating cached preview values for %s' % eadid,
+                invalidate_findingaid, eadid, preview=True)
+    # facet values must be stored before the collection state is updated
+    for ead in eads:
+        attempt('storing facet values for %s' % ead.eadid, facets.update_facets, ead)
+    attempt('updating the catalog', CatalogEntry.publish, eadids)
+    # also invalidates cached values derived from each collection
+    attempt('updating the public collection state', CollectionState.update)
+    attempt('updating the preview collection state', CollectionState.update,
+            settings.EXISTDB_PREVIEW_COLLECTION)
+    for ead in eads:
+        attempt('indexing %s' % ead.eadid, fulltext.index_findingaid, ead)
+        attempt('caching navigation for %s' % ead.eadid, cache_navigation, request, ead)
+    attempt('queueing a sitemap update', queue_sitemap_update, eadids)
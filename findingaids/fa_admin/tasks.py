@@ -28,6 +28,7 @@ from django.dispatch import receiver
 from eulcommon.djangoextras.taskresult.models import TaskResult
 
 from findingaids import __version__ as SW_VERSION
+from findingaids.fa import cachekeys, pdfstore, sitemapstore
 from findingaids.fa.models import Archive
 from findingaids.fa_admin.svn import svn_client
 
@@ -36,11 +37,20 @@ logger = logging.getLogger(__name__)
 
 @task
 def reload_cached_pdf(eadid):
-    """Request the PDF of the finding aid (specified by eadid) from the configured
-    proxy server, to trigger the proxy reloading and caching the latest version
-    of that PDF (e.g., after updating or adding a new document in eXist)."""
+    """Generate and store the PDF for the latest version of the finding aid
+    (specified by eadid), e.g., after updating or adding a new document in eXist.
+
+    If PDF storage is configured (see :mod:`findingaids.fa.pdfstore`), the PDF
+    is generated and stored directly.  Otherwise, the PDF is requested from
+    the configured proxy server, to trigger the proxy reloading and caching
+    the latest version of that PDF."""
     logger = reload_cached_pdf.get_logger()
-    if hasattr(settings, 'PROXY_HOST') and hasattr(settings, 'SITE_BASE_URL'):
+    if pdfstore.pdf_storage() is not None:
+        name = pdfstore.store_pdf(eadid)
+        logger.info("Stored PDF for %s as %s" % (eadid, name))
+        return True
+
+    elif hasattr(settings, 'PROXY_HOST') and hasattr(settings, 'SITE_BASE_URL'):
         sleep(3)    # may need to sleep for a few seconds so cache will recognized as modified (?)
         url = "%s%s" % (settings.SITE_BASE_URL.rstrip('/'),
             reverse('fa:printable', kwargs={'id': eadid}))
@@ -75,6 +85,40 @@ def reload_cached_pdf(eadid):
         raise Exception("PROXY_HOST and/or SITE_BASE_URL settings not available.  Failed to reload cached PDF.")
 
 
+@task
+def batch_publish(eadids):
+    """Publish multiple previewed documents; see
+    :meth:`findingaids.fa_admin.publish.publish_documents`.  Returns a
+    summary of the outcome for each document, for display in the task
+    result."""
+    # avoid circular import
+    from findingaids.fa_admin.publish import publish_documents
+    results = publish_documents(eadids, jobs=getattr(settings, 'PUBLISH_JOBS', None))
+    published = [r for r in results if r.published]
+    summary = ['Published %d of %d document%s' % (len(published), len(results),
+                                                    's' if len(results) != 1 else '')]
+    summary.extend(unicode(r) for r in results)
+    return '\n'.join(summary)
+
+
+@task
+def update_sitemaps(eadids):
+    """Update precomputed sitemap files after documents are published,
+    loaded, or deleted; see
+    :meth:`findingaids.fa.sitemapstore.update_sitemaps`."""
+    changed = sitemapstore.update_sitemaps(eadids)
+    if changed:
+        return 'Updated sitemaps: %s' % ', '.join(sorted(changed))
+    return 'No sitemap changes'
+
+
+def queue_sitemap_update(eadids):
+    '''Queue a task to update precomputed sitemap files for published or
+    deleted documents, if sitemap files are enabled.'''
+    if sitemapstore.sitemap_store() is not None:
+        update_sitemaps.delay(list(eadids))
+
+
 @task
 def archive_svn_checkout(archive, update=False):
     client = svn_client()
@@ -86,6 +130,8 @@ def archive_svn_checkout(archive, update=False):
                     archive.svn_local_path)
 
     client.checkout(archive.svn, archive.svn_local_path, 'HEAD')
+    # values prepared from the previous checkout are no longer valid
+    cachekeys.invalidate_archive(archive.slug)
     # NOTE: could return brief text here to indicate more about what was done
     # (update / initial checkout), for display in task result list
 
@@ -34,15 +34,17 @@ from django.contrib.auth.models import AnonymousUser
 
 from eulexistdb.db import ExistDB, ExistDBException
 from eulexistdb.testutil import TestCase
-from eulxml.xmlmap.core import load_xmlobject_from_file
+from eulxml.xmlmap.core import load_xmlobject_from_file, load_xmlobject_from_string
 from eulxml.xmlmap.eadmap import EAD_NAMESPACE
 
 from findingaids.fa.models import FindingAid, Archive
 from findingaids.fa.urls import TITLE_LETTERS
-from findingaids.fa_admin import tasks, utils, auth
+from findingaids.fa_admin import tasks, utils, auth, publish
 from findingaids.fa_admin.management.commands import prep_ead as prep_ead_cmd
 from findingaids.fa_admin.management.commands import unitid_identifier
 from findingaids.fa_admin.management.commands import itemid_to_dao
+from findingaids.fa_admin.management.commands import publish_ead as publish_ead_cmd
+from findingaids.fa_admin.management.commands import load_ead as load_ead_cmd
 from findingaids.fa_admin.mocks import MockDjangoPidmanClient  # MockHttplib unused?
 
 
@@ -263,6 +265,40 @@ class UtilsTest(TestCase):
         self.assert_(all('list title' not in err for err in errors),
                      'nested <title> in <unittitle> should not generate a list title whitespace error')
 
+    def test_ead_document(self):
+        eaddoc = utils.EadDocument(self.invalid_eadfile)
+        with patch('findingaids.fa_admin.utils.load_xmlobject_from_file',
+                   wraps=load_xmlobject_from_file) as mockload:
+            prepped_xml = eaddoc.prepare()
+            errors = eaddoc.check_eadxml()
+            # document is only parsed once
+            self.assertEqual(1, mockload.call_count)
+
+        self.assertEqual(prepped_xml, eaddoc.prepared_xml)
+        self.assert_(eaddoc.changed)
+        self.assertEqual(self.invalid_ead.serializeDocument(), eaddoc.original_xml)
+        self.assertNotEqual(eaddoc.original_xml, eaddoc.prepared_xml)
+        # checks on the prepared tree should match checks on a re-parsed copy
+        # (line numbers in detailed errors refer to the original file)
+        reparsed_errors = utils.check_eadxml(load_xmlobject_from_string(prepped_xml, FindingAid))
+        self.assertEqual([err for err in reparsed_errors if not isinstance(err, list)],
+                         [err for err in errors if not isinstance(err, list)])
+
+        # preparing an already-prepared document makes no changes
+        eaddoc = utils.EadDocument(self.invalid_eadfile, xml=prepped_xml)
+        eaddoc.prepare()
+        self.assertFalse(eaddoc.changed)
+
+    def test_validate_ead(self):
+        # schema is loaded once per process
+        self.assert_(utils.ead_schema() is utils.ead_schema())
+        self.assertEqual([], utils.validate_ead(self.valid_ead.node))
+        errors = utils.validate_ead(self.invalid_ead.node)
+        self.assertNotEqual(0, len(errors))
+        # errors from previous validations are not carried over
+        self.assertEqual(len(errors), len(utils.validate_ead(self.invalid_ead.node)))
+        self.assertEqual([], utils.validate_ead(self.valid_ead.node))
+
     def test_prep_ead(self):
         # valid fixtures is an ead with series/subseries, and index
         # - clear out fixture ark url to trigger generating a new one (simulated)
@@ -471,6 +507,220 @@ def _celerytest_tearDown(testcase):
 
 
 @patch.object(settings, 'CELERY_ALWAYS_EAGER', new=True)
+class PublishDocumentsTest(TestCase):
+    fixtures = ['archives']
+
+    def _preview(self, eadid, filename, repository):
+        # mock preview document as returned by the preview query
+        preview = Mock(document_name=filename, repository=repository)
+        preview.eadid.value = eadid
+        return preview
+
+    @patch('findingaids.fa_admin.publish.FindingAid')
+    def test_preview_documents(self, mockfa):
+        marbl = Archive.objects.get(slug='marbl')
+        mockfa.objects.filter.return_value.only.return_value.using.return_value = [
+            # partial return values are not normalized
+            self._preview('hartsfield558', 'hartsfield558.xml',
+                          [marbl.name.replace(' ', '\n    ')]),
+            self._preview('norepo1', 'norepo1.xml', []),
+            self._preview('other1', 'other1.xml', ['Unknown Library']),
+        ]
+        eadids = ['other1', 'missing1', 'norepo1', 'hartsfield558']
+        results = publish.preview_documents(eadids)
+
+        mockfa.objects.filter.assert_called_with(eadid__in=eadids)
+        mockfa.objects.filter.return_value.only.return_value.using \
+              .assert_called_with(settings.EXISTDB_PREVIEW_COLLECTION)
+        # results are in the requested order
+        self.assertEqual(eadids, [r.eadid for r in results])
+        self.assertEqual(['Could not find archive Unknown Library'], results[0].errors)
+        self.assertEqual(['Not found in preview collection'], results[1].errors)
+        self.assert_('Could not determine which archive' in results[2].errors[0])
+        self.assertEqual([], results[3].errors)
+        self.assertEqual(marbl, results[3].archive)
+        self.assertEqual('hartsfield558.xml', results[3].filename)
+
+    def _publish_mocks(self):
+        # patch everything publish_documents uses apart from the source files
+        patches = {}
+        for name in ['preview_documents', 'check_documents', 'move_documents',
+                     'FindingAid.objects', 'invalidate_findingaid', 'cache_navigation',
+                     'facets', 'fulltext', 'CatalogEntry', 'CollectionState']:
+            patcher = patch('findingaids.fa_admin.publish.%s' % name)
+            patches[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        for name in ['reload_cached_pdf', 'queue_sitemap_update']:
+            patcher = patch('findingaids.fa_admin.tasks.%s' % name)
+            patches[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        patches['fulltext'].search_index.return_value = None
+        patches['reload_cached_pdf'].delay.return_value.task_id = 'pdf-task-id'
+        patches['move_documents'].return_value = {}
+        return patches
+
+    def test_publish_documents(self):
+        mocks = self._publish_mocks()
+        marbl = Archive.objects.get(slug='marbl')
+        mocks['preview_documents'].return_value = [
+            publish.PublishResult('hartsfield558', 'hartsfield558.xml', marbl),
+            publish.PublishResult('bogus1', 'bogus1.xml', marbl),
+        ]
+        mocks['check_documents'].return_value = [[], ['bad eadid']]
+        # hartsfield558 is already published
+        published = Mock()
+        published.eadid.value = 'hartsfield558'
+        mocks['FindingAid.objects'].filter.return_value.only.return_value = [published]
+
+        fixture_dir = os.path.join(settings.BASE_DIR, 'fa_admin', 'fixtures')
+        with patch('findingaids.fa.models.Archive.svn_local_path', fixture_dir):
+            results = publish.publish_documents(['hartsfield558', 'bogus1'], jobs=2)
+
+        mocks['check_documents'].assert_called_with([
+            (os.path.join(fixture_dir, 'hartsfield558.xml'),
+             settings.EXISTDB_ROOT_COLLECTION + '/hartsfield558.xml'),
+            (os.path.join(fixture_dir, 'bogus1.xml'),
+             settings.EXISTDB_ROOT_COLLECTION + '/bogus1.xml')], 2)
+        # only documents that pass checks are moved
+        mocks['move_documents'].assert_called_with(['hartsfield558.xml'])
+
+        self.assert_(results[0].published)
+        self.assert_(results[0].replaced)
+        self.assertEqual('hartsfield558: updated', unicode(results[0]))
+        self.assertEqual('pdf-task-id', results[0].pdf_task.task_id)
+        self.assertFalse(results[1].published)
+        self.assertEqual(['bad eadid'], results[1].errors)
+
+        mocks['invalidate_findingaid'].assert_any_call('hartsfield558')
+        mocks['invalidate_findingaid'].assert_any_call('hartsfield558', preview=True)
+        # navigation is cached as for single-document publish, from the source file
+        self.assertEqual(1, mocks['cache_navigation'].call_count)
+        request, ead = mocks['cache_navigation'].call_args[0]
+        self.assertEqual(None, request)
+        self.assertEqual('hartsfield558', ead.eadid.value)
+        mocks['reload_cached_pdf'].delay.assert_called_once_with('hartsfield558')
+        mocks['CatalogEntry'].publish.assert_called_with(['hartsfield558'])
+        mocks['queue_sitemap_update'].assert_called_with(['hartsfield558'])
+        self.assertEqual(2, mocks['CollectionState'].update.call_count)
+        # facets and full-text index are updated from the source file
+        self.assertEqual(ead, mocks['facets'].update_facets.call_args[0][0])
+        mocks['fulltext'].index_findingaid.assert_called_once_with(ead)
+
+    def test_update_published(self):
+        mocks = self._publish_mocks()
+        ead = Mock()
+        # every step is attempted even when earlier steps fail
+        mocks['invalidate_findingaid'].side_effect = Exception('cache unavailable')
+        mocks['CatalogEntry'].publish.side_effect = Exception('database error')
+        mocks['CollectionState'].update.side_effect = Exception('database error')
+        with patch('findingaids.fa_admin.publish.logger') as mocklogger:
+            publish.update_published(['eadid1'], [ead], 'request')
+            self.assertEqual(5, mocklogger.exception.call_count)
+        mocks['facets'].update_facets.assert_called_with(ead)
+        mocks['fulltext'].index_findingaid.assert_called_with(ead)
+        mocks['cache_navigation'].assert_called_with('request', ead)
+        mocks['queue_sitemap_update'].assert_called_with(['eadid1'])
+
+    def test_publish_documents_move_error(self):
+        mocks = self._publish_mocks()
+        marbl = Archive.objects.get(slug='marbl')
+        mocks['preview_documents'].return_value = [
+            publish.PublishResult('hartsfield558', 'hartsfield558.xml', marbl)]
+        mocks['check_documents'].return_value = [[]]
+        mocks['FindingAid.objects'].filter.return_value.only.return_value = []
+        mocks['move_documents'].return_value = {'hartsfield558.xml': 'Failed to move'}
+
+        fixture_dir = os.path.join(settings.BASE_DIR, 'fa_admin', 'fixtures')
+        with patch('findingaids.fa.models.Archive.svn_local_path', fixture_dir):
+            results = publish.publish_documents(['hartsfield558'], reload_pdfs=False)
+
+        self.assertFalse(results[0].published)
+        self.assertEqual(['Failed to move'], results[0].errors)
+        self.assertEqual(0, mocks['cache_navigation'].call_count)
+        self.assertEqual(0, mocks['reload_cached_pdf'].delay.call_count)
+        self.assertEqual(0, mocks['CatalogEntry'].publish.call_count)
+        self.assertEqual(0, mocks['queue_sitemap_update'].call_count)
+
+    def test_publish_documents_no_checks(self):
+        # nothing is moved if no documents pass the checks
+        mocks = self._publish_mocks()
+        mocks['preview_documents'].return_value = [publish.PublishResult('missing1')]
+        mocks['preview_documents'].return_value[0].errors.append('Not found')
+        mocks['check_documents'].return_value = []
+        results = publish.publish_documents(['missing1'])
+        self.assertEqual(['Not found'], results[0].errors)
+        self.assertEqual(0, mocks['move_documents'].call_count)
+
+    @patch('findingaids.fa_admin.publish.publish_documents')
+    def test_batch_publish_task(self, mockpublish):
+        published = publish.PublishResult('hartsfield558')
+        published.published = True
+        failed = publish.PublishResult('bogus1')
+        failed.errors.append('Not found in preview collection')
+        mockpublish.return_value = [published, failed]
+        with override_settings(PUBLISH_JOBS=3):
+            summary = tasks.batch_publish(['hartsfield558', 'bogus1'])
+        mockpublish.assert_called_with(['hartsfield558', 'bogus1'], jobs=3)
+        self.assertEqual('Published 1 of 2 documents\n' +
+                         'hartsfield558: added\n' +
+                         'bogus1: Not found in preview collection', summary)
+
+    def test_check_documents(self):
+        paths = [('/tmp/doc%d.xml' % i, '/db/test/doc%d.xml' % i) for i in range(4)]
+
+        def fake_check(fullpath, dbpath):
+            if fullpath.endswith('1.xml'):
+                return ['bad eadid']
+            if fullpath.endswith('2.xml'):
+                raise Exception('unreadable')
+            return []
+
+        with patch('findingaids.fa_admin.publish.check_ead', new=fake_check):
+            expected = [[], ['bad eadid'], ['Error checking doc2.xml: unreadable'], []]
+            # serial and parallel checks should return errors in the same order
+            self.assertEqual(expected, publish.check_documents(paths, jobs=1))
+            self.assertEqual(expected, publish.check_documents(paths, jobs=2))
+
+            # daemon processes (e.g., celery workers) check serially
+            with patch('findingaids.fa_admin.publish.multiprocessing') as mockmp:
+                mockmp.current_process.return_value.daemon = True
+                with patch('findingaids.fa_admin.publish.logger') as mocklogger:
+                    self.assertEqual(expected, publish.check_documents(paths, jobs=2))
+                    self.assertEqual(1, mocklogger.info.call_count)
+                self.assertEqual(0, mockmp.Pool.call_count)
+
+    @override_settings(EXISTDB_PREVIEW_COLLECTION='/db/preview',
+                       EXISTDB_ROOT_COLLECTION='/db/public')
+    def test_move_documents(self):
+        mockdb = Mock()
+        # all documents moved in a single query
+        self.assertEqual({}, publish.move_documents(['a.xml', 'b.xml'], mockdb))
+        self.assertEqual(1, mockdb.query.call_count)
+        xquery = mockdb.query.call_args[0][0]
+        self.assert_('xmldb:move("/db/preview", "/db/public", "a.xml")' in xquery)
+        self.assert_('xmldb:move("/db/preview", "/db/public", "b.xml")' in xquery)
+
+        # quotes and ampersands in names are escaped in the xquery
+        mockdb.reset_mock()
+        publish.move_documents(['o\'brien"1".xml', 'a&b.xml'], mockdb)
+        xquery = mockdb.query.call_args[0][0]
+        self.assert_('xmldb:move("/db/preview", "/db/public", "o\'brien""1"".xml")' in xquery)
+        self.assert_('xmldb:move("/db/preview", "/db/public", "a&amp;b.xml")' in xquery)
+
+        # group failure falls back to moving documents individually
+        mockdb.reset_mock()
+        mockdb.query.side_effect = ExistDBException(Exception('move failed'))
+        # a.xml was moved before the group query failed
+        mockdb.hasDocument.side_effect = lambda path: path in ['/db/public/a.xml',
+                                                               '/db/preview/b.xml',
+                                                               '/db/preview/c.xml']
+        mockdb.moveDocument.side_effect = lambda src, dest, name: \
+            True if name == 'b.xml' else mockdb.query()
+        errors = publish.move_documents(['a.xml', 'b.xml', 'c.xml'], mockdb)
+        self.assertEqual(['c.xml'], errors.keys())
+        self.assertEqual(2, mockdb.moveDocument.call_count)
+
+
 class ReloadCachedPdfTestCase(TestCase):
 
     def setUp(self):
@@ -525,6 +775,17 @@ class ReloadCachedPdfTestCase(TestCase):
         self.assertFalse(result.successful(),
             "for http status 404, task result successful() is not True")
 
+    @patch('findingaids.fa_admin.tasks.urllib2')
+    @patch('findingaids.fa_admin.tasks.pdfstore')
+    def test_pdf_storage(self, mockpdfstore, mockurllib2):
+        # when pdf storage is configured, pdf is stored directly
+        mockpdfstore.store_pdf.return_value = 'eadid/abc.pdf'
+        result = tasks.reload_cached_pdf.delay('eadid')
+        self.assertEqual(True, result.get())
+        mockpdfstore.store_pdf.assert_called_with('eadid')
+        self.assertEqual(0, mockurllib2.urlopen.call_count,
+            'proxy should not be used when pdf storage is configured')
+
     def test_missing_settings(self):
         delattr(settings, 'PROXY_HOST')
         delattr(settings, 'SITE_BASE_URL')
@@ -639,6 +900,209 @@ class PrepEadTestCommand(prep_ead_cmd.Command, TestCommand):
     pass
 
 
+class LoadEadTestCommand(load_ead_cmd.Command, TestCommand):
+    pass
+
+
+class LoadEadCommandTest(TestCase):
+    fixture_dir = os.path.join(settings.BASE_DIR, 'fa_admin', 'fixtures')
+
+    def setUp(self):
+        self.command = LoadEadTestCommand()
+        self.valid = os.path.join(self.fixture_dir, 'hartsfield558.xml')
+        self.badlyformed = os.path.join(self.fixture_dir, 'badlyformed.xml')
+        # eXist connections are kept per thread; don't reuse one from another test
+        load_ead_cmd._upload_local.db = None
+
+    def tearDown(self):
+        load_ead_cmd._upload_local.db = None
+
+    @patch('findingaids.fa_admin.management.commands.load_ead.check_ead')
+    def test_check_file(self, mockcheck):
+        mockcheck.return_value = []
+        result = load_ead_cmd.check_file((self.valid, '/db/test/hartsfield558.xml', False))
+        self.assertEqual('hartsfield558', result['eadid'])
+        self.assertEqual([], result['errors'])
+        self.assert_('Manuscript' in result['facets']['repositories'])
+        self.assert_(result['parse'] > 0)
+        self.assert_(result['validate'] >= 0)
+        # checks are run on the already-parsed document
+        args, kwargs = mockcheck.call_args
+        self.assertEqual((self.valid, '/db/test/hartsfield558.xml'), args)
+        self.assertEqual('hartsfield558', kwargs['ead'].eadid.value)
+        self.assertEqual(None, result['fulltext'])
+
+        # full-text index values are calculated from the parsed document
+        result = load_ead_cmd.check_file((self.valid, '/db/test/hartsfield558.xml', True))
+        self.assertEqual('hartsfield558', result['fulltext']['eadid'])
+        self.assert_(result['fulltext']['components'])
+
+        mockcheck.return_value = ['Invalid eadid']
+        result = load_ead_cmd.check_file((self.valid, '/db/test/hartsfield558.xml', True))
+        self.assertEqual(['Invalid eadid'], result['errors'])
+        self.assertEqual(None, result['fulltext'])
+
+        # eXist and unexpected errors are reported as errors for the file
+        mockcheck.side_effect = ExistDBException(Exception('eXist is down'))
+        result = load_ead_cmd.check_file((self.valid, '/db/test/hartsfield558.xml', False))
+        self.assertEqual(1, len(result['errors']))
+        mockcheck.side_effect = ValueError('unexpected')
+        result = load_ead_cmd.check_file((self.valid, '/db/test/hartsfield558.xml', False))
+        self.assertEqual(['Error checking hartsfield558.xml: unexpected'], result['errors'])
+
+        # files that can't be parsed are not checked
+        mockcheck.reset_mock()
+        result = load_ead_cmd.check_file((self.badlyformed, '/db/test/badlyformed.xml', True))
+        self.assertEqual(None, result['eadid'])
+        self.assertEqual(1, len(result['errors']))
+        result = load_ead_cmd.check_file(('/tmp/does-not-exist.xml', '/db/test/none.xml', True))
+        self.assertEqual(1, len(result['errors']))
+        with patch('findingaids.fa_admin.management.commands.load_ead.load_xmlobject_from_file',
+                   side_effect=MemoryError('too big')):
+            result = load_ead_cmd.check_file((self.valid, '/db/test/hartsfield558.xml', False))
+        self.assertEqual(['Error loading hartsfield558.xml: too big'], result['errors'])
+        self.assertEqual(0, mockcheck.call_count)
+
+    @patch('findingaids.fa_admin.management.commands.load_ead.ExistDB')
+    def test_upload_file(self, mockexistdb):
+        mockexistdb.return_value.load.return_value = True
+        success, error, upload_time = load_ead_cmd.upload_file(self.valid, '/db/test/h.xml')
+        self.assert_(success)
+        self.assertEqual(None, error)
+        self.assert_(upload_time >= 0)
+        self.assertEqual('/db/test/h.xml', mockexistdb.return_value.load.call_args[0][1])
+
+        mockexistdb.return_value.load.side_effect = ExistDBException(Exception('denied'))
+        success, error, upload_time = load_ead_cmd.upload_file(self.valid, '/db/test/h.xml')
+        self.assertFalse(success)
+        self.assert_('denied' in error)
+
+        success, error, upload_time = load_ead_cmd.upload_file('/tmp/does-not-exist.xml',
+                                                               '/db/test/none.xml')
+        self.assertFalse(success)
+        self.assert_(error.startswith('Error loading does-not-exist.xml'))
+        # one eXist connection is reused by the thread
+        self.assertEqual(1, mockexistdb.call_count)
+
+    def _run_load(self, *args, **kwargs):
+        # run the command with everything after checking and uploading patched;
+        # takes an optional search index
+        cmd = 'findingaids.fa_admin.management.commands.load_ead'
+        with patch('%s.check_ead' % cmd, return_value=[]), \
+                patch('%s.ExistDB' % cmd) as mockexistdb, \
+                patch('%s.invalidate_findingaid' % cmd), \
+                patch('%s.facets' % cmd) as mockfacets, \
+                patch('%s.fulltext' % cmd) as mockfulltext, \
+                patch('%s.CatalogEntry' % cmd) as mockcatalog, \
+                patch('%s.CollectionState' % cmd), \
+                patch('%s.queue_sitemap_update' % cmd):
+            mockexistdb.return_value.load.return_value = True
+            mockfulltext.search_index.return_value = kwargs.get('index')
+            mockfulltext.index_values.return_value = {'eadid': 'hartsfield558'}
+            mockfacets.facet_values.return_value = {'repositories': 'marbl'}
+            self.command.run_command(*args)
+        return mockfacets, mockcatalog, mockfulltext
+
+    def test_load(self):
+        mockfacets, mockcatalog, mockfulltext = self._run_load('-s', self.valid, self.badlyformed)
+        output = self.command.output
+        self.assert_('Loaded %s' % self.valid in output)
+        self.assert_('Error: %s does not pass publication checks' % self.badlyformed in output)
+        self.assert_('1 document loaded' in output)
+        self.assert_('1 document with errors' in output)
+        # per-phase timing is reported
+        self.assert_(re.search(r'Time spent \(cumulative across 1 job\): parse [0-9.]+s, ' +
+                               r'validate [0-9.]+s, upload [0-9.]+s, PDF queue [0-9.]+s', output))
+        mockcatalog.update.assert_called_with(['hartsfield558'])
+        mockfacets.save_facets.assert_called_with('hartsfield558', {'repositories': 'marbl'})
+        self.assertEqual(0, mockfulltext.save_index_values.call_count)
+
+    @patch('findingaids.fa_admin.management.commands.load_ead.ead_schema')
+    def test_load_jobs(self, mockschema):
+        # files are checked in worker processes and uploaded by threads
+        copy_dir = tempfile.mkdtemp(prefix='findingaids-load_ead-test')
+        self.addCleanup(rmtree, copy_dir)
+        files = []
+        for i in range(3):
+            files.append(os.path.join(copy_dir, 'hartsfield558-%d.xml' % i))
+            copyfile(self.valid, files[-1])
+        files.append(self.badlyformed)
+        mockfacets, mockcatalog, mockfulltext = self._run_load('-s', '--jobs', '2', *files,
+                                                               index=Mock())
+        output = self.command.output
+        for filename in files[:3]:
+            self.assert_('Loaded %s' % filename in output)
+        self.assert_('3 documents loaded' in output)
+        self.assert_('1 document with errors' in output)
+        self.assert_('Time spent (cumulative across 2 jobs)' in output)
+        # schema is compiled before worker processes are started
+        mockschema.assert_called_with()
+        self.assertEqual(['hartsfield558'] * 3, mockcatalog.update.call_args[0][0])
+        # documents are indexed from values calculated by the workers,
+        # without parsing them again
+        self.assertEqual(3, mockfulltext.save_index_values.call_count)
+        mockfulltext.save_index_values.assert_called_with({'eadid': 'hartsfield558'})
+        self.assertEqual(0, mockfulltext.index_findingaid.call_count)
+
+    def test_incompatible_options(self):
+        self.assertRaises(CommandError, self.command.handle, pdf_only=True,
+                          skip_pdf_reload=True, jobs=1, verbosity=0)
+
+
+class PublishEadTestCommand(publish_ead_cmd.Command, TestCommand):
+    pass
+
+
+class PublishEadCommandTest(TestCase):
+
+    def setUp(self):
+        self.command = PublishEadTestCommand()
+
+    def _result(self, eadid, published=False, replaced=False, errors=None):
+        result = publish.PublishResult(eadid)
+        result.published = published
+        result.replaced = replaced
+        result.errors.extend(errors or [])
+        return result
+
+    @patch('findingaids.fa_admin.management.commands.publish_ead.publish_documents')
+    def test_publish(self, mockpublish):
+        mockpublish.return_value = [
+            self._result('hartsfield558', published=True, replaced=True),
+            self._result('abbey244', published=True),
+            self._result('bogus1', errors=['Not found in preview collection'])]
+        self.command.run_command('hartsfield558', 'abbey244', 'bogus1', '-j', '2', '-s')
+        mockpublish.assert_called_with(['hartsfield558', 'abbey244', 'bogus1'],
+                                       jobs=2, reload_pdfs=False)
+        output = self.command.output
+        self.assert_('Updated hartsfield558' in output)
+        self.assert_('Added abbey244' in output)
+        self.assert_('Error: bogus1 was not published' in output)
+        self.assert_('Not found in preview collection' in output)
+        self.assert_('2 documents published' in output)
+        self.assert_('1 document with errors' in output)
+
+    @patch('findingaids.fa_admin.management.commands.publish_ead.FindingAid')
+    @patch('findingaids.fa_admin.management.commands.publish_ead.publish_documents')
+    def test_publish_all(self, mockpublish, mockfa):
+        preview = Mock()
+        preview.eadid.value = 'hartsfield558'
+        mockfa.objects.only.return_value.using.return_value = [preview]
+        mockpublish.return_value = [self._result('hartsfield558', published=True)]
+        self.command.run_command('--all')
+        mockfa.objects.only.return_value.using.assert_called_with(
+            settings.EXISTDB_PREVIEW_COLLECTION)
+        self.assertEqual(['hartsfield558'], mockpublish.call_args[0][0])
+        self.assertEqual(True, mockpublish.call_args[1]['reload_pdfs'])
+
+    def test_errors(self):
+        # no documents specified, or both eadids and --all
+        self.assertRaises(CommandError, self.command.handle, all=False, jobs=None,
+                          skip_pdf_reload=False, verbosity=0)
+        self.assertRaises(CommandError, self.command.handle, 'hartsfield558', all=True,
+                          jobs=None, skip_pdf_reload=False, verbosity=0)
+
+
 @override_settings(PIDMAN_PASSWORD='this-better-not-be-a-real-password')
 class PrepEadCommandTest(TestCase):
     fixtures = ['archives']
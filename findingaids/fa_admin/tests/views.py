@@ -37,9 +37,11 @@ from eulcommon.djangoextras.taskresult.models import TaskResult
 from eulexistdb.testutil import TestCase
 from eulxml.xmlmap import load_xmlobject_from_file
 
+from findingaids.fa import cachekeys
 from findingaids.fa.models import Deleted, Archive, FindingAid
 from findingaids.fa_admin import tasks, views
 from findingaids.fa_admin.models import EadFile
+from findingaids.fa_admin.publish import PublishResult
 from findingaids.fa_admin.mocks import MockDjangoPidmanClient  # MockHttplib unused?
 
 ### unit tests for findingaids.fa_admin.views
@@ -548,8 +550,8 @@ class AdminViewsTest(BaseAdminViewsTest):
             with patch('findingaids.fa_admin.views.svn_client') as svn_client:
                 # simulate successful commit
                 svn_client.return_value.commit.return_value = (8, '2013-11-13T18:19:00.191382Z', 'keep')
-                # delete
-                cache.delete(filename)
+                # clear any previously prepared copy
+                cachekeys.invalidate_archive(arch.slug)
                 response = self.client.post(prep_xml, follow=True)
 
         msgs = [str(msg) for msg in response.context['messages']]
@@ -682,6 +684,47 @@ class AdminViewsTest(BaseAdminViewsTest):
             "response contains pagination")
 
 
+    @patch('findingaids.fa_admin.views.batch_publish_task')
+    @patch('findingaids.fa_admin.views.preview_documents')
+    def test_batch_publish(self, mockpreview, mocktask):
+        batch_url = reverse('fa-admin:batch-publish')
+        # user without publish permission
+        self.client.login(**self.credentials['no_perms'])
+        response = self.client.post(batch_url, {'preview_ids': ['hartsfield558']})
+        self.assertEqual(403, response.status_code)
+        self.assertEqual(0, mocktask.delay.call_count)
+
+        self.client.login(**self.credentials['admin'])
+        # post without preview ids should error - message + redirect
+        response = self.client.post(batch_url, follow=True)
+        (redirect_url, code) = response.redirect_chain[0]
+        self.assert_(reverse('fa-admin:index') in redirect_url)
+        self.assertEqual(303, code)
+        msgs = [str(msg) for msg in response.context['messages']]
+        self.assertEqual('No preview documents specified for publication', msgs[0])
+
+        # admin user has access to marbl but not eua
+        marbl = Archive.objects.get(slug='marbl')
+        eua = Archive.objects.get(slug='eua')
+        notfound = PublishResult('bogus345')
+        notfound.errors.append('Not found in preview collection')
+        mockpreview.return_value = [PublishResult('hartsfield558', 'hartsfield558.xml', marbl),
+                                    PublishResult('eua1', 'eua1.xml', eua), notfound]
+        mocktask.delay.return_value.task_id = 'batch-task-id'
+        response = self.client.post(batch_url,
+            {'preview_ids': ['hartsfield558', 'eua1', 'bogus345']}, follow=True)
+        mockpreview.assert_called_with(['hartsfield558', 'eua1', 'bogus345'])
+        # only documents the user may publish are queued
+        mocktask.delay.assert_called_once_with(['hartsfield558'])
+        msgs = [str(msg) for msg in response.context['messages']]
+        self.assert_(any('You do not have permission to publish' in msg and 'eua1' in msg
+                         for msg in msgs))
+        self.assert_(any('Could not publish <b>bogus345</b>' in msg for msg in msgs))
+        self.assert_(any('Queued <b>1</b> document for publication' in msg for msg in msgs))
+        task = TaskResult.objects.get(task_id='batch-task-id')
+        self.assertEqual('Batch publish', task.label)
+        self.assertEqual('1 document', task.object_id)
+
     def test_delete_ead(self):
         # login as admin to test admin-only feature
         self.client.login(**self.credentials['admin'])
@@ -26,6 +26,7 @@ urlpatterns = [
     url(r'^archives/current/', views.current_archive, name='current-archive'),
     url(r'^accounts/logout$', views.logout, name="logout"),
     url(r'^publish/$', views.publish, name="publish-ead"),
+    url(r'^publish/batch/$', views.batch_publish, name="batch-publish"),
     url(r'^(?P<archive>[a-z0-9-]+)/preview/$', views.preview, name="preview-ead"),
     url(r'^(?P<archive>[a-z0-9-]+)/(?P<filename>[^/]+)/prep/$',
         views.prepared_eadxml, name="prep-ead"),
@@ -16,14 +16,17 @@
 
 import os
 import logging
+from lxml import etree
 from lxml.etree import XMLSyntaxError, XPath, tostring
 import re
+import threading
 from urllib2 import HTTPError
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import striptags
 
+import eulxml
 from eulxml.xmlmap.core import load_xmlobject_from_file, load_xmlobject_from_string
 from eulxml.xmlmap.eadmap import EAD_NAMESPACE
 from pidservices.djangowrapper.shortcuts import DjangoPidmanRestClient
@@ -39,7 +42,135 @@ local_name = XPath('local-name()')
 # init logger for this module
 logger = logging.getLogger(__name__)
 
-def check_ead(filename, dbpath, xml=None):
+# pre-compiled xpaths and tag names used to check and prep EAD documents
+_ead_ns = {'e': EAD_NAMESPACE}
+origination_count = XPath('count(e:archdesc/e:did/e:origination)', namespaces=_ead_ns)
+list_title_fields = XPath('e:archdesc/e:did/e:origination/node()|e:archdesc/e:did/e:unittitle',
+                          namespaces=_ead_ns)
+DID_TAG = '{%s}did' % EAD_NAMESPACE
+CONTAINER_TAG = '{%s}container' % EAD_NAMESPACE
+_compiled_xpaths = {}
+
+
+def compiled_xpath(xpath):
+    '''Compile an xpath in the EAD namespace, reusing a previously
+    compiled version when available.'''
+    if xpath not in _compiled_xpaths:
+        _compiled_xpaths[xpath] = XPath(xpath, namespaces=_ead_ns)
+    return _compiled_xpaths[xpath]
+
+
+_ead_schema = None
+_ead_schema_lock = threading.Lock()
+
+
+def ead_schema_location():
+    '''Location of the EAD XSD schema used to validate documents:
+    **EAD_XSD_SCHEMA** if configured, otherwise the local copy of the schema
+    distributed with :mod:`eulxml`, so that validation does not depend on
+    network access; falls back to the canonical schema url.'''
+    location = getattr(settings, 'EAD_XSD_SCHEMA', None)
+    if location:
+        return location
+    local_copy = os.path.join(eulxml.XMLCATALOG_DIR, 'ead.xsd')
+    if os.path.exists(local_copy):
+        return local_copy
+    return FindingAid.XSD_SCHEMA
+
+
+def ead_schema():
+    '''Process-wide compiled EAD :class:`lxml.etree.XMLSchema`, loaded
+    the first time it is needed.'''
+    global _ead_schema
+    with _ead_schema_lock:
+        if _ead_schema is None:
+            location = ead_schema_location()
+            logger.debug('Loading EAD schema from %s' % location)
+            _ead_schema = etree.XMLSchema(etree.parse(location))
+    return _ead_schema
+
+
+def validate_ead(node):
+    '''Validate an EAD document against the cached EAD schema.  Each
+    validation gets a fresh error log, so errors from previous documents
+    are never reported.
+
+    :param node: :class:`lxml.etree._Element` or
+        :class:`lxml.etree._ElementTree` for the document
+    :returns: list of :class:`lxml.etree._LogEntry` validation errors;
+        empty if the document is valid
+    '''
+    schema = ead_schema()
+    # the error log is stored on the schema, so validations must not overlap
+    with _ead_schema_lock:
+        if schema.validate(node):
+            return []
+        return list(schema.error_log)
+
+
+class EadDocument(object):
+    '''Processing context for a single EAD file.  The file is parsed once,
+    and the same tree is used for preparing, comparing, and checking the
+    document, so that an admin action or script that does all of these does
+    not re-parse or re-serialize the document for each step.
+
+    :param filename: full path to the EAD file
+    :param xml: optional xml content to use instead of the file contents
+    '''
+
+    #: serialized document before :meth:`prepare` was called
+    original_xml = None
+    #: serialized document after :meth:`prepare` was called
+    prepared_xml = None
+
+    def __init__(self, filename, xml=None):
+        self.filename = filename
+        self.xml = xml
+        self._ead = None
+
+    @property
+    def ead(self):
+        ''':class:`~findingaids.fa.models.FindingAid` for the document,
+        parsed on first access.  Raises
+        :class:`lxml.etree.XMLSyntaxError` if the document is not
+        well-formed.'''
+        if self._ead is None:
+            if self.xml is not None:
+                self._ead = load_xmlobject_from_string(self.xml, FindingAid)
+            else:
+                self._ead = load_xmlobject_from_file(self.filename, FindingAid)
+        return self._ead
+
+    def prepare(self, pretty=False):
+        '''Prepare the document for publication with :meth:`prep_ead`,
+        storing the serialized document before and after prep in
+        :attr:`original_xml` and :attr:`prepared_xml`.
+
+        :param pretty: pretty-print serialized xml; defaults to False
+        :returns: prepared xml
+        '''
+        self.original_xml = self.ead.serializeDocument(pretty=pretty)
+        prep_ead(self.ead, self.filename)
+        self.prepared_xml = self.ead.serializeDocument(pretty=pretty)
+        return self.prepared_xml
+
+    @property
+    def changed(self):
+        'True if :meth:`prepare` modified the document'
+        return self.original_xml != self.prepared_xml
+
+    def check(self, dbpath):
+        '''Run all publication checks on the document in its current
+        state; see :meth:`check_ead`.'''
+        return check_ead(self.filename, dbpath, ead=self.ead)
+
+    def check_eadxml(self):
+        '''Run xml checks on the document in its current state; see
+        :meth:`check_eadxml`.'''
+        return check_eadxml(self.ead)
+
+
+def check_ead(filename, dbpath, xml=None, ead=None):
     """
     Sanity check an EAD file before it is loaded to the configured database.
 
@@ -51,36 +182,38 @@ def check_ead(filename, dbpath, xml=None):
 
     :param filename: full path to the EAD file to be checked
     :param dbpath: full path within eXist where the document will be saved
+    :param xml: optional xml content to check instead of the file contents
+    :param ead: optional :class:`~findingaids.fa.models.FindingAid`
+        already loaded from the file, to avoid parsing it again
     :returns: list of all errors found
     :rtype: list
     """
     errors = []
-    if xml is not None:
-        load_xml = load_xmlobject_from_string
-        content = xml
-    else:
-        load_xml = load_xmlobject_from_file
-        content = filename
-
-    try:
-        ead = load_xml(content, FindingAid)
-    except XMLSyntaxError as err:
-        # if this fails, document is not well-formed xml
-        # can't do any further processing, so return
-        errors.append(err)
-        return errors
+    if ead is None:
+        if xml is not None:
+            load_xml = load_xmlobject_from_string
+            content = xml
+        else:
+            load_xml = load_xmlobject_from_file
+            content = filename
+
+        try:
+            ead = load_xml(content, FindingAid)
+        except XMLSyntaxError as err:
+            # if this fails, document is not well-formed xml
+            # can't do any further processing, so return
+            errors.append(err)
+            return errors
 
     # schema validation
-    if not ead.schema_valid():
-        # if not valid, report all schema validation errors
-        # - simplify error message: report line & columen #s, and text of the error
-        errors.extend('Line %d, column %d: %s' % (err.line, err.column, err.message)
-                        for err in set(ead.validation_errors()))
-
-        # NOTE: somewhere between lxml 2.3.1 and 3.0.1 this started
-        # returning duplicate validation errors (possibly an issue in eulxml?)
-        # Would be good to uniquify (better to fix in eulxml, if possible)
-        # (errors seem to be aggregating instead of clearing out....)
+    # - if not valid, report all schema validation errors
+    # - simplify error message: report line & columen #s, and text of the error
+    reported = set()
+    for err in validate_ead(ead.node):
+        msg = 'Line %d, column %d: %s' % (err.line, err.column, err.message)
+        if msg not in reported:
+            reported.add(msg)
+            errors.append(msg)
 
     # eadid is expected to match filename without .xml extension
     expected_eadid = os.path.basename(filename).replace('.xml', '')
@@ -142,31 +275,34 @@ def check_eadxml(ead):
     list_title_path = "%s/%s" % (local_name(ead.list_title.node.getparent()),
                                  local_name(ead.list_title.node))
     # - check for at most one top-level origination
-    origination_count = ead.node.xpath('count(e:archdesc/e:did/e:origination)',
-                                       namespaces={'e': EAD_NAMESPACE})
-    if int(origination_count) > 1:
+    originations = origination_count(ead.node)
+    if int(originations) > 1:
         errors.append("Site expects only one archdesc/did/origination; found %d" \
-                        % origination_count)
+                        % originations)
 
     # container list formatting (based on encoding practice) expects only 2 containers per did
+    # - find dids with more than 2 and with only one container in a single pass
+    extra_containers = []
+    single_container = []
+    for did in ead.node.getroottree().iter(DID_TAG):
+        count = sum(1 for child in did if child.tag == CONTAINER_TAG)
+        if count > 2:
+            extra_containers.append(did)
+        elif count == 1:
+            single_container.append(did)
     # - dids with more than 2 containers
-    containers = ead.node.xpath('//e:did[count(e:container) > 2]',
-                                namespaces={'e': EAD_NAMESPACE})
-    if len(containers):
+    if len(extra_containers):
         errors.append("Site expects maximum of 2 containers per did; found %d did(s) with more than 2" \
-                        % len(containers))
-        errors.append(['Line %d: %s' % (c.sourceline, tostring(c)) for c in containers])
+                        % len(extra_containers))
+        errors.append(['Line %d: %s' % (c.sourceline, tostring(c)) for c in extra_containers])
     # - dids with only one container
-    containers = ead.node.xpath('//e:did[count(e:container) = 1]',
-                                namespaces={'e': EAD_NAMESPACE})
-    if len(containers):
+    if len(single_container):
         errors.append("Site expects 2 containers per did; found %d did(s) with only 1" \
-                        % len(containers))
-        errors.append(['Line %d: %s' % (c.sourceline, tostring(c)) for c in containers])
+                        % len(single_container))
+        errors.append(['Line %d: %s' % (c.sourceline, tostring(c)) for c in single_container])
 
     # - no leading whitespace in list title
-    title_node = ead.node.xpath("%s/text()" % ead.list_title_xpath,
-                                namespaces={'e': EAD_NAMESPACE})
+    title_node = compiled_xpath("%s/text()" % ead.list_title_xpath)(ead.node)
     if hasattr(title_node[0], 'text'):
         title_text = title_node[0].text
     else:
@@ -268,8 +404,7 @@ def prep_ead(ead, filename):
     # NOTE: only removing *leading* whitespace because these fields
     # can contain mixed content, and trailing whitespace here may be significant
     # - list title fields - origination nodes and unittitle
-    for field in ead.node.xpath('e:archdesc/e:did/e:origination/node()|e:archdesc/e:did/e:unittitle',
-                                namespaces={'e': EAD_NAMESPACE}):
+    for field in list_title_fields(ead.node):
         # the text of an lxml node is the text content *before* any child elements
         # in some finding aids, this could be blank, e.g.
         # <unittitle><title>Pitts v. Freeman</title> case files</unittitle>
@@ -43,17 +43,24 @@ from eulexistdb.db import ExistDB, ExistDBException
 from eulcommon.djangoextras.http import HttpResponseSeeOtherRedirect
 from eulcommon.djangoextras.taskresult.models import TaskResult
 from eullocal.django.log import message_logging
-from eulxml.xmlmap.core import load_xmlobject_from_file, load_xmlobject_from_string
+from eulxml.xmlmap.core import load_xmlobject_from_file
 from eulexistdb.exceptions import DoesNotExist
 
-from findingaids.fa.models import FindingAid, Deleted, Archive
-from findingaids.fa.utils import pages_to_show, get_findingaid, paginate_queryset
+from findingaids.fa import cachekeys, pdfstore
+from findingaids.fa import facets, fulltext
+from findingaids.fa.models import FindingAid, Deleted, Archive, CollectionState, \
+    CatalogEntry
+from findingaids.fa.navigation import cache_navigation
+from findingaids.fa.utils import pages_to_show, get_findingaid, paginate_queryset, \
+    invalidate_findingaid
 from findingaids.fa_admin.auth import archive_access
 from findingaids.fa_admin.forms import DeleteForm
 from findingaids.fa_admin.models import Archivist
 from findingaids.fa_admin.source import files_to_publish
 from findingaids.fa_admin.svn import svn_client
-from findingaids.fa_admin.tasks import reload_cached_pdf
+from findingaids.fa_admin.publish import preview_documents, update_published
+from findingaids.fa_admin.tasks import reload_cached_pdf, batch_publish as batch_publish_task, \
+    queue_sitemap_update
 from findingaids.fa_admin import utils
 
 logger = logging.getLogger(__name__)
@@ -124,8 +131,13 @@ def list_files(request, archive):
 
     # query for publish/preview modification time all at once
     # (more efficient than individual queries for each file)
-    published = FindingAid.objects.only('document_name', 'last_modified') \
-        .filter(document_name__in=[f.filename for f in recent_files.object_list])
+    filenames = [f.filename for f in recent_files.object_list]
+    if CatalogEntry.is_complete():
+        published = CatalogEntry.published().only('document_name', 'last_modified') \
+            .filter(document_name__in=filenames)
+    else:
+        published = FindingAid.objects.only('document_name', 'last_modified') \
+            .filter(document_name__in=filenames)
     pubinfo = dict((r.document_name, r.last_modified) for r in published)
     # NOTE: if needed, we can also load preview info like this:
     # preview = published.using(settings.EXISTDB_PREVIEW_COLLECTION)
@@ -325,6 +337,10 @@ def publish(request):
         success = False
 
     if success:
+        # document has moved out of preview; update cached values, catalog,
+        # facets, and search index (failures are logged, not raised)
+        update_published([ead.eadid.value], [ead], request)
+
         # request the cache to reload the PDF - queue asynchronous task
         result = reload_cached_pdf.delay(ead.eadid.value)
         task = TaskResult(label='PDF reload', object_id=ead.eadid.value,
@@ -344,6 +360,47 @@ def publish(request):
             {'errors': errors, 'filename': filename, 'mode': 'publish', 'exception': err})
 
 
+@permission_required_with_403('fa_admin.can_publish')
+@require_POST
+def batch_publish(request):
+    """
+    Publish multiple documents from the preview collection.  Expects one
+    or more ``preview_ids`` in the POST data.  Documents the user does not
+    have permission to publish are skipped; the rest are published by a
+    background task (see :meth:`~findingaids.fa_admin.tasks.batch_publish`),
+    which runs publication checks in parallel and reports the outcome for
+    each document in its task result.  Redirects to the main admin page.
+    """
+    ids = request.POST.getlist('preview_ids')
+    if not ids:
+        messages.error(request, "No preview documents specified for publication")
+        return HttpResponseSeeOtherRedirect(reverse('fa-admin:index'))
+
+    eadids = []
+    for result in preview_documents(ids):
+        if result.errors:
+            messages.error(request, 'Could not publish <b>%s</b>: %s' %
+                           (result.eadid, '; '.join(result.errors)))
+        elif not archive_access(request.user, result.archive.slug):
+            messages.error(request,
+                'You do not have permission to publish <b>%s</b> materials (<b>%s</b>).'
+                % (result.archive.label, result.eadid))
+        else:
+            eadids.append(result.eadid)
+
+    if eadids:
+        result = batch_publish_task.delay(eadids)
+        task = TaskResult(label='Batch publish',
+            object_id='%d document%s' % (len(eadids), 's' if len(eadids) != 1 else ''),
+            url=reverse('fa-admin:index'),
+            task_id=result.task_id)
+        task.save()
+        messages.success(request, 'Queued <b>%d</b> document%s for publication.'
+                % (len(eadids), 's' if len(eadids) != 1 else ''))
+
+    return HttpResponseSeeOtherRedirect(reverse('fa-admin:index'))
+
+
 @permission_required_with_403('fa_admin.can_preview')
 @user_passes_test_with_ajax(archive_access)
 def preview(request, archive):
@@ -374,6 +431,10 @@ def preview(request, archive):
         if success:
             # load the file as a FindingAid object so we can generate the preview url
             ead = load_xmlobject_from_file(fullpath, FindingAid)
+            invalidate_findingaid(ead.eadid.value, preview=True)
+            CatalogEntry.update([ead.eadid.value], settings.EXISTDB_PREVIEW_COLLECTION)
+            CollectionState.update(settings.EXISTDB_PREVIEW_COLLECTION)
+            cache_navigation(request, ead, preview=True)
             messages.success(request, 'Successfully loaded <b>%s</b> for preview.' % filename)
             # redirect to document preview page with code 303 (See Other)
             return HttpResponseSeeOtherRedirect(reverse('fa-admin:preview:findingaid', kwargs={'id': ead.eadid}))
@@ -397,6 +458,48 @@ def preview(request, archive):
                 })
 
 
+def _prepared_cache_key(archive, filename):
+    """Cache key for the prepared version of an EAD file, in the cache
+    namespace for the archive source files.  Includes the modification time
+    of the file, so a file that has been updated is prepared again.
+
+    :param archive: :class:`~findingaids.fa.models.Archive`
+    :param filename: base filename of the ead file
+    """
+    try:
+        mtime = os.path.getmtime(os.path.join(archive.svn_local_path, filename))
+    except OSError:
+        mtime = None
+    return cachekeys.cache_key('prepared-eadxml',
+        cachekeys.archive_namespace(archive.slug), filename, mtime)
+
+
+def _prepare_ead(request, eaddoc, cache_key):
+    """Prepare an EAD document for publication and cache the prepared xml.
+
+    :param request: request object, for displaying any messages logged
+        during prep
+    :param eaddoc: :class:`~findingaids.fa_admin.utils.EadDocument`
+    :param cache_key: cache key for the prepared xml, from
+        :meth:`_prepared_cache_key`
+    :returns: error response to display if the document could not be
+        loaded or prepared, otherwise None
+    """
+    try:
+        eaddoc.ead  # validate or not?
+    except XMLSyntaxError, e:
+        # xml is not well-formed : return 500 with error message
+        return HttpResponseServerError("Could not load document: %s" % e)
+
+    # flash meesage that appear on the screen for user, message itself is generated in utils.py
+    with message_logging(request, 'findingaids.fa_admin.utils', logging.INFO):
+        try:
+            cache.set(cache_key, eaddoc.prepare(), cachekeys.timeout())
+        except Exception as e:
+            # any exception on prep is most likely ark generation
+            return HttpResponseServerError('Failed to prep the document: ' + str(e))
+
+
 @permission_required_with_403('fa_admin.can_prepare')
 @user_passes_test_with_ajax(archive_access)
 def prepared_eadxml(request, archive, filename):
@@ -416,25 +519,16 @@ def prepared_eadxml(request, archive, filename):
         document will be pulled from the configured source directory.
     """
     # find relative to svn path if associated with an archive
-    prepped_xml = cache.get(filename)
     arch = get_object_or_404(Archive, slug=archive)
     fullpath = os.path.join(arch.svn_local_path, filename)
+    cache_key = _prepared_cache_key(arch, filename)
+    prepped_xml = cache.get(cache_key)
     if prepped_xml is None:
-        try:
-            ead = load_xmlobject_from_file(fullpath, FindingAid)  # validate or not?
-        except XMLSyntaxError, e:
-            # xml is not well-formed : return 500 with error message
-            return HttpResponseServerError("Could not load document: %s" % e)
-
-        # flash meesage that appear on the screen for user, message itself is generated in utils.py
-        with message_logging(request, 'findingaids.fa_admin.utils', logging.INFO):
-            try:
-                ead = utils.prep_ead(ead, filename)
-                prepped_xml = ead.serializeDocument()
-                cache.set(filename, prepped_xml)
-            except Exception as e:
-                # any exception on prep is most likely ark generation
-                return HttpResponseServerError('Failed to prep the document: ' + str(e))
+        eaddoc = utils.EadDocument(fullpath)
+        error_response = _prepare_ead(request, eaddoc, cache_key)
+        if error_response is not None:
+            return error_response
+        prepped_xml = eaddoc.prepared_xml
 
     # on GET, display the xml and make available for download
     if request.method == 'GET':
@@ -497,17 +591,17 @@ def prepared_ead(request, archive, filename, mode):
     fullpath = os.path.join(arch.svn_local_path, filename)
     changes = []
 
-    # this my change clear up the cache on this view so user-uploaded
-    # document matches the prepped ead that is displayed, rather than using an out of date cached copy
-    cache.delete(filename)
-    prep_ead = prepared_eadxml(request, arch.slug, filename)
-
-    if prep_ead.status_code == 200:
-        orig_ead = load_xmlobject_from_file(fullpath, FindingAid)  # validate or not?
-        original_xml = orig_ead.serializeDocument()  # store as serialized by xml object, so xml output will be the same
-
-        prep_xml = prep_ead.content
-        ead = load_xmlobject_from_string(prep_xml, FindingAid)  # validate?
+    # always prepare the document here and replace any cached copy, so
+    # the user-uploaded document matches the prepped ead that is displayed
+    # parse the document once; original and prepared xml are both
+    # serialized from the same tree, and checks run on the prepared tree
+    eaddoc = utils.EadDocument(fullpath)
+    error_response = _prepare_ead(request, eaddoc, _prepared_cache_key(arch, filename))
+
+    if error_response is None:
+        xml_status = 200
+        original_xml = eaddoc.original_xml
+        prep_xml = eaddoc.prepared_xml
         if mode == 'diff':
             diff = difflib.HtmlDiff(8, 80)  # set columns to wrap at 80 characters
             # generate a html table with line-by-line comparison (meant to be called in a new window)
@@ -515,38 +609,42 @@ def prepared_ead(request, archive, filename, mode):
             return HttpResponse(changes)
         elif mode == 'summary':
             # prepared EAD should pass sanity checks required for publication
-            errors = utils.check_eadxml(ead)
+            errors = eaddoc.check_eadxml()
             changes = list(difflib.unified_diff(original_xml.split('\n'), prep_xml.split('\n')))
             if not changes:
                 messages.info(request, 'No changes made to <b>%s</b>; EAD is already prepared.' % filename)
                 # redirect to main admin page with code 303 (See Other)
                 return HttpResponseSeeOtherRedirect(reverse('fa-admin:index'))
-    elif prep_ead.status_code == 500:
+    else:
         # something went wrong with generating prep xml; could be one of:
         # - non-well-formed xml (failed to load original document at all)
         # - error generating an ARK for the document
-        errors = [prep_ead.content]
-    else:
-        # this shouldn't happen; not 200 or 500 == something went dreadfully wrong
-        errors = ['Something went wrong trying to load the specified document.',
-                  prep_ead.content]     # pass along the output in case it is useful?
+        xml_status = error_response.status_code
+        errors = [error_response.content]
 
     return render(request, 'fa_admin/prepared.html', {
         'filename': filename,
         'changes': changes, 'errors': errors,
-        'xml_status': prep_ead.status_code,
+        'xml_status': xml_status,
         'archive': arch})
 
 
 @login_required
 def list_published(request, archive=None):
     """List all published EADs, optionally restricted to a single archive."""
-    fa = FindingAid.objects.order_by('eadid').only('document_name', 'eadid', 'last_modified')
     arch = None
     if archive is not None:
         arch = get_object_or_404(Archive, slug=archive)
-        # fa = fa.filter(repository=arch.name)
-        fa = fa.filter(repository__fulltext_terms='"%s"' % arch.name)
+    if CatalogEntry.is_complete():
+        fa = CatalogEntry.published().order_by('eadid') \
+                         .only('document_name', 'eadid', 'last_modified')
+        if arch is not None:
+            fa = fa.filter(archive=arch)
+    else:
+        fa = FindingAid.objects.order_by('eadid').only('document_name', 'eadid', 'last_modified')
+        if arch is not None:
+            # fa = fa.filter(repository=arch.name)
+            fa = fa.filter(repository__fulltext_terms='"%s"' % arch.name)
 
     fa_subset, paginator = paginate_queryset(request, fa, per_page=30, orphans=5)
     show_pages = pages_to_show(paginator, fa_subset.number)
@@ -599,7 +697,14 @@ def delete_ead(request, id, archive=None):
                 try:
                     success = db.removeDocument(fa.collection_name + '/' + fa.document_name)
                     if success:
+                        invalidate_findingaid(fa.eadid.value)
+                        pdfstore.remove_pdfs(fa.eadid.value)
+                        fulltext.remove_findingaid(fa.eadid.value)
+                        facets.remove_facets(fa.eadid.value)
+                        CatalogEntry.remove(fa.eadid.value)
+                        # saving the deleted record also updates the collection state
                         DeleteForm(request.POST, instance=deleted_info).save()
+                        queue_sitemap_update([fa.eadid.value])
                         messages.success(request, 'Successfully removed <b>%s</b>.' % id)
                     else:
                         # remove exited normally but was not successful
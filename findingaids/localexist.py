@@ -0,0 +1,934 @@
+# file findingaids/localexist.py
+#
+#   Copyright 2012 Emory University Library
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''
+In-process stand-in for eXist, for running the site, the view tests, and
+the **response_times** benchmarks without an eXist server.
+
+When **EXISTDB_LOCAL_STORE** is set, :func:`install` is called at startup
+and every :class:`eulexistdb.db.ExistDB` (or subclass) created afterwards
+(by the eulexistdb model managers, the eulexistdb test case fixture
+loading, the admin views, etc.) is a :class:`LocalExistDB` backed by an
+in-memory lxml :class:`DocumentStore`, and every
+:class:`eulexistdb.query.QuerySet` using one is a :class:`LocalQuerySet`.
+The store is seeded with the EAD files in the configured directory (or
+the test fixtures, if the setting is True), loaded to
+**EXISTDB_ROOT_COLLECTION**.
+
+Querysets support the filters, :meth:`only`/:meth:`also` (including raw
+and special fields), :meth:`order_by`, :meth:`distinct`, and
+:meth:`using` as they are used by the site, and return results in the
+same constructed form as eXist, so the same return types are used.  XPaths
+are evaluated with lxml (XPath 1.0; the eXist-specific expressions used
+for raw match-count fields are translated).  Full-text queries are
+approximated: terms, "phrases", trailing wildcards, AND/OR/NOT and +/-
+are supported against the words in the text of the queried nodes, scores
+are based on the number of matches, and highlighting adds
+``exist:match`` elements around matching words.
+
+Queries and XML-RPC-style calls are reported the same way as for eXist
+(the :data:`eulexistdb.db.xquery_called` signal and the request stats of
+:mod:`findingaids.exist_middleware`), so query counts are realistic;
+query times are not.
+'''
+
+from collections import OrderedDict
+import copy
+from datetime import datetime
+import glob
+import hashlib
+import itertools
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+from django.conf import settings
+from eulexistdb import db
+from eulexistdb.db import ExistDB, ExistDBException, EXISTDB_NAMESPACE
+from eulexistdb.query import QuerySet, Xquery
+from eulxml.xpath import core as xpath_core
+from lxml import etree
+
+from findingaids.exist_middleware import current_stats
+from findingaids.fa import lucene
+from findingaids.fa.lucene import MUST, MUST_NOT
+
+logger = logging.getLogger(__name__)
+
+#: default directory of EAD files to seed the store with
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fa', 'tests', 'fixtures')
+
+_EXIST = '{%s}' % EXISTDB_NAMESPACE
+
+_store = None
+
+
+def _normalize_path(path):
+    # database paths with or without /db and leading or trailing slashes
+    path = (path or '').strip('/')
+    if path == 'db' or path.startswith('db/'):
+        path = path[3:]
+    return path
+
+
+class StoredDocument(object):
+    '''A single document in the :class:`DocumentStore`.'''
+
+    def __init__(self, path, tree):
+        self.path = path
+        self.tree = tree
+        self.created = self.modified = datetime.now()
+        # words in the text of nodes queried with full-text filters,
+        # keyed on node path
+        self._words = {}
+
+    @property
+    def name(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def collection(self):
+        return self.path.rsplit('/', 1)[0] if '/' in self.path else ''
+
+    def words(self, node):
+        'lower-case words in the text of a node, for full-text queries'
+        key = self.tree.getpath(node)
+        words = self._words.get(key)
+        if words is None:
+            words = self._words[key] = _words(node.xpath('string()'))
+        return words
+
+
+class DocumentStore(object):
+    '''In-memory collections of parsed xml documents, keyed on database
+    path (without the leading /db).'''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.documents = OrderedDict()
+        self.collections = set([''])
+        self.indexes = {}
+        self.sessions = itertools.count(1)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add_collection(self, collection):
+        collection = _normalize_path(collection)
+        with self._lock:
+            parts = collection.split('/')
+            for i in range(len(parts)):
+                self.collections.add('/'.join(parts[:i + 1]))
+
+    def has_collection(self, collection):
+        return _normalize_path(collection) in self.collections
+
+    def remove_collection(self, collection):
+        collection = _normalize_path(collection)
+        prefix = collection + '/'
+        with self._lock:
+            self.collections = set(c for c in self.collections
+                                   if c != collection and not c.startswith(prefix))
+            for path in [p for p in self.documents if p.startswith(prefix)]:
+                del self.documents[path]
+            self.collections.add('')
+
+    def get(self, path):
+        return self.documents.get(_normalize_path(path))
+
+    def put(self, path, tree):
+        path = _normalize_path(path)
+        document = StoredDocument(path, tree)
+        with self._lock:
+            self.add_collection(document.collection)
+            # a replaced document keeps its place in the collection
+            previous = self.documents.get(path)
+            if previous is not None:
+                document.created = previous.created
+            self.documents[path] = document
+        return document
+
+    def remove(self, path):
+        with self._lock:
+            return self.documents.pop(_normalize_path(path), None)
+
+    def select(self, collection=None, document=None):
+        '''Documents in a collection (including its sub-collections), or
+        a single document, in the order they were loaded.'''
+        if document is not None:
+            doc = self.get(document)
+            return [doc] if doc is not None else []
+        with self._lock:
+            documents = list(self.documents.values())
+        collection = _normalize_path(collection)
+        if not collection:
+            return documents
+        prefix = collection + '/'
+        return [doc for doc in documents if doc.path.startswith(prefix)]
+
+    def load_directory(self, directory, collection):
+        '''Load all of the xml files in a directory to a collection.
+
+        :returns: number of documents loaded
+        '''
+        filenames = sorted(glob.glob(os.path.join(directory, '*.xml')))
+        for filename in filenames:
+            self.put('%s/%s' % (_normalize_path(collection), os.path.basename(filename)),
+                     etree.parse(filename))
+        return len(filenames)
+
+
+def _record_xmlrpc(method, start):
+    # report the equivalent eXist XML-RPC call to the request stats
+    stats = current_stats()
+    if stats is not None:
+        stats.add_xmlrpc(method, time.time() - start)
+
+
+class LocalExistDB(ExistDB):
+    ''':class:`~eulexistdb.db.ExistDB` backed by a :class:`DocumentStore`
+    instead of an eXist server.  Accepts (and ignores) the same
+    connection arguments as :class:`~eulexistdb.db.ExistDB`.  Arbitrary
+    XQueries are not supported.
+
+    :param store: :class:`DocumentStore`; defaults to the store set up
+        by :func:`install`
+    '''
+
+    def __init__(self, *args, **kwargs):
+        store = kwargs.get('store') or _store
+        if store is None:
+            raise Exception('Local eXist store has not been installed')
+        self.store = store
+        self.resultType = db.QueryResult
+
+    def _query_called(self, xquery, begin, **kwargs):
+        # report a query as eXist queries are reported
+        if db.xquery_called is not None:
+            args = {'xquery': xquery, 'start': 1, 'how_many': 10, 'cache': False,
+                    'session': None, 'release': None, 'result_type': None}
+            args.update(kwargs)
+            db.xquery_called.send(sender=self.__class__, time_taken=time.time() - begin,
+                                  name='query', return_value=None, args=[], kwargs=args)
+
+    def getDocument(self, name):
+        doc = self.store.get(name)
+        if doc is None:
+            raise ExistDBException('%s not found' % name)
+        return etree.tostring(doc.tree, encoding='UTF-8', xml_declaration=True)
+
+    def createCollection(self, collection_name, overwrite=False):
+        if not overwrite and self.hasCollection(collection_name):
+            raise ExistDBException(collection_name + " exists")
+        start = time.time()
+        self.store.add_collection(collection_name)
+        _record_xmlrpc('createCollection', start)
+        return True
+
+    def removeCollection(self, collection_name):
+        if not self.hasCollection(collection_name):
+            raise ExistDBException(collection_name + " does not exist")
+        start = time.time()
+        self.store.remove_collection(collection_name)
+        _record_xmlrpc('removeCollection', start)
+        return True
+
+    def hasCollection(self, collection_name):
+        start = time.time()
+        found = self.store.has_collection(collection_name)
+        _record_xmlrpc('describeCollection', start)
+        return found
+
+    def reindexCollection(self, collection_name):
+        if not self.hasCollection(collection_name):
+            raise ExistDBException(collection_name + " does not exist")
+        self._query_called("xmldb:reindex('%s')" % collection_name, time.time())
+        return True
+
+    def describeDocument(self, document_path):
+        start = time.time()
+        doc = self.store.get(document_path)
+        _record_xmlrpc('describeResource', start)
+        if doc is None:
+            return {}
+        return {
+            'name': '/db/%s' % doc.path,
+            'owner': self.username or 'admin',
+            'group': 'dba',
+            'permissions': 420,
+            'type': 'XMLResource',
+            'mime-type': 'application/xml',
+            'created': doc.created,
+            'modified': doc.modified,
+        }
+
+    def getCollectionDescription(self, collection_name):
+        start = time.time()
+        collection = _normalize_path(collection_name)
+        if not self.store.has_collection(collection):
+            _record_xmlrpc('getCollectionDesc', start)
+            raise ExistDBException('collection %s not found' % collection_name)
+        prefix = collection + '/' if collection else ''
+        subcollections = sorted(c[len(prefix):] for c in self.store.collections
+                                if c.startswith(prefix) and c != collection
+                                and '/' not in c[len(prefix):])
+        documents = [{'name': doc.name, 'owner': 'admin', 'group': 'dba',
+                      'permissions': 420, 'type': 'XMLResource'}
+                     for doc in self.store.select(collection) if doc.collection == collection]
+        _record_xmlrpc('getCollectionDesc', start)
+        return {'name': '/db/%s' % collection, 'owner': 'admin', 'group': 'dba',
+                'permissions': 493, 'collections': subcollections,
+                'documents': documents}
+
+    def load(self, xml, path):
+        if hasattr(xml, 'read'):
+            xml = xml.read()
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        try:
+            tree = etree.fromstring(xml).getroottree()
+        except etree.XMLSyntaxError as err:
+            raise ExistDBException('Error loading %s: %s' % (path, err))
+        self.store.put(path, tree)
+        return True
+
+    def removeDocument(self, name):
+        start = time.time()
+        removed = self.store.remove(name)
+        _record_xmlrpc('remove', start)
+        if removed is None:
+            raise ExistDBException('Document %s not found' % name)
+        return True
+
+    def moveDocument(self, from_collection, to_collection, document):
+        start = time.time()
+        doc = self.store.get('%s/%s' % (_normalize_path(from_collection), document))
+        if doc is None or not self.store.has_collection(to_collection):
+            self._query_called("xmldb:move('%s', '%s', '%s')" %
+                               (from_collection, to_collection, document), start)
+            raise ExistDBException('Failed to move %s from %s to %s' %
+                                   (document, from_collection, to_collection))
+        self.store.remove(doc.path)
+        self.store.put('%s/%s' % (_normalize_path(to_collection), document), doc.tree)
+        self._query_called("xmldb:move('%s', '%s', '%s')" %
+                           (from_collection, to_collection, document), start)
+        return True
+
+    def query(self, xquery=None, start=1, how_many=10, cache=False, session=None,
+              release=None, result_type=None):
+        self._query_called(xquery, time.time(), start=start, how_many=how_many,
+                           cache=cache, session=session, release=release,
+                           result_type=result_type)
+        if release is not None:
+            return True
+        # querysets are evaluated by LocalQuerySet; other XQueries
+        # (e.g., batched document moves) fail as they would on a server
+        # without the required modules
+        raise ExistDBException('XQuery is not supported by the local eXist store')
+
+    def executeQuery(self, xquery):
+        raise ExistDBException('XQuery is not supported by the local eXist store')
+
+    def setPermissions(self, resource, permissions):
+        return True
+
+    def loadCollectionIndex(self, collection_name, index):
+        if hasattr(index, 'read'):
+            index = index.read()
+        self.store.add_collection(collection_name)
+        self.store.indexes[_normalize_path(collection_name)] = index
+        return True
+
+    def removeCollectionIndex(self, collection_name):
+        if self.store.indexes.pop(_normalize_path(collection_name), None) is None:
+            raise ExistDBException('No index configuration for %s' % collection_name)
+        return True
+
+    def hasCollectionIndex(self, collection_name):
+        return _normalize_path(collection_name) in self.store.indexes
+
+
+## full-text queries
+
+_word = re.compile(r'\w+', re.UNICODE)
+_query_word = re.compile(r'[\w*?]+', re.UNICODE)
+
+
+def _words(text):
+    return _word.findall(text.lower())
+
+
+def _term_matcher(term):
+    # plain terms match exactly; wildcard terms by regular expression
+    if '*' in term or '?' in term:
+        pattern = re.escape(term).replace(r'\*', r'\w*').replace(r'\?', r'\w')
+        return re.compile('^%s$' % pattern, re.UNICODE).match
+    return term.__eq__
+
+
+class FulltextQuery(object):
+    '''Approximation of an eXist (Lucene) full-text query, matched
+    against the words in a text.
+
+    :param query: query string, as passed to the ``fulltext_terms``
+        filter
+    :param default_operator: operator for terms without AND or OR;
+        ``or`` (the eXist default) or ``and``
+    '''
+
+    def __init__(self, query, default_operator='or'):
+        self.matchers = []
+        try:
+            clause = lucene.parse(query, default_operator)
+        except lucene.QuerySyntaxError as err:
+            raise ExistDBException('Cannot parse full-text query %r: %s' % (query, err))
+        self.clause = self._convert(clause)
+
+    def _convert(self, clause, positive=True):
+        # match words for terms and phrases; clauses with no words to
+        # match are left out
+        kind, value = clause
+        if kind != 'bool':
+            return self._terms(value, positive)
+        clauses = []
+        for occur, subclause in value:
+            subclause = self._convert(subclause, positive and occur != MUST_NOT)
+            if subclause is not None:
+                clauses.append((occur, subclause))
+        return ('bool', clauses)
+
+    def _terms(self, text, positive=True):
+        # a single term, or a phrase for quoted or punctuated terms
+        matchers = [_term_matcher(term) for term in _query_word.findall(text.lower())]
+        if not matchers:
+            return None
+        if positive:
+            self.matchers.extend(matchers)
+        if len(matchers) == 1:
+            return ('term', matchers[0])
+        return ('phrase', matchers)
+
+    def _count(self, clause, words):
+        kind, value = clause
+        if kind == 'term':
+            return sum(1 for word in words if value(word))
+        if kind == 'phrase':
+            length = len(value)
+            return sum(1 for i in range(len(words) - length + 1)
+                       if all(match(words[i + j]) for j, match in enumerate(value)))
+        total = optional = 0
+        required = False
+        for occur, subclause in value:
+            count = self._count(subclause, words)
+            if occur == MUST_NOT:
+                if count:
+                    return 0
+            elif occur == MUST:
+                if not count:
+                    return 0
+                required = True
+                total += count
+            else:
+                optional += count
+        # with no required clauses, at least one optional clause must match
+        if not required and not optional:
+            return 0
+        return total + optional
+
+    def score(self, words):
+        '''Score for a list of words: 0 if the query does not match,
+        otherwise based on the number of matches and the length of the
+        text.'''
+        count = self._count(self.clause, words)
+        if not count:
+            return 0.0
+        return count / math.sqrt(len(words))
+
+    def matches_word(self, word):
+        'check if a single word should be highlighted'
+        return any(match(word) for match in self.matchers)
+
+
+def _highlight(node, queries):
+    '''Mark words matching any of the full-text queries in the text of an
+    element (as for eXist search term highlighting) by wrapping them in
+    ``exist:match`` elements.'''
+    def split(text):
+        # text before the first match, and (match, following text) pairs
+        parts = []
+        last = 0
+        before = None
+        for found in _word.finditer(text):
+            if any(query.matches_word(found.group().lower()) for query in queries):
+                if before is None:
+                    before = text[:found.start()]
+                else:
+                    parts[-1][1] = text[last:found.start()]
+                parts.append([found.group(), ''])
+                last = found.end()
+        if parts:
+            parts[-1][1] = text[last:]
+        return before, parts
+
+    def match(word, tail):
+        element = etree.Element(_EXIST + 'match', nsmap={'exist': EXISTDB_NAMESPACE})
+        element.text = word
+        element.tail = tail or None
+        return element
+
+    for element in list(node.iter()):
+        if isinstance(element.tag, basestring) and element.text:
+            before, parts = split(element.text)
+            if parts:
+                element.text = before or None
+                for i, (word, tail) in enumerate(parts):
+                    element.insert(i, match(word, tail))
+        if element is not node and element.tail:
+            before, parts = split(element.tail)
+            if parts:
+                element.tail = before or None
+                parent = element.getparent()
+                index = parent.index(element)
+                for i, (word, tail) in enumerate(parts):
+                    parent.insert(index + 1 + i, match(word, tail))
+    return node
+
+
+## xpath evaluation
+
+_xpath_cache = threading.local()
+
+_util_expand = 'util:expand('
+_grouped_steps = re.compile(r'([^\s(),|]+)/\(([^()]+)\)')
+
+
+def _compiled(xpath, namespaces):
+    # compiled xpaths are cached per thread
+    cache = getattr(_xpath_cache, 'xpaths', None)
+    if cache is None:
+        cache = _xpath_cache.xpaths = {}
+    key = (xpath, tuple(sorted(namespaces.iteritems())))
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = cache[key] = etree.XPath(xpath, namespaces=namespaces)
+    return compiled
+
+
+def _local_xpath(xpath):
+    '''Translate the eXist-specific parts of a raw field xpath to XPath
+    1.0: ``util:expand(...)`` is dropped (highlighted results are
+    already expanded) and ``path/(a|b)`` becomes ``(path/a|path/b)``.'''
+    while _util_expand in xpath:
+        start = xpath.index(_util_expand)
+        depth = 0
+        for end in range(start + len(_util_expand), len(xpath)):
+            if xpath[end] == '(':
+                depth += 1
+            elif xpath[end] == ')':
+                if depth == 0:
+                    break
+                depth -= 1
+        xpath = xpath[:start] + xpath[start + len(_util_expand):end] + xpath[end + 1:]
+    return _grouped_steps.sub(
+        lambda match: '(%s)' % '|'.join('%s/%s' % (match.group(1), step.strip())
+                                        for step in match.group(2).split('|')),
+        xpath)
+
+
+def _string_value(item):
+    if isinstance(item, etree._Element):
+        return item.xpath('string()')
+    return _xq_string(item)
+
+
+def _xq_string(value):
+    # value as serialized by eXist
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, float):
+        return u'%d' % value if value.is_integer() else unicode(repr(value))
+    if isinstance(value, datetime):
+        return unicode(value.isoformat())
+    return unicode(value)
+
+
+def _copy(node):
+    copied = copy.deepcopy(node)
+    copied.tail = None
+    return copied
+
+
+class LocalXquery(Xquery):
+    ''':class:`~eulexistdb.query.Xquery` that keeps the filters as added,
+    for evaluation by :class:`LocalQuerySet`, as well as the generated
+    XQuery.'''
+
+    def __init__(self, *args, **kwargs):
+        super(LocalXquery, self).__init__(*args, **kwargs)
+        # (xpath, lookup type, value, mode)
+        self.local_filters = []
+
+    def getCopy(self):
+        xq = LocalXquery()
+        xq.__dict__.update(super(LocalXquery, self).getCopy().__dict__)
+        xq.local_filters = list(self.local_filters)
+        return xq
+
+    def add_filter(self, xpath, type, value, mode=None):
+        super(LocalXquery, self).add_filter(xpath, type, value, mode)
+        self.local_filters.append((xpath, type, value, mode))
+
+    def clear_filters(self):
+        super(LocalXquery, self).clear_filters()
+        self.local_filters = [f for f in self.local_filters
+                              if f[3] in ('OR', 'NOT') or f[0] in self.special_fields]
+
+
+class LocalQuerySet(QuerySet):
+    ''':class:`~eulexistdb.query.QuerySet` evaluated against the
+    :class:`DocumentStore` of a :class:`LocalExistDB`.'''
+
+    _gtlt = {'gt': lambda a, b: a > b, 'gte': lambda a, b: a >= b,
+             'lt': lambda a, b: a < b, 'lte': lambda a, b: a <= b}
+
+    def __init__(self, model=None, xpath=None, using=None, collection=None,
+                 xquery=None, fulltext_options=None):
+        if xquery is None:
+            xquery = LocalXquery(xpath=xpath, collection=collection,
+                                 namespaces=getattr(model, 'ROOT_NAMESPACES', None),
+                                 fulltext_options=fulltext_options or {})
+        super(LocalQuerySet, self).__init__(model=model, using=using, xquery=xquery)
+
+    @property
+    def _namespaces(self):
+        namespaces = dict(self.query.namespaces or {})
+        namespaces.setdefault('exist', EXISTDB_NAMESPACE)
+        return namespaces
+
+    def _runQuery(self, start=None, max_items=None):
+        if max_items is None:
+            max_items = self.default_chunk_size
+        if start is None:
+            start = self._start + 1
+        session_opts = {}
+        if self._result_id is None:
+            session_opts['cache'] = True
+        else:
+            session_opts['session'] = self._result_id
+
+        xquery = self.query.getQuery()
+        begin = time.time()
+        try:
+            result = self._evaluate(start, max_items)
+        except etree.XPathError as err:
+            raise ExistDBException('Error evaluating %s: %s' % (xquery, err))
+        finally:
+            self._db._query_called(xquery, begin, start=start, how_many=max_items,
+                                   result_type=self.query_result_type, **session_opts)
+
+        if self._result_id is None:
+            self._result_id = result.session
+        self._count = result.hits
+        if max_items != 0:
+            self._result_cache = dict(enumerate(result.items, start=start - 1))
+        return result
+
+    def _evaluate(self, start, max_items):
+        query = self.query
+        namespaces = self._namespaces
+        operator = query.fulltext_options.get('default-operator', 'or')
+        # filters, with parsed full-text queries
+        filters = [(xpath, lookup, value, mode,
+                    FulltextQuery(value, operator) if lookup == 'fulltext_terms' else None)
+                   for xpath, lookup, value, mode in query.local_filters
+                   if lookup != 'highlight']
+        if query.highlight is True:
+            highlight = [f[4] for f in filters if f[4] is not None]
+        elif query.highlight:
+            highlight = [FulltextQuery(query.highlight)]
+        else:
+            highlight = []
+
+        # matching nodes, with full-text scores
+        matches = []
+        base_xpath = _compiled(query.xpath, namespaces)
+        for doc in self._db.store.select(query.collection, query.document):
+            for node in base_xpath(doc.tree):
+                score = self._filter(doc, node, namespaces, filters)
+                if score is not None:
+                    matches.append((doc, node, score))
+
+        if query.order_by:
+            matches = self._sort(matches, namespaces)
+        if query.start or query.end is not None:
+            matches = matches[query.start:query.end]
+
+        if query._distinct:
+            values = []
+            for doc, node, score in matches:
+                value = _string_value(self._return_node(doc, node, score, namespaces, highlight))
+                if value not in values:
+                    values.append(value)
+            total = len(values)
+            items = []
+            for value in values[start - 1:start - 1 + max_items]:
+                item = etree.Element(_EXIST + 'value', nsmap={'exist': EXISTDB_NAMESPACE})
+                item.text = value
+                items.append(item)
+        else:
+            total = len(matches)
+            items = [self._return_node(doc, node, score, namespaces, highlight)
+                     for doc, node, score in matches[start - 1:start - 1 + max_items]]
+
+        result = etree.Element(_EXIST + 'result', nsmap={'exist': EXISTDB_NAMESPACE})
+        result.set(_EXIST + 'hits', str(total))
+        result.set(_EXIST + 'start', str(start))
+        result.set(_EXIST + 'count', str(len(items)))
+        if self._result_id is None:
+            result.set(_EXIST + 'session', str(next(self._db.store.sessions)))
+        result.extend(items)
+        return self.query_result_type(result)
+
+    def _values(self, doc, node, xpath, namespaces, score):
+        # value of a filter or sort field for a matching node
+        if xpath in self.query.special_fields:
+            return self._special(doc, node, xpath, score, namespaces)
+        return _compiled(xpath, namespaces)(node)
+
+    def _filter(self, doc, node, namespaces, filters):
+        '''Full-text score for a node if it matches all of the filters,
+        otherwise None.'''
+        score = 0.0
+        any_or = matched_or = False
+        for xpath, lookup, value, mode, ft_query in filters:
+            if ft_query is not None:
+                result = _compiled(xpath, namespaces)(node)
+                words = []
+                for item in (result if isinstance(result, list) else [result]):
+                    if isinstance(item, etree._Element):
+                        words.extend(doc.words(item))
+                    else:
+                        words.extend(_words(_xq_string(item)))
+                match_score = ft_query.score(words) if words else 0.0
+                matched = match_score > 0
+                score += match_score
+            else:
+                matched = self._match(self._values(doc, node, xpath, namespaces, score),
+                                      lookup, value)
+            if mode == 'OR':
+                any_or = True
+                matched_or = matched_or or matched
+            elif mode == 'NOT':
+                if matched:
+                    return None
+            elif not matched:
+                return None
+        if any_or and not matched_or:
+            return None
+        return score
+
+    def _match(self, result, lookup, value):
+        if lookup == 'exists':
+            if isinstance(result, list):
+                found = len(result) > 0
+            else:
+                found = bool(result)
+            return found == bool(value)
+
+        if isinstance(result, list):
+            strings = [_string_value(item) for item in result]
+        elif isinstance(result, datetime):
+            strings = [result]
+        else:
+            strings = [_xq_string(result)]
+
+        if lookup == 'exact':
+            return unicode(value) in strings
+        if lookup == 'in':
+            return any(unicode(v) in strings for v in value)
+        if lookup == 'contains':
+            return unicode(value) in (strings[0] if strings else u'')
+        if lookup == 'startswith':
+            return (strings[0] if strings else u'').startswith(unicode(value))
+        if lookup in self._gtlt:
+            compare = self._gtlt[lookup]
+            for item in strings:
+                if isinstance(value, (int, long, float)):
+                    try:
+                        item = float(item)
+                    except ValueError:
+                        continue
+                if compare(item, value):
+                    return True
+        return False
+
+    def _special(self, doc, node, field, score, namespaces, highlighted=None):
+        if field == 'document_name':
+            return doc.name
+        if field == 'collection_name':
+            return '/db/%s' % doc.collection
+        if field == 'hash':
+            return hashlib.sha1(etree.tostring(node, with_tail=False)).hexdigest()
+        if field == 'last_modified':
+            return doc.modified
+        if field == 'fulltext_score':
+            return score
+        if field == 'match_count':
+            if highlighted is None:
+                return 0.0
+            return float(len(highlighted.xpath('.//exist:match', namespaces=namespaces)))
+
+    def _sort(self, matches, namespaces):
+        query = self.query
+        order_by = query.order_by
+        lower = False
+        if order_by in query.special_fields:
+            xpath = order_by
+        elif query.order_by_rawxpath:
+            xpath = _local_xpath(order_by % {'xq_var': '.'})
+        else:
+            xpath = order_by
+            if xpath.startswith('fn:lower-case(') and xpath.endswith(')'):
+                xpath = xpath[len('fn:lower-case('):-1]
+                lower = True
+
+        def sort_key(match):
+            doc, node, score = match
+            value = self._values(doc, node, xpath, namespaces, score)
+            if isinstance(value, list):
+                if not value:
+                    return (0, u'')
+                value = _string_value(value[0])
+            elif isinstance(value, basestring):
+                value = unicode(value)
+            if lower:
+                value = value.lower()
+            # empty values sort first, as in eXist
+            return (1, value)
+
+        return sorted(matches, key=sort_key, reverse=query.order_mode == 'descending')
+
+    def _return_node(self, doc, node, score, namespaces, highlight):
+        '''Result item for a matching node, constructed as eXist would for
+        the return fields and highlighting of the query.'''
+        query = self.query
+
+        def copied(item):
+            item = _copy(item)
+            if highlight:
+                _highlight(item, highlight)
+            return item
+
+        if not (query.return_fields or query.additional_return_fields):
+            return copied(node)
+
+        highlighted = None
+        fields = dict(query.return_fields, **query.additional_return_fields)
+        if highlight and ('match_count' in fields or query.raw_fields):
+            highlighted = copied(node)
+
+        name = str(query._return_name_from_xpath(xpath_core.parse(query.xpath)))
+        if ':' in name:
+            prefix, name = name.split(':', 1)
+            name = '{%s}%s' % (namespaces[prefix], name)
+        constructed = etree.Element(name)
+        if query.additional_return_fields:
+            constructed.append(highlighted if highlighted is not None else copied(node))
+            if highlighted is not None:
+                highlighted = constructed[0]
+
+        for field, xpath in fields.iteritems():
+            if field in query.special_fields:
+                element = etree.SubElement(constructed, field)
+                element.text = _xq_string(self._special(doc, node, field, score,
+                                                        namespaces, highlighted))
+                continue
+            if field in query.raw_fields:
+                element = etree.SubElement(constructed, query._raw_prefix + field)
+                context = highlighted if highlighted is not None else node
+                value = _compiled(_local_xpath(xpath % {'xq_var': '.'}), namespaces)(context)
+            else:
+                element = etree.SubElement(constructed, 'field')
+                value = _compiled(xpath, namespaces)(node)
+
+            for item in (value if isinstance(value, list) else [value]):
+                if isinstance(item, etree._Element):
+                    element.append(copied(item))
+                elif getattr(item, 'is_attribute', False):
+                    element.set(item.attrname, item)
+                else:
+                    text = _xq_string(item)
+                    if len(element):
+                        element[-1].tail = (element[-1].tail or u'') + text
+                    else:
+                        element.text = (element.text or u'') + text
+        return constructed
+
+    def _release_query_result(self):
+        self._db.query(release=self._result_id)
+        self._result_id = None
+
+
+def _existdb_new(cls, *args, **kwargs):
+    if issubclass(cls, LocalExistDB):
+        return object.__new__(cls)
+    local = object.__new__(LocalExistDB)
+    if cls is not ExistDB:
+        # python only initializes instances of the class being created
+        local.__init__(*args, **kwargs)
+    return local
+
+
+def _queryset_new(cls, *args, **kwargs):
+    using = kwargs.get('using', args[2] if len(args) > 2 else None)
+    if cls is QuerySet and isinstance(using, LocalExistDB):
+        cls = LocalQuerySet
+    return object.__new__(cls)
+
+
+def install(fixtures=FIXTURE_DIR, store=None):
+    '''Use a local document store for all eXist connections created from
+    now on.
+
+    :param fixtures: directory of xml files to load to
+        **EXISTDB_ROOT_COLLECTION**, or None
+    :param store: :class:`DocumentStore` to use; a new store is created
+        by default
+    :returns: the :class:`DocumentStore`
+    '''
+    global _store
+    _store = store if store is not None else DocumentStore()
+    if fixtures:
+        count = _store.load_directory(fixtures, settings.EXISTDB_ROOT_COLLECTION)
+        logger.info('Loaded %d documents from %s to the local eXist store', count, fixtures)
+    ExistDB.__new__ = staticmethod(_existdb_new)
+    QuerySet.__new__ = staticmethod(_queryset_new)
+    return _store
+
+
+def uninstall():
+    'Stop using the local document store for new eXist connections.'
+    global _store
+    for cls in (ExistDB, QuerySet):
+        if '__new__' in cls.__dict__:
+            del cls.__new__
+    _store = None
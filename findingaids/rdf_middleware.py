@@ -1,38 +1,77 @@
+import mimeparse
 import rdflib
 import re
 from django.core.urlresolvers import resolve
 from django.http import Http404, HttpResponse
 
+from findingaids.fa import rdf
+
 
 class RDFaMiddleware(object):
     '''Middleware to display embedded RDFa for an HTML page as
-    RDF XML.  Simply add ``RDF/`` to the end of any Django site
-    URL to see the RDF XML version of RDFa embedded in the page.
+    RDF.  Simply add ``RDF/`` to the end of any Django site
+    URL to see the RDF version of RDFa embedded in the page.
 
+    RDF is serialized as RDF/XML by default; Turtle or JSON-LD (when
+    the rdflib-jsonld plugin is installed) can be requested with an
+    HTTP Accept header.  For published finding aid, series, and index
+    pages, RDF is generated directly from the EAD document and cached
+    by document version (see :mod:`findingaids.fa.rdf`); for any other
+    page, the html is rendered and parsed as RDFa.
     '''
     urlpattern = re.compile('/rdf/$', flags=re.IGNORECASE)
 
     def process_request(self, request):
 #        if urlpattern.search(request.path).endswith('/RDF/'):
         if self.urlpattern.search(request.path):
+            mimetype, rdf_format = self.serialization(request)
             # load the html for the non-rdf page
             request.path = request.path[:-4]  # strip off 'rdf/' from end
             # NOTE: modifying actual request so anything that relies
             # on the request to generate URLs will be accurate
-            view, args, kwargs = resolve(request.path)
-            kwargs['request'] = request
+            match = resolve(request.path)
+            data = None
             try:
-                result = view(*args, **kwargs)
+                if match.view_name in rdf.PAGE_VIEWS:
+                    data = rdf.page_rdf(request, match.kwargs, rdf_format)
+                if data is None:
+                    data = self.parse_page(request, match, rdf_format)
             except Http404:
                 return None
 
-            g = rdflib.ConjunctiveGraph()
-            # TODO: probably should only attempt to parse RDFa
-            # from HTML pages (e.g., not PDF, etc)
-            g.parse(data=result.content, format='rdfa')
             # only return rdf if graph contains triples
-            if len(g):
-                return HttpResponse(g.serialize(),
-                                    content_type='application/rdf+xml')
+            if data is not None:
+                response = HttpResponse(data, content_type=mimetype)
+                response['Vary'] = 'Accept'
+                return response
 
         return None
+
+    def serialization(self, request):
+        '''Determine the RDF serialization to return, based on the
+        request Accept header.
+
+        :returns: tuple of mimetype and rdflib format
+        '''
+        # order matters; ties go to the last supported mimetype
+        mimetype = mimeparse.best_match([m for m, f in rdf.SERIALIZATIONS],
+                                        request.META.get('HTTP_ACCEPT', ''))
+        if not mimetype:
+            mimetype = 'application/rdf+xml'
+        return mimetype, dict(rdf.SERIALIZATIONS)[mimetype]
+
+    def parse_page(self, request, match, rdf_format):
+        '''Render the html page and parse it as RDFa.
+
+        :returns: serialized RDF, or None if the page has no triples
+        '''
+        view, args, kwargs = match
+        kwargs['request'] = request
+        result = view(*args, **kwargs)
+
+        g = rdflib.ConjunctiveGraph()
+        # TODO: probably should only attempt to parse RDFa
+        # from HTML pages (e.g., not PDF, etc)
+        g.parse(data=result.content, format='rdfa')
+        if len(g):
+            return g.serialize(format=rdf_format)
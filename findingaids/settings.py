@@ -100,6 +100,8 @@ STATICFILES_FINDERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # first, so eXist queries made by any other middleware are counted
+    'findingaids.exist_middleware.ExistQueryTimingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
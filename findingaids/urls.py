@@ -16,7 +16,6 @@
 
 from django.conf.urls import url, include
 from django.contrib import admin
-from django.contrib.sitemaps import views as sitemaps_views
 from django.views.generic import TemplateView
 from django.views.generic.base import RedirectView
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
@@ -24,6 +23,7 @@ from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from findingaids.fa.sitemaps import FINDINGAID_SITEMAPS
 from findingaids.content.sitemaps import ContentSitemap
 from findingaids.content import views as contentviews
+from findingaids.fa import views as faviews
 
 
 admin.autodiscover()
@@ -53,9 +53,10 @@ sitemap_cfg = {'content': ContentSitemap}
 sitemap_cfg.update(FINDINGAID_SITEMAPS)
 
 urlpatterns += [
-    url(r'^sitemap\.xml$', sitemaps_views.index, {'sitemaps': sitemap_cfg},
+    # served from precomputed files when available
+    url(r'^sitemap\.xml$', faviews.sitemap_index, {'sitemaps': sitemap_cfg},
        name='django.contrib.sitemaps.views.sitemap'),
-    url(r'^sitemap-(?P<section>.+)\.xml$', sitemaps_views.sitemap,
+    url(r'^sitemap-(?P<section>.+)\.xml$', faviews.sitemap,
        {'sitemaps': sitemap_cfg},
        name='django.contrib.sitemaps.views.sitemap'),
 ]
@@ -0,0 +1,92 @@
+/*
+ * file scripts/fop-worker/FopWorker.java
+ *
+ *   Copyright 2012 Emory University Library
+ *
+ *   Licensed under the Apache License, Version 2.0 (the "License");
+ *   you may not use this file except in compliance with the License.
+ *   You may obtain a copy of the License at
+ *
+ *       http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *   Unless required by applicable law or agreed to in writing, software
+ *   distributed under the License is distributed on an "AS IS" BASIS,
+ *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ *   See the License for the specific language governing permissions and
+ *   limitations under the License.
+ */
+
+import java.io.BufferedOutputStream;
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+
+import javax.xml.transform.Transformer;
+import javax.xml.transform.TransformerFactory;
+import javax.xml.transform.sax.SAXResult;
+import javax.xml.transform.stream.StreamSource;
+
+import org.apache.fop.apps.Fop;
+import org.apache.fop.apps.FopFactory;
+import org.apache.fop.apps.MimeConstants;
+
+/**
+ * Long-running XSL-FO to PDF worker for findingaids.fa.fop
+ * (XSLFO_WORKER_COMMAND), using Apache FOP (2.x) in embedded mode so the
+ * JVM, FOP classes, and fonts are loaded once instead of for every PDF.
+ *
+ * Reads one job per line on stdin, as the XSL-FO and PDF paths separated
+ * by a tab, and writes one line per job to stdout: "OK" on success, or
+ * "ERROR" followed by a message on failure.  FOP log output goes to
+ * stderr, so stdout only carries responses.  Exits at the end of input, or
+ * after reporting an out of memory error so that it will be restarted.
+ */
+public class FopWorker {
+
+    public static void main(String[] args) throws Exception {
+        // responses only; keep anything else written to stdout out of the protocol
+        PrintStream out = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        System.setOut(System.err);
+
+        FopFactory fopFactory = FopFactory.newInstance(new File(".").toURI());
+        TransformerFactory transformerFactory = TransformerFactory.newInstance();
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] paths = line.split("\t");
+            if (paths.length != 2) {
+                out.println("ERROR invalid request");
+                continue;
+            }
+            try {
+                render(fopFactory, transformerFactory, new File(paths[0]), new File(paths[1]));
+                out.println("OK");
+            } catch (OutOfMemoryError e) {
+                out.println("ERROR out of memory");
+                System.exit(1);
+            } catch (Throwable e) {
+                String message = String.valueOf(e.getMessage()).replaceAll("\\s+", " ");
+                out.println("ERROR " + e.getClass().getSimpleName() + ": " + message);
+            }
+        }
+    }
+
+    static void render(FopFactory fopFactory, TransformerFactory transformerFactory,
+                       File foFile, File pdfFile) throws Exception {
+        OutputStream pdf = new BufferedOutputStream(new FileOutputStream(pdfFile));
+        try {
+            Fop fop = fopFactory.newFop(MimeConstants.MIME_PDF, fopFactory.newFOUserAgent(), pdf);
+            // identity transform: the XSL-FO is already complete
+            Transformer transformer = transformerFactory.newTransformer();
+            StreamSource source = new StreamSource(foFile);
+            transformer.transform(source, new SAXResult(fop.getDefaultHandler()));
+        } finally {
+            pdf.close();
+        }
+    }
+}